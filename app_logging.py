@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Структурированное логирование бота
+
+Все записи идут через QueueHandler: обработчик только кладет запись в очередь,
+форматирование и запись в консоль/файл выполняет фоновый поток QueueListener.
+Логгеры подсистем - hay.<подсистема> (agents, database, conflicts, bot, llm, reports),
+уровни задаются в LOG_LEVELS ("agents=DEBUG,database=WARNING").
+
+Полные промпты и ответы LLM пишутся в отдельный логгер hay.agents.prompts
+и только для доли вызовов LOG_PROMPT_SAMPLE_RATE (решение принимается один раз
+на вызов агента, промпт и ответ попадают в лог вместе).
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+from config import (
+    LOG_LEVEL, LOG_LEVELS, LOG_CONSOLE, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT,
+    LOG_PROMPT_SAMPLE_RATE
+)
+
+ROOT_LOGGER = "hay"
+SUBSYSTEMS = ('agents', 'database', 'conflicts', 'bot', 'llm', 'reports')
+
+# Атрибуты LogRecord, которые не являются пользовательскими полями (extra)
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+_prompt_logger = logging.getLogger(f"{ROOT_LOGGER}.agents.prompts")
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; поля из extra добавляются как есть"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Логгер подсистемы (agents, database, conflicts, bot, llm, reports)"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def setup_logging() -> None:
+    """Настроить очередь, обработчики и уровни (повторный вызов ничего не делает)"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        
+        handlers = []
+        if LOG_CONSOLE:
+            console = logging.StreamHandler()
+            console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s", "%H:%M:%S"))
+            handlers.append(console)
+        if LOG_FILE:
+            os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+            file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                               encoding='utf-8')
+            file_handler.setFormatter(JsonFormatter())
+            handlers.append(file_handler)
+        
+        log_queue = queue.SimpleQueue()
+        root = logging.getLogger(ROOT_LOGGER)
+        root.handlers = [QueueHandler(log_queue)]
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        for subsystem, level in LOG_LEVELS.items():
+            logging.getLogger(f"{ROOT_LOGGER}.{subsystem}").setLevel(level)
+        
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Дописать очередь и остановить фоновый поток"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def prompt_dump_sampled() -> bool:
+    """Писать ли полный промпт и ответ этого вызова агента"""
+    return LOG_PROMPT_SAMPLE_RATE > 0 and _prompt_logger.isEnabledFor(logging.INFO) and (
+        LOG_PROMPT_SAMPLE_RATE >= 1 or random.random() < LOG_PROMPT_SAMPLE_RATE)
+
+
+def dump_prompt(title: str, text: str, **fields) -> None:
+    """Полный текст промпта/ответа (вызывать только если prompt_dump_sampled())"""
+    _prompt_logger.info("%s\n%s", title, text, extra={'chars': len(text), **fields})
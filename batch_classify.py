@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Пакетная обработка ответов, собранных в таблице Excel (без бота)
+
+Форматы листа:
+    long - колонки "Вопрос" и "Ответ" (+ необязательная колонка сотрудника);
+           без колонки сотрудника каждый лист - один сотрудник
+    wide - строка на сотрудника, колонки - вопросы ("8. С кем ...", "Вопрос 8", "Q8")
+Номер вопроса берется из начала заголовка/текста вопроса и должен совпадать с таблицей questions.
+
+Для каждого сотрудника: свободные ответы сводятся AnswerCompilerAgent и классифицируются
+ClassificationAgent, ответы пишутся в responses (с проверкой конфликтов), затем считается грейд
+и формируется HTML отчет. Сотрудники обрабатываются параллельно, прогресс сохраняется
+в таблицу batch_checkpoints - повторный запуск продолжает с места остановки.
+
+Переспросить сотрудника при конфликте нельзя: ответы на вопросы конфликта восстанавливаются
+без повторной классификации, конфликт записывается в сводку, а сотрудник получает статус
+needs_review (грейд и отчет формируются, результат требует ручной проверки).
+
+Пример:
+    python batch_classify.py "data/пример ответов.xlsx" --llm gigachat --workers 8
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from database import Database
+from grade_calculator import GradeCalculator
+from html_report_generator import HTMLReportGenerator
+from llm_services import LLMFactory, LLMError
+from processing_agents import AnswerCompilerAgent, ClassificationAgent
+
+# Статусы завершенной обработки сотрудника (повторный запуск их пропускает)
+FINISHED_STATUSES = ('done', 'needs_review')
+
+EMPLOYEE_COLUMNS = ("Сотрудник", "ФИО", "Табельный номер", "ID", "Employee")
+_QUESTION_NUMBER = re.compile(r'^\s*(?:Q|В|Вопрос)?\s*(\d+)\s*(?:[.):]|\s|$)', re.IGNORECASE)
+
+
+def parse_question_id(text) -> Optional[int]:
+    """Номер вопроса из заголовка колонки или текста вопроса"""
+    if isinstance(text, (int, float)) and not pd.isna(text):
+        return int(text)
+    match = _QUESTION_NUMBER.match(str(text))
+    return int(match.group(1)) if match else None
+
+
+def _is_empty(value) -> bool:
+    return value is None or (isinstance(value, float) and pd.isna(value)) or str(value).strip() == ""
+
+
+def read_answers(path: str, sheet_format: str = "auto", employee_column: str = None) -> Dict[str, Dict[int, str]]:
+    """Ответы из книги Excel: {сотрудник: {номер вопроса: ответ}}"""
+    employees: Dict[str, Dict[int, str]] = {}
+    stem = os.path.splitext(os.path.basename(path))[0]
+    
+    for sheet_name, df in pd.read_excel(path, sheet_name=None).items():
+        columns = [str(column).strip() for column in df.columns]
+        df.columns = columns
+        employee_col = employee_column or next((column for column in EMPLOYEE_COLUMNS if column in columns), None)
+        
+        fmt = sheet_format
+        if fmt == "auto":
+            fmt = "long" if "Вопрос" in columns and "Ответ" in columns else "wide"
+        
+        if fmt == "long":
+            for _, row in df.iterrows():
+                question_id = parse_question_id(row["Вопрос"])
+                if question_id is None or _is_empty(row["Ответ"]):
+                    continue
+                employee = str(row[employee_col]).strip() if employee_col else f"{stem}/{sheet_name}"
+                employees.setdefault(employee, {})[question_id] = str(row["Ответ"]).strip()
+        else:
+            question_columns = {column: parse_question_id(column) for column in columns if column != employee_col}
+            question_columns = {column: question_id for column, question_id in question_columns.items() if question_id}
+            if not question_columns:
+                print(f"⚠️ Лист '{sheet_name}': не найдены колонки вопросов, пропускаем")
+                continue
+            for index, row in df.iterrows():
+                employee = str(row[employee_col]).strip() if employee_col else f"{stem}/{sheet_name}/{index + 2}"
+                answers = {question_id: str(row[column]).strip()
+                           for column, question_id in question_columns.items() if not _is_empty(row[column])}
+                if answers:
+                    employees.setdefault(employee, {}).update(answers)
+    
+    return employees
+
+
+def employee_user_id(source: str, employee: str) -> int:
+    """Устойчивый отрицательный user для сотрудника (не пересекается с ID Telegram)"""
+    digest = hashlib.sha1(f"{source}\n{employee}".encode("utf-8")).hexdigest()
+    return -int(digest[:12], 16)
+
+
+class BatchCheckpoints:
+    """Прогресс пакетной обработки в таблице batch_checkpoints"""
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS batch_checkpoints (
+                    source TEXT NOT NULL,
+                    employee TEXT NOT NULL,
+                    user INTEGER NOT NULL,
+                    session_id INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    grade TEXT,
+                    conflicts TEXT,
+                    report_path TEXT,
+                    error TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (source, employee)
+                )
+            """)
+            conn.commit()
+    
+    def get(self, source: str, employee: str) -> Optional[Dict]:
+        with sqlite3.connect(self.db_path) as conn:
+            conn.text_factory = str
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM batch_checkpoints WHERE source = ? AND employee = ?", (source, employee))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def save(self, source: str, employee: str, user: int, session_id: int, status: str,
+             grade: str = None, conflicts: str = None, report_path: str = None, error: str = None) -> None:
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO batch_checkpoints
+                (source, employee, user, session_id, status, grade, conflicts, report_path, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (source, employee, user, session_id, status, grade, conflicts, report_path, error, time.time()))
+            conn.commit()
+    
+    def get_all(self, source: str) -> List[Dict]:
+        with sqlite3.connect(self.db_path) as conn:
+            conn.text_factory = str
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM batch_checkpoints WHERE source = ? ORDER BY employee", (source,))
+            return [dict(row) for row in cursor.fetchall()]
+
+
+class BatchClassifier:
+    """Обработка ответов сотрудников тем же конвейером агентов, что и в боте"""
+    
+    def __init__(self, llm_type: str = "gigachat", db_path: str = "data/database.db",
+                 reports_dir: str = "reports/batch"):
+        self.db = Database(db_path)
+        self.llm_service = LLMFactory.create_service(llm_type)
+        self.answer_agent = AnswerCompilerAgent(self.llm_service)
+        self.classification_agent = ClassificationAgent(self.llm_service)
+        self.grade_calculator = GradeCalculator(db_path)
+        self.report_generator = HTMLReportGenerator(db_path)
+        self.checkpoints = BatchCheckpoints(db_path)
+        self.reports_dir = reports_dir
+    
+    def _start_session(self, source: str, employee: str) -> Tuple[int, int]:
+        """user и session_id сотрудника: незавершенная сессия продолжается, иначе новая"""
+        user = employee_user_id(source, employee)
+        checkpoint = self.checkpoints.get(source, employee)
+        if checkpoint and checkpoint['status'] == 'in_progress':
+            return user, checkpoint['session_id']
+        session_id = self.db.get_next_session_id(user)
+        self.checkpoints.save(source, employee, user, session_id, 'in_progress')
+        return user, session_id
+    
+    def _answer_question(self, user: int, session_id: int, question_data: Dict,
+                         answer: str) -> Tuple[str, str, List[Dict]]:
+        """Классификация и сохранение одного ответа: (сводный ответ, уровень, найденные конфликты)"""
+        portrait = self.db.get_session_portrait(user, session_id)
+        full_answer = answer
+        if not question_data['answer_options'] and question_data.get('classifier'):
+            # Свободный ответ сводится так же, как итог диалога в боте
+            full_answer = self.answer_agent.create_full_answer(question_data, [answer], portrait)
+        final_answer = self.classification_agent.classify_answer(question_data, full_answer, portrait)
+        
+        has_classifier = bool(question_data.get('classifier'))
+        _, conflicts = self.db.save_response(user, session_id, question_data['id'], full_answer, final_answer,
+                                             None, check_conflicts=has_classifier)
+        self.db.generate_user_portrait(user, session_id)
+        return full_answer, final_answer, conflicts
+    
+    def _restore_answer(self, user: int, session_id: int, question_id: int, full_answer: str, final_answer: str) -> None:
+        """Вернуть ответ, деактивированный конфликтом: те же данные, без классификации и проверки конфликтов"""
+        self.db.save_response(user, session_id, question_id, full_answer, final_answer, None, check_conflicts=False)
+        self.db.generate_user_portrait(user, session_id)
+    
+    @staticmethod
+    def _format_conflicts(conflicts: List[Dict]) -> Optional[str]:
+        """Конфликты для сводки: 'id (Q8, Q9, Q10)' через точку с запятой"""
+        described = {}
+        for conflict in conflicts:
+            question_ids = ", ".join(f"Q{question_id}" for question_id in conflict.get('question_ids', []))
+            described[conflict.get('id')] = f"{conflict.get('id')} ({question_ids})"
+        return "; ".join(described[conflict_id] for conflict_id in sorted(described)) or None
+    
+    def process_employee(self, source: str, employee: str, answers: Dict[int, str]) -> Dict:
+        """Все ответы сотрудника по порядку вопросов (с учетом условий показа), грейд и отчет"""
+        user, session_id = self._start_session(source, employee)
+        conflicts = []
+        skipped = set()
+        # Ответы, сохраненные в этом запуске: {вопрос: (сводный ответ, уровень)}
+        saved: Dict[int, Tuple[str, str]] = {}
+        restored = set()
+        try:
+            while True:
+                # Уже сохраненные ответы не входят в remaining - после перезапуска продолжаем с места остановки
+                remaining = [question_id for question_id in self.db.get_remaining_questions(user, session_id)
+                             if question_id not in skipped]
+                if not remaining:
+                    break
+                question_id = remaining[0]
+                if question_id in saved:
+                    # Ответ деактивирован конфликтом; те же ответы дали бы тот же конфликт - возвращаем как есть
+                    self._restore_answer(user, session_id, question_id, *saved[question_id])
+                    restored.add(question_id)
+                    continue
+                question_data = self.db.get_question(question_id)
+                if question_id not in answers or not question_data:
+                    skipped.add(question_id)
+                    continue
+                full_answer, final_answer, found = self._answer_question(user, session_id, question_data,
+                                                                         answers[question_id])
+                saved[question_id] = (full_answer, final_answer)
+                conflicts.extend(found)
+            
+            grade_result = self.grade_calculator.calculate_grade(user, session_id)
+            grade = grade_result.get('final_grade') or grade_result.get('error')
+            os.makedirs(self.reports_dir, exist_ok=True)
+            report_path = self.report_generator.save_report_to_file(
+                user_id=user, session_id=session_id,
+                output_path=os.path.join(self.reports_dir, f"report_user_{user}_session_{session_id}.html")
+            )
+            conflicts_text = self._format_conflicts(conflicts)
+            status = 'needs_review' if conflicts else 'done'
+            self.checkpoints.save(source, employee, user, session_id, status, str(grade), conflicts_text, report_path)
+            return {'employee': employee, 'status': status, 'grade': grade, 'conflicts': conflicts_text,
+                    'needs_review': sorted(restored), 'missing': sorted(skipped)}
+        except LLMError as e:
+            # Сессия остается in_progress - при следующем запуске продолжится
+            self.checkpoints.save(source, employee, user, session_id, 'in_progress', error=str(e))
+            return {'employee': employee, 'status': 'error', 'error': str(e)}
+    
+    def run(self, path: str, sheet_format: str = "auto", employee_column: str = None, workers: int = 8,
+            summary_path: str = None) -> List[Dict]:
+        source = os.path.basename(path)
+        employees = read_answers(path, sheet_format, employee_column)
+        pending = {employee: answers for employee, answers in employees.items()
+                   if (self.checkpoints.get(source, employee) or {}).get('status') not in FINISHED_STATUSES}
+        print(f"📥 {source}: сотрудников {len(employees)}, к обработке {len(pending)}, параллельно {workers}")
+        
+        started = time.monotonic()
+        results = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as executor:
+            futures = {executor.submit(self.process_employee, source, employee, answers): employee
+                       for employee, answers in pending.items()}
+            for done_count, future in enumerate(as_completed(futures), 1):
+                employee = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'employee': employee, 'status': 'error', 'error': str(e)}
+                results.append(result)
+                elapsed = time.monotonic() - started
+                rate = done_count / elapsed * 3600 if elapsed > 0 else 0
+                if result['status'] == 'done':
+                    icon, status = '✅', f"грейд {result.get('grade')}"
+                elif result['status'] == 'needs_review':
+                    icon, status = '⚠️', f"грейд {result.get('grade')}, конфликты: {result.get('conflicts')}"
+                else:
+                    icon, status = '❌', f"ошибка: {result.get('error')}"
+                print(f"{icon} [{done_count}/{len(pending)}] {employee}: {status} ({rate:.0f} сотр./час)")
+        
+        summary = pd.DataFrame(self.checkpoints.get_all(source))
+        summary_path = summary_path or os.path.join(self.reports_dir, f"batch_{os.path.splitext(source)[0]}.xlsx")
+        os.makedirs(os.path.dirname(summary_path) or ".", exist_ok=True)
+        summary.to_excel(summary_path, index=False)
+        print(f"📊 Сводка: {summary_path}")
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная классификация ответов из Excel")
+    parser.add_argument("path", help="Файл Excel с ответами")
+    parser.add_argument("--llm", default="gigachat", help="gigachat или openai")
+    parser.add_argument("--format", dest="sheet_format", default="auto", choices=["auto", "long", "wide"])
+    parser.add_argument("--employee-column", help="Колонка с идентификатором сотрудника")
+    parser.add_argument("--workers", type=int, default=8, help="Сотрудников обрабатывается параллельно")
+    parser.add_argument("--db", default="data/database.db")
+    parser.add_argument("--reports-dir", default="reports/batch")
+    parser.add_argument("--summary", help="Путь к сводному xlsx")
+    args = parser.parse_args()
+    
+    classifier = BatchClassifier(args.llm, args.db, args.reports_dir)
+    classifier.run(args.path, args.sheet_format, args.employee_column, args.workers, args.summary)
+
+
+if __name__ == "__main__":
+    main()
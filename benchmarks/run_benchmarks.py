@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки базы, грейдинга, конфликтов, отчетов и скриптов импорта
+
+Каждый бенчмарк - функция, которая получает BenchmarkContext, выполняет подготовку
+и возвращает замеряемый вызов без аргументов. Вызов повторяется, пока не набрано
+--min-rounds повторов и не истекло --max-time секунд; в результат попадают min/median/mean/stdev.
+
+Бенчмарки работают с синтетической базой (benchmarks/synthetic_db.py) во временном каталоге,
+скрипты импорта - с копиями data/hag.xlsx и data/штат.xlsx там же, поэтому рабочие данные
+не меняются. Логи бота на время замеров ограничены уровнем ERROR.
+
+Результаты сохраняются в benchmarks/results/<коммит>.json; --compare сравнивает с прошлым
+прогоном и отмечает замедления больше --threshold.
+
+Пример:
+    python benchmarks/run_benchmarks.py --users 200
+    python benchmarks/run_benchmarks.py --filter grade --compare benchmarks/results/abc1234.json
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import runpy
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from synthetic_db import generate_database  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+IMPORT_SCRIPTS = ('update_questions', 'update_hay_dictionary', 'update_conflicts',
+                  'update_grading_tables', 'update_question_variants')
+
+
+class BenchmarkContext:
+    """Синтетическая база и выборки пользователей/сессий для бенчмарков"""
+    
+    def __init__(self, workdir: str, db_path: str):
+        self.workdir = workdir
+        self.db_path = db_path
+        with sqlite3.connect(db_path) as conn:
+            self.sessions: List[Tuple[int, int]] = conn.execute("""
+                SELECT DISTINCT user, session_id FROM responses ORDER BY user, session_id
+            """).fetchall()
+            # Завершенные сессии - с ответом на последний вопрос
+            self.completed_sessions: List[Tuple[int, int]] = conn.execute("""
+                SELECT DISTINCT user, session_id FROM responses
+                WHERE status = 'active' AND question = (SELECT MAX(id) FROM questions)
+                ORDER BY user, session_id
+            """).fetchall()
+    
+    def cycle(self, pairs: List[Tuple[int, int]]):
+        """Бесконечный перебор пар (user, session_id) - чтобы не мерить один и тот же запрос"""
+        return itertools.cycle(pairs)
+
+
+BENCHMARKS: Dict[str, Tuple[str, Callable[[BenchmarkContext], Callable[[], object]]]] = {}
+
+
+def benchmark(group: str):
+    """Зарегистрировать бенчмарк (имя - имя функции)"""
+    def decorator(setup: Callable[[BenchmarkContext], Callable[[], object]]):
+        BENCHMARKS[setup.__name__] = (group, setup)
+        return setup
+    return decorator
+
+
+@benchmark('database')
+def get_remaining_questions(ctx: BenchmarkContext):
+    from database import Database
+    db = Database(ctx.db_path)
+    pairs = ctx.cycle(ctx.sessions)
+    return lambda: db.get_remaining_questions(*next(pairs))
+
+
+@benchmark('database')
+def save_response_with_conflict_check(ctx: BenchmarkContext):
+    from database import Database
+    db = Database(ctx.db_path)
+    pairs = ctx.cycle(ctx.completed_sessions)
+    levels = itertools.cycle(range(1, 6))
+    
+    def run():
+        user, session_id = next(pairs)
+        return db.save_response(user, session_id, 9, "Планирует работу на квартал", str(next(levels)),
+                                check_conflicts=True)
+    return run
+
+
+@benchmark('database')
+def generate_user_portrait(ctx: BenchmarkContext):
+    from database import Database
+    db = Database(ctx.db_path)
+    pairs = ctx.cycle(ctx.completed_sessions)
+    return lambda: db.generate_user_portrait(*next(pairs))
+
+
+@benchmark('grading')
+def calculate_grade(ctx: BenchmarkContext):
+    from grade_calculator import GradeCalculator
+    calculator = GradeCalculator(ctx.db_path)
+    pairs = ctx.cycle(ctx.completed_sessions)
+    return lambda: calculator.calculate_grade(*next(pairs))
+
+
+@benchmark('grading')
+def grade_bounds(ctx: BenchmarkContext):
+    from grade_bounds import get_grade_bounds
+    engine = get_grade_bounds(ctx.db_path)
+    # Неполные наборы ответов, как по ходу интервью: ответы на Q8-Q16 по очереди
+    partial_levels = []
+    with sqlite3.connect(ctx.db_path) as conn:
+        for user, session_id in ctx.completed_sessions[:50]:
+            rows = conn.execute("""
+                SELECT question, final_answer FROM responses
+                WHERE user = ? AND session_id = ? AND status = 'active' AND question BETWEEN 8 AND 16
+                ORDER BY question
+            """, (user, session_id)).fetchall()
+            levels = {q: int(a) for q, a in rows if a and a.isdigit()}
+            partial_levels += [{q: a for q, a in levels.items() if q <= last} for last in range(7, 17)]
+    cases = itertools.cycle(partial_levels or [{}])
+    return lambda: engine.bounds(next(cases))
+
+
+@benchmark('conflicts')
+def find_active_conflicts(ctx: BenchmarkContext):
+    from database import Database
+    from conflictator import ConflictDetector
+    detector = ConflictDetector(Database(ctx.db_path))
+    response_maps = []
+    with sqlite3.connect(ctx.db_path) as conn:
+        for user, session_id in ctx.completed_sessions[:200]:
+            rows = conn.execute("""
+                SELECT question, final_answer FROM responses
+                WHERE user = ? AND session_id = ? AND status = 'active'
+            """, (user, session_id)).fetchall()
+            response_maps.append({q: int(a) for q, a in rows if a and a.isdigit()})
+    maps = itertools.cycle(response_maps or [{}])
+    return lambda: detector._find_active_conflicts(next(maps))
+
+
+@benchmark('conflicts')
+def conflict_audit_all_sessions(ctx: BenchmarkContext):
+    from conflict_audit import load_response_levels, load_rules, match_rules
+    _, columns, levels = load_response_levels(ctx.db_path)
+    rules = load_rules(ctx.db_path)
+    return lambda: match_rules(levels, columns, rules)
+
+
+@benchmark('reports')
+def html_generate_report(ctx: BenchmarkContext):
+    from html_report_generator import HTMLReportGenerator
+    generator = HTMLReportGenerator(ctx.db_path)
+    pairs = ctx.cycle(ctx.completed_sessions)
+    return lambda: generator.generate_report(*next(pairs))
+
+
+def _import_script_benchmark(script: str):
+    """Скрипт импорта из Excel: запускается в рабочем каталоге с копиями data/hag.xlsx и базы"""
+    def setup(ctx: BenchmarkContext):
+        script_path = os.path.join(ROOT_DIR, f"{script}.py")
+        
+        def run():
+            with _chdir(ctx.workdir), contextlib.redirect_stdout(io.StringIO()):
+                runpy.run_path(script_path, run_name="__main__")
+        return run
+    setup.__name__ = f"import_{script}"
+    return setup
+
+
+for _script in IMPORT_SCRIPTS:
+    benchmark('imports')(_import_script_benchmark(_script))
+
+
+@benchmark('imports')
+def import_update_shtat(ctx: BenchmarkContext):
+    from update_shtat import build_hierarchy_from_excel, load_hierarchy_to_db
+    excel_path = os.path.join(ctx.workdir, "data", "штат.xlsx")
+    
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_hierarchy_to_db(build_hierarchy_from_excel(excel_path), ctx.db_path)
+    return run
+
+
+@contextlib.contextmanager
+def _chdir(path: str):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def measure(call: Callable[[], object], min_rounds: int, max_time: float) -> Dict:
+    """Прогрев и повторные замеры одного вызова"""
+    call()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_rounds or (time.perf_counter() - started < max_time and len(timings) < 10_000):
+        t0 = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - t0)
+    return {
+        'rounds': len(timings),
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0
+    }
+
+
+def _git_revision() -> Tuple[Optional[str], bool]:
+    """Текущий коммит и есть ли незакоммиченные изменения"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+
+def run_benchmarks(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="hay_bench_")
+    data_dir = os.path.join(workdir, "data")
+    os.makedirs(data_dir)
+    db_path = os.path.join(data_dir, "database.db")
+    for name in ("hag.xlsx", "штат.xlsx"):
+        shutil.copyfile(os.path.join(ROOT_DIR, "data", name), os.path.join(data_dir, name))
+    
+    try:
+        if args.db:
+            shutil.copyfile(args.db, db_path)
+            db_info = {'source': args.db, 'size_bytes': os.path.getsize(db_path)}
+        else:
+            db_info = generate_database(db_path, args.users, args.sessions, args.seed,
+                                        extra_conflict_rules=args.extra_conflict_rules)
+        print(f"🗄️ База: {json.dumps(db_info, ensure_ascii=False)}")
+        
+        logging.getLogger("hay").setLevel(logging.ERROR)
+        ctx = BenchmarkContext(workdir, db_path)
+        snapshot_path = os.path.join(workdir, "snapshot.db")
+        shutil.copyfile(db_path, snapshot_path)
+        results = {}
+        for name, (group, setup) in BENCHMARKS.items():
+            if args.filter and not any(pattern in name or pattern == group for pattern in args.filter):
+                continue
+            try:
+                stats = measure(setup(ctx), args.min_rounds, args.max_time)
+            finally:
+                # save_response и импорт меняют базу - следующий бенчмарк начинает с исходной
+                shutil.copyfile(snapshot_path, db_path)
+            results[name] = {'group': group, **stats}
+            print(f"  {name:<40} {stats['median'] * 1000:>10.3f} мс  (min {stats['min'] * 1000:.3f}, "
+                  f"{stats['rounds']} повт.)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    commit, dirty = _git_revision()
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': db_info,
+        'unit': 'seconds',
+        'benchmarks': results
+    }
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Печать сравнения медиан с прошлым прогоном; возвращает имена замедлившихся бенчмарков"""
+    regressions = []
+    print(f"\n📊 Сравнение с {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for name, result in current['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if not previous:
+            print(f"  {name:<40} новый")
+            continue
+        ratio = result['median'] / previous['median'] if previous['median'] else float('inf')
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = " ⚠️ замедление"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            mark = " ✅ ускорение"
+        print(f"  {name:<40} {previous['median'] * 1000:>10.3f} → {result['median'] * 1000:>10.3f} мс"
+              f"  x{ratio:.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки базы, грейдинга, конфликтов и отчетов")
+    parser.add_argument("--users", type=int, default=100, help="Пользователей в синтетической базе")
+    parser.add_argument("--sessions", type=int, default=2, help="Сессий на пользователя")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--extra-conflict-rules", type=int, default=0, help="Синтетических правил конфликтов")
+    parser.add_argument("--db", help="Готовая база вместо синтетической (используется копия)")
+    parser.add_argument("--filter", nargs="*", help="Имена или группы бенчмарков (подстрока)")
+    parser.add_argument("--min-rounds", type=int, default=5)
+    parser.add_argument("--max-time", type=float, default=1.0, help="Время замеров одного бенчмарка, с")
+    parser.add_argument("--output", help="JSON с результатами (по умолчанию benchmarks/results/<коммит>.json)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Допустимое замедление медианы (0.1 = 10%%)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Код выхода 1 при замедлении")
+    args = parser.parse_args()
+    
+    result = run_benchmarks(args)
+    
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        suffix = "-dirty" if result['dirty'] else ""
+        output = os.path.join(RESULTS_DIR, f"{result['commit'] or 'unknown'}{suffix}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результаты сохранены: {output}")
+    
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Генератор синтетической базы для бенчмарков
+
+Справочные таблицы (вопросы, конфликты, таблицы грейдинга, словарь Hay, варианты Q11/Q12,
+штатная иерархия) копируются из исходной базы как есть, таблицы responses и sessions
+заполняются заново: USERS пользователей по SESSIONS сессий.
+
+Ответы правдоподобны для бота:
+- тексты ответов берутся из реальных ответов исходной базы;
+- уровни Q8-Q10, Q11/Q12, Q13/Q14/Q15/Q16 выбираются из строк таблиц грейдинга,
+  поэтому грейд по большинству сессий вычисляется;
+- в доле conflict_rate сессий сначала даны противоречивые ответы (строка таблицы conflicts),
+  они помечены inactive и переотвечены - как после обработки конфликта ботом;
+- в доле incomplete_rate сессий опрос прерван на случайном вопросе;
+- extra_conflict_rules добавляет синтетические правила конфликтов (вариации реальных),
+  чтобы измерять проверку конфликтов на больших справочниках.
+
+Пример:
+    python benchmarks/synthetic_db.py bench.db --users 500 --sessions 2 --seed 7
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_USER_ID = 7_000_000_000
+CLASSIFIED_QUESTIONS = (8, 9, 10, 11, 12, 13, 14, 15, 16)
+LLM_TYPES = ('gigachat', 'openai')
+
+
+class SyntheticDataSource:
+    """Справочники исходной базы, из которых собираются синтетические сессии"""
+    
+    def __init__(self, conn: sqlite3.Connection):
+        self.questions = [row[0] for row in conn.execute("SELECT id FROM questions ORDER BY id")]
+        self.question_texts = dict(conn.execute("SELECT id, question FROM questions"))
+        self.p1_rows = conn.execute("SELECT answer_q8, answer_q9, answer_q10, p1_value FROM grading_p1").fetchall()
+        self.p2_rows = conn.execute("SELECT answer_q11, answer_q12, p2_value FROM grading_p2").fetchall()
+        self.p3_keys = {(float(p1), int(p2)) for p1, p2 in conn.execute(
+            "SELECT p1_value, p2_value FROM grading_p3") if p1 is not None and p2 is not None}
+        self.p4_14_rows = conn.execute("SELECT answer_q16, answer_q13, answer_q14 FROM grading_p4_14").fetchall()
+        self.p4_15_rows = conn.execute("SELECT answer_q16, answer_q13, answer_q15 FROM grading_p4_15").fetchall()
+        self.conflict_rules = [
+            [(row[i], row[i + 1]) for i in range(0, 10, 2) if row[i] is not None and row[i + 1] is not None]
+            for row in conn.execute("""
+                SELECT question1_id, answer1_id, question2_id, answer2_id, question3_id, answer3_id,
+                       question4_id, answer4_id, question5_id, answer5_id
+                FROM conflicts
+            """)
+        ]
+        
+        # Реальные тексты ответов по вопросам (для вопросов без классификатора - вместе с final_answer)
+        self.answer_texts: Dict[int, List[Tuple[str, Optional[str]]]] = {}
+        for question, answer, final_answer in conn.execute(
+                "SELECT question, answer, final_answer FROM responses WHERE answer IS NOT NULL AND answer != ''"):
+            self.answer_texts.setdefault(question, []).append((answer, final_answer))
+    
+    def answer_text(self, rng: random.Random, question_id: int) -> Tuple[str, Optional[str]]:
+        """Текст ответа и итоговый ответ для вопроса без классификатора"""
+        samples = self.answer_texts.get(question_id)
+        if samples:
+            return rng.choice(samples)
+        text = f"Ответ на вопрос {question_id}"
+        return text, text
+    
+    def sample_levels(self, rng: random.Random) -> Dict[int, int]:
+        """Согласованный набор уровней Q8-Q16, для которого есть строки таблиц грейдинга"""
+        for _ in range(20):
+            q8, q9, q10, p1 = rng.choice(self.p1_rows)
+            q11, q12, p2 = rng.choice(self.p2_rows)
+            levels = {8: q8, 9: q9, 10: q10, 11: q11, 12: q12}
+            if p1 is not None and p2 is not None and (float(p1), int(p2)) in self.p3_keys:
+                break
+        if rng.random() < 0.8 and self.p4_14_rows:
+            q16, q13, q14 = rng.choice(self.p4_14_rows)
+            levels.update({16: q16, 13: q13, 14: q14})
+        else:
+            q16, q13, q15 = rng.choice(self.p4_15_rows)
+            levels.update({16: q16, 13: q13, 15: q15})
+        return levels
+
+
+def _build_state(session_id: int, remaining: List[int], llm_type: str) -> str:
+    return json.dumps({
+        'session_id': session_id,
+        'remaining_questions': remaining,
+        'conversation': [],
+        'llm_type': llm_type
+    }, ensure_ascii=False)
+
+
+def _session_rows(source: SyntheticDataSource, rng: random.Random, user_id: int, session_id: int,
+                  conflict_rate: float, incomplete_rate: float) -> List[Tuple]:
+    """Строки responses одной сессии в порядке, в котором их записал бы бот"""
+    levels = source.sample_levels(rng)
+    llm_type = rng.choice(LLM_TYPES)
+    
+    # Вопросы сессии: Q14 или Q15 в зависимости от Q13, как в show_conditions
+    questions = [q for q in source.questions if q not in (14, 15) or q in levels]
+    if rng.random() < incomplete_rate:
+        questions = questions[:rng.randint(1, len(questions) - 1)]
+    
+    rows = []
+    
+    # Противоречивые ответы до переспрашивания - остаются в истории как inactive
+    if source.conflict_rules and rng.random() < conflict_rate:
+        rule = rng.choice(source.conflict_rules)
+        for question_id, answer_id in rule:
+            if question_id in questions:
+                text, _ = source.answer_text(rng, question_id)
+                rows.append((user_id, session_id, question_id, text, str(answer_id), None, 'inactive'))
+    
+    for index, question_id in enumerate(questions):
+        text, final_answer = source.answer_text(rng, question_id)
+        if question_id in CLASSIFIED_QUESTIONS:
+            final_answer = str(levels[question_id])
+        state = _build_state(session_id, questions[index + 1:], llm_type)
+        rows.append((user_id, session_id, question_id, text, final_answer, state, 'active'))
+    return rows
+
+
+def _portrait(source: SyntheticDataSource, rows: List[Tuple]) -> Optional[str]:
+    """Портрет в формате Database.generate_user_portrait"""
+    parts = [
+        f"Вопрос {question}: {source.question_texts.get(question, '')}\n→ Ответ: {answer}\n→ Уровень: {final_answer or answer}"
+        for _, _, question, answer, final_answer, _, status in rows if status == 'active'
+    ]
+    return "\n\n".join(parts) if parts else None
+
+
+def _add_conflict_rules(conn: sqlite3.Connection, rng: random.Random, count: int) -> None:
+    """Синтетические правила конфликтов: реальные правила со сдвинутыми номерами ответов"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(conflicts)") if row[1] != 'id']
+    templates = conn.execute(f"SELECT {', '.join(columns)} FROM conflicts").fetchall()
+    if not templates:
+        return
+    answer_columns = [i for i, name in enumerate(columns) if name.startswith('answer') and name.endswith('_id')]
+    generated = []
+    for _ in range(count):
+        row = list(rng.choice(templates))
+        for i in answer_columns:
+            if row[i] is not None:
+                row[i] = max(1, row[i] + rng.choice((-2, -1, 1, 2)))
+        generated.append(row)
+    conn.executemany(
+        f"INSERT INTO conflicts ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", generated)
+
+
+def generate_database(output_path: str, users: int = 100, sessions: int = 2, seed: int = 1,
+                      conflict_rate: float = 0.15, incomplete_rate: float = 0.2,
+                      extra_conflict_rules: int = 0,
+                      source_path: str = os.path.join(ROOT_DIR, "data", "database.db")) -> Dict:
+    """
+    Создать синтетическую базу по образцу исходной
+
+    Возвращает: описание базы (параметры, число строк, размер файла)
+    """
+    rng = random.Random(seed)
+    shutil.copyfile(source_path, output_path)
+    
+    with sqlite3.connect(output_path) as conn:
+        conn.text_factory = str
+        source = SyntheticDataSource(conn)
+        
+        conn.execute("DELETE FROM responses")
+        conn.execute("DELETE FROM sessions")
+        if extra_conflict_rules:
+            _add_conflict_rules(conn, rng, extra_conflict_rules)
+        
+        for user_index in range(users):
+            user_id = FIRST_USER_ID + user_index
+            for session_id in range(1, sessions + 1):
+                rows = _session_rows(source, rng, user_id, session_id, conflict_rate, incomplete_rate)
+                conn.executemany("""
+                    INSERT INTO responses (user, session_id, question, answer, final_answer, user_state, status)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+                conn.execute("""
+                    INSERT INTO sessions (user_id, session_id, user_portrait) VALUES (?, ?, ?)
+                """, (user_id, session_id, _portrait(source, rows)))
+        conn.commit()
+        
+        response_count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        conflict_count = conn.execute("SELECT COUNT(*) FROM conflicts").fetchone()[0]
+    
+    # Файл после VACUUM - без пустых страниц от удаленных исходных ответов
+    with sqlite3.connect(output_path) as conn:
+        conn.execute("VACUUM")
+    
+    return {
+        'users': users,
+        'sessions_per_user': sessions,
+        'seed': seed,
+        'conflict_rate': conflict_rate,
+        'incomplete_rate': incomplete_rate,
+        'responses': response_count,
+        'conflict_rules': conflict_count,
+        'size_bytes': os.path.getsize(output_path)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетическая база для бенчмарков")
+    parser.add_argument("output", help="Путь создаваемой базы")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--sessions", type=int, default=2, help="Сессий на пользователя")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--conflict-rate", type=float, default=0.15, help="Доля сессий с конфликтом")
+    parser.add_argument("--incomplete-rate", type=float, default=0.2, help="Доля незавершенных сессий")
+    parser.add_argument("--extra-conflict-rules", type=int, default=0, help="Добавить синтетических правил конфликтов")
+    parser.add_argument("--source", default=os.path.join(ROOT_DIR, "data", "database.db"), help="Исходная база")
+    args = parser.parse_args()
+    
+    info = generate_database(args.output, args.users, args.sessions, args.seed, args.conflict_rate,
+                             args.incomplete_rate, args.extra_conflict_rules, args.source)
+    print(f"✅ База создана: {args.output}")
+    print(json.dumps(info, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
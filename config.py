@@ -7,6 +7,10 @@ load_dotenv()
 # Telegram Bot
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+# Потоковый вывод длинных ответов LLM: одно сообщение редактируется не чаще раза в интервал (секунды)
+TELEGRAM_STREAMING_ENABLED = os.getenv("TELEGRAM_STREAMING_ENABLED", "True").lower() in ("true", "1", "yes")
+TELEGRAM_STREAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL", "1.0"))
+
 # GigaChat конфигурация
 GIGACHAT_AUTH = os.getenv("GIGACHAT_AUTH")
 GIGACHAT_SCOPE = os.getenv("GIGACHAT_SCOPE", "GIGACHAT_API_CORP")
@@ -26,41 +30,197 @@ OPENAI_PROXY_PORT = os.getenv("OPENAI_PROXY_PORT")
 OPENAI_PROXY_USER = os.getenv("OPENAI_PROXY_USER")
 OPENAI_PROXY_PASSWORD = os.getenv("OPENAI_PROXY_PASSWORD")
 
+# Структурированные ответы верификации и классификации (JSON схема)
+VERIFICATION_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'accepted': {'type': 'boolean', 'description': 'Ответ пользователя принят'},
+        'question': {'type': 'string', 'description': 'Уточняющий вопрос пользователю, пустая строка если ответ принят'}
+    },
+    'required': ['accepted', 'question'],
+    'additionalProperties': False
+}
+
+CLASSIFICATION_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'level': {'type': 'integer', 'description': 'Номер уровня'}
+    },
+    'required': ['level'],
+    'additionalProperties': False
+}
+
 # Настройки для разных типов задач LLM
 # Обе модели (GigaChat и OpenAI) используют одинаковые настройки для каждой задачи
+# timeout - ожидание ответа API в секундах
+# priority - очередность при ограничении параллельности (0 - раньше всех: пользователь ждет ответа)
+# context_tokens - бюджет токенов на портрет пользователя в промпте агента (processing_agents.count_tokens:
+#                  tiktoken cl100k_base, без него - оценка ~3 символа на токен)
+# response_schema - ответ в формате JSON по схеме (OpenAI response_format, GigaChat functions)
 
 LLM_TASK_SETTINGS = {
     # Верификация ответов - требует высокой точности
     'verification': {
         'temperature': 0.2,
-        'max_tokens': 16000
+        'max_tokens': 16000,
+        'timeout': 60,
+        'priority': 0,
+        'context_tokens': 2500,
+        'response_schema': VERIFICATION_RESPONSE_SCHEMA
     },
     
     # Классификация - требует точности и краткости
+    # cache=True - ответы кэшируются (задача детерминирована, ответы сотрудников повторяются)
     'classification': {
         'temperature': 0.1,
-        'max_tokens': 2000
+        'max_tokens': 2000,
+        'timeout': 30,
+        'cache': True,
+        'priority': 0,
+        'context_tokens': 1500,
+        'response_schema': CLASSIFICATION_RESPONSE_SCHEMA
     },
     
     # Компиляция ответов - баланс точности и структурированности
     'compilation': {
         'temperature': 0.3,
-        'max_tokens': 10000
+        'max_tokens': 10000,
+        'timeout': 60,
+        'priority': 1,
+        'context_tokens': 1500
     },
     
     # Объяснение конфликтов - может быть более креативным
     'explanation': {
         'temperature': 0.5,
-        'max_tokens': 8000
+        'max_tokens': 8000,
+        'timeout': 90,
+        'priority': 2
     },
     
     # Функциональный анализ - требует точности
     'functionality': {
         'temperature': 0.2,
-        'max_tokens': 12000
+        'max_tokens': 12000,
+        'timeout': 120,
+        'priority': 2,
+        'context_tokens': 4000
     }
 }
 
+# Устойчивость вызовов LLM: таймаут получения токена, повторы и автомат защиты
+LLM_TOKEN_TIMEOUT = float(os.getenv("LLM_TOKEN_TIMEOUT", "10"))
+LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "10.0"))
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+LLM_CIRCUIT_RESET_TIMEOUT = float(os.getenv("LLM_CIRCUIT_RESET_TIMEOUT", "60"))
+
+# Маршрутизация между GigaChat и OpenAI: переключение при отказе и хеджирование медленных запросов
+LLM_ROUTING_ENABLED = os.getenv("LLM_ROUTING_ENABLED", "False").lower() in ("true", "1", "yes")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_TASKS = [t.strip() for t in os.getenv("LLM_HEDGE_TASKS", "verification,classification,compilation").split(",") if t.strip()]
+
+# Контекст агентов из портрета: какие предыдущие ответы относятся к вопросу
+# Ответы на PORTRAIT_CONTEXT_ALWAYS передаются всегда; вопросы без записи получают все ответы
+PORTRAIT_CONTEXT_ALWAYS = [1, 2, 3, 4]
+PORTRAIT_CONTEXT_QUESTIONS = {
+    5: [6, 7],
+    6: [5, 7],
+    7: [5, 6, 10],
+    8: [7, 9, 10],
+    9: [8, 10],
+    10: [5, 6, 7, 8, 9],
+    11: [8, 9, 10, 12],
+    12: [8, 9, 10, 11],
+    13: [9, 11, 12, 14, 15, 16],
+    14: [13, 16],
+    15: [13, 16],
+    16: [9, 11, 13, 14, 15],
+    17: [9, 16],
+}
+# Длинные ответы в контексте обрезаются до этого числа токенов (подсчет - как для context_tokens)
+PORTRAIT_ANSWER_MAX_TOKENS = int(os.getenv("PORTRAIT_ANSWER_MAX_TOKENS", "250"))
+
+# Клиентские лимиты бэкендов (0 - без ограничения): запросы и токены в минуту, параллельные запросы
+LLM_RATE_LIMITS = {
+    'gigachat': {
+        'rpm': int(os.getenv("GIGACHAT_RPM_LIMIT", "0")),
+        'tpm': int(os.getenv("GIGACHAT_TPM_LIMIT", "0")),
+        'max_concurrency': int(os.getenv("GIGACHAT_MAX_CONCURRENCY", "8"))
+    },
+    'openai': {
+        'rpm': int(os.getenv("OPENAI_RPM_LIMIT", "0")),
+        'tpm': int(os.getenv("OPENAI_TPM_LIMIT", "0")),
+        'max_concurrency': int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+    }
+}
+
+# Кэш ответов LLM (только для задач с 'cache': True в LLM_TASK_SETTINGS)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "True").lower() in ("true", "1", "yes")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/llm_cache.db")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Семантический кэш классификации: переиспользование уровня для почти одинаковых ответов
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "False").lower() in ("true", "1", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "256"))
+SEMANTIC_CACHE_LSH_TABLES = int(os.getenv("SEMANTIC_CACHE_LSH_TABLES", "8"))
+SEMANTIC_CACHE_LSH_BITS = int(os.getenv("SEMANTIC_CACHE_LSH_BITS", "10"))
+
+# Кэш объяснений конфликтов по правилу и семейству должностей (explanation_cache.py)
+CONFLICT_EXPLANATION_CACHE_ENABLED = os.getenv("CONFLICT_EXPLANATION_CACHE_ENABLED", "True").lower() in ("true", "1", "yes")
+# После объяснения из кэша готовить в фоне персональное объяснение по портрету и заменять им сообщение
+CONFLICT_EXPLANATION_PERSONALIZE = os.getenv("CONFLICT_EXPLANATION_PERSONALIZE", "False").lower() in ("true", "1", "yes")
+
+# Упреждающая подготовка адаптивных вопросов (P1, варианты Q11/Q12, функционал Q18)
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "True").lower() in ("true", "1", "yes")
+# Вопросы, без ответов на которые функционал Q18 генерируется заранее (пока пользователь на них отвечает)
+FUNCTIONALITY_PREFETCH_IGNORED_QUESTIONS = [
+    int(question_id) for question_id in os.getenv("FUNCTIONALITY_PREFETCH_IGNORED_QUESTIONS", "16,17").split(",")
+    if question_id.strip()
+]
+
+# Заготовки функционала Q18 по должностям штатного расписания (functionality_drafts.py)
+FUNCTIONALITY_DRAFTS_ENABLED = os.getenv("FUNCTIONALITY_DRAFTS_ENABLED", "True").lower() in ("true", "1", "yes")
+# Минимальная оценка совпадения ответа на Q1 с должностью иерархии (0..1)
+FUNCTIONALITY_DRAFT_MIN_SCORE = float(os.getenv("FUNCTIONALITY_DRAFT_MIN_SCORE", "0.5"))
+# После заготовки готовить в фоне функционал по портрету сессии и заменять им сообщение
+FUNCTIONALITY_DRAFT_REFINE = os.getenv("FUNCTIONALITY_DRAFT_REFINE", "True").lower() in ("true", "1", "yes")
+# Заготовка перегенерируется, когда по должности завершено столько новых сессий
+FUNCTIONALITY_DRAFT_REFRESH_SESSIONS = int(os.getenv("FUNCTIONALITY_DRAFT_REFRESH_SESSIONS", "3"))
+
+# Метрики ходов пользователя (участки, длительности, токены) и эндпоинт Prometheus /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "False").lower() in ("true", "1", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Логирование: общий уровень, уровни подсистем ("agents=DEBUG,database=WARNING"), файл JSON с ротацией
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = {
+    subsystem.strip(): level.strip().upper()
+    for subsystem, level in (item.split("=", 1) for item in os.getenv("LOG_LEVELS", "").split(",") if "=" in item)
+}
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "True").lower() in ("true", "1", "yes")
+LOG_FILE = os.getenv("LOG_FILE", "logs/bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Доля вызовов агентов, для которых пишутся полные промпты и ответы LLM (0 - никогда, 1 - всегда)
+LOG_PROMPT_SAMPLE_RATE = float(os.getenv("LOG_PROMPT_SAMPLE_RATE", "0.01"))
+
+# Запись сессий (сообщения, нажатия кнопок, запросы/ответы LLM) для воспроизведения session_replay.py
+SESSION_RECORDING_ENABLED = os.getenv("SESSION_RECORDING_ENABLED", "False").lower() in ("true", "1", "yes")
+SESSION_RECORDING_DIR = os.getenv("SESSION_RECORDING_DIR", "data/recordings")
+
+# Варианты ответа, которые сразу дадут конфликт с предыдущими ответами (таблица conflicts):
+# off - не проверять (по умолчанию), mark - помечать варианты Q11/Q12 и подсказывать классификатору,
+# hide - скрывать такие варианты Q11/Q12 и подсказывать классификатору.
+# Классификатор в любом режиме может выбрать любой уровень - противоречие в ответе пользователя
+# по-прежнему обнаруживается ConflictDetector. Включение меняет промпты и кнопки - влияет на уровни.
+CONFLICT_AWARE_OPTIONS = os.getenv("CONFLICT_AWARE_OPTIONS", "off").lower()
+
 # Включение AI верификации
 ENABLE_AI_VERIFICATION = os.getenv("ENABLE_AI_VERIFICATION", "True").lower() in ("true", "1", "yes")
 
@@ -74,6 +234,6 @@ MESSAGES = {
     'question_template': """Вопрос {current} из {total}:
 
 {question}""",
-    
+
 
 } 
\ No newline at end of file
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Анализ и минимизация правил конфликтов (таблица conflicts)
+
+Правило - набор условий (вопрос, ответ); конфликт срабатывает, когда ответы пользователя
+совпадают со всеми условиями. Анализатор находит правила, которые не нужно проверять:
+- unsatisfiable - условия противоречат сами себе (два разных ответа на один вопрос)
+  или ответ вне уровней вопроса из справочника HAY;
+- unreachable - вопросы правила не могут быть показаны вместе (условия показа, например
+  Q14 и Q15 или Q15 при Q13 != 1);
+- duplicate - те же условия, что у правила с меньшим id;
+- subsumed - условия включают все условия более короткого правила: оно сработает раньше.
+
+Результат пишется в таблицу conflict_analysis (conflict_id, status, reason, related_id);
+ConflictDetector проверяет только правила со статусом kept. Анализ выполняется при
+импорте (update_conflicts.py) и вручную:
+    python conflict_analyzer.py --db data/database.db [--dry-run]
+"""
+
+import sqlite3
+from typing import Dict, List, Optional, Set, Tuple
+
+from question_flow import QuestionFlow, ShowCondition
+from reference_version import bump_reference_version
+
+# Условие правила: (вопрос, ответ, текст вопроса, текст ответа)
+Condition = Tuple[Optional[int], Optional[int], Optional[str], Optional[str]]
+
+STATUSES = ('kept', 'duplicate', 'subsumed', 'unsatisfiable', 'unreachable')
+
+
+def read_rules(conn: sqlite3.Connection) -> List[Tuple[int, List[Condition]]]:
+    """Правила таблицы conflicts в порядке id: пары 1-2 обязательные, пары 3-5 - если заполнены"""
+    rows = conn.execute("""
+        SELECT id, question1_id, answer1_id, question1_text, answer1_text,
+               question2_id, answer2_id, question2_text, answer2_text,
+               question3_id, answer3_id, question3_text, answer3_text,
+               question4_id, answer4_id, question4_text, answer4_text,
+               question5_id, answer5_id, question5_text, answer5_text
+        FROM conflicts ORDER BY id
+    """).fetchall()
+    rules = []
+    for row in rows:
+        conditions = []
+        for pair in range(5):
+            question_id, answer_id, question_text, answer_text = row[1 + pair * 4:5 + pair * 4]
+            if pair >= 2 and (question_id is None or answer_id is None):
+                continue
+            conditions.append((question_id, answer_id, question_text, answer_text))
+        rules.append((row[0], conditions))
+    return rules
+
+
+def excluded_rule_ids(conn: sqlite3.Connection) -> Set[int]:
+    """Правила, исключенные анализом (пусто - анализ не выполнялся)"""
+    try:
+        return {row[0] for row in conn.execute("SELECT conflict_id FROM conflict_analysis WHERE status != 'kept'")}
+    except sqlite3.OperationalError:
+        return set()
+
+
+def _reachable(flow: QuestionFlow, answers: Dict[int, int]) -> Optional[str]:
+    """Причина, по которой ответы не могут быть получены вместе (None - могут)"""
+    # Вопрос -> (значения, при которых показаны вопросы правила, кто этого требует);
+    # ответы в условиях показа - строки final_answer
+    required: Dict[int, Tuple[Set[str], int]] = {
+        question_id: ({str(answer_id)}, question_id) for question_id, answer_id in answers.items()
+    }
+    for question_id in answers:
+        condition = flow.conditions.get(question_id)
+        if not isinstance(condition, ShowCondition):
+            continue
+        for dependency, allowed in condition.requirements:
+            allowed = {str(value) for value in allowed}
+            if dependency is None or not allowed:
+                return f"Q{question_id} не показывается ни при каких ответах"
+            if dependency not in required:
+                required[dependency] = (allowed, question_id)
+                continue
+            values, source = required[dependency]
+            if not values & allowed:
+                if source == dependency:
+                    return f"Q{question_id} не показывается при ответе {answers[dependency]} на Q{dependency}"
+                return f"Q{question_id} и Q{source} не показываются при одном ответе на Q{dependency}"
+            required[dependency] = (values & allowed, source)
+    return None
+
+
+def analyze_rules(rules: List[Tuple[int, List[Condition]]], levels: Dict[int, Set[int]],
+                  flow: QuestionFlow) -> List[Dict]:
+    """
+    Статус каждого правила
+
+    Args:
+        rules: правила (read_rules)
+        levels: допустимые уровни вопросов {вопрос: уровни}; вопросы без уровней не проверяются
+        flow: условия показа вопросов
+    Возвращает: [{conflict_id, status, reason, related_id}] в порядке правил
+    """
+    results = []
+    live: List[Tuple[int, frozenset]] = []
+    seen: Dict[frozenset, int] = {}
+    
+    for conflict_id, conditions in rules:
+        result = {'conflict_id': conflict_id, 'status': 'kept', 'reason': None, 'related_id': None}
+        results.append(result)
+        
+        answers: Dict[int, int] = {}
+        for question_id, answer_id, _, _ in conditions:
+            if question_id is None or answer_id is None:
+                result['status'], result['reason'] = 'unsatisfiable', "пустое обязательное условие"
+                break
+            if answers.get(question_id, answer_id) != answer_id:
+                result['status'] = 'unsatisfiable'
+                result['reason'] = f"разные ответы на Q{question_id}: {answers[question_id]} и {answer_id}"
+                break
+            if levels.get(question_id) and answer_id not in levels[question_id]:
+                result['status'] = 'unsatisfiable'
+                result['reason'] = f"ответа {answer_id} нет среди уровней Q{question_id}"
+                break
+            answers[question_id] = answer_id
+        if result['status'] != 'kept':
+            continue
+        
+        reason = _reachable(flow, answers)
+        if reason is not None:
+            result['status'], result['reason'] = 'unreachable', reason
+            continue
+        
+        key = frozenset(answers.items())
+        if key in seen:
+            result['status'], result['related_id'] = 'duplicate', seen[key]
+            result['reason'] = f"повторяет правило {seen[key]}"
+            continue
+        seen[key] = conflict_id
+        live.append((conflict_id, key))
+    
+    # Поглощение: правило с подмножеством условий срабатывает всегда, когда срабатывает это
+    by_id = {result['conflict_id']: result for result in results}
+    for conflict_id, key in live:
+        for other_id, other_key in live:
+            if len(other_key) < len(key) and other_key <= key:
+                result = by_id[conflict_id]
+                result['status'], result['related_id'] = 'subsumed', other_id
+                result['reason'] = f"включает все условия правила {other_id}"
+                break
+    return results
+
+
+def evaluation_stats(rules: List[Tuple[int, List[Condition]]], kept_ids: Set[int]) -> Dict:
+    """Сколько правил и условий проверяется на один ответ - до и после минимизации"""
+    kept = [(conflict_id, conditions) for conflict_id, conditions in rules if conflict_id in kept_ids]
+    
+    def per_question(rule_set) -> Dict[int, int]:
+        counts: Dict[int, int] = {}
+        for _, conditions in rule_set:
+            for question_id in {condition[0] for condition in conditions}:
+                counts[question_id] = counts.get(question_id, 0) + 1
+        return counts
+    
+    before, after = per_question(rules), per_question(kept)
+    return {
+        'rules_before': len(rules),
+        'rules_after': len(kept),
+        'conditions_before': sum(len(conditions) for _, conditions in rules),
+        'conditions_after': sum(len(conditions) for _, conditions in kept),
+        'per_question': {question_id: (before[question_id], after.get(question_id, 0)) for question_id in sorted(before)}
+    }
+
+
+def analyze_conflicts_table(conn: sqlite3.Connection, save: bool = True) -> Dict:
+    """Анализ правил базы; save - записать статусы в conflict_analysis и увеличить версию справочников"""
+    conn.text_factory = str
+    rules = read_rules(conn)
+    levels: Dict[int, Set[int]] = {}
+    try:
+        for question_id, level in conn.execute("SELECT DISTINCT question_number, answer_number FROM hay_dictionary"):
+            levels.setdefault(question_id, set()).add(level)
+    except sqlite3.OperationalError:
+        pass
+    questions = [{'id': row[0], 'show_conditions': row[1]}
+                 for row in conn.execute("SELECT id, show_conditions FROM questions")]
+    
+    results = analyze_rules(rules, levels, QuestionFlow(questions))
+    kept_ids = {result['conflict_id'] for result in results if result['status'] == 'kept'}
+    
+    version = None
+    if save:
+        conn.execute("DROP TABLE IF EXISTS conflict_analysis")
+        conn.execute("""
+            CREATE TABLE conflict_analysis (
+                conflict_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                reason TEXT,
+                related_id INTEGER
+            )
+        """)
+        conn.executemany("""
+            INSERT INTO conflict_analysis (conflict_id, status, reason, related_id) VALUES (?, ?, ?, ?)
+        """, [(result['conflict_id'], result['status'], result['reason'], result['related_id']) for result in results])
+        # Работающий бот перечитает правила вместе со статусами (см. conflictator.get_conflict_rules)
+        version = bump_reference_version(conn)
+        conn.commit()
+    
+    return {
+        'results': results,
+        'reference_version': version,
+        'counts': {status: sum(1 for result in results if result['status'] == status) for status in STATUSES},
+        'evaluations': evaluation_stats(rules, kept_ids)
+    }
+
+
+def print_report(report: Dict) -> None:
+    counts = report['counts']
+    evaluations = report['evaluations']
+    print(f"🔍 Правил конфликтов: {len(report['results'])}, оставлено: {counts['kept']}")
+    for status in STATUSES[1:]:
+        if counts[status]:
+            print(f"   {status}: {counts[status]}")
+    for result in report['results']:
+        if result['status'] != 'kept':
+            print(f"   ✂️ Правило {result['conflict_id']} ({result['status']}): {result['reason']}")
+    
+    print(f"⚡ Проверок на ответ: правил {evaluations['rules_before']} -> {evaluations['rules_after']}, "
+          f"условий {evaluations['conditions_before']} -> {evaluations['conditions_after']}")
+    for question_id, (before, after) in evaluations['per_question'].items():
+        print(f"   Q{question_id}: правил с вопросом {before} -> {after}")
+    if report.get('reference_version') is not None:
+        print(f"🔄 Версия справочников: {report['reference_version']} - работающий бот перечитает таблицы без перезапуска")
+
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Анализ и минимизация правил конфликтов")
+    parser.add_argument("--db", default="data/database.db")
+    parser.add_argument("--dry-run", action="store_true", help="Только отчет, без записи conflict_analysis")
+    args = parser.parse_args()
+    
+    with sqlite3.connect(args.db) as connection:
+        print_report(analyze_conflicts_table(connection, save=not args.dry_run))
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Аудит правил конфликтов по всем сессиям базы
+
+Активные ответы всех сессий загружаются в матрицу уровней (сессия x вопрос), и каждое
+правило таблицы conflicts проверяется для всех сессий сразу: правила группируются по
+набору вопросов, ответы сессий и условия правил кодируются одним числом, и совпадения
+находятся поиском в отсортированном массиве ключей - без цикла по сессиям и вызовов
+ConflictDetector._find_active_conflicts.
+
+Уровни ответа разбираются как в ConflictDetector: final_answer (или answer, если final_answer
+пуст), только положительные целые числа; уровни выше наибольшего уровня вопроса в справочнике HAY
+(для вопросов без справочника - выше предела int64) не учитываются.
+
+Результат:
+- по правилам: число сессий, в которых правило срабатывает, и эти сессии;
+- по сессиям: сработавшие правила (первое - то, которое показал бы бот);
+- с --baseline-rules: сессии, которые правила --rules-db отмечают впервые или перестают отмечать.
+
+Пример:
+    python conflict_audit.py --rules-db new_rules.db --baseline-rules data/database.db --json audit.json
+    python conflict_audit.py --verify 500
+    python conflict_audit.py --benchmark 100000 --benchmark-rules 5000
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from conflict_analyzer import excluded_rule_ids, read_rules
+
+# Нет числового ответа на вопрос
+MISSING = 0
+# Наибольшее число ключей группы, для которого строится таблица ключ -> правила
+_KEY_TABLE_LIMIT = 1 << 22
+# Уровень вопроса без справочника должен поместиться в матрицу int64
+_INT64_MAX = np.iinfo(np.int64).max
+
+
+def _level(final_answer, answer, max_level: Optional[int] = None) -> Optional[int]:
+    """
+    Уровень ответа по правилам conflictator.response_levels (None - не учитывается)
+    
+    max_level - наибольший уровень вопроса; уровень выше не совпадет ни с одним правилом.
+    """
+    text = final_answer or answer
+    try:
+        # isdigit() принимает и надстрочные цифры ('²'), которые int() не разбирает
+        level = int(text) if isinstance(text, str) and text and text.isdigit() else None
+    except ValueError:
+        return None
+    if not level or level > (max_level if max_level is not None else _INT64_MAX):
+        return None
+    return level
+
+
+def load_max_levels(conn: sqlite3.Connection) -> Dict[int, int]:
+    """Наибольший уровень каждого вопроса по справочнику HAY (пусто - справочника нет)"""
+    try:
+        return dict(conn.execute("SELECT question_number, MAX(answer_number) FROM hay_dictionary "
+                                 "GROUP BY question_number").fetchall())
+    except sqlite3.OperationalError:
+        return {}
+
+
+def load_response_levels(db_path: str) -> Tuple[List[Tuple[int, int]], Dict[int, int], np.ndarray]:
+    """
+    Сессии, столбцы вопросов {вопрос: столбец} и матрица уровней активных ответов
+    (MISSING - нет числового ответа)
+    """
+    sessions: Dict[Tuple[int, int], int] = {}
+    columns: Dict[int, int] = {}
+    rows = []
+    with sqlite3.connect(db_path) as conn:
+        conn.text_factory = str
+        max_levels = load_max_levels(conn)
+        for user, session_id, question, answer, final_answer in conn.execute("""
+            SELECT user, session_id, question, answer, final_answer
+            FROM responses
+            WHERE status = 'active'
+            ORDER BY user, session_id, question, id
+        """):
+            index = sessions.setdefault((user, session_id), len(sessions))
+            level = _level(final_answer, answer, max_levels.get(question))
+            if level is not None:
+                rows.append((index, columns.setdefault(question, len(columns)), level))
+    
+    levels = np.full((len(sessions), len(columns)), MISSING, dtype=np.int64)
+    if rows:
+        # Более поздний ответ на тот же вопрос перезаписывает ранний, как в словаре ответов
+        data = np.array(rows, dtype=np.int64)
+        levels[data[:, 0], data[:, 1]] = data[:, 2]
+    return list(sessions), columns, levels
+
+
+def load_rules(db_path: str, minimized: bool = True) -> List[Tuple[int, List[Tuple[Optional[int], Optional[int]]]]]:
+    """Правила (id, [(вопрос, ответ)]) в порядке таблицы; minimized - без исключенных анализом"""
+    with sqlite3.connect(db_path) as conn:
+        conn.text_factory = str
+        rules = read_rules(conn)
+        excluded = excluded_rule_ids(conn) if minimized else set()
+    return [(conflict_id, [(question_id, answer_id) for question_id, answer_id, _, _ in conditions])
+            for conflict_id, conditions in rules if conflict_id not in excluded]
+
+
+def match_rules(levels: np.ndarray, columns: Dict[int, int],
+                rules: List[Tuple[int, List[Tuple[Optional[int], Optional[int]]]]]) -> List[np.ndarray]:
+    """
+    Номера сессий (строк levels), в которых срабатывает каждое правило
+
+    Условие (вопрос, ответ) выполнено, когда уровень сессии по вопросу равен ответу; как и в
+    ConflictDetector, условие с ответом None выполнено при отсутствии ответа на вопрос.
+    """
+    n = levels.shape[0]
+    empty = np.zeros(0, dtype=np.int64)
+    hits: List[np.ndarray] = [empty] * len(rules)
+    
+    # Группы правил с одинаковым (упорядоченным) набором вопросов
+    groups: Dict[tuple, List[Tuple[int, tuple]]] = {}
+    for index, (_, conditions) in enumerate(rules):
+        ordered = sorted(conditions, key=lambda condition: (condition[0] is None, condition[0] or 0))
+        # Ответ 0 и отрицательные уровни в ответах сессии не встречаются
+        if any(answer_id is not None and answer_id <= 0 for _, answer_id in ordered):
+            continue
+        answers = tuple(MISSING if answer_id is None else answer_id for _, answer_id in ordered)
+        groups.setdefault(tuple(question_id for question_id, _ in ordered), []).append((index, answers))
+    if not groups:
+        return hits
+    
+    # Уровни выше наибольшего ответа правил ни с чем не совпадают - сводим их к одному значению,
+    # чтобы перекодировать столбцы таблицей подстановки
+    top = max(max(answers) for members in groups.values() for _, answers in members) + 1
+    # Столбцы подряд в памяти - их читает каждая группа
+    clipped = np.asfortranarray(np.minimum(levels, top))
+    missing_column = np.full(n, MISSING, dtype=np.int64)
+    
+    for questions, members in groups.items():
+        answers_matrix = np.array([answers for _, answers in members], dtype=np.int64)
+        session_key = np.zeros(n, dtype=np.int64)
+        rule_key = np.zeros(len(members), dtype=np.int64)
+        radix_total = 1
+        for position, question_id in enumerate(questions):
+            # Ответы правил на позиции - коды 0..k-1; код k - "не совпадает ни с одним"
+            vocabulary, rule_codes = np.unique(answers_matrix[:, position], return_inverse=True)
+            radix = len(vocabulary) + 1
+            radix_total *= radix
+            if radix_total >= 2 ** 62:
+                break
+            lookup = np.full(top + 1, len(vocabulary), dtype=np.int64)
+            lookup[vocabulary] = np.arange(len(vocabulary))
+            column = clipped[:, columns[question_id]] if question_id in columns else missing_column
+            session_key = session_key * radix + lookup[column]
+            rule_key = rule_key * radix + rule_codes.reshape(-1)
+        else:
+            unique_keys, rule_group = np.unique(rule_key, return_inverse=True)
+            if radix_total <= _KEY_TABLE_LIMIT:
+                # Ключей немного - номер группы по таблице, иначе поиском в отсортированных ключах
+                key_table = np.full(radix_total, -1, dtype=np.int64)
+                key_table[unique_keys] = np.arange(len(unique_keys))
+                position = key_table[session_key]
+                matched = np.nonzero(position >= 0)[0]
+            else:
+                position = np.minimum(np.searchsorted(unique_keys, session_key), len(unique_keys) - 1)
+                matched = np.nonzero(unique_keys[position] == session_key)[0]
+            session_group = position[matched]
+            order = np.argsort(session_group, kind='stable')
+            matched, session_group = matched[order], session_group[order]
+            bounds = np.searchsorted(session_group, np.arange(len(unique_keys) + 1))
+            for (index, _), group in zip(members, rule_group.reshape(-1).tolist()):
+                hits[index] = matched[bounds[group]:bounds[group + 1]]
+            continue
+        
+        # Слишком много разных ответов для одного числового ключа - маски по столбцам
+        for index, answers in members:
+            mask = np.ones(n, dtype=bool)
+            for question_id, answer_id in zip(questions, answers):
+                mask &= (levels[:, columns[question_id]] if question_id in columns else missing_column) == answer_id
+            hits[index] = np.nonzero(mask)[0]
+    return hits
+
+
+def _flagged(hits: List[np.ndarray], n: int) -> np.ndarray:
+    flagged = np.zeros(n, dtype=bool)
+    for sessions in hits:
+        flagged[sessions] = True
+    return flagged
+
+
+def audit(db_path: str, rules_db: str = None, baseline_rules: str = None, minimized: bool = True) -> Dict:
+    """Срабатывания правил rules_db (по умолчанию - правил самой базы) на сессиях db_path"""
+    started = time.perf_counter()
+    sessions, columns, levels = load_response_levels(db_path)
+    rules = load_rules(rules_db or db_path, minimized)
+    hits = match_rules(levels, columns, rules)
+    
+    per_rule = [
+        {
+            'conflict_id': conflict_id,
+            'questions': [question_id for question_id, _ in conditions],
+            'answers': [answer_id for _, answer_id in conditions],
+            'sessions': int(len(rule_hits)),
+            'affected': [list(sessions[index]) for index in rule_hits.tolist()]
+        }
+        for (conflict_id, conditions), rule_hits in zip(rules, hits)
+    ]
+    
+    # Сработавшие правила каждой сессии в порядке таблицы
+    by_session: Dict[int, List[int]] = {}
+    for (conflict_id, _), rule_hits in zip(rules, hits):
+        for index in rule_hits.tolist():
+            by_session.setdefault(index, []).append(conflict_id)
+    per_session = [
+        {'user_id': sessions[index][0], 'session_id': sessions[index][1], 'conflicts': conflict_ids}
+        for index, conflict_ids in sorted(by_session.items())
+    ]
+    
+    result = {
+        'sessions': len(sessions),
+        'rules': len(rules),
+        'flagged_sessions': len(per_session),
+        'duration_s': None,
+        'per_rule': per_rule,
+        'per_session': per_session
+    }
+    
+    if baseline_rules:
+        flagged = _flagged(hits, len(sessions))
+        baseline = _flagged(match_rules(levels, columns, load_rules(baseline_rules, minimized)), len(sessions))
+        result['newly_flagged'] = [list(sessions[index]) for index in np.nonzero(flagged & ~baseline)[0].tolist()]
+        result['no_longer_flagged'] = [list(sessions[index]) for index in np.nonzero(baseline & ~flagged)[0].tolist()]
+    
+    result['duration_s'] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def verify(db_path: str, limit: int, minimized: bool = True) -> int:
+    """Сверка с ConflictRules.find_active на первых limit сессиях"""
+    from conflictator import ConflictRules, response_levels
+    from database import Database
+    
+    db = Database(db_path)
+    sessions, columns, levels = load_response_levels(db_path)
+    rules = load_rules(db_path, minimized)
+    hits = match_rules(levels[:limit], columns, rules)
+    by_session: Dict[int, List[int]] = {}
+    for (conflict_id, _), rule_hits in zip(rules, hits):
+        for index in rule_hits.tolist():
+            by_session.setdefault(index, []).append(conflict_id)
+    
+    detector_rules = ConflictRules(db_path, minimized)
+    failures = 0
+    for index, (user, session_id) in enumerate(sessions[:limit]):
+        response_map = response_levels(db.get_user_responses(user, session_id, only_active=True))
+        expected = [conflict['id'] for conflict in detector_rules.find_active(response_map)]
+        if expected != by_session.get(index, []):
+            failures += 1
+            if failures <= 5:
+                print(f"❌ Сессия {user}/{session_id}: ConflictDetector {expected}, аудит {by_session.get(index, [])}")
+    print(f"{'✅' if not failures else '❌'} Сверено сессий: {min(limit, len(sessions))}, расхождений: {failures}")
+    return failures
+
+
+def benchmark(sessions: int, rules: int, seed: int) -> None:
+    """Замер на случайной матрице уровней и случайных правилах"""
+    rng = np.random.default_rng(seed)
+    questions = list(range(8, 17))
+    columns = {question_id: index for index, question_id in enumerate(questions)}
+    levels = rng.integers(0, 9, size=(sessions, len(questions)))
+    random_rules = []
+    for conflict_id in range(1, rules + 1):
+        chosen = rng.choice(questions, size=int(rng.integers(2, 6)), replace=False)
+        random_rules.append((conflict_id, [(int(question_id), int(rng.integers(1, 9))) for question_id in chosen]))
+    
+    started = time.perf_counter()
+    hits = match_rules(levels, columns, random_rules)
+    elapsed = time.perf_counter() - started
+    print(f"⚡ Сессий: {sessions}, правил: {rules}, срабатываний: {sum(len(rule_hits) for rule_hits in hits)}, "
+          f"время: {elapsed:.2f} с")
+    
+    # Та же проверка циклом по сессиям (как ConflictRules.find_active) - для сравнения времени и результата
+    by_session: Dict[int, List[int]] = {}
+    for (conflict_id, _), rule_hits in zip(random_rules, hits):
+        for index in rule_hits.tolist():
+            by_session.setdefault(index, []).append(conflict_id)
+    sample = min(sessions, 200)
+    mismatches = 0
+    started = time.perf_counter()
+    for index in range(sample):
+        response_map = {question_id: int(levels[index, column]) for question_id, column in columns.items()
+                        if levels[index, column]}
+        expected = [conflict_id for conflict_id, conditions in random_rules
+                    if all(response_map.get(question_id) == answer_id for question_id, answer_id in conditions)]
+        mismatches += expected != by_session.get(index, [])
+    per_session = (time.perf_counter() - started) / sample
+    print(f"🐢 Проверка по одной сессии: {per_session * 1e3:.2f} мс на сессию, "
+          f"оценка для всех сессий: {per_session * sessions:.1f} с; расхождений на {sample} сессиях: {mismatches}")
+
+
+def print_report(result: Dict, top: int = 20) -> None:
+    print("=" * 70)
+    print(f"📊 Сессий: {result['sessions']}, правил: {result['rules']}, "
+          f"с конфликтами: {result['flagged_sessions']} ({result['duration_s']} с)")
+    if 'newly_flagged' in result:
+        print(f"🆕 Отмечаются впервые: {len(result['newly_flagged'])}, "
+              f"больше не отмечаются: {len(result['no_longer_flagged'])}")
+    print(f"{'Правило':>8} {'сессий':>8}  вопросы = ответы")
+    for rule in sorted(result['per_rule'], key=lambda rule: -rule['sessions'])[:top]:
+        if not rule['sessions']:
+            break
+        conditions = ", ".join(f"Q{question_id}={answer_id}"
+                               for question_id, answer_id in zip(rule['questions'], rule['answers']))
+        print(f"{rule['conflict_id']:>8} {rule['sessions']:>8}  {conditions}")
+    print("=" * 70)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аудит правил конфликтов по всем сессиям")
+    parser.add_argument("--db", default="data/database.db", help="База с ответами")
+    parser.add_argument("--rules-db", help="База с проверяемыми правилами (по умолчанию --db)")
+    parser.add_argument("--baseline-rules", help="База с прежними правилами - для списка новых срабатываний")
+    parser.add_argument("--all-rules", action="store_true", help="Учитывать правила, исключенные conflict_analyzer.py")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результаты в JSON")
+    parser.add_argument("--verify", type=int, default=0,
+                        help="Сверить с ConflictDetector на первых N сессиях (0 - не сверять)")
+    parser.add_argument("--benchmark", type=int, default=0, help="Замер на N случайных сессиях вместо аудита")
+    parser.add_argument("--benchmark-rules", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        benchmark(args.benchmark, args.benchmark_rules, args.seed)
+        return
+    if args.verify and verify(args.db, args.verify, not args.all_rules):
+        raise SystemExit(1)
+    
+    result = audit(args.db, args.rules_db, args.baseline_rules, not args.all_rules)
+    print_report(result)
+    
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,112 @@
 #!/usr/bin/env python3
 import sqlite3
+import threading
 from typing import List, Dict, Optional, Tuple
 from database import Database
+from app_logging import get_logger
+from conflict_analyzer import read_rules, excluded_rule_ids
+from reference_version import reference_version
+
+logger = get_logger('conflicts')
+
+
+def response_levels(user_responses: List[Dict]) -> Dict[int, int]:
+    """Ответы сессии в виде {номер_вопроса: номер_ответа} (нечисловые ответы пропускаются)"""
+    response_map = {}
+    for resp in user_responses:
+        # Используем final_answer если есть, иначе answer
+        answer_text = resp['final_answer'] or resp['answer']
+        try:
+            # Пытаемся преобразовать ответ в номер
+            answer_num = int(answer_text) if answer_text and answer_text.isdigit() else None
+            if answer_num:
+                response_map[resp['question']] = answer_num
+        except (ValueError, TypeError):
+            continue
+    return response_map
+
+
+class ConflictRules:
+    """
+    Правила таблицы conflicts, загруженные один раз на версию справочников (get_conflict_rules)
+    
+    Правило - набор условий (вопрос, ответ): пары 1-2 обязательные, пары 3-5 - если заполнены.
+    Конфликт активен, когда ответы пользователя совпадают со всеми условиями правила.
+    Правила, исключенные анализом (conflict_analyzer.py), не проверяются.
+    """
+    
+    def __init__(self, db_path: str, minimized: bool = True):
+        with sqlite3.connect(db_path) as conn:
+            conn.text_factory = str
+            rules = read_rules(conn)
+            excluded = excluded_rule_ids(conn) if minimized else set()
+        
+        # (id, [(вопрос, ответ, текст вопроса, текст ответа), ...]) в порядке таблицы
+        self.rules: List[Tuple[int, List[Tuple]]] = [rule for rule in rules if rule[0] not in excluded]
+        # Вопрос -> номера правил, в условиях которых он участвует
+        self.by_question: Dict[int, List[int]] = {}
+        for index, (_, conditions) in enumerate(self.rules):
+            for question_id in {condition[0] for condition in conditions}:
+                self.by_question.setdefault(question_id, []).append(index)
+    
+    @staticmethod
+    def _conflict(conflict_id: int, conditions: List[Tuple]) -> Dict:
+        return {
+            'id': conflict_id,
+            'questions': [
+                {
+                    'question_id': question_id,
+                    'answer_id': answer_id,
+                    'question_text': question_text,
+                    'answer_text': answer_text
+                }
+                for question_id, answer_id, question_text, answer_text in conditions
+            ],
+            'question_ids': [condition[0] for condition in conditions]
+        }
+    
+    def find_active(self, response_map: Dict[int, int]) -> List[Dict]:
+        """Все конфликты, условия которых выполнены ответами response_map"""
+        return [self._conflict(conflict_id, conditions) for conflict_id, conditions in self.rules
+                if all(response_map.get(question_id) == answer_id for question_id, answer_id, _, _ in conditions)]
+    
+    def all_conflicts(self) -> List[Dict]:
+        """Все правила в формате конфликтов find_active"""
+        return [self._conflict(conflict_id, conditions) for conflict_id, conditions in self.rules]
+    
+    def conflicting_levels(self, question_id: int, response_map: Dict[int, int]) -> Dict[int, List[int]]:
+        """
+        Уровни вопроса question_id, которые при ответах response_map (без учета ответа
+        на сам вопрос) выполнят все условия какого-либо правила
+        
+        Возвращает: {уровень: [другие вопросы этих правил]}
+        """
+        result: Dict[int, set] = {}
+        for index in self.by_question.get(question_id, ()):
+            _, conditions = self.rules[index]
+            levels = {answer_id for condition_question, answer_id, _, _ in conditions if condition_question == question_id}
+            if len(levels) != 1:
+                continue
+            others = [(condition_question, answer_id) for condition_question, answer_id, _, _ in conditions
+                      if condition_question != question_id]
+            if all(response_map.get(condition_question) == answer_id for condition_question, answer_id in others):
+                result.setdefault(levels.pop(), set()).update(condition_question for condition_question, _ in others)
+        return {level: sorted(questions) for level, questions in sorted(result.items())}
+
+
+# db_path -> (версия справочников, правила)
+_conflict_rules: Dict[str, Tuple[int, ConflictRules]] = {}
+_conflict_rules_lock = threading.Lock()
+
+
+def get_conflict_rules(db_path: str) -> ConflictRules:
+    """Правила конфликтов базы db_path (перечитываются, когда update_conflicts.py меняет версию справочников)"""
+    version = reference_version(db_path)
+    with _conflict_rules_lock:
+        cached = _conflict_rules.get(db_path)
+        if cached is None or cached[0] != version:
+            cached = _conflict_rules[db_path] = (version, ConflictRules(db_path))
+        return cached[1]
 
 class ConflictDetector:
     """Агент для обнаружения и обработки конфликтов в ответах"""
@@ -15,23 +120,13 @@ class ConflictDetector:
         Проверка конфликтов после ответа на вопрос
         Возвращает список найденных конфликтов
         """
-        print(f"🔍 Проверка конфликтов Q{answered_question}")
+        logger.debug("🔍 Проверка конфликтов Q%s", answered_question)
         
         # Получаем только активные ответы текущей сессии
         user_responses = self.db.get_user_responses(user_id, session_id, only_active=True)
         
         # Преобразуем в удобный формат {номер_вопроса: номер_ответа}
-        response_map = {}
-        for resp in user_responses:
-            # Используем final_answer если есть, иначе answer
-            answer_text = resp['final_answer'] or resp['answer']
-            try:
-                # Пытаемся преобразовать ответ в номер
-                answer_num = int(answer_text) if answer_text and answer_text.isdigit() else None
-                if answer_num:
-                    response_map[resp['question']] = answer_num
-            except (ValueError, TypeError):
-                continue
+        response_map = response_levels(user_responses)
         
         # Проверяем все конфликты
         conflicts = self._find_active_conflicts(response_map)
@@ -40,133 +135,28 @@ class ConflictDetector:
             # Выводим краткую информацию о найденном конфликте
             conflict = conflicts[0]  # Берем первый найденный конфликт
             question_ids = conflict['question_ids']
-            print(f"\n⚠️ ОБНАРУЖЕН КОНФЛИКТ!")
-            print(f"   Вопросы: {question_ids}")
-            
             # Выводим уровни по каждому вопросу
             user_levels = [response_map.get(q_id, '?') for q_id in question_ids]
-            print(f"   Уровни пользователя: {user_levels}")
-            print()
+            logger.warning("⚠️ ОБНАРУЖЕН КОНФЛИКТ! Вопросы: %s, уровни пользователя: %s", question_ids, user_levels,
+                           extra={'user_id': user_id, 'session_id': session_id, 'conflict_id': conflict.get('id')})
         
         return conflicts
     
     def _find_active_conflicts(self, response_map: Dict[int, int]) -> List[Dict]:
         """Находит все активные конфликты для данного набора ответов"""
-        with sqlite3.connect(self.db.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            
-            # Получаем все конфликты
-            cursor.execute("""
-                SELECT id, question1_id, answer1_id, question1_text, answer1_text,
-                       question2_id, answer2_id, question2_text, answer2_text,
-                       question3_id, answer3_id, question3_text, answer3_text,
-                       question4_id, answer4_id, question4_text, answer4_text,
-                       question5_id, answer5_id, question5_text, answer5_text
-                FROM conflicts
-            """)
-            
-            all_conflicts = cursor.fetchall()
-            active_conflicts = []
-            
-            for conflict_row in all_conflicts:
-                conflict_id = conflict_row[0]
-                q1_id, a1_id = conflict_row[1], conflict_row[2]
-                q2_id, a2_id = conflict_row[5], conflict_row[6]
-                q3_id, a3_id = conflict_row[9], conflict_row[10]
-                q4_id, a4_id = conflict_row[13], conflict_row[14]
-                q5_id, a5_id = conflict_row[17], conflict_row[18]
-                
-                conflict = {
-                    'id': conflict_id,
-                    'questions': [],
-                    'question_ids': []
-                }
-                
-                # Проверяем первую пару (обязательная)
-                q1_text, a1_text = conflict_row[3], conflict_row[4]
-                
-                user_answer_1 = response_map.get(q1_id)
-                if user_answer_1 != a1_id:
-                    continue  # Первое условие не выполнено
-                
-                conflict['questions'].append({
-                    'question_id': q1_id,
-                    'answer_id': a1_id,
-                    'question_text': q1_text,
-                    'answer_text': a1_text
-                })
-                conflict['question_ids'].append(q1_id)
-                
-                # Проверяем вторую пару (обязательная)
-                q2_text, a2_text = conflict_row[7], conflict_row[8]
-                
-                user_answer_2 = response_map.get(q2_id)
-                if user_answer_2 != a2_id:
-                    continue  # Второе условие не выполнено
-                
-                conflict['questions'].append({
-                    'question_id': q2_id,
-                    'answer_id': a2_id,
-                    'question_text': q2_text,
-                    'answer_text': a2_text
-                })
-                conflict['question_ids'].append(q2_id)
-                
-                # Проверяем третью пару (опциональная)
-                if q3_id is not None and a3_id is not None:
-                    q3_text, a3_text = conflict_row[11], conflict_row[12]
-                    
-                    user_answer_3 = response_map.get(q3_id)
-                    if user_answer_3 != a3_id:
-                        continue  # Третье условие не выполнено
-                    
-                    conflict['questions'].append({
-                        'question_id': q3_id,
-                        'answer_id': a3_id,
-                        'question_text': q3_text,
-                        'answer_text': a3_text
-                    })
-                    conflict['question_ids'].append(q3_id)
-                
-                # Проверяем четвертую пару (опциональная)
-                if q4_id is not None and a4_id is not None:
-                    q4_text, a4_text = conflict_row[15], conflict_row[16]
-                    
-                    user_answer_4 = response_map.get(q4_id)
-                    if user_answer_4 != a4_id:
-                        continue  # Четвертое условие не выполнено
-                    
-                    conflict['questions'].append({
-                        'question_id': q4_id,
-                        'answer_id': a4_id,
-                        'question_text': q4_text,
-                        'answer_text': a4_text
-                    })
-                    conflict['question_ids'].append(q4_id)
-                
-                # Проверяем пятую пару (опциональная)
-                if q5_id is not None and a5_id is not None:
-                    q5_text, a5_text = conflict_row[19], conflict_row[20]
-                    
-                    user_answer_5 = response_map.get(q5_id)
-                    if user_answer_5 != a5_id:
-                        continue  # Пятое условие не выполнено
-                    
-                    conflict['questions'].append({
-                        'question_id': q5_id,
-                        'answer_id': a5_id,
-                        'question_text': q5_text,
-                        'answer_text': a5_text
-                    })
-                    conflict['question_ids'].append(q5_id)
-                
-                # Все условия выполнены - конфликт активен
-                active_conflicts.append(conflict)
-            
-            return active_conflicts
+        return get_conflict_rules(self.db.db_path).find_active(response_map)
+    
+    def conflicting_levels(self, user_id: int, session_id: int, question_id: int) -> Dict[int, List[int]]:
+        """
+        Уровни вопроса, ответ которыми сразу даст конфликт с текущими ответами сессии
+        
+        Возвращает: {уровень: [вопросы, с ответами на которые он конфликтует]}
+        """
+        levels = self.db.get_session_derived(user_id, session_id).levels
+        return get_conflict_rules(self.db.db_path).conflicting_levels(question_id, dict(levels))
     
-    def generate_conflict_explanation(self, conflict: Dict, user_portrait: str = None) -> str:
+    @staticmethod
+    def generate_conflict_explanation(conflict: Dict, user_portrait: str = None) -> str:
         """Генерирует объяснение одного конфликта с учетом контекста пользователя"""
         
         prompt = ""
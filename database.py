@@ -1,13 +1,36 @@
 import sqlite3
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Optional, Union, Tuple
 import json
 
+import metrics
+from app_logging import get_logger
+from grade_calculator import answer_level
+from question_flow import (DERIVED_DEPENDENCIES, DependencyGraph, QuestionFlow, QuestionScheduler,
+                           answers_from_responses, question_node, default_dependencies, should_show_question)
+from reference_version import reference_version
+from session_derived import SessionDerivedValues
+
+logger = get_logger('database')
+
+# Сколько сессий держать в памяти (оставшиеся вопросы, производные значения)
+SESSION_CACHE_SIZE = 1024
+
 class Database:
     def __init__(self, db_path: str = "data/database.db"):
         self.db_path = db_path
+        # Условия показа компилируются при первом обращении, планировщики и производные
+        # значения - по сессиям (LRU); все сбрасываются при смене версии справочников
+        self._reference_version: Optional[int] = None
+        self._question_flow: Optional[QuestionFlow] = None
+        self._dependency_graph: Optional[DependencyGraph] = None
+        self._schedulers: "OrderedDict[Tuple[int, int], QuestionScheduler]" = OrderedDict()
+        self._derived: "OrderedDict[Tuple[int, int], SessionDerivedValues]" = OrderedDict()
+        self._flow_lock = threading.Lock()
+    
+    
     
-
-
     def get_question(self, question_id: int) -> Optional[Dict]:
         """Получение вопроса по ID"""
         with sqlite3.connect(self.db_path) as conn:
@@ -28,10 +51,22 @@ class Database:
                     'verification_instruction': result[3],
                     'classifier': result[4],
                     'show_conditions': result[5],
-                    'section': result[6]
+                    'section': result[6],
+                    'levels': self.get_question_levels(question_id)
                 }
             return None
     
+    def get_question_levels(self, question_id: int) -> List[int]:
+        """Допустимые уровни ответа на вопрос (номера из справочника HAY)"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT DISTINCT answer_number FROM hay_dictionary
+                WHERE question_number = ?
+                ORDER BY answer_number
+            """, (question_id,))
+            return [row[0] for row in cursor.fetchall()]
+    
     def get_all_questions(self) -> List[Dict]:
         """Получение всех вопросов"""
         with sqlite3.connect(self.db_path) as conn:
@@ -115,7 +150,7 @@ class Database:
         """
         user_state_json = json.dumps(user_state, ensure_ascii=False) if user_state else None
         
-        with sqlite3.connect(self.db_path) as conn:
+        with metrics.span('response_save'), sqlite3.connect(self.db_path) as conn:
             conn.text_factory = str
             cursor = conn.cursor()
             
@@ -134,34 +169,38 @@ class Database:
             conn.commit()
             response_id = cursor.lastrowid
         
+        # Оставшиеся вопросы и производные значения: пересчитывается только зависящее от этого вопроса
+        scheduler = self._get_scheduler(user, session_id, create=False)
+        if scheduler is not None:
+            if status == 'active':
+                scheduler.answer(question, final_answer if final_answer else answer)
+            else:
+                scheduler.retract([question])
+        derived = self._session_cached(self._derived, user, session_id)
+        if derived is not None:
+            if status == 'active':
+                derived.set_level(question, final_answer)
+            else:
+                derived.drop_levels([question])
+        
         # Проверяем конфликты только если нужно (для вопросов с классификатором)
         conflicts = []
         if check_conflicts:
-            from conflictator import ConflictDetector
-            detector = ConflictDetector(self)
-            conflicts = detector.check_conflicts_after_answer(user, session_id, question, final_answer or answer)
-            
-            # Если есть конфликты, помечаем участвующие ответы как 'conflicted'
-            if conflicts:
-                self._mark_responses_as_conflicted(user, session_id, conflicts)
+            with metrics.span('conflict_check'):
+                from conflictator import ConflictDetector
+                detector = ConflictDetector(self)
+                conflicts = detector.check_conflicts_after_answer(user, session_id, question, final_answer or answer)
+                
+                # Если есть конфликты, помечаем участвующие ответы как 'conflicted'
+                if conflicts:
+                    self._mark_responses_as_conflicted(user, session_id, conflicts)
         
         return response_id, conflicts
     
     def _mark_responses_as_conflicted(self, user: int, session_id: int, conflicts: List[Dict]) -> None:
-        """Помечает ответы, участвующие в конфликтах, как 'inactive'"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            
-            for conflict in conflicts:
-                for question_id in conflict['question_ids']:
-                    cursor.execute("""
-                        UPDATE responses 
-                        SET status = 'inactive' 
-                        WHERE user = ? AND session_id = ? AND question = ?
-                    """, (user, session_id, question_id))
-            
-            conn.commit()
+        """Помечает ответы, участвующие в конфликтах, и зависящие от них как 'inactive'"""
+        question_ids = [question_id for conflict in conflicts for question_id in conflict['question_ids']]
+        self.invalidate_questions(user, session_id, question_ids)
     
     def add_questions_to_remaining(self, user: int, session_id: int, question_ids: List[int]) -> None:
         """Добавляет вопросы обратно в remaining_questions в состоянии пользователя"""
@@ -182,20 +221,74 @@ class Database:
     
     def _expand_with_subquestions(self, question_ids: List[int]) -> List[int]:
         """
-        Расширяет список вопросов подвопросами
-        Если в списке есть вопрос 13, добавляет вопросы 14 и 15
+        Расширяет список вопросов зависимыми - по графу question_dependencies
+        (например, к вопросу 13 добавляются 14 и 15, к вопросу 8 - 11 и 12 через P1)
         """
-        expanded_ids = list(question_ids)  # Копируем исходный список
+        affected = self.get_dependency_graph().affected_questions(question_ids)
+        return list(question_ids) + [question_id for question_id in affected if question_id not in question_ids]
+    
+    def get_dependency_graph(self) -> DependencyGraph:
+        """Граф зависимостей из таблицы question_dependencies (загружается один раз на версию справочников)"""
+        self._check_reference_version()
+        with self._flow_lock:
+            if self._dependency_graph is not None:
+                return self._dependency_graph
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.text_factory = str
+                edges = conn.execute("SELECT node, depends_on, kind FROM question_dependencies").fetchall()
+        except sqlite3.OperationalError:
+            # База без таблицы (до запуска update_questions.py) - граф строится по вопросам
+            logger.warning("⚠️ Таблица question_dependencies не найдена, граф зависимостей строится по вопросам")
+            edges = default_dependencies(self.get_all_questions())
+        # Производные значения вычисляются кодом - их зависимости берутся из кода и тогда,
+        # когда таблица создана более ранней версией update_questions.py
+        with self._flow_lock:
+            self._dependency_graph = DependencyGraph(list(edges) + DERIVED_DEPENDENCIES)
+            return self._dependency_graph
+    
+    def invalidate_questions(self, user: int, session_id: int, question_ids: List[int]) -> List[int]:
+        """
+        Переспросить вопросы: их ответы и все зависящие от них (по графу зависимостей)
+        помечаются 'inactive' одним запросом, вопросы возвращаются в remaining_questions,
+        портрет пересобирается без неактуальных ответов
+
+        Возвращает: номера вопросов, ответы на которые стали неактуальны
+        """
+        graph = self.get_dependency_graph()
+        affected = graph.affected_questions(question_ids)
+        if not affected:
+            return []
+        
+        placeholders = ", ".join("?" * len(affected))
+        with sqlite3.connect(self.db_path) as conn:
+            conn.text_factory = str
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE responses 
+                SET status = 'inactive' 
+                WHERE user = ? AND session_id = ? AND status = 'active' AND question IN ({placeholders})
+            """, (user, session_id, *affected))
+            changed = cursor.rowcount
+            conn.commit()
+        
+        scheduler = self._get_scheduler(user, session_id, create=False)
+        if scheduler is not None:
+            scheduler.retract(affected)
+        derived = self._session_cached(self._derived, user, session_id)
+        if derived is not None:
+            derived.drop_levels(affected)
+        
+        # Оставшиеся вопросы - неотвеченные с выполненными условиями показа (в т.ч. переспрашиваемые)
+        state = self.get_user_state(user, session_id)
+        if state and 'remaining_questions' in state:
+            state['remaining_questions'] = self.get_remaining_questions(user, session_id)
+            self.save_user_state(user, session_id, state)
         
-        for question_id in question_ids:
-            if question_id == 13:
-                # Добавляем подвопросы 14 и 15, если их еще нет
-                if 14 not in expanded_ids:
-                    expanded_ids.append(14)
-                if 15 not in expanded_ids:
-                    expanded_ids.append(15)
+        if changed and 'portrait' in graph.affected_nodes(question_node(question_id) for question_id in affected):
+            self.generate_user_portrait(user, session_id)
         
-        return expanded_ids
+        return affected
     
     def get_user_responses(self, user: int, session_id: int, only_active: bool = True) -> List[Dict]:
         """
@@ -316,54 +409,72 @@ class Database:
             results = cursor.fetchall()
             return [result[0] for result in results]
     
+    def get_question_flow(self) -> QuestionFlow:
+        """Порядок вопросов и скомпилированные условия показа (загружаются один раз на версию справочников)"""
+        self._check_reference_version()
+        with self._flow_lock:
+            if self._question_flow is None:
+                self._question_flow = QuestionFlow(self.get_all_questions())
+            return self._question_flow
+    
+    def _check_reference_version(self) -> None:
+        """Сбрасывает условия показа, граф зависимостей и кэши сессий, если update_*.py обновили справочники"""
+        version = reference_version(self.db_path)
+        with self._flow_lock:
+            if version == self._reference_version:
+                return
+            if self._reference_version is not None:
+                logger.info(f"🔄 Версия справочников изменилась ({self._reference_version} → {version}), кэши вопросов сброшены")
+            self._reference_version = version
+            self._question_flow = None
+            self._dependency_graph = None
+            self._schedulers.clear()
+            self._derived.clear()
+    
+    def _session_cached(self, cache: OrderedDict, user: int, session_id: int, build=None):
+        """Объект сессии из LRU-кэша; build() создает его, если в кэше нет (без build - None)"""
+        self._check_reference_version()
+        key = (user, session_id)
+        with self._flow_lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+                return value
+        if build is None:
+            return None
+        
+        value = build()
+        with self._flow_lock:
+            cache[key] = value
+            if len(cache) > SESSION_CACHE_SIZE:
+                cache.popitem(last=False)
+        return value
+    
+    def _get_scheduler(self, user: int, session_id: int, create: bool = True) -> Optional[QuestionScheduler]:
+        """Планировщик вопросов сессии; при create=False - только если он уже в памяти"""
+        def build() -> QuestionScheduler:
+            flow = self.get_question_flow()
+            return flow.scheduler(answers_from_responses(self.get_user_responses(user, session_id)))
+        return self._session_cached(self._schedulers, user, session_id, build if create else None)
+    
+    def get_session_derived(self, user: int, session_id: int) -> SessionDerivedValues:
+        """Производные значения сессии (уровни ответов, P1, варианты Q11/Q12, компоненты грейда)"""
+        def build() -> SessionDerivedValues:
+            levels = {}
+            for response in self.get_user_responses(user, session_id):
+                level = answer_level(response['final_answer'])
+                if level is not None:
+                    levels[response['question']] = level
+            return SessionDerivedValues(self, self.get_dependency_graph(), levels)
+        return self._session_cached(self._derived, user, session_id, build)
+    
     def get_remaining_questions(self, user: int, session_id: int) -> List[int]:
         """Получение списка вопросов, которые нужно задать пользователю в текущей сессии"""
-        user_responses = self.get_user_responses(user, session_id)
-        answered_questions = {response['question'] for response in user_responses}
-        
-        all_questions = self.get_all_questions()
-        
-        remaining = []
-        for question in all_questions:
-            question_id = question['id']
-            
-            if question_id in answered_questions:
-                continue
-                
-            if question['show_conditions']:
-                if not self._should_show_question(question['show_conditions'], user_responses):
-                    continue
-                    
-            remaining.append(question_id)
-            
-        return sorted(remaining)
+        return self._get_scheduler(user, session_id).remaining()
     
     def _should_show_question(self, show_conditions_json: str, user_responses: List[Dict]) -> bool:
         """Проверяет, нужно ли показывать вопрос на основе условий"""
-        try:
-            conditions = json.loads(show_conditions_json)
-            if not conditions or 'show_if' not in conditions:
-                return True
-                
-            show_if = conditions['show_if']
-            
-            responses_dict = {}
-            for response in user_responses:
-                answer_value = response['final_answer'] if response['final_answer'] else response['answer']
-                responses_dict[f"question_{response['question']}"] = answer_value
-            
-            for condition_question, required_answers in show_if.items():
-                if condition_question not in responses_dict:
-                    return False
-                    
-                user_answer = responses_dict[condition_question]
-                if user_answer not in required_answers:
-                    return False
-                    
-            return True
-            
-        except (json.JSONDecodeError, KeyError, TypeError):
-            return True
+        return should_show_question(show_conditions_json, user_responses)
     
     def get_question_variants(self, question_num: int, p1_value: int, q11_answer: int = None) -> List[Dict]:
         """
@@ -391,11 +502,11 @@ class Database:
                         'variant_text': variant_text,
                         'answer_value': answer_value
                     })
-                
+            
             elif question_num == 12:
                 # Для Q12 нужен ответ на Q11
                 if q11_answer is None:
-                    print(f"⚠️ Для Q12 нужен ответ на Q11")
+                    logger.warning("⚠️ Для Q12 нужен ответ на Q11")
                     return []
                 
                 # Получаем варианты Q12 для данного P1 и ответа Q11
@@ -415,7 +526,7 @@ class Database:
                     })
             else:
                 # Для других вопросов возвращаем пустой список
-                print(f"⚠️ Адаптивные варианты доступны только для Q11 и Q12")
+                logger.warning("⚠️ Адаптивные варианты доступны только для Q11 и Q12")
                 return []
             
             return variants
@@ -454,44 +565,15 @@ class Database:
                 except (ValueError, TypeError):
                     # Если не удается преобразовать, пропускаем
                     continue
-                    
+            
             return answers
     
     def reset_questions_from_8(self, user_id: int, session_id: int) -> None:
         """
-        Деактивировать ответы на вопросы 8-12 и добавить их обратно в remaining_questions
-        1. UPDATE responses SET status='inactive' WHERE question IN (8,9,10,11,12)
-        2. Добавить 8,9,10,11,12 в remaining_questions текущего состояния
+        Переответить с 8-го вопроса: деактивировать ответы на вопросы 8-10 и все зависящие
+        от них (Q11/Q12 через P1 и варианты) и вернуть их в remaining_questions
         """
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            
-            # 1. Деактивируем ответы на вопросы 8-12
-            cursor.execute("""
-                UPDATE responses 
-                SET status = 'inactive' 
-                WHERE user = ? AND session_id = ? AND question IN (8, 9, 10, 11, 12)
-            """, (user_id, session_id))
-            
-            conn.commit()
-        
-        # 2. Обновляем состояние пользователя - добавляем вопросы обратно в remaining
-        state = self.get_user_state(user_id, session_id)
-        if state and 'remaining_questions' in state:
-            # Добавляем вопросы 8-12, если их еще нет в remaining
-            questions_to_add = [8, 9, 10, 11, 12]
-            existing_ids = state['remaining_questions']
-            
-            for question_id in questions_to_add:
-                if question_id not in existing_ids:
-                    existing_ids.append(question_id)
-            
-            # Сортируем для правильного порядка
-            state['remaining_questions'] = sorted(existing_ids)
-            
-            # Сохраняем обновленное состояние
-            self.save_user_state(user_id, session_id, state)
+        self.invalidate_questions(user_id, session_id, [8, 9, 10])
     
     def update_session_portrait(self, user_id: int, session_id: int, portrait: str) -> None:
         """Обновляет портрет пользователя в последней записи сессии"""
@@ -548,7 +630,7 @@ class Database:
         
         if not portrait_parts:
             return None
-            
+        
         # Объединяем все части с разделителем
         portrait = "\n\n".join(portrait_parts)
         
@@ -628,4 +710,3 @@ class Database:
             return result[0] == 0 if result else True
 
 
- 
\ No newline at end of file
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Кэш объяснений конфликтов по правилу и семейству должностей
+
+Объяснение одного и того же правила конфликта для похожих должностей почти не меняется,
+поэтому оно генерируется один раз на пару (правило, семейство должностей) и дальше
+показывается сразу, без запроса к LLM. Семейство определяется по ответу на Q1 (название
+должности) грубым сопоставлением ключевых слов - в промпт попадает только обобщенное
+описание семейства, не данные конкретного пользователя.
+
+Ключ записи - хэш промпта (тексты условий правила + семейство + шаблон), поэтому после
+изменения правил или шаблона объяснения генерируются заново.
+
+Промах: пользователь получает объяснение по своему портрету, как раньше, а обобщенное
+объяснение для кэша готовится в фоне. Попадание: объяснение из кэша сразу; при
+CONFLICT_EXPLANATION_PERSONALIZE персональное объяснение готовится в фоне и заменяет его.
+
+Заполнение кэша заранее для частых семейств и правил:
+    python explanation_cache.py --prewarm --llm gigachat --top 30
+    python explanation_cache.py --stats
+"""
+
+import argparse
+import contextvars
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from config import LLM_CACHE_PATH, CONFLICT_EXPLANATION_CACHE_ENABLED
+from app_logging import get_logger
+
+logger = get_logger('conflicts')
+
+# (ключ, описание для промпта, основы слов в названии должности) - первое совпадение выигрывает
+ROLE_FAMILIES: Tuple[Tuple[str, str, Tuple[str, ...]], ...] = (
+    ('top_manager', "Руководитель высшего звена (генеральный директор, директор направления, заместитель)",
+     ('генеральн', 'ceo', 'cfo', 'cto', 'директор', 'заместител', 'вице', 'президент', 'партнер')),
+    ('manager', "Руководитель подразделения (начальник отдела, руководитель группы)",
+     ('руководител', 'начальник', 'заведующ', 'head', 'лид', 'lead', 'мастер', 'бригадир', 'управляющ')),
+    ('expert', "Эксперт (архитектор, аналитик, главный или ведущий специалист)",
+     ('архитектор', 'аналитик', 'эксперт', 'главн', 'ведущ', 'старш', 'консультант', 'методолог')),
+    ('specialist', "Специалист (менеджер, инженер, бухгалтер, юрист)",
+     ('специалист', 'менеджер', 'инженер', 'разработчик', 'программист', 'бухгалтер', 'юрист', 'экономист',
+      'маркетолог', 'дизайнер', 'технолог', 'рекрутер', 'логист', 'аудитор')),
+    ('staff', "Исполнитель (оператор, ассистент, сотрудник линейного персонала)",
+     ('оператор', 'ассистент', 'секретар', 'помощник', 'кассир', 'водитель', 'курьер', 'рабоч', 'стажер',
+      'продавец', 'администратор', 'делопроизводител'))
+)
+GENERAL_FAMILY = 'general'
+GENERAL_TITLE = "Сотрудник организации"
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="explanations")
+
+
+def role_family(position: Optional[str]) -> str:
+    """Семейство должностей по названию должности (ответу на Q1)"""
+    if position:
+        text = ' ' + re.sub(r'[^\w]+', ' ', position.lower().replace('ё', 'е')) + ' '
+        for family, _, stems in ROLE_FAMILIES:
+            if any(' ' + stem in text for stem in stems):
+                return family
+    return GENERAL_FAMILY
+
+
+def role_title(family: str) -> str:
+    for key, title, _ in ROLE_FAMILIES:
+        if key == family:
+            return title
+    return GENERAL_TITLE
+
+
+def generic_prompt(conflict: Dict, family: str) -> str:
+    """Промпт объяснения с обобщенным портретом семейства вместо портрета пользователя"""
+    from conflictator import ConflictDetector
+    portrait = f"Вопрос 1: Должность\n→ Ответ: {role_title(family)}"
+    return ConflictDetector.generate_conflict_explanation(conflict, portrait)
+
+
+class ConflictExplanationCache:
+    """Объяснения конфликтов на диске (таблица conflict_explanations базы кэша LLM)"""
+    
+    def __init__(self, db_path: str = LLM_CACHE_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # Ключи, для которых объяснение уже генерируется в фоне
+        self._pending = set()
+        
+        self.hits = 0
+        self.misses = 0
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS conflict_explanations (
+                    key TEXT PRIMARY KEY,
+                    conflict_id INTEGER,
+                    role_family TEXT NOT NULL,
+                    explanation TEXT NOT NULL,
+                    model TEXT,
+                    created_at REAL NOT NULL,
+                    hits INTEGER DEFAULT 0
+                )
+            """)
+            conn.commit()
+    
+    @staticmethod
+    def make_key(conflict: Dict, family: str) -> str:
+        return hashlib.sha256(generic_prompt(conflict, family).encode('utf-8')).hexdigest()
+    
+    def get(self, conflict: Dict, family: str) -> Optional[str]:
+        """Объяснение из кэша (None - еще не сгенерировано)"""
+        key = self.make_key(conflict, family)
+        with self._lock, sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("SELECT explanation FROM conflict_explanations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE conflict_explanations SET hits = hits + 1 WHERE key = ?", (key,))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+    
+    def contains(self, conflict: Dict, family: str) -> bool:
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute("SELECT 1 FROM conflict_explanations WHERE key = ?",
+                                (self.make_key(conflict, family),)).fetchone() is not None
+    
+    def put(self, conflict: Dict, family: str, explanation: str, model: str = None) -> None:
+        with self._lock, sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO conflict_explanations (key, conflict_id, role_family, explanation, model, created_at, hits)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            """, (self.make_key(conflict, family), conflict.get('id'), family, explanation, model, time.time()))
+            conn.commit()
+    
+    def generate(self, llm, conflict: Dict, family: str) -> str:
+        """Сгенерировать обобщенное объяснение и сохранить его (ошибки LLM пробрасываются)"""
+        messages = [{"role": "user", "content": generic_prompt(conflict, family)}]
+        explanation = llm.generate_response(messages, task_type='explanation').strip()
+        if explanation:
+            self.put(conflict, family, explanation, getattr(llm, 'model', None))
+        return explanation
+    
+    def generate_in_background(self, llm, conflict: Dict, family: str) -> None:
+        """Сгенерировать объяснение для кэша в фоне (повторные вызовы до готовности игнорируются)"""
+        key = self.make_key(conflict, family)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        
+        def run():
+            try:
+                self.generate(llm, conflict, family)
+                logger.info("💾 Объяснение конфликта %s для семейства %s сохранено в кэш", conflict.get('id'), family)
+            except Exception as e:
+                logger.warning("⚠️ Не удалось подготовить объяснение конфликта %s: %s", conflict.get('id'), e)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+        
+        _executor.submit(contextvars.copy_context().run, run)
+    
+    def get_stats(self) -> Dict:
+        with sqlite3.connect(self.db_path) as conn:
+            entries = conn.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM conflict_explanations").fetchone()
+            families = dict(conn.execute("""
+                SELECT role_family, COUNT(*) FROM conflict_explanations GROUP BY role_family ORDER BY 2 DESC
+            """).fetchall())
+        total = self.hits + self.misses
+        return {
+            'entries': entries[0],
+            'stored_hits': entries[1],
+            'families': families,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0
+        }
+
+
+_explanation_cache = None
+_explanation_cache_lock = threading.Lock()
+
+
+def get_explanation_cache() -> Optional[ConflictExplanationCache]:
+    """Общий экземпляр кэша объяснений (None, если он выключен)"""
+    global _explanation_cache
+    if not CONFLICT_EXPLANATION_CACHE_ENABLED:
+        return None
+    with _explanation_cache_lock:
+        if _explanation_cache is None:
+            _explanation_cache = ConflictExplanationCache()
+        return _explanation_cache
+
+
+def common_families(db_path: str) -> List[Tuple[str, int]]:
+    """Семейства по ответам на Q1 прошлых сессий и должностям штатного расписания, по частоте"""
+    counts = Counter()
+    with sqlite3.connect(db_path) as conn:
+        conn.text_factory = str
+        for (answer,) in conn.execute("SELECT answer FROM responses WHERE question = 1 AND status = 'active'"):
+            counts[role_family(answer)] += 1
+        try:
+            # Листья иерархии - должности
+            for (role,) in conn.execute("""
+                SELECT role FROM shtat_hierarchy h
+                WHERE NOT EXISTS (SELECT 1 FROM shtat_hierarchy c WHERE c.id_rod = h.id)
+            """):
+                counts[role_family(role)] += 1
+        except sqlite3.OperationalError:
+            pass
+    return counts.most_common()
+
+
+def prewarm(db_path: str, llm_type: str, families: List[str], top: int, workers: int) -> Dict:
+    """Сгенерировать недостающие объяснения для правил (самые частые по прошлым сессиям - первыми)"""
+    from conflict_audit import audit
+    from conflictator import get_conflict_rules
+    from llm_services import LLMFactory
+    
+    cache = ConflictExplanationCache()
+    conflicts = get_conflict_rules(db_path).all_conflicts()
+    # Порядок правил - по числу прошлых сессий, в которых они срабатывают
+    frequency = {rule['conflict_id']: rule['sessions'] for rule in audit(db_path)['per_rule']}
+    conflicts.sort(key=lambda conflict: -frequency.get(conflict['id'], 0))
+    if top:
+        conflicts = conflicts[:top]
+    
+    llm = LLMFactory.create_service(llm_type)
+    jobs = [(conflict, family) for conflict in conflicts for family in families
+            if not cache.contains(conflict, family)]
+    print(f"🔥 Правил: {len(conflicts)}, семейств: {len(families)}, генерируем объяснений: {len(jobs)}")
+    
+    generated = 0
+    failed = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, cache.generate, llm, conflict, family)
+                   for conflict, family in jobs]
+        for (conflict, family), future in zip(jobs, futures):
+            try:
+                future.result()
+                generated += 1
+            except Exception as e:
+                failed += 1
+                print(f"❌ Конфликт {conflict['id']}, {family}: {e}")
+    
+    return {'generated': generated, 'failed': failed, 'duration_s': round(time.perf_counter() - started, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Кэш объяснений конфликтов")
+    parser.add_argument("--db", default="data/database.db")
+    parser.add_argument("--prewarm", action="store_true", help="Сгенерировать недостающие объяснения")
+    parser.add_argument("--llm", default="gigachat", help="gigachat или openai")
+    parser.add_argument("--families", help="Семейства через запятую (по умолчанию - встречающиеся в базе)")
+    parser.add_argument("--top", type=int, default=0, help="Только N самых частых правил (0 - все)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--stats", action="store_true", help="Статистика кэша")
+    args = parser.parse_args()
+    
+    if args.prewarm:
+        if args.families:
+            families = [family.strip() for family in args.families.split(",") if family.strip()]
+        else:
+            families = [family for family, _ in common_families(args.db)] or [GENERAL_FAMILY]
+        result = prewarm(args.db, args.llm, families, args.top, args.workers)
+        print(f"✅ Сгенерировано: {result['generated']}, ошибок: {result['failed']}, за {result['duration_s']} с")
+    
+    if args.stats or not args.prewarm:
+        stats = ConflictExplanationCache().get_stats()
+        print(f"📊 Объяснений в кэше: {stats['entries']}, показов из кэша: {stats['stored_hits']}")
+        for family, count in stats['families'].items():
+            print(f"   {family}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Заготовки функционала Q18 по должностям штатного расписания
+
+Функционал Q18 генерируется в конце интервью, и пользователь ждет ответа LLM. Для каждой
+должности-листа иерархии shtat_hierarchy функционал можно сгенерировать заранее: бот
+подбирает должность по ответу на Q1 (совпадение основ слов с названием должности и
+подразделений из full_path) и сразу показывает ее заготовку. При FUNCTIONALITY_DRAFT_REFINE
+функционал по портрету сессии готовится в фоне и заменяет заготовку в том же сообщении.
+
+В промпт заготовки кроме должности и пути в структуре попадает функционал, подтвержденный
+пользователями в завершенных сессиях той же должности. Заготовка перегенерируется, когда
+таких сессий становится на FUNCTIONALITY_DRAFT_REFRESH_SESSIONS больше, чем при прошлой
+генерации - при пакетном запуске и в фоне после завершения сессии ботом.
+
+Заготовки хранятся в таблице functionality_drafts базы кэша LLM (ключ - full_path должности):
+    python functionality_drafts.py --build --llm gigachat
+    python functionality_drafts.py --match "Руководитель отдела операций"
+    python functionality_drafts.py --stats
+"""
+
+import argparse
+import contextvars
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import (LLM_CACHE_PATH, FUNCTIONALITY_DRAFTS_ENABLED, FUNCTIONALITY_DRAFT_MIN_SCORE,
+                    FUNCTIONALITY_DRAFT_REFRESH_SESSIONS)
+from app_logging import get_logger
+
+logger = get_logger('agents')
+
+# Сколько последних подтвержденных функционалов должности попадает в промпт заготовки
+MAX_EXAMPLES = 3
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="functionality-drafts")
+
+
+def _stems(text: Optional[str]) -> Set[str]:
+    """Основы слов (первые 5 букв) без коротких слов и чисел"""
+    if not text:
+        return set()
+    words = re.findall(r'[^\W\d_]+', text.lower().replace('ё', 'е'))
+    return {word[:5] for word in words if len(word) >= 3}
+
+
+def leaf_roles(db_path: str) -> List[Dict]:
+    """Должности - листья иерархии штата: [{id, role, full_path}] в порядке id"""
+    with sqlite3.connect(db_path) as conn:
+        conn.text_factory = str
+        try:
+            rows = conn.execute("""
+                SELECT id, role, full_path FROM shtat_hierarchy h
+                WHERE NOT EXISTS (SELECT 1 FROM shtat_hierarchy c WHERE c.id_rod = h.id)
+                ORDER BY id
+            """).fetchall()
+        except sqlite3.OperationalError:
+            return []
+    return [{'id': row[0], 'role': row[1], 'full_path': row[2] or row[1]} for row in rows]
+
+
+class RoleMatcher:
+    """Подбор должности иерархии по названию должности из ответа на Q1"""
+    
+    def __init__(self, roles: List[Dict]):
+        self.roles = []
+        for role in roles:
+            # Первый элемент пути - организация, последний - сама должность
+            departments = role['full_path'].split(' -> ')[1:-1]
+            self.roles.append((role, _stems(role['role']), _stems(' '.join(departments))))
+        # Слова названий всех должностей: такое слово в ответе, которого нет у должности, указывает на другую
+        self.role_vocabulary = set().union(*(role_words for _, role_words, _ in self.roles))
+    
+    def match(self, position: Optional[str]) -> Tuple[Optional[Dict], float]:
+        """
+        Лучшая должность и оценка 0..1
+
+        Оценка - доля основ ответа, найденных в названии должности или ее подразделений,
+        умноженная на долю основ названия должности, найденных в ответе, и на 0.5 за каждое
+        слово ответа из названий других должностей ("заместитель" для "Генеральный директор").
+        Ответ должен совпадать хотя бы с одним словом названия должности. При равенстве - меньший id.
+        """
+        words = _stems(position)
+        best, best_score = None, 0.0
+        if not words:
+            return best, best_score
+        for role, role_words, department_words in self.roles:
+            role_hits = len(words & role_words)
+            if not role_hits:
+                continue
+            department_hits = len((words - role_words) & department_words)
+            foreign = len((words & self.role_vocabulary) - role_words - department_words)
+            score = (role_hits + department_hits) / len(words) * role_hits / len(role_words) * 0.5 ** foreign
+            if score > best_score:
+                best, best_score = role, score
+        return best, best_score
+
+
+def completed_functionality(db_path: str, matcher: RoleMatcher) -> Dict[str, List[str]]:
+    """Подтвержденный функционал Q18 завершенных сессий по должностям: {full_path: [тексты, новые первыми]}"""
+    by_role: Dict[str, List[str]] = {}
+    with sqlite3.connect(db_path) as conn:
+        conn.text_factory = str
+        rows = conn.execute("""
+            SELECT COALESCE(r1.final_answer, r1.answer), COALESCE(r18.final_answer, r18.answer)
+            FROM responses r18
+            JOIN responses r1 ON r1.user = r18.user AND r1.session_id = r18.session_id
+                             AND r1.question = 1 AND r1.status = 'active'
+            WHERE r18.question = 18 AND r18.status = 'active'
+            ORDER BY r18.id DESC
+        """).fetchall()
+    for position, functionality in rows:
+        role, score = matcher.match(position)
+        if role is not None and score >= FUNCTIONALITY_DRAFT_MIN_SCORE and functionality:
+            by_role.setdefault(role['full_path'], []).append(functionality.strip())
+    return by_role
+
+
+class FunctionalityDrafts:
+    """Заготовки функционала должностей (таблица functionality_drafts базы кэша LLM)"""
+    
+    def __init__(self, db_path: str, cache_path: str = LLM_CACHE_PATH):
+        """
+        Args:
+            db_path: основная база (иерархия штата, ответы сессий)
+            cache_path: база, в которой хранятся заготовки
+        """
+        self.db_path = db_path
+        self.cache_path = cache_path
+        self.matcher = RoleMatcher(leaf_roles(db_path))
+        self._lock = threading.Lock()
+        # Должности, заготовки которых уже обновляются в фоне
+        self._pending = set()
+        
+        self.hits = 0
+        self.misses = 0
+        
+        with sqlite3.connect(self.cache_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS functionality_drafts (
+                    full_path TEXT PRIMARY KEY,
+                    role TEXT NOT NULL,
+                    draft TEXT NOT NULL,
+                    sessions INTEGER DEFAULT 0,
+                    model TEXT,
+                    created_at REAL NOT NULL,
+                    hits INTEGER DEFAULT 0
+                )
+            """)
+            conn.commit()
+    
+    def match(self, position: Optional[str]) -> Optional[Dict]:
+        """Должность для ответа на Q1 (None - ни одна не совпадает достаточно)"""
+        role, score = self.matcher.match(position)
+        return role if role is not None and score >= FUNCTIONALITY_DRAFT_MIN_SCORE else None
+    
+    def get(self, position: Optional[str]) -> Optional[Tuple[str, Dict]]:
+        """(заготовка, должность) для ответа на Q1; None - должность не найдена или заготовки еще нет"""
+        role = self.match(position)
+        if role is None:
+            self.misses += 1
+            return None
+        with self._lock, sqlite3.connect(self.cache_path) as conn:
+            row = conn.execute("SELECT draft FROM functionality_drafts WHERE full_path = ?",
+                               (role['full_path'],)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE functionality_drafts SET hits = hits + 1 WHERE full_path = ?", (role['full_path'],))
+            conn.commit()
+            self.hits += 1
+            return row[0], role
+    
+    def stored_draft(self, role: Dict) -> Optional[str]:
+        """Заготовка должности без учета показа"""
+        with sqlite3.connect(self.cache_path) as conn:
+            row = conn.execute("SELECT draft FROM functionality_drafts WHERE full_path = ?",
+                               (role['full_path'],)).fetchone()
+        return row[0] if row else None
+    
+    def stored_sessions(self) -> Dict[str, int]:
+        """Число подтвержденных функционалов, по которым построена каждая заготовка"""
+        with sqlite3.connect(self.cache_path) as conn:
+            return dict(conn.execute("SELECT full_path, sessions FROM functionality_drafts").fetchall())
+    
+    def put(self, role: Dict, draft: str, sessions: int, model: str = None) -> None:
+        with self._lock, sqlite3.connect(self.cache_path) as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO functionality_drafts (full_path, role, draft, sessions, model, created_at, hits)
+                VALUES (?, ?, ?, ?, ?, ?, COALESCE((SELECT hits FROM functionality_drafts WHERE full_path = ?), 0))
+            """, (role['full_path'], role['role'], draft, sessions, model, time.time(), role['full_path']))
+            conn.commit()
+    
+    @staticmethod
+    def is_stale(stored: Optional[int], sessions: int) -> bool:
+        """Заготовки нет или с прошлой генерации завершено достаточно новых сессий"""
+        return stored is None or sessions - stored >= max(1, FUNCTIONALITY_DRAFT_REFRESH_SESSIONS)
+    
+    def generate(self, llm, role: Dict, examples: List[str]) -> str:
+        """Сгенерировать заготовку должности и сохранить ее (ошибки LLM пробрасываются)"""
+        from processing_agents import FunctionalityAgent
+        draft = FunctionalityAgent(llm).generate_role_draft(role['role'], role['full_path'], examples[:MAX_EXAMPLES])
+        if draft:
+            self.put(role, draft, len(examples), getattr(llm, 'model', None))
+        return draft
+    
+    def refresh_in_background(self, llm, position: Optional[str]) -> None:
+        """
+        После завершения сессии: обновить в фоне заготовку ее должности, если она устарела
+        (повторные вызовы до готовности игнорируются)
+        """
+        role = self.match(position)
+        if role is None:
+            return
+        key = role['full_path']
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        
+        def run():
+            try:
+                examples = completed_functionality(self.db_path, self.matcher).get(key, [])
+                if not self.is_stale(self.stored_sessions().get(key), len(examples)):
+                    return
+                self.generate(llm, role, examples)
+                logger.info("💾 Заготовка функционала для должности '%s' обновлена (сессий: %s)", key, len(examples))
+            except Exception as e:
+                logger.warning("⚠️ Не удалось обновить заготовку функционала '%s': %s", key, e)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+        
+        _executor.submit(contextvars.copy_context().run, run)
+    
+    def get_stats(self) -> Dict:
+        with sqlite3.connect(self.cache_path) as conn:
+            entries = conn.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM functionality_drafts").fetchone()
+        total = self.hits + self.misses
+        return {
+            'roles': len(self.matcher.roles),
+            'entries': entries[0],
+            'stored_hits': entries[1],
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0
+        }
+
+
+_functionality_drafts: Dict[str, FunctionalityDrafts] = {}
+_functionality_drafts_lock = threading.Lock()
+
+
+def get_functionality_drafts(db_path: str) -> Optional[FunctionalityDrafts]:
+    """Заготовки для базы db_path (None, если они выключены)"""
+    if not FUNCTIONALITY_DRAFTS_ENABLED:
+        return None
+    with _functionality_drafts_lock:
+        drafts = _functionality_drafts.get(db_path)
+        if drafts is None:
+            drafts = _functionality_drafts[db_path] = FunctionalityDrafts(db_path)
+        return drafts
+
+
+def build(db_path: str, llm_type: str, workers: int, force: bool = False) -> Dict:
+    """Сгенерировать заготовки для должностей без заготовки или с устаревшей заготовкой"""
+    from llm_services import LLMFactory
+    
+    drafts = FunctionalityDrafts(db_path)
+    by_role = completed_functionality(db_path, drafts.matcher)
+    stored = drafts.stored_sessions()
+    roles = [role for role, _, _ in drafts.matcher.roles]
+    jobs = [role for role in roles
+            if force or drafts.is_stale(stored.get(role['full_path']), len(by_role.get(role['full_path'], [])))]
+    print(f"📋 Должностей: {len(roles)}, с завершенными сессиями: {len(by_role)}, генерируем заготовок: {len(jobs)}")
+    
+    llm = LLMFactory.create_service(llm_type)
+    generated = 0
+    failed = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, drafts.generate, llm, role,
+                               by_role.get(role['full_path'], []))
+                   for role in jobs]
+        for role, future in zip(jobs, futures):
+            try:
+                future.result()
+                generated += 1
+            except Exception as e:
+                failed += 1
+                print(f"❌ {role['full_path']}: {e}")
+    
+    return {'generated': generated, 'failed': failed, 'duration_s': round(time.perf_counter() - started, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заготовки функционала Q18 по должностям штатного расписания")
+    parser.add_argument("--db", default="data/database.db")
+    parser.add_argument("--build", action="store_true", help="Сгенерировать недостающие и устаревшие заготовки")
+    parser.add_argument("--force", action="store_true", help="Перегенерировать все заготовки")
+    parser.add_argument("--llm", default="gigachat", help="gigachat или openai")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--match", help="Показать должность и заготовку для названия должности")
+    parser.add_argument("--stats", action="store_true", help="Статистика заготовок")
+    args = parser.parse_args()
+    
+    if args.build:
+        result = build(args.db, args.llm, args.workers, args.force)
+        print(f"✅ Сгенерировано: {result['generated']}, ошибок: {result['failed']}, за {result['duration_s']} с")
+    
+    if args.match:
+        drafts = FunctionalityDrafts(args.db)
+        role, score = drafts.matcher.match(args.match)
+        if role is None:
+            print(f"❌ Должность для '{args.match}' не найдена")
+        else:
+            print(f"🔍 {role['full_path']} (оценка {score:.2f}, порог {FUNCTIONALITY_DRAFT_MIN_SCORE})")
+            draft = drafts.stored_draft(role)
+            print(draft if draft else "⚠️ Заготовки нет")
+    
+    if args.stats or not (args.build or args.match):
+        drafts = FunctionalityDrafts(args.db)
+        stats = drafts.get_stats()
+        stored = drafts.stored_sessions()
+        print(f"📊 Должностей: {stats['roles']}, заготовок: {stats['entries']}, показов: {stats['stored_hits']}")
+        for role, _, _ in drafts.matcher.roles:
+            sessions = stored.get(role['full_path'])
+            print(f"   {'✅' if sessions is not None else '—'} {role['full_path']}"
+                  + (f" (сессий: {sessions})" if sessions else ""))
+
+
+if __name__ == "__main__":
+    main()
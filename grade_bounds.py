@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Границы итогового параметра p и грейда по неполному набору ответов
+
+total_p = p1 + p3(p1, p2) + p4 складывается из двух независимых частей:
+- "передняя" - p1 + p3 по ответам Q8-Q12 (p1 из grading_p1, p2 из grading_p2, p3 из grading_p3);
+- "задняя" - p4 по ответам Q13, Q14 или Q15, Q16 (grading_p4_14 / grading_p4_15).
+
+Для каждой части при загрузке перебираются все строки таблиц и для каждого набора
+отвеченных вопросов (маски) заранее считаются min/max по неотвеченным. Запрос - два
+поиска в словаре и проход по шкале грейдов, без обращений к базе.
+
+Варианты Q11/Q12 зависят от P1 (question_variants_q11_q12), поэтому неотвеченные Q11/Q12
+сначала перебираются только среди предлагаемых ботом вариантов; если ответы в них
+не укладываются (например, дан свободный ответ), используются все строки grading_p2.
+
+Самопроверка (сравнение с полным перебором) и замер времени:
+    python grade_bounds.py --samples 2000
+"""
+
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from grade_calculator import get_grading_tables
+
+FRONT_QUESTIONS = (8, 9, 10, 11, 12)
+BACK_QUESTIONS = (13, 14, 15, 16)
+GRADING_QUESTIONS = FRONT_QUESTIONS + BACK_QUESTIONS
+
+
+def _mask_index(rows: Iterable[Tuple[tuple, int]], dims: int) -> Dict[int, Dict[tuple, Tuple[int, int]]]:
+    """Для каждой маски известных измерений: значения известных -> (min, max) по остальным"""
+    rows = list(rows)
+    index = {}
+    for mask in range(1 << dims):
+        positions = [i for i in range(dims) if mask >> i & 1]
+        table: Dict[tuple, Tuple[int, int]] = {}
+        for key, value in rows:
+            sub = tuple(key[i] for i in positions)
+            bounds = table.get(sub)
+            table[sub] = (value, value) if bounds is None else (min(bounds[0], value), max(bounds[1], value))
+        index[mask] = table
+    return index
+
+
+def _lookup(index: Dict[int, Dict[tuple, Tuple[int, int]]], questions: Tuple[int, ...],
+            levels: Dict[int, int]) -> Optional[Tuple[int, int]]:
+    mask = 0
+    sub = []
+    for i, question_id in enumerate(questions):
+        if question_id in levels:
+            mask |= 1 << i
+            sub.append(levels[question_id])
+    return index[mask].get(tuple(sub))
+
+
+class GradeBounds:
+    """Предвычисленные границы частей total_p для базы"""
+    
+    def __init__(self, db_path: str):
+        tables = get_grading_tables(db_path)
+        self.scale = tables.scale
+        
+        with sqlite3.connect(db_path) as conn:
+            conn.text_factory = str
+            variant_pairs: Dict[int, set] = {}
+            for p1_value, q11, q12 in conn.execute(
+                    "SELECT p1_value, q11_answer_value, q12_answer_value FROM question_variants_q11_q12"):
+                variant_pairs.setdefault(p1_value, set()).add((q11, q12))
+        
+        # Передняя часть: (Q8, Q9, Q10, Q11, Q12) -> p1 + p3, только для существующих p3
+        front_all = []
+        front_offered = []
+        for (q8, q9, q10), p1 in tables.p1.items():
+            if p1 is None:
+                continue
+            offered = variant_pairs.get(p1)
+            for (q11, q12), p2 in tables.p2.items():
+                p3 = tables.p3.get((float(p1), p2)) if p2 is not None else None
+                if p3 is None:
+                    continue
+                row = ((q8, q9, q10, q11, q12), p1 + p3)
+                front_all.append(row)
+                if offered is None or (q11, q12) in offered:
+                    front_offered.append(row)
+        self.front_rows = (front_offered, front_all)
+        self.front_all = _mask_index(front_all, len(FRONT_QUESTIONS))
+        self.front_offered = _mask_index(front_offered, len(FRONT_QUESTIONS))
+        
+        # Задняя часть: (Q13, Q14, Q15, Q16) -> p4; в ветке Q14 ответа на Q15 нет и наоборот
+        back = [((q13, q14, None, q16), p4) for (q16, q13, q14), p4 in tables.p4_14.items() if p4 is not None]
+        back += [((q13, None, q15, q16), p4) for (q16, q13, q15), p4 in tables.p4_15.items() if p4 is not None]
+        self.back_rows = back
+        self.back = _mask_index(back, len(BACK_QUESTIONS))
+    
+    def total_range(self, levels: Dict[int, int]) -> Optional[Tuple[int, int]]:
+        """(min, max) достижимого total_p; None - ответы не дают ни одной строки таблиц"""
+        if 14 in levels and 15 in levels:
+            # Как в GradeCalculator: при обоих ответах p4 считается по Q14
+            levels = {question_id: level for question_id, level in levels.items() if question_id != 15}
+        front = _lookup(self.front_offered, FRONT_QUESTIONS, levels) or _lookup(self.front_all, FRONT_QUESTIONS, levels)
+        back = _lookup(self.back, BACK_QUESTIONS, levels)
+        if front is None or back is None:
+            return None
+        return front[0] + back[0], front[1] + back[1]
+    
+    def bounds(self, levels: Dict[int, int]) -> Optional[Dict]:
+        """
+        Границы total_p и грейда по уровням ответов {вопрос: число}
+
+        Возвращает: total_min, total_max, grades (грейды шкалы в диапазоне, по возрастанию),
+        grade_min, grade_max, determined (грейд уже однозначен), open_questions
+        (неотвеченные вопросы, влияющие на грейд); None - грейд недостижим
+        """
+        total_range = self.total_range(levels)
+        if total_range is None:
+            return None
+        total_min, total_max = total_range
+        
+        grades: List[str] = []
+        for low, _, high, grade in self.scale:
+            if low <= total_max and high >= total_min:
+                label = grade if grade else "—"
+                if not grades or grades[-1] != label:
+                    grades.append(label)
+        
+        open_questions = [question_id for question_id in GRADING_QUESTIONS if question_id not in levels]
+        if 14 in levels or 15 in levels:
+            open_questions = [question_id for question_id in open_questions if question_id not in (14, 15)]
+        return {
+            'total_min': total_min,
+            'total_max': total_max,
+            'grades': grades,
+            'grade_min': grades[0] if grades else None,
+            'grade_max': grades[-1] if grades else None,
+            'determined': len(set(grades)) == 1,
+            'open_questions': open_questions
+        }
+
+
+_grade_bounds: Dict[str, GradeBounds] = {}
+_grade_bounds_lock = threading.Lock()
+
+
+def get_grade_bounds(db_path: str) -> GradeBounds:
+    """Границы для базы db_path (предвычисляются при первом обращении)"""
+    with _grade_bounds_lock:
+        engine = _grade_bounds.get(db_path)
+        if engine is None:
+            engine = _grade_bounds[db_path] = GradeBounds(db_path)
+        return engine
+
+
+def _self_check(db_path: str, samples: int, seed: int) -> int:
+    """Сравнение границ с полным перебором на случайных неполных наборах ответов"""
+    import random
+    import time
+    
+    engine = get_grade_bounds(db_path)
+    rng = random.Random(seed)
+    
+    front_offered, front_all = engine.front_rows
+    back = engine.back_rows
+    
+    def brute(rows, questions, levels):
+        values = [value for key, value in rows
+                  if all(question_id not in levels or key[i] == levels[question_id]
+                         for i, question_id in enumerate(questions))]
+        return (min(values), max(values)) if values else None
+    
+    failures = 0
+    cases = []
+    for _ in range(samples):
+        front_key, _ = rng.choice(front_all)
+        back_key, _ = rng.choice(back)
+        levels = {question_id: value
+                  for question_id, value in zip(FRONT_QUESTIONS + BACK_QUESTIONS, front_key + back_key)
+                  if value is not None and rng.random() < 0.5}
+        if rng.random() < 0.1:
+            levels[rng.choice(GRADING_QUESTIONS)] = rng.randint(1, 9)
+        cases.append(levels)
+        
+        levels_14 = {q: v for q, v in levels.items() if not (q == 15 and 14 in levels)}
+        front = brute(front_offered, FRONT_QUESTIONS, levels_14) or brute(front_all, FRONT_QUESTIONS, levels_14)
+        back_range = brute(back, BACK_QUESTIONS, levels_14)
+        expected = None if front is None or back_range is None else (front[0] + back_range[0], front[1] + back_range[1])
+        if engine.total_range(levels) != expected:
+            failures += 1
+            if failures <= 5:
+                print(f"❌ Ответы {levels}: перебор {expected}, границы {engine.total_range(levels)}")
+    
+    started = time.perf_counter()
+    for levels in cases:
+        engine.bounds(levels)
+    per_call = (time.perf_counter() - started) / len(cases) * 1e6 if cases else 0.0
+    
+    print(f"{'✅' if not failures else '❌'} Наборов ответов: {len(cases)}, расхождений: {failures}, "
+          f"bounds(): {per_call:.1f} мкс на вызов")
+    return failures
+
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Самопроверка границ грейда")
+    parser.add_argument("--db", default="data/database.db")
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    raise SystemExit(1 if _self_check(args.db, args.samples, args.seed) else 0)
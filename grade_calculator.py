@@ -1,13 +1,106 @@
 #!/usr/bin/env python3
 import sqlite3
+import threading
 from typing import Optional, Dict, List, Tuple
 
+from app_logging import get_logger
+from reference_version import reference_version
+
+logger = get_logger('reports')
+
+class GradingTables:
+    """
+    Таблицы грейдинга (grading_p1 ... grading_scale) в памяти
+
+    Загружаются один раз на процесс для каждой базы; таблицы меняются только
+    скриптами импорта, после которых бот перезапускается.
+    """
+    
+    def __init__(self, db_path: str):
+        with sqlite3.connect(db_path) as conn:
+            conn.text_factory = str
+            cursor = conn.cursor()
+            
+            # При повторяющихся ключах берется первая строка - как fetchone() в прежних запросах
+            self.p1: Dict[Tuple, int] = {}
+            for answer_q8, answer_q9, answer_q10, p1_value in cursor.execute(
+                    "SELECT answer_q8, answer_q9, answer_q10, p1_value FROM grading_p1 ORDER BY id"):
+                self.p1.setdefault((answer_q8, answer_q9, answer_q10), p1_value)
+            
+            self.p2: Dict[Tuple, int] = {}
+            for answer_q11, answer_q12, p2_value in cursor.execute(
+                    "SELECT answer_q11, answer_q12, p2_value FROM grading_p2 ORDER BY id"):
+                self.p2.setdefault((answer_q11, answer_q12), p2_value)
+            
+            self.p3: Dict[Tuple, int] = {}
+            for p1_value, p2_value, p3_value in cursor.execute(
+                    "SELECT p1_value, p2_value, p3_value FROM grading_p3 ORDER BY id"):
+                self.p3.setdefault((p1_value, p2_value), p3_value)
+            
+            self.p4_14: Dict[Tuple, int] = {}
+            for answer_q16, answer_q13, answer_q14, p4_value in cursor.execute(
+                    "SELECT answer_q16, answer_q13, answer_q14, p4_value FROM grading_p4_14 ORDER BY id"):
+                self.p4_14.setdefault((answer_q16, answer_q13, answer_q14), p4_value)
+            
+            self.p4_15: Dict[Tuple, int] = {}
+            for answer_q16, answer_q13, answer_q15, p4_value in cursor.execute(
+                    "SELECT answer_q16, answer_q13, answer_q15, p4_value FROM grading_p4_15 ORDER BY id"):
+                self.p4_15.setdefault((answer_q16, answer_q13, answer_q15), p4_value)
+            
+            # Строки шкалы с обеими границами, по возрастанию нижней границы
+            self.scale: List[Tuple] = [row for row in cursor.execute("""
+                SELECT low_bound, mid_point, high_bound, sber_grade
+                FROM grading_scale
+                WHERE low_bound IS NOT NULL AND high_bound IS NOT NULL
+                ORDER BY low_bound, id
+            """)]
+    
+    def grade(self, total_p) -> Optional[Dict]:
+        """Строка шкалы, в диапазон которой попадает итоговый параметр p"""
+        for low, mid, high, grade in self.scale:
+            if low <= total_p <= high:
+                return {
+                    "low": low,
+                    "mid": mid,
+                    "high": high,
+                    "grade": grade if grade else "—"
+                }
+        return None
+
+
+# db_path -> (версия справочников, таблицы)
+_grading_tables: Dict[str, Tuple[int, GradingTables]] = {}
+_grading_tables_lock = threading.Lock()
+
+
+def get_grading_tables(db_path: str) -> GradingTables:
+    """Таблицы грейдинга базы db_path (перечитываются, когда update_grading_tables.py меняет версию справочников)"""
+    version = reference_version(db_path)
+    with _grading_tables_lock:
+        cached = _grading_tables.get(db_path)
+        if cached is None or cached[0] != version:
+            cached = _grading_tables[db_path] = (version, GradingTables(db_path))
+        return cached[1]
+
+
+def answer_level(final_answer) -> Optional[int]:
+    """Уровень ответа (final_answer как число) или None, если ответ не числовой"""
+    try:
+        return int(final_answer)
+    except (ValueError, TypeError):
+        return None
+
+
 class GradeCalculator:
     """Класс для расчета грейда пользователя по алгоритму"""
     
     def __init__(self, db_path: str = "data/database.db"):
         self.db_path = db_path
     
+    @property
+    def tables(self) -> GradingTables:
+        return get_grading_tables(self.db_path)
+    
     def calculate_grade(self, user_id: int, session_id: int) -> Dict:
         """
         Основной метод расчета грейда для пользователя
@@ -77,7 +170,7 @@ class GradeCalculator:
                 return {"error": "Не удалось определить грейд"}
             
             return result
-            
+        
         except Exception as e:
             return {"error": f"Ошибка при расчете грейда: {str(e)}"}
     
@@ -97,13 +190,11 @@ class GradeCalculator:
             answers = {}
             
             for question_id, final_answer in results:
-                # Преобразуем final_answer в числовое значение
-                try:
-                    answers[question_id] = int(final_answer)
-                except (ValueError, TypeError):
-                    # Если не удается преобразовать, пропускаем
-                    continue
-                    
+                # Преобразуем final_answer в числовое значение, нечисловые пропускаем
+                level = answer_level(final_answer)
+                if level is not None:
+                    answers[question_id] = level
+            
             return answers
     
     def _calculate_p1(self, user_answers: Dict[int, int]) -> Optional[int]:
@@ -111,61 +202,27 @@ class GradeCalculator:
         # Проверяем наличие нужных ответов
         if 8 not in user_answers or 9 not in user_answers or 10 not in user_answers:
             return None
-            
-        answer_q8 = user_answers[8]
-        answer_q9 = user_answers[9] 
-        answer_q10 = user_answers[10]
         
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p1_value FROM grading_p1 
-                WHERE answer_q8 = ? AND answer_q9 = ? AND answer_q10 = ?
-            """, (answer_q8, answer_q9, answer_q10))
-            
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return self.tables.p1.get((user_answers[8], user_answers[9], user_answers[10]))
     
     def _calculate_p2(self, user_answers: Dict[int, int]) -> Optional[int]:
         """Вычислить p2 по таблице p2 (вопросы 11, 12)"""
         # Проверяем наличие нужных ответов
         if 11 not in user_answers or 12 not in user_answers:
             return None
-            
-        answer_q11 = user_answers[11]
-        answer_q12 = user_answers[12]
         
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p2_value FROM grading_p2 
-                WHERE answer_q11 = ? AND answer_q12 = ?
-            """, (answer_q11, answer_q12))
-            
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return self.tables.p2.get((user_answers[11], user_answers[12]))
     
     def _calculate_p3(self, p1: int, p2: int) -> Optional[int]:
         """Вычислить p3 по таблице поиска p3 (по уже вычисленным p1 и p2)"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p3_value FROM grading_p3 
-                WHERE p1_value = ? AND p2_value = ?
-            """, (float(p1), p2))
-            
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return self.tables.p3.get((float(p1), p2))
     
     def _calculate_p4(self, user_answers: Dict[int, int]) -> Optional[int]:
         """Вычислить p4 в зависимости от того, есть ли ответ на вопрос 14 или 15"""
         # Проверяем общие вопросы (13, 16)
         if 13 not in user_answers or 16 not in user_answers:
             return None
-            
+        
         answer_q13 = user_answers[13]
         answer_q16 = user_answers[16]
         
@@ -176,56 +233,31 @@ class GradeCalculator:
         # Проверяем есть ли ответ на вопрос 15
         if 15 in user_answers:
             return self._calculate_p4_by_q15(answer_q16, answer_q13, user_answers[15])
-            
+        
         return None
     
     def _calculate_p4_by_q14(self, answer_q16: int, answer_q13: int, answer_q14: int) -> Optional[int]:
         """Вычислить p4 по таблице p4-14"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p4_value FROM grading_p4_14 
-                WHERE answer_q16 = ? AND answer_q13 = ? AND answer_q14 = ?
-            """, (answer_q16, answer_q13, answer_q14))
-            
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return self.tables.p4_14.get((answer_q16, answer_q13, answer_q14))
     
     def _calculate_p4_by_q15(self, answer_q16: int, answer_q13: int, answer_q15: int) -> Optional[int]:
         """Вычислить p4 по таблице p4-15"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p4_value FROM grading_p4_15 
-                WHERE answer_q16 = ? AND answer_q13 = ? AND answer_q15 = ?
-            """, (answer_q16, answer_q13, answer_q15))
-            
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return self.tables.p4_15.get((answer_q16, answer_q13, answer_q15))
     
     def _determine_grade(self, total_p: int) -> Optional[Dict]:
         """Определить грейд по итоговому параметру p"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.text_factory = str
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT low_bound, mid_point, high_bound, sber_grade 
-                FROM grading_scale 
-                WHERE ? >= low_bound AND ? <= high_bound
-                ORDER BY low_bound
-            """, (total_p, total_p))
-            
-            result = cursor.fetchone()
-            if result:
-                return {
-                    "low": result[0],
-                    "mid": result[1], 
-                    "high": result[2],
-                    "grade": result[3] if result[3] else "—"
-                }
-            return None
+        return self.tables.grade(total_p)
+    
+    def calculate_components(self, user_answers: Dict[int, int]) -> Dict[str, Optional[int]]:
+        """Компоненты грейда p1-p4 по известным уровням ответов (None - пока не вычисляется)"""
+        p1 = self._calculate_p1(user_answers)
+        p2 = self._calculate_p2(user_answers)
+        return {
+            "p1": p1,
+            "p2": p2,
+            "p3": self._calculate_p3(p1, p2) if p1 is not None and p2 is not None else None,
+            "p4": self._calculate_p4(user_answers)
+        }
     
     def calculate_intermediate_p1(self, user_id: int, session_id: int) -> Optional[int]:
         """
@@ -244,21 +276,21 @@ class GradeCalculator:
             
             if not required_questions.issubset(available_questions):
                 missing = required_questions - available_questions
-                print(f"⚠️ Не хватает ответов на вопросы: {missing}")
+                logger.warning("⚠️ Не хватает ответов на вопросы: %s", missing)
                 return None
             
             # Вычисляем P1 используя существующую логику
             p1_value = self._calculate_p1(user_answers)
             
             if p1_value is not None:
-                print(f"✅ Промежуточный P1 = {p1_value}")
+                logger.debug("✅ Промежуточный P1 = %s", p1_value)
             else:
-                print("❌ Не удалось вычислить P1")
-                
-            return p1_value
+                logger.error("❌ Не удалось вычислить P1")
             
+            return p1_value
+        
         except Exception as e:
-            print(f"❌ Ошибка при расчёте промежуточного P1: {str(e)}")
+            logger.error("❌ Ошибка при расчёте промежуточного P1: %s", e)
             return None
 
 # Пример использования
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Чувствительность грейда к ответам на Q8-Q16 по всем сессиям
+
+Для каждой сессии с вычислимым грейдом ответ на каждый из вопросов Q8-Q16 по очереди
+сдвигается на уровень вверх и вниз, и грейд пересчитывается. Все сдвиги всех сессий
+считаются одним векторным проходом: таблицы грейдинга разворачиваются в массивы numpy,
+а p1-p4, total_p и грейд вычисляются для матрицы уровней (сессия x сдвиг) сразу,
+без вызовов GradeCalculator.calculate_grade.
+
+Результат:
+- по вопросам: сколько сессий допускают сдвиг, в скольких сдвиг меняет грейд
+  (вопрос "решающий"), средний сдвиг total_p и грейда;
+- по сессиям: грейд и список решающих вопросов.
+
+Сдвиг, для которого в таблицах нет строки (уровень вне шкалы, комбинация без значения p),
+считается недопустимым и в статистику не входит.
+
+Пример:
+    python grade_sensitivity.py --xlsx sensitivity.xlsx --json sensitivity.json
+    python grade_sensitivity.py --verify 200
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from grade_calculator import answer_level, get_grading_tables
+
+QUESTIONS = (8, 9, 10, 11, 12, 13, 14, 15, 16)
+COLUMN = {question_id: index for index, question_id in enumerate(QUESTIONS)}
+MISSING = -1
+
+
+def load_session_levels(db_path: str) -> Tuple[List[Tuple[int, int]], np.ndarray]:
+    """Сессии и матрица уровней активных ответов на Q8-Q16 (MISSING - нет числового ответа)"""
+    sessions: Dict[Tuple[int, int], int] = {}
+    rows = []
+    with sqlite3.connect(db_path) as conn:
+        conn.text_factory = str
+        for user, session_id, question, final_answer in conn.execute(f"""
+            SELECT user, session_id, question, final_answer
+            FROM responses
+            WHERE status = 'active' AND question IN ({', '.join(map(str, QUESTIONS))})
+            ORDER BY user, session_id, id
+        """):
+            index = sessions.setdefault((user, session_id), len(sessions))
+            level = answer_level(final_answer)
+            if level is not None:
+                rows.append((index, COLUMN[question], level))
+    
+    levels = np.full((len(sessions), len(QUESTIONS)), MISSING, dtype=np.int64)
+    if rows:
+        data = np.array(rows, dtype=np.int64)
+        levels[data[:, 0], data[:, 1]] = data[:, 2]
+    return list(sessions), levels
+
+
+class VectorGrading:
+    """Таблицы грейдинга в виде массивов: p1-p4, total_p и грейд для матрицы уровней"""
+    
+    def __init__(self, db_path: str):
+        tables = get_grading_tables(db_path)
+        self.p1 = self._dense(tables.p1)
+        self.p2 = self._dense(tables.p2)
+        self.p4_14 = self._dense(tables.p4_14)
+        self.p4_15 = self._dense(tables.p4_15)
+        
+        # p3 по (p1, p2): значения p1/p2 переводятся в индексы отсортированных списков
+        p3_items = [(key, value) for key, value in tables.p3.items()
+                    if None not in key and value is not None]
+        self.p3_p1_values = np.array(sorted({float(p1) for (p1, _), _ in p3_items}), dtype=np.float64)
+        self.p3_p2_values = np.array(sorted({float(p2) for (_, p2), _ in p3_items}), dtype=np.float64)
+        self.p3 = np.full((len(self.p3_p1_values), len(self.p3_p2_values)), np.nan)
+        for (p1, p2), value in p3_items:
+            self.p3[np.searchsorted(self.p3_p1_values, float(p1)),
+                    np.searchsorted(self.p3_p2_values, float(p2))] = value
+        
+        self.scale_low = np.array([row[0] for row in tables.scale], dtype=np.float64)
+        self.scale_high = np.array([row[2] for row in tables.scale], dtype=np.float64)
+        self.scale_labels = [row[3] if row[3] else "—" for row in tables.scale]
+    
+    @staticmethod
+    def _dense(table: Dict[tuple, int]) -> np.ndarray:
+        """Таблица {(уровни): значение} -> массив с NaN для отсутствующих комбинаций"""
+        keys = [key for key, value in table.items() if None not in key and value is not None]
+        if not keys:
+            return np.full((1,), np.nan)
+        shape = tuple(max(key[i] for key in keys) + 1 for i in range(len(keys[0])))
+        dense = np.full(shape, np.nan)
+        for key in keys:
+            if min(key) >= 0:
+                dense[key] = table[key]
+        return dense
+    
+    @staticmethod
+    def _take(dense: np.ndarray, *levels: np.ndarray) -> np.ndarray:
+        """Значения таблицы по столбцам уровней; NaN вне таблицы и для пропущенных ответов"""
+        valid = np.ones(levels[0].shape, dtype=bool)
+        for axis, column in enumerate(levels):
+            valid &= (column >= 0) & (column < dense.shape[axis])
+        index = tuple(np.where(valid, column, 0) for column in levels)
+        return np.where(valid, dense[index], np.nan)
+    
+    @staticmethod
+    def _position(values: np.ndarray, sorted_values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        position = np.clip(np.searchsorted(sorted_values, values), 0, max(len(sorted_values) - 1, 0))
+        found = ~np.isnan(values) & (sorted_values[position] == values) if len(sorted_values) else \
+            np.zeros(values.shape, dtype=bool)
+        return position, found
+    
+    def evaluate(self, levels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        total_p и индекс строки шкалы грейдов для каждой строки матрицы уровней
+
+        Возвращает: (total_p, NaN - не вычисляется; индекс строки шкалы, -1 - грейд не определен)
+        """
+        column = {question_id: levels[:, COLUMN[question_id]] for question_id in QUESTIONS}
+        p1 = self._take(self.p1, column[8], column[9], column[10])
+        p2 = self._take(self.p2, column[11], column[12])
+        
+        p1_position, p1_found = self._position(p1, self.p3_p1_values)
+        p2_position, p2_found = self._position(p2, self.p3_p2_values)
+        p3 = np.where(p1_found & p2_found, self.p3[p1_position, p2_position], np.nan) if self.p3.size else \
+            np.full(p1.shape, np.nan)
+        
+        # p4: по Q14, если на него есть ответ, иначе по Q15 (как в GradeCalculator)
+        p4 = np.where(column[14] != MISSING,
+                      self._take(self.p4_14, column[16], column[13], column[14]),
+                      self._take(self.p4_15, column[16], column[13], column[15]))
+        p4 = np.where((column[13] != MISSING) & (column[16] != MISSING), p4, np.nan)
+        
+        total = p1 + p3 + p4
+        match = (total[:, None] >= self.scale_low[None, :]) & (total[:, None] <= self.scale_high[None, :])
+        grade_row = np.where(match.any(axis=1), match.argmax(axis=1), -1)
+        return total, grade_row
+
+
+def analyze(db_path: str) -> Dict:
+    """Чувствительность грейда по всем сессиям базы"""
+    started = time.perf_counter()
+    sessions, levels = load_session_levels(db_path)
+    grading = VectorGrading(db_path)
+    n = len(sessions)
+    
+    # Блок 0 - исходные ответы, затем для каждого вопроса сдвиги +1 и -1
+    shifts = [(question_id, delta) for question_id in QUESTIONS for delta in (1, -1)]
+    batch = np.repeat(levels[None, :, :], len(shifts) + 1, axis=0)
+    for block, (question_id, delta) in enumerate(shifts, start=1):
+        column = batch[block, :, COLUMN[question_id]]
+        batch[block, :, COLUMN[question_id]] = np.where(column != MISSING, column + delta, MISSING)
+    total, grade_row = grading.evaluate(batch.reshape(-1, len(QUESTIONS)))
+    total = total.reshape(len(shifts) + 1, n)
+    grade_row = grade_row.reshape(len(shifts) + 1, n)
+    
+    labels = np.array(grading.scale_labels + ["—"], dtype=object)
+    grade = labels[grade_row]
+    graded = grade_row[0] >= 0
+    # Номер грейда на шкале (уникальные подписи по возрастанию) - для среднего сдвига грейда
+    steps = {label: step for step, label in enumerate(dict.fromkeys(grading.scale_labels))}
+    grade_step = np.array([steps.get(label, -1) for label in grade.ravel()]).reshape(grade.shape)
+    
+    per_question = []
+    pivotal = np.zeros((n, len(QUESTIONS)), dtype=bool)
+    for index, question_id in enumerate(QUESTIONS):
+        stats = {'question': question_id}
+        changed_any = np.zeros(n, dtype=bool)
+        for delta, name in ((1, 'up'), (-1, 'down')):
+            block = 1 + shifts.index((question_id, delta))
+            valid = graded & (grade_row[block] >= 0)
+            changed = valid & (grade[block] != grade[0])
+            changed_any |= changed
+            stats[f'{name}_valid'] = int(valid.sum())
+            stats[f'{name}_grade_changed'] = int(changed.sum())
+            stats[f'{name}_mean_total_delta'] = round(float((total[block] - total[0])[valid].mean()), 2) if valid.any() else None
+            stats[f'{name}_mean_grade_steps'] = round(float((grade_step[block] - grade_step[0])[valid].mean()), 3) \
+                if valid.any() else None
+        pivotal[:, index] = changed_any
+        stats['pivotal_sessions'] = int(changed_any.sum())
+        stats['pivotal_share'] = round(float(changed_any.sum()) / int(graded.sum()), 4) if graded.any() else 0.0
+        per_question.append(stats)
+    
+    per_session = [
+        {
+            'user_id': user,
+            'session_id': session_id,
+            'total_p': float(total[0, index]),
+            'grade': grade[0, index],
+            'pivotal_questions': [question_id for column, question_id in enumerate(QUESTIONS) if pivotal[index, column]]
+        }
+        for index, (user, session_id) in enumerate(sessions) if graded[index]
+    ]
+    
+    return {
+        'sessions': n,
+        'graded_sessions': int(graded.sum()),
+        'evaluations': int(total.size),
+        'duration_s': round(time.perf_counter() - started, 3),
+        'questions': sorted(per_question, key=lambda stats: -stats['pivotal_sessions']),
+        'per_session': per_session
+    }
+
+
+def verify(db_path: str, limit: int) -> int:
+    """Сверка исходных total_p и грейда с GradeCalculator.calculate_grade на первых limit сессиях"""
+    from grade_calculator import GradeCalculator
+    
+    sessions, levels = load_session_levels(db_path)
+    total, grade_row = VectorGrading(db_path).evaluate(levels[:limit])
+    labels = get_grading_tables(db_path).scale
+    calculator = GradeCalculator(db_path)
+    failures = 0
+    for index, (user, session_id) in enumerate(sessions[:limit]):
+        expected = calculator.calculate_grade(user, session_id)
+        if 'error' in expected:
+            actual_ok = grade_row[index] < 0
+        else:
+            row = labels[grade_row[index]] if grade_row[index] >= 0 else None
+            actual_ok = (row is not None and total[index] == expected['calculations']['total_p']
+                         and (row[3] if row[3] else "—") == expected['final_grade'])
+        if not actual_ok:
+            failures += 1
+            if failures <= 5:
+                print(f"❌ Сессия {user}/{session_id}: {expected.get('calculations', expected)}, "
+                      f"вектор: total_p {total[index]}, строка шкалы {grade_row[index]}")
+    print(f"{'✅' if not failures else '❌'} Сверено сессий: {min(limit, len(sessions))}, расхождений: {failures}")
+    return failures
+
+
+def print_report(result: Dict) -> None:
+    print("=" * 70)
+    print(f"📊 Сессий: {result['sessions']}, с грейдом: {result['graded_sessions']}, "
+          f"расчетов: {result['evaluations']} за {result['duration_s']} с")
+    print(f"{'Вопрос':>7} {'решающий':>10} {'доля':>7} {'↑ меняет':>10} {'↓ меняет':>10} {'Δp ↑':>8} {'Δp ↓':>8}")
+    for stats in result['questions']:
+        print(f"{stats['question']:>7} {stats['pivotal_sessions']:>10} {stats['pivotal_share']:>7.1%} "
+              f"{stats['up_grade_changed']:>4}/{stats['up_valid']:<5} {stats['down_grade_changed']:>4}/{stats['down_valid']:<5} "
+              f"{stats['up_mean_total_delta'] if stats['up_mean_total_delta'] is not None else '-':>8} "
+              f"{stats['down_mean_total_delta'] if stats['down_mean_total_delta'] is not None else '-':>8}")
+    print("=" * 70)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Чувствительность грейда к ответам на Q8-Q16")
+    parser.add_argument("--db", default="data/database.db")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результаты в JSON")
+    parser.add_argument("--xlsx", dest="xlsx_path", help="Сохранить листы 'Вопросы' и 'Сессии' в Excel")
+    parser.add_argument("--verify", type=int, default=0,
+                        help="Сверить с GradeCalculator на первых N сессиях (0 - не сверять)")
+    args = parser.parse_args()
+    
+    if args.verify and verify(args.db, args.verify):
+        raise SystemExit(1)
+    
+    result = analyze(args.db)
+    print_report(result)
+    
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json_path}")
+    if args.xlsx_path:
+        import pandas as pd
+        sessions = [dict(row, pivotal_questions=", ".join(map(str, row['pivotal_questions'])))
+                    for row in result['per_session']]
+        with pd.ExcelWriter(args.xlsx_path) as writer:
+            pd.DataFrame(result['questions']).to_excel(writer, sheet_name="Вопросы", index=False)
+            pd.DataFrame(sessions).to_excel(writer, sheet_name="Сессии", index=False)
+        print(f"💾 Таблица сохранена: {args.xlsx_path}")
+
+
+if __name__ == "__main__":
+    main()
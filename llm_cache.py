@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Кэш ответов LLM для детерминированных задач (классификация и т.п.)
+
+Ключ - хэш от модели, типа задачи, настроек и сообщений; при маршрутизации - от модели,
+которая фактически ответила (ответы разных бэкендов не подменяют друг друга).
+Хранилище - отдельная SQLite база с LRU вытеснением и TTL.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Dict, Optional, Iterator, Tuple, Callable
+
+from config import (
+    LLM_TASK_SETTINGS, LLM_CACHE_ENABLED, LLM_CACHE_PATH,
+    LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS
+)
+from llm_services import BaseLLMService, answered_by_model
+from app_logging import get_logger
+import metrics
+
+logger = get_logger('llm')
+
+# Сводка статистики кэша в лог INFO - раз в столько обращений
+STATS_LOG_INTERVAL = 100
+
+# Проверка ответа перед сохранением и выдачей из кэша в текущем контексте (None - любой ответ)
+_response_check: ContextVar[Optional[Callable[[str], bool]]] = ContextVar('llm_cache_response_check', default=None)
+
+
+def _bypass(response: str) -> bool:
+    return False
+
+
+@contextmanager
+def cache_only_valid(check: Callable[[str], bool]):
+    """
+    Кэшировать в этом контексте только ответы, для которых check(ответ) истинно
+    
+    Сохраненный ответ, не прошедший проверку, удаляется и считается промахом.
+    """
+    token = _response_check.set(check)
+    try:
+        yield
+    finally:
+        _response_check.reset(token)
+
+
+def cache_bypass():
+    """Запросы в этом контексте идут мимо кэша (не читаются и не сохраняются)"""
+    return cache_only_valid(_bypass)
+
+
+class LLMResponseCache:
+    """Контентно-адресуемый кэш ответов LLM на диске"""
+    
+    def __init__(self, db_path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl_seconds: int = LLM_CACHE_TTL_SECONDS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        
+        # Статистика с момента запуска процесса
+        self.hits = 0
+        self.misses = 0
+        self.saved_latency = 0.0
+        
+        self._create_table()
+    
+    def _create_table(self) -> None:
+        """Создание таблицы кэша, если ее еще нет"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    task_type TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    latency REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER DEFAULT 0
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+            conn.commit()
+    
+    @staticmethod
+    def make_key(model: str, task_type: str, messages: List[Dict]) -> str:
+        """Хэш от модели, типа задачи, настроек (включая схему ответа) и сообщений"""
+        settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
+        payload = {
+            'model': model,
+            'task_type': task_type,
+            'temperature': settings['temperature'],
+            'max_tokens': settings['max_tokens'],
+            'response_schema': settings.get('response_schema'),
+            'messages': messages
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Получить ответ из кэша (None - нет записи или истек TTL)"""
+        entry = self.lookup(key)
+        return entry[0] if entry is not None else None
+    
+    def lookup(self, key: str, check: Callable[[str], bool] = None) -> Optional[Tuple[str, float]]:
+        """
+        (ответ, задержка исходного запроса) из кэша
+        
+        None - нет записи, истек TTL или ответ не прошел check (такая запись удаляется).
+        """
+        now = time.time()
+        with self._lock, sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT response, latency, created_at FROM llm_cache WHERE key = ?
+            """, (key,))
+            result = cursor.fetchone()
+            
+            if result is None:
+                self.misses += 1
+                return None
+            
+            response, latency, created_at = result
+            if (self.ttl_seconds and now - created_at > self.ttl_seconds) or (check is not None and not check(response)):
+                cursor.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                self.misses += 1
+                return None
+            
+            cursor.execute("""
+                UPDATE llm_cache SET last_access = ?, hits = hits + 1 WHERE key = ?
+            """, (now, key))
+            conn.commit()
+            
+            self.hits += 1
+            self.saved_latency += latency
+            return response, latency
+    
+    def put(self, key: str, task_type: str, response: str, latency: float) -> None:
+        """Сохранить ответ в кэш и вытеснить самые старые записи при переполнении"""
+        now = time.time()
+        with self._lock, sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO llm_cache (key, task_type, response, latency, created_at, last_access, hits)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            """, (key, task_type, response, latency, now, now))
+            
+            # LRU вытеснение: оставляем max_entries записей с самым свежим обращением
+            cursor.execute("SELECT COUNT(*) FROM llm_cache")
+            count = cursor.fetchone()[0]
+            if count > self.max_entries:
+                cursor.execute("""
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?
+                    )
+                """, (count - self.max_entries,))
+            conn.commit()
+    
+    def get_stats(self) -> Dict:
+        """Статистика попаданий и сэкономленного времени"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'saved_latency': self.saved_latency
+        }
+    
+    def format_stats(self) -> str:
+        """Краткая строка статистики для логов"""
+        stats = self.get_stats()
+        return (f"попаданий {stats['hits']}/{stats['hits'] + stats['misses']} "
+                f"({stats['hit_ratio']:.0%}), сэкономлено {stats['saved_latency']:.2f} с")
+
+
+class CachedLLMService(BaseLLMService):
+    """Обертка над LLM сервисом: отдает ответы из кэша для задач с 'cache': True"""
+    
+    def __init__(self, service: BaseLLMService, cache: 'LLMResponseCache'):
+        self.service = service
+        self.cache = cache
+    
+    @property
+    def name(self) -> str:
+        return self.service.name
+    
+    @property
+    def emoji(self) -> str:
+        return self.service.emoji
+    
+    @property
+    def model(self) -> str:
+        return self.service.model
+    
+    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
+        """Ответ из кэша, если есть, иначе запрос к сервису с сохранением результата"""
+        settings = LLM_TASK_SETTINGS.get(task_type, {})
+        check = _response_check.get()
+        if not settings.get('cache') or check is _bypass:
+            return self.service.generate_response(messages, task_type)
+        
+        key = self.cache.make_key(self.model, task_type, messages)
+        cached = self.cache.lookup(key, check)
+        if (self.cache.hits + self.cache.misses) % STATS_LOG_INTERVAL == 0:
+            logger.info("💾 LLM кэш: %s", self.cache.format_stats())
+        if cached is not None:
+            metrics.inc('hay_llm_cache_requests_total', task=task_type, result='hit')
+            metrics.inc('hay_llm_cache_saved_seconds_total', cached[1], task=task_type)
+            logger.debug("💾 LLM кэш (%s): попадание, %s", task_type, self.cache.format_stats())
+            return cached[0]
+        metrics.inc('hay_llm_cache_requests_total', task=task_type, result='miss')
+        
+        # Ошибки (LLMError) пробрасываются и в кэш не попадают
+        started = time.monotonic()
+        token = answered_by_model.set(None)
+        try:
+            response = self.service.generate_response(messages, task_type)
+            answered_by = answered_by_model.get()
+        finally:
+            answered_by_model.reset(token)
+        latency = time.monotonic() - started
+        
+        # Некорректный ответ (не прошел проверку вызывающего) не кэшируется
+        if check is not None and not check(response):
+            logger.debug("💾 LLM кэш (%s): ответ не прошел проверку, не сохраняем", task_type)
+            return response
+        
+        # Ответ второго бэкенда (маршрутизатор) - под ключом его модели, а не основной
+        if answered_by and answered_by != self.model:
+            key = self.cache.make_key(answered_by, task_type, messages)
+        self.cache.put(key, task_type, response, latency)
+        return response
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        """Кэшируемые задачи отдаются целиком (из кэша или с сохранением), остальные - потоком"""
+        if LLM_TASK_SETTINGS.get(task_type, {}).get('cache'):
+            yield self.generate_response(messages, task_type)
+            return
+        yield from self.service.generate_response_stream(messages, task_type)
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> Optional[LLMResponseCache]:
+    """Общий экземпляр кэша на процесс (None, если кэш выключен)"""
+    global _response_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = LLMResponseCache()
+        return _response_cache
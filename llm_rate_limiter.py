@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Клиентское ограничение частоты запросов к LLM
+
+Для каждого бэкенда - общие на процесс токен-бакеты (запросы и токены в минуту)
+и семафор параллельности с приоритетами задач из LLM_TASK_SETTINGS.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Dict, Iterator
+
+from config import LLM_TASK_SETTINGS, LLM_RATE_LIMITS
+from llm_services import BaseLLMService
+import metrics
+from app_logging import get_logger
+
+logger = get_logger('llm')
+
+
+class TokenBucket:
+    """Токен-бакет с пополнением limit_per_minute в минуту (0 - без ограничения)"""
+    
+    def __init__(self, limit_per_minute: int):
+        self.capacity = float(limit_per_minute)
+        self.rate = limit_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, amount: float = 1.0) -> None:
+        """Блокирует поток, пока в бакете не наберется amount"""
+        if self.capacity <= 0:
+            return
+        # Запрос больше емкости бакета иначе не прошел бы никогда
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_time = (amount - self.tokens) / self.rate
+            time.sleep(min(wait_time, 1.0))
+    
+    def available(self) -> float:
+        """Остаток бакета на текущий момент"""
+        with self._lock:
+            return min(self.capacity, self.tokens + (time.monotonic() - self.updated_at) * self.rate)
+
+
+class PrioritySemaphore:
+    """Семафор, который при освобождении места пропускает ожидающего с наименьшим priority"""
+    
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+    
+    def acquire(self, priority: int) -> None:
+        if self.max_concurrency <= 0:
+            return
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return
+            event = threading.Event()
+            heapq.heappush(self._waiters, (priority, next(self._counter), event))
+        # Место передается напрямую в release(), active уже увеличен за нас
+        event.wait()
+    
+    def release(self) -> None:
+        if self.max_concurrency <= 0:
+            return
+        with self._lock:
+            if self._waiters:
+                _, _, event = heapq.heappop(self._waiters)
+                event.set()
+            else:
+                self.active -= 1
+    
+    def queue_length(self) -> int:
+        with self._lock:
+            return len(self._waiters)
+
+
+class BackendGovernor:
+    """Ограничения одного бэкенда и статистика времени ожидания в очереди"""
+    
+    def __init__(self, name: str, rpm: int = 0, tpm: int = 0, max_concurrency: int = 0):
+        self.name = name
+        self.requests_bucket = TokenBucket(rpm)
+        self.tokens_bucket = TokenBucket(tpm)
+        self.semaphore = PrioritySemaphore(max_concurrency)
+        self._wait_times: Dict[str, deque] = {}
+        self._stats_lock = threading.Lock()
+    
+    @contextmanager
+    def slot(self, task_type: str, estimated_tokens: int):
+        """Занять место под запрос: сначала по приоритету задачи, затем по лимитам частоты"""
+        priority = LLM_TASK_SETTINGS.get(task_type, {}).get('priority', 1)
+        started = time.monotonic()
+        self.semaphore.acquire(priority)
+        try:
+            self.requests_bucket.acquire(1)
+            self.tokens_bucket.acquire(estimated_tokens)
+            waited = time.monotonic() - started
+            self._record_wait(task_type, waited)
+            metrics.observe('hay_llm_queue_wait_seconds', waited, backend=self.name, task=task_type)
+            if waited >= 1.0:
+                logger.info("🚦 %s (%s): ожидание в очереди %.1f с, в очереди еще %s",
+                            self.name, task_type, waited, self.semaphore.queue_length())
+            yield
+        finally:
+            self.semaphore.release()
+    
+    def _record_wait(self, task_type: str, waited: float) -> None:
+        with self._stats_lock:
+            self._wait_times.setdefault(task_type, deque(maxlen=1000)).append(waited)
+    
+    def get_stats(self) -> Dict[str, Dict]:
+        """Время ожидания в очереди по типам задач: число, среднее, p95, максимум"""
+        with self._stats_lock:
+            items = {task_type: sorted(samples) for task_type, samples in self._wait_times.items()}
+        stats = {}
+        for task_type, samples in items.items():
+            if not samples:
+                continue
+            stats[task_type] = {
+                'count': len(samples),
+                'avg': sum(samples) / len(samples),
+                'p95': samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+                'max': samples[-1]
+            }
+        return stats
+
+
+_governors: Dict[str, BackendGovernor] = {}
+_governors_lock = threading.Lock()
+
+def get_backend_governor(service_type: str) -> BackendGovernor:
+    """Общий для всех экземпляров сервиса ограничитель бэкенда (по ключу из LLM_RATE_LIMITS)"""
+    with _governors_lock:
+        if service_type not in _governors:
+            limits = LLM_RATE_LIMITS.get(service_type, {})
+            _governors[service_type] = BackendGovernor(
+                service_type,
+                rpm=limits.get('rpm', 0),
+                tpm=limits.get('tpm', 0),
+                max_concurrency=limits.get('max_concurrency', 0)
+            )
+        return _governors[service_type]
+
+def get_rate_limiter_stats() -> Dict[str, Dict]:
+    """
+    Состояние ограничителей всех бэкендов
+    
+    queue_length - запросы, ждущие места под параллельный запрос;
+    requests_available / tokens_available - остаток бакетов (None - без ограничения);
+    wait - статистика ожидания по типам задач (BackendGovernor.get_stats)
+    """
+    with _governors_lock:
+        governors = list(_governors.values())
+    return {
+        governor.name: {
+            'queue_length': governor.semaphore.queue_length(),
+            'requests_available': governor.requests_bucket.available() if governor.requests_bucket.capacity > 0 else None,
+            'tokens_available': governor.tokens_bucket.available() if governor.tokens_bucket.capacity > 0 else None,
+            'wait': governor.get_stats()
+        }
+        for governor in governors
+    }
+
+def _collect_metrics():
+    """Датчики очереди и бакетов для /metrics"""
+    for backend, stats in get_rate_limiter_stats().items():
+        yield 'hay_llm_queue_length', stats['queue_length'], {'backend': backend}
+        for bucket in ('requests', 'tokens'):
+            available = stats[f"{bucket}_available"]
+            if available is not None:
+                yield 'hay_llm_rate_limit_available', round(available, 1), {'backend': backend, 'bucket': bucket}
+
+metrics.register_collector(_collect_metrics)
+
+
+def estimate_tokens(messages: List[Dict], task_type: str) -> int:
+    """
+    Оценка токенов запроса для лимита TPM
+
+    Провайдеры резервируют max_tokens ответа сразу, поэтому он учитывается целиком;
+    промпт - примерно 3 символа на токен для русского текста.
+    """
+    settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
+    prompt_chars = sum(len(message.get('content') or '') for message in messages)
+    return prompt_chars // 3 + settings['max_tokens']
+
+
+class RateLimitedLLMService(BaseLLMService):
+    """Обертка над LLM сервисом: каждый запрос проходит через ограничитель бэкенда"""
+    
+    def __init__(self, service: BaseLLMService, governor: BackendGovernor):
+        self.service = service
+        self.governor = governor
+    
+    @property
+    def name(self) -> str:
+        return self.service.name
+    
+    @property
+    def emoji(self) -> str:
+        return self.service.emoji
+    
+    @property
+    def model(self) -> str:
+        return self.service.model
+    
+    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
+        with self.governor.slot(task_type, estimate_tokens(messages, task_type)):
+            return self.service.generate_response(messages, task_type)
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        # Место занято, пока поток не дочитан или не закрыт
+        with self.governor.slot(task_type, estimate_tokens(messages, task_type)):
+            yield from self.service.generate_response_stream(messages, task_type)
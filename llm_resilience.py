@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Устойчивость вызовов LLM: повторы с экспоненциальной задержкой и автомат защиты (circuit breaker)
+"""
+
+import random
+import threading
+import time
+from typing import List, Dict, Iterator
+
+from config import (
+    LLM_RETRY_MAX_ATTEMPTS, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY,
+    LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_TIMEOUT
+)
+from llm_services import BaseLLMService, LLMError, LLMRateLimitError, LLMCircuitOpenError
+from app_logging import get_logger
+
+logger = get_logger('llm')
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты для одного бэкенда
+
+    closed    - запросы идут как обычно
+    open      - после серии ошибок подряд запросы сразу отклоняются
+    half_open - по истечении паузы пропускается один пробный запрос
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = LLM_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = LLM_CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+    
+    def allow_request(self) -> bool:
+        """Можно ли сейчас отправить запрос"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._trial_in_progress = False
+            if self.state == 'half_open' and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+    
+    def is_open(self) -> bool:
+        """Отклоняет ли автомат запросы (без изменения состояния)"""
+        with self._lock:
+            if self.state == 'open':
+                return time.monotonic() - self.opened_at < self.reset_timeout
+            return self.state == 'half_open' and self._trial_in_progress
+    
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != 'closed':
+                logger.info("✅ Автомат защиты %s: сервис восстановлен", self.name)
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_in_progress = False
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning("🔌 Автомат защиты %s: отключаем сервис на %.0f с после %s ошибок подряд",
+                                   self.name, self.reset_timeout, self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._trial_in_progress = False
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(service_name: str) -> CircuitBreaker:
+    """Общий автомат защиты для бэкенда (один на процесс)"""
+    with _circuit_breakers_lock:
+        if service_name not in _circuit_breakers:
+            _circuit_breakers[service_name] = CircuitBreaker(service_name)
+        return _circuit_breakers[service_name]
+
+
+class RetryPolicy:
+    """Повторы с экспоненциальной задержкой и полным случайным разбросом (full jitter)"""
+    
+    def __init__(self, max_attempts: int = LLM_RETRY_MAX_ATTEMPTS, base_delay: float = LLM_RETRY_BASE_DELAY,
+                 max_delay: float = LLM_RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def get_delay(self, attempt: int, error: LLMError) -> float:
+        """Пауза перед повтором номер attempt (с 1)"""
+        if isinstance(error, LLMRateLimitError) and error.retry_after:
+            return min(self.max_delay, error.retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class ResilientLLMService(BaseLLMService):
+    """Обертка над LLM сервисом: повторы при 429/5xx/таймаутах и автомат защиты бэкенда"""
+    
+    def __init__(self, service: BaseLLMService, retry_policy: RetryPolicy = None,
+                 circuit_breaker: CircuitBreaker = None):
+        self.service = service
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or get_circuit_breaker(service.name)
+    
+    @property
+    def name(self) -> str:
+        return self.service.name
+    
+    @property
+    def emoji(self) -> str:
+        return self.service.emoji
+    
+    @property
+    def model(self) -> str:
+        return self.service.model
+    
+    def _before_attempt(self) -> None:
+        """Проверка автомата защиты перед очередной попыткой"""
+        if not self.circuit_breaker.allow_request():
+            raise LLMCircuitOpenError(f"{self.name} временно отключен после серии ошибок", self.name)
+    
+    def _on_error(self, attempt: int, error: LLMError, task_type: str, can_retry: bool = True) -> float:
+        """Учет ошибки попытки: пауза перед повтором или повторный выброс ошибки"""
+        if not error.retryable:
+            # Бэкенд ответил, ошибка в самом запросе - повтор не поможет
+            self.circuit_breaker.record_success()
+            raise error
+        self.circuit_breaker.record_failure()
+        if not can_retry:
+            logger.error("❌ %s (%s): поток прерван после начала ответа: %s", self.name, task_type, error)
+            raise error
+        if attempt >= self.retry_policy.max_attempts:
+            logger.error("❌ %s (%s): попытки исчерпаны (%s): %s", self.name, task_type, attempt, error)
+            raise error
+        delay = self.retry_policy.get_delay(attempt, error)
+        logger.warning("⚠️ %s (%s): %s: %s. Повтор %s/%s через %.1f с",
+                       self.name, task_type, type(error).__name__, error, attempt + 1, self.retry_policy.max_attempts,
+                       delay)
+        return delay
+    
+    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
+        """Ответ сервиса или LLMError, если все попытки исчерпаны"""
+        attempt = 0
+        while True:
+            attempt += 1
+            self._before_attempt()
+            
+            try:
+                response = self.service.generate_response(messages, task_type)
+            except LLMError as e:
+                time.sleep(self._on_error(attempt, e, task_type))
+                continue
+            
+            self.circuit_breaker.record_success()
+            return response
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        """Поток фрагментов; повтор возможен, только пока не отдан ни один фрагмент"""
+        attempt = 0
+        while True:
+            attempt += 1
+            self._before_attempt()
+            
+            started = False
+            try:
+                for chunk in self.service.generate_response_stream(messages, task_type):
+                    started = True
+                    yield chunk
+            except LLMError as e:
+                time.sleep(self._on_error(attempt, e, task_type, can_retry=not started))
+                continue
+            except GeneratorExit:
+                # Потребитель прекратил чтение - бэкенд при этом отвечал
+                self.circuit_breaker.record_success()
+                raise
+            
+            self.circuit_breaker.record_success()
+            return
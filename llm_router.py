@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Маршрутизация запросов между GigaChat и OpenAI
+
+Хеджирование: если основной бэкенд не ответил за p95 своих недавних задержек,
+параллельно отправляется запрос во второй бэкенд и берется первый успешный ответ.
+Если автомат защиты основного бэкенда разомкнут, запрос сразу уходит во второй.
+"""
+
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional, Iterator, Tuple
+
+from config import LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_TASKS
+from llm_services import BaseLLMService, LLMError, answered_by_model
+from llm_resilience import get_circuit_breaker
+import metrics
+from app_logging import get_logger
+
+logger = get_logger('llm')
+
+
+class LatencyTracker:
+    """Скользящее окно задержек успешных запросов одного бэкенда для одного типа задачи"""
+    
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._samples.append(latency)
+    
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+    
+    def percentile(self, p: float) -> Optional[float]:
+        """Перцентиль p (0-100) или None, если замеров нет"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+_latency_trackers: Dict[tuple, LatencyTracker] = {}
+_latency_trackers_lock = threading.Lock()
+
+def get_latency_tracker(service_name: str, task_type: str) -> LatencyTracker:
+    """Общий трекер задержек для пары (бэкенд, тип задачи)"""
+    key = (service_name, task_type)
+    with _latency_trackers_lock:
+        if key not in _latency_trackers:
+            _latency_trackers[key] = LatencyTracker()
+        return _latency_trackers[key]
+
+def get_latency_stats() -> Dict[str, Dict[str, Dict]]:
+    """p50/p95 по всем бэкендам и типам задач: {бэкенд: {тип задачи: {count, p50, p95}}}"""
+    with _latency_trackers_lock:
+        items = list(_latency_trackers.items())
+    stats: Dict[str, Dict[str, Dict]] = {}
+    for (service_name, task_type), tracker in items:
+        stats.setdefault(service_name, {})[task_type] = {
+            'count': tracker.count(),
+            'p50': tracker.percentile(50),
+            'p95': tracker.percentile(95)
+        }
+    return stats
+
+def _collect_metrics():
+    """Перцентили задержек бэкендов (по ним выбирается момент хеджирования) для /metrics"""
+    for service_name, tasks in get_latency_stats().items():
+        for task_type, stats in tasks.items():
+            for key, quantile in (('p50', '0.5'), ('p95', '0.95')):
+                if stats[key] is not None:
+                    yield ('hay_llm_latency_seconds', round(stats[key], 3),
+                           {'backend': service_name, 'task': task_type, 'quantile': quantile})
+
+metrics.register_collector(_collect_metrics)
+
+
+# Потоки для параллельных (хеджированных) запросов; requests блокирующий
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+
+
+class RoutingLLMService(BaseLLMService):
+    """LLM сервис поверх двух бэкендов с хеджированием и переключением при отказе"""
+    
+    def __init__(self, primary: BaseLLMService, secondary: BaseLLMService):
+        self.primary = primary
+        self.secondary = secondary
+    
+    @property
+    def name(self) -> str:
+        return self.primary.name
+    
+    @property
+    def emoji(self) -> str:
+        return self.primary.emoji
+    
+    @property
+    def model(self) -> str:
+        return self.primary.model
+    
+    def _call(self, service: BaseLLMService, messages: List[Dict], task_type: str) -> str:
+        """Запрос к бэкенду с записью задержки успешного ответа"""
+        started = time.monotonic()
+        response = service.generate_response(messages, task_type)
+        get_latency_tracker(service.name, task_type).record(time.monotonic() - started)
+        return response
+    
+    def _hedge_delay(self, task_type: str) -> Optional[float]:
+        """Через сколько секунд отправлять дублирующий запрос (None - не хеджировать)"""
+        if task_type not in LLM_HEDGE_TASKS:
+            return None
+        tracker = get_latency_tracker(self.primary.name, task_type)
+        if tracker.count() < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return tracker.percentile(LLM_HEDGE_PERCENTILE)
+    
+    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
+        """Ответ основного бэкенда, второго при отказе или того, кто ответил первым"""
+        response, service = self._route(messages, task_type)
+        # Кэш ответов сохраняет ответ под ключом модели, которая его дала
+        answered_by_model.set(service.model)
+        return response
+    
+    def _route(self, messages: List[Dict], task_type: str) -> Tuple[str, BaseLLMService]:
+        """(ответ, бэкенд, который его дал)"""
+        # Основной бэкенд отключен автоматом защиты - сразу переключаемся
+        if get_circuit_breaker(self.primary.name).is_open() and not get_circuit_breaker(self.secondary.name).is_open():
+            logger.info("🔀 %s отключен, запрос %s отправлен в %s", self.primary.name, task_type, self.secondary.name)
+            return self._call(self.secondary, messages, task_type), self.secondary
+        
+        hedge_delay = self._hedge_delay(task_type)
+        if hedge_delay is None:
+            try:
+                return self._call(self.primary, messages, task_type), self.primary
+            except LLMError as e:
+                logger.info("🔀 %s не ответил (%s), переключаемся на %s", self.primary.name, e, self.secondary.name)
+                return self._call(self.secondary, messages, task_type), self.secondary
+        
+        # Контекст (текущий участок хода для метрик) переносится в потоки запросов
+        primary_future = _executor.submit(contextvars.copy_context().run, self._call, self.primary, messages, task_type)
+        done, _ = wait([primary_future], timeout=hedge_delay)
+        if done:
+            try:
+                return primary_future.result(), self.primary
+            except LLMError as e:
+                logger.info("🔀 %s не ответил (%s), переключаемся на %s", self.primary.name, e, self.secondary.name)
+                return self._call(self.secondary, messages, task_type), self.secondary
+        
+        logger.info("⏱️ %s (%s) дольше p%.0f=%.1f с, дублируем запрос в %s",
+                    self.primary.name, task_type, LLM_HEDGE_PERCENTILE, hedge_delay, self.secondary.name)
+        secondary_future = _executor.submit(contextvars.copy_context().run, self._call, self.secondary, messages, task_type)
+        pending = {primary_future, secondary_future}
+        last_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except LLMError as e:
+                    last_error = e
+                    continue
+                winner = self.primary if future is primary_future else self.secondary
+                logger.info("🏁 Первым ответил %s", winner.name)
+                # Проигравший запрос не прерывается (requests блокирующий) - его результат просто отбрасывается
+                return response, winner
+        raise last_error
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        """
+        Поток основного бэкенда или второго, если основной отказал до первого фрагмента
+        
+        Хеджирование для потоков не применяется: первый фрагмент приходит быстро,
+        а дублирующий поток удвоил бы расход токенов на длинных ответах.
+        """
+        if get_circuit_breaker(self.primary.name).is_open() and not get_circuit_breaker(self.secondary.name).is_open():
+            logger.info("🔀 %s отключен, поток %s запрошен у %s", self.primary.name, task_type, self.secondary.name)
+            yield from self.secondary.generate_response_stream(messages, task_type)
+            return
+        
+        started = False
+        try:
+            for chunk in self.primary.generate_response_stream(messages, task_type):
+                started = True
+                yield chunk
+        except LLMError as e:
+            if started:
+                raise
+            logger.info("🔀 %s не ответил (%s), переключаемся на %s", self.primary.name, e, self.secondary.name)
+            yield from self.secondary.generate_response_stream(messages, task_type)
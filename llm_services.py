@@ -3,17 +3,61 @@
 Модуль для работы с различными LLM сервисами
 """
 
+import json
 import requests
 import uuid
 from abc import ABC, abstractmethod
-from typing import List, Dict
+from contextvars import ContextVar
+from typing import List, Dict, Optional, Iterator
 
 from config import (
     GIGACHAT_AUTH, GIGACHAT_SCOPE, GIGACHAT_API_URL, GIGACHAT_TOKEN_URL, GIGACHAT_MODEL,
     OPENAI_API_KEY, OPENAI_MODEL, OPENAI_API_URL,
     OPENAI_USE_PROXY, OPENAI_PROXY_HOST, OPENAI_PROXY_PORT, OPENAI_PROXY_USER, OPENAI_PROXY_PASSWORD,
-    LLM_TASK_SETTINGS
+    LLM_TASK_SETTINGS, LLM_TOKEN_TIMEOUT, LLM_ROUTING_ENABLED
 )
+import metrics
+from app_logging import get_logger
+
+logger = get_logger('llm')
+
+# Модель, которая фактически ответила на последний запрос в текущем контексте.
+# Ставит маршрутизатор (ответ мог дать второй бэкенд); кэш ответов сохраняет ответ под ключом этой модели.
+answered_by_model: ContextVar[Optional[str]] = ContextVar('llm_answered_by_model', default=None)
+
+class LLMError(Exception):
+    """Базовая ошибка обращения к LLM (в отличие от содержательного ответа модели)"""
+    
+    # Имеет ли смысл повторить запрос
+    retryable = True
+    
+    def __init__(self, message: str, service_name: str = None):
+        super().__init__(message)
+        self.service_name = service_name
+
+class LLMTimeoutError(LLMError):
+    """Превышено время ожидания ответа"""
+
+class LLMRateLimitError(LLMError):
+    """Провайдер ограничил частоту запросов (HTTP 429)"""
+    
+    def __init__(self, message: str, service_name: str = None, retry_after: Optional[float] = None):
+        super().__init__(message, service_name)
+        self.retry_after = retry_after
+
+class LLMServerError(LLMError):
+    """Ошибка на стороне провайдера (HTTP 5xx) или разрыв соединения"""
+
+class LLMResponseError(LLMError):
+    """Ответ API не удалось разобрать"""
+
+class LLMClientError(LLMError):
+    """Некорректный запрос (HTTP 4xx) - повтор не поможет"""
+    retryable = False
+
+class LLMCircuitOpenError(LLMError):
+    """Сервис временно отключен автоматом защиты после серии ошибок"""
+    retryable = False
 
 class BaseLLMService(ABC):
     """Базовый класс для всех LLM сервисов"""
@@ -22,10 +66,13 @@ class BaseLLMService(ABC):
     def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
         """
         Генерация ответа от LLM
-        
+
         Args:
             messages: Список сообщений для LLM
             task_type: Тип задачи ('verification', 'classification', 'compilation', 'explanation', 'functionality')
+
+        Raises:
+            LLMError: если ответ получить не удалось
         """
         pass
     
@@ -40,6 +87,96 @@ class BaseLLMService(ABC):
     def emoji(self) -> str:
         """Эмодзи для отображения"""
         pass
+    
+    @property
+    def model(self) -> str:
+        """Название модели (используется в ключе кэша)"""
+        return self.name
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        """
+        Потоковая генерация: фрагменты текста по мере поступления
+        
+        По умолчанию - весь ответ одним фрагментом; бэкенды с поддержкой SSE переопределяют.
+        """
+        yield self.generate_response(messages, task_type)
+    
+    def _post(self, url: str, timeout: float, **kwargs) -> requests.Response:
+        """POST запрос с переводом сетевых и HTTP ошибок в типизированные LLMError"""
+        try:
+            response = requests.post(url, timeout=timeout, **kwargs)
+        except requests.exceptions.Timeout as e:
+            raise LLMTimeoutError(f"Таймаут {timeout} с: {e}", self.name)
+        except requests.exceptions.RequestException as e:
+            raise LLMServerError(f"Ошибка соединения: {e}", self.name)
+        
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            raise LLMRateLimitError(f"HTTP 429: {response.text[:200]}", self.name, retry_after)
+        if response.status_code >= 500:
+            raise LLMServerError(f"HTTP {response.status_code}: {response.text[:200]}", self.name)
+        if response.status_code >= 400:
+            raise LLMClientError(f"HTTP {response.status_code}: {response.text[:200]}", self.name)
+        return response
+    
+    def _post_json(self, url: str, timeout: float, **kwargs) -> Dict:
+        """POST запрос с разбором JSON ответа"""
+        response = self._post(url, timeout, **kwargs)
+        try:
+            return response.json()
+        except ValueError:
+            raise LLMResponseError(f"Ответ не является JSON: {response.text[:200]}", self.name)
+    
+    def _post_stream(self, url: str, timeout: float, **kwargs) -> Iterator[str]:
+        """
+        POST запрос с потоковым ответом (Server-Sent Events в формате chat completions)
+        
+        timeout - ожидание соединения и каждого следующего фрагмента, а не всего ответа.
+        """
+        response = self._post(url, timeout, stream=True, **kwargs)
+        response.encoding = 'utf-8'
+        try:
+            # chunk_size=None - фрагменты отдаются по мере поступления, без накопления буфера
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    raise LLMResponseError(f"Некорректное событие потока: {data[:200]}", self.name)
+                choices = event.get('choices') or []
+                if not choices:
+                    continue
+                content = (choices[0].get('delta') or {}).get('content')
+                if content:
+                    yield content
+        except requests.exceptions.Timeout as e:
+            raise LLMTimeoutError(f"Таймаут {timeout} с в потоке: {e}", self.name)
+        except requests.exceptions.RequestException as e:
+            raise LLMServerError(f"Поток прерван: {e}", self.name)
+        finally:
+            response.close()
+    
+    def _record_usage(self, response_json: Dict) -> None:
+        """Токены из поля usage ответа - в метрики текущего участка хода"""
+        usage = response_json.get('usage') or {}
+        metrics.record_tokens(usage.get('prompt_tokens'), usage.get('completion_tokens'))
+    
+    def _extract_content(self, response_json: Dict) -> str:
+        """Текст ответа из формата chat completions"""
+        if 'choices' not in response_json or not response_json['choices']:
+            raise LLMResponseError(f"Некорректный ответ API: {response_json}", self.name)
+        content = response_json['choices'][0].get('message', {}).get('content')
+        if content is None:
+            raise LLMResponseError(f"В ответе API нет текста: {response_json}", self.name)
+        return content
 
 class GigaChatService(BaseLLMService):
     """Сервис для работы с GigaChat"""
@@ -48,62 +185,87 @@ class GigaChatService(BaseLLMService):
     def name(self) -> str:
         return "GigaChat"
     
-    @property  
+    @property
     def emoji(self) -> str:
         return "🇷🇺"
     
+    @property
+    def model(self) -> str:
+        return GIGACHAT_MODEL
+    
+    def _get_token(self) -> str:
+        """Получение нового токена доступа"""
+        token_headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+            'RqUID': str(uuid.uuid4()),
+            'Authorization': f'Basic {GIGACHAT_AUTH}'
+        }
+        
+        token_data = f'scope={GIGACHAT_SCOPE}'
+        
+        token_json = self._post_json(GIGACHAT_TOKEN_URL, LLM_TOKEN_TIMEOUT,
+                                     headers=token_headers, data=token_data, verify=False)
+        if 'access_token' not in token_json:
+            raise LLMResponseError(f"Ошибка получения токена: {token_json}", self.name)
+        
+        return token_json['access_token']
+    
+    def _build_request(self, messages: List[Dict], settings: Dict, stream: bool) -> Dict:
+        """Заголовки (с новым токеном) и тело запроса к API"""
+        api_headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream' if stream else 'application/json',
+            'Authorization': f'Bearer {self._get_token()}'
+        }
+        
+        payload = {
+            "model": GIGACHAT_MODEL,
+            "messages": messages,
+            "temperature": settings['temperature'],
+            "max_tokens": settings['max_tokens'],
+            "stream": stream
+        }
+        
+        # Структурированный ответ - через обязательный вызов функции с параметрами по схеме
+        schema = settings.get('response_schema')
+        if schema and not stream:
+            payload["functions"] = [{
+                "name": "submit_response",
+                "description": "Передать ответ в структурированном виде",
+                "parameters": {key: value for key, value in schema.items() if key != 'additionalProperties'}
+            }]
+            payload["function_call"] = {"name": "submit_response"}
+        return {'headers': api_headers, 'json': payload, 'verify': False}
+    
     def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
         """Генерация ответа через ГигаЧат с получением нового токена"""
-        try:
-            # Получаем настройки для типа задачи
-            settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
-            
-            # Получаем токен
-            token_headers = {
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'Accept': 'application/json',
-                'RqUID': str(uuid.uuid4()),
-                'Authorization': f'Basic {GIGACHAT_AUTH}'
-            }
-            
-            token_data = f'scope={GIGACHAT_SCOPE}'
-            
-            response = requests.post(GIGACHAT_TOKEN_URL, headers=token_headers, data=token_data, verify=False)
-            response.raise_for_status()
-            
-            token_json = response.json()
-            if 'access_token' not in token_json:
-                raise Exception(f"Ошибка получения токена: {token_json}")
-                
-            token = token_json['access_token']
-            
-            # Отправляем запрос к API
-            api_headers = {
-                'Content-Type': 'application/json',
-                'Accept': 'application/json',
-                'Authorization': f'Bearer {token}'
-            }
-            
-            payload = {
-                "model": GIGACHAT_MODEL,
-                "messages": messages,
-                "temperature": settings['temperature'],
-                "max_tokens": settings['max_tokens'],
-                "stream": False
-            }
-            
-            response = requests.post(GIGACHAT_API_URL, headers=api_headers, json=payload, verify=False)
-            response.raise_for_status()
-            
-            response_json = response.json()
-            if 'choices' not in response_json or not response_json['choices']:
-                raise Exception(f"Некорректный ответ API: {response_json}")
-                
-            return response_json['choices'][0]['message']['content']
-            
-        except Exception as e:
-            print(f"❌ Ошибка GigaChat API: {e}")
-            return "Извините, произошла ошибка при обработке запроса GigaChat. Попробуйте позже."
+        # Получаем настройки для типа задачи
+        settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
+        
+        response_json = self._post_json(GIGACHAT_API_URL, settings['timeout'],
+                                        **self._build_request(messages, settings, stream=False))
+        self._record_usage(response_json)
+        if settings.get('response_schema'):
+            return self._extract_function_arguments(response_json)
+        return self._extract_content(response_json)
+    
+    def _extract_function_arguments(self, response_json: Dict) -> str:
+        """Аргументы вызова функции как JSON строка (или текст, если модель ответила текстом)"""
+        choices = response_json.get('choices') or []
+        function_call = choices[0].get('message', {}).get('function_call') if choices else None
+        if not function_call or function_call.get('arguments') is None:
+            return self._extract_content(response_json)
+        arguments = function_call['arguments']
+        if isinstance(arguments, str):
+            return arguments
+        return json.dumps(arguments, ensure_ascii=False)
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        """Потоковая генерация через ГигаЧат (SSE)"""
+        settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
+        yield from self._post_stream(GIGACHAT_API_URL, settings['timeout'],
+                                     **self._build_request(messages, settings, stream=True))
 
 class OpenAIService(BaseLLMService):
     """Сервис для работы с OpenAI GPT"""
@@ -116,46 +278,60 @@ class OpenAIService(BaseLLMService):
     def emoji(self) -> str:
         return "🇺🇸"
     
-    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
-        """Генерация ответа через OpenAI API"""
-        try:
-            # Получаем настройки для типа задачи
-            settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
-            
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {OPENAI_API_KEY}'
+    @property
+    def model(self) -> str:
+        return OPENAI_MODEL
+    
+    def _build_request(self, messages: List[Dict], settings: Dict, stream: bool) -> Dict:
+        """Заголовки, тело запроса и прокси"""
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {OPENAI_API_KEY}'
+        }
+        
+        payload = {
+            "model": OPENAI_MODEL,
+            "messages": messages,
+            "temperature": settings['temperature'],
+            "max_tokens": settings['max_tokens']
+        }
+        if stream:
+            payload["stream"] = True
+        
+        schema = settings.get('response_schema')
+        if schema and not stream:
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "strict": True, "schema": schema}
             }
-            
-            payload = {
-                "model": OPENAI_MODEL,
-                "messages": messages,
-                "temperature": settings['temperature'],
-                "max_tokens": settings['max_tokens']
+        
+        # Настраиваем прокси, если включено
+        proxies = None
+        if OPENAI_USE_PROXY and OPENAI_PROXY_HOST and OPENAI_PROXY_PORT:
+            proxy_url = f"http://{OPENAI_PROXY_USER}:{OPENAI_PROXY_PASSWORD}@{OPENAI_PROXY_HOST}:{OPENAI_PROXY_PORT}"
+            proxies = {
+                "http": proxy_url,
+                "https": proxy_url
             }
-            
-            # Настраиваем прокси, если включено
-            proxies = None
-            if OPENAI_USE_PROXY and OPENAI_PROXY_HOST and OPENAI_PROXY_PORT:
-                proxy_url = f"http://{OPENAI_PROXY_USER}:{OPENAI_PROXY_PASSWORD}@{OPENAI_PROXY_HOST}:{OPENAI_PROXY_PORT}"
-                proxies = {
-                    "http": proxy_url,
-                    "https": proxy_url
-                }
-                print(f"🌐 OpenAI: Используется прокси {OPENAI_PROXY_HOST}:{OPENAI_PROXY_PORT}")
-            
-            response = requests.post(OPENAI_API_URL, headers=headers, json=payload, proxies=proxies, timeout=60)
-            response.raise_for_status()
-            
-            response_json = response.json()
-            if 'choices' not in response_json or not response_json['choices']:
-                raise Exception(f"Некорректный ответ API: {response_json}")
-                
-            return response_json['choices'][0]['message']['content']
-            
-        except Exception as e:
-            print(f"❌ Ошибка OpenAI API: {e}")
-            return "Извините, произошла ошибка при обработке запроса GPT-5. Попробуйте позже."
+            logger.info("🌐 OpenAI: Используется прокси %s:%s", OPENAI_PROXY_HOST, OPENAI_PROXY_PORT)
+        
+        return {'headers': headers, 'json': payload, 'proxies': proxies}
+    
+    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
+        """Генерация ответа через OpenAI API"""
+        # Получаем настройки для типа задачи
+        settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
+        
+        response_json = self._post_json(OPENAI_API_URL, settings['timeout'],
+                                        **self._build_request(messages, settings, stream=False))
+        self._record_usage(response_json)
+        return self._extract_content(response_json)
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        """Потоковая генерация через OpenAI API (SSE)"""
+        settings = LLM_TASK_SETTINGS.get(task_type, LLM_TASK_SETTINGS['verification'])
+        yield from self._post_stream(OPENAI_API_URL, settings['timeout'],
+                                     **self._build_request(messages, settings, stream=True))
 
 class LLMFactory:
     """Фабрика для создания LLM сервисов"""
@@ -167,13 +343,49 @@ class LLMFactory:
     
     @classmethod
     def create_service(cls, service_type: str) -> BaseLLMService:
-        """Создать LLM сервис по типу"""
-        service_class = cls._services.get(service_type.lower())
-        if service_class:
-            return service_class()
-        else:
-            print(f"⚠️ Неизвестный тип LLM: {service_type}, используем GigaChat")
-            return GigaChatService()
+        """
+        Создать LLM сервис по типу
+        
+        Сервис оборачивается в клиентские лимиты бэкенда, политику повторов/автомат защиты, при включенной маршрутизации -
+        в маршрутизатор со вторым бэкендом, и, если включен, в кэш ответов. Снаружи - запись сессий
+        или воспроизведение записи (session_recorder), если они включены.
+        """
+        service_type = service_type.lower()
+        if service_type not in cls._services:
+            logger.warning("⚠️ Неизвестный тип LLM: %s, используем GigaChat", service_type)
+            service_type = 'gigachat'
+        
+        service = cls._create_resilient(service_type)
+        
+        if LLM_ROUTING_ENABLED:
+            secondary_type = 'openai' if service_type == 'gigachat' else 'gigachat'
+            if cls._is_configured(secondary_type):
+                from llm_router import RoutingLLMService
+                service = RoutingLLMService(service, cls._create_resilient(secondary_type))
+        
+        from llm_cache import CachedLLMService, get_response_cache
+        cache = get_response_cache()
+        if cache is not None:
+            service = CachedLLMService(service, cache)
+        
+        # Запись сессий видит все запросы бота, включая попадания в кэш
+        from session_recorder import wrap_llm_service
+        return wrap_llm_service(service, service_type)
+    
+    @classmethod
+    def _create_resilient(cls, service_type: str) -> BaseLLMService:
+        """Сервис с повторами и автоматом защиты; каждая попытка проходит через лимиты бэкенда"""
+        from llm_resilience import ResilientLLMService
+        from llm_rate_limiter import RateLimitedLLMService, get_backend_governor
+        service = RateLimitedLLMService(cls._services[service_type](), get_backend_governor(service_type))
+        return ResilientLLMService(service)
+    
+    @staticmethod
+    def _is_configured(service_type: str) -> bool:
+        """Заданы ли ключи доступа к бэкенду"""
+        if service_type == 'gigachat':
+            return bool(GIGACHAT_AUTH)
+        return bool(OPENAI_API_KEY)
     
     @classmethod
     def get_available_services(cls) -> Dict[str, BaseLLMService]:
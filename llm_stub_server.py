@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка LLM для нагрузочного тестирования без платных запросов
+
+Поддерживает протоколы:
+    GigaChat - POST /api/v2/oauth (токен) и POST /api/v1/chat/completions
+    OpenAI   - POST /v1/chat/completions
+Структурированные ответы (функция submit_response GigaChat, response_format OpenAI)
+строятся по переданной схеме, потоковые (stream=true) отдаются как SSE.
+GET /stats - счетчики запросов.
+
+Сценарий (JSON файл, все поля необязательны - см. DEFAULT_SCENARIO):
+    seed         - зерно генератора задержек и ошибок
+    latency      - распределение задержки до ответа (до первого фрагмента в потоке):
+                   {"distribution": "fixed", "ms": 500}
+                   {"distribution": "uniform", "min_ms": 200, "max_ms": 900}
+                   {"distribution": "normal", "mean_ms": 600, "stddev_ms": 150}
+                   {"distribution": "lognormal", "median_ms": 600, "sigma": 0.4}
+    stream_chunk_chars, stream_chunk_ms - размер фрагмента потока и пауза между фрагментами
+    errors       - доли ответов 429 (rate_limit), 500 (server_error) и зависаний (timeout),
+                   hang_seconds - длительность зависания
+    faults       - детерминированные сбои: список, по элементу на очередной запрос к чату
+                   (после исчерпания - обычное поведение):
+                   {"status": 429, "retry_after": 2} - ответ с кодом (retry_after - заголовок Retry-After)
+                   {"hang_seconds": 5}               - зависание перед ответом 504
+                   {"stream_break_after": 1}         - обрыв потока после N фрагментов
+                   null                              - запрос без сбоя
+    accept_rate  - доля принятых ответов при проверке (булевы поля структурированного ответа)
+    rules        - сценарные ответы: первый подошедший шаблон (regex по тексту промпта);
+                   response - текст, группы шаблона подставляются как \\1; у правила может быть свой latency
+
+Содержимое ответов детерминировано: зависит только от промпта. Задержки и ошибки
+воспроизводимы по seed (при параллельных запросах - с точностью до порядка их прихода).
+
+Пример:
+    python llm_stub_server.py --port 8900 --scenario stub_scenario.json
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+DEFAULT_SCENARIO = {
+    'seed': 42,
+    'latency': {'distribution': 'lognormal', 'median_ms': 600, 'sigma': 0.4},
+    'stream_chunk_chars': 24,
+    'stream_chunk_ms': 40,
+    'errors': {'rate_limit': 0.0, 'server_error': 0.0, 'timeout': 0.0, 'hang_seconds': 130},
+    'accept_rate': 0.85,
+    'rules': [
+        {
+            # AnswerCompilerAgent - итоговый ответ = последняя реплика пользователя
+            'pattern': r'итоговый ответ пользователя(?:.|\n)*Пользователь: ([^\n]+)\n',
+            'response': r'\1'
+        },
+        {
+            # FunctionalityAgent
+            'pattern': r'сгенерировать функционал должности',
+            'response': "• Выполнение плана продаж по закрепленным клиентам\n"
+                        "• Поиск и привлечение новых клиентов\n"
+                        "• Подготовка коммерческих предложений и ведение переговоров\n"
+                        "• Сопровождение сделок и контроль оплаты\n"
+                        "• Ведение клиентской базы в CRM и отчетность руководителю"
+        },
+        {
+            # Объяснение конфликта (conflictator)
+            'pattern': r'логическое противоречие',
+            'response': "Ответы на эти вопросы описывают роль по-разному: в одном случае она выглядит "
+                        "исполнительской, в другом - управленческой. Уточните, пожалуйста, оба ответа."
+        }
+    ],
+    'default_response': "Принято."
+}
+
+# Уточняющий вопрос при непринятом ответе
+CLARIFYING_QUESTION = "Уточните, пожалуйста, ваш ответ: приведите конкретный пример из работы этой роли."
+
+# Допустимые уровни из инструкции ClassificationAgent: 'где N - 1, 2, 3'
+_LEVELS_PATTERN = re.compile(r'где N - ([\d,\s]+)')
+
+
+class LatencyModel:
+    """Распределение задержки ответа (в секундах)"""
+    
+    def __init__(self, spec: Dict):
+        self.spec = spec
+        self.distribution = spec.get('distribution', 'fixed')
+        if self.distribution not in ('fixed', 'uniform', 'normal', 'lognormal'):
+            raise ValueError(f"Неизвестное распределение задержки: {self.distribution}")
+    
+    def sample(self, rng: random.Random) -> float:
+        spec = self.spec
+        if self.distribution == 'fixed':
+            ms = spec.get('ms', 0)
+        elif self.distribution == 'uniform':
+            ms = rng.uniform(spec.get('min_ms', 0), spec.get('max_ms', 0))
+        elif self.distribution == 'normal':
+            ms = rng.gauss(spec.get('mean_ms', 0), spec.get('stddev_ms', 0))
+        else:
+            ms = rng.lognormvariate(0, spec.get('sigma', 0.5)) * spec.get('median_ms', 0)
+        return max(0.0, ms) / 1000
+
+
+class StubScenario:
+    """Ответы, задержки и ошибки заглушки"""
+    
+    def __init__(self, config: Optional[Dict] = None):
+        config = {**DEFAULT_SCENARIO, **(config or {})}
+        self.config = config
+        self.latency = LatencyModel(config['latency'])
+        self.stream_chunk_chars = max(1, int(config['stream_chunk_chars']))
+        self.stream_chunk_ms = float(config['stream_chunk_ms'])
+        self.errors = {**DEFAULT_SCENARIO['errors'], **config.get('errors', {})}
+        self.accept_rate = float(config['accept_rate'])
+        self.default_response = config['default_response']
+        self._faults = deque(config.get('faults') or [])
+        self.rules = [
+            {
+                'pattern': re.compile(rule['pattern']),
+                'response': rule['response'],
+                'latency': LatencyModel(rule['latency']) if rule.get('latency') else None
+            }
+            for rule in config['rules']
+        ]
+        self._rng = random.Random(config['seed'])
+        self._rng_lock = threading.Lock()
+    
+    def random(self) -> float:
+        with self._rng_lock:
+            return self._rng.random()
+    
+    def sample_latency(self, prompt: str) -> float:
+        rule = self._match(prompt)
+        model = rule[0]['latency'] if rule and rule[0]['latency'] else self.latency
+        with self._rng_lock:
+            return model.sample(self._rng)
+    
+    def next_fault(self) -> Optional[Dict]:
+        """Очередной сбой из списка faults (None - без сбоя)"""
+        with self._rng_lock:
+            return self._faults.popleft() if self._faults else None
+    
+    def sample_error(self) -> Optional[str]:
+        """'rate_limit', 'server_error', 'timeout' или None"""
+        roll = self.random()
+        for kind in ('rate_limit', 'server_error', 'timeout'):
+            rate = float(self.errors.get(kind, 0))
+            if roll < rate:
+                return kind
+            roll -= rate
+        return None
+    
+    def _match(self, prompt: str):
+        for rule in self.rules:
+            match = rule['pattern'].search(prompt)
+            if match:
+                return rule, match
+        return None
+    
+    def text_answer(self, prompt: str) -> str:
+        rule = self._match(prompt)
+        if rule is None:
+            return self.default_response
+        rule, match = rule
+        return match.expand(rule['response']).strip()
+    
+    @staticmethod
+    def _pick(prompt: str, salt: str) -> float:
+        """Детерминированное число [0, 1) по промпту"""
+        digest = hashlib.sha1(f"{salt}\n{prompt}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64
+    
+    def structured_answer(self, schema: Dict, prompt: str) -> Dict:
+        """Значения полей по схеме: булевы - с долей accept_rate, целые - из допустимых уровней"""
+        answer = {}
+        for name, prop in (schema.get('properties') or {}).items():
+            prop_type = prop.get('type')
+            if prop_type == 'boolean':
+                answer[name] = self._pick(prompt, name) < self.accept_rate
+            elif prop_type in ('integer', 'number'):
+                match = _LEVELS_PATTERN.search(prompt)
+                levels = [int(level) for level in re.findall(r'\d+', match.group(1))] if match else [1]
+                answer[name] = levels[int(self._pick(prompt, name) * len(levels))]
+            elif prop_type == 'string':
+                rejected = any(value is False for value in answer.values())
+                answer[name] = CLARIFYING_QUESTION if rejected else ""
+            else:
+                answer[name] = None
+        return answer
+
+
+class LLMStubServer(ThreadingHTTPServer):
+    """HTTP сервер заглушки; запускается в фоновом потоке или из командной строки"""
+    
+    daemon_threads = True
+    
+    def __init__(self, scenario: StubScenario = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _StubRequestHandler)
+        self.scenario = scenario or StubScenario()
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._tokens = set()
+        self._thread: Optional[threading.Thread] = None
+    
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+    
+    def env(self) -> Dict[str, str]:
+        """Переменные окружения, направляющие бота в заглушку (задать до импорта config)"""
+        return {
+            'GIGACHAT_AUTH': 'stub',
+            'GIGACHAT_TOKEN_URL': f"{self.url}/api/v2/oauth",
+            'GIGACHAT_API_URL': f"{self.url}/api/v1/chat/completions",
+            'OPENAI_API_KEY': 'stub',
+            'OPENAI_API_URL': f"{self.url}/v1/chat/completions",
+            'OPENAI_USE_PROXY': 'False'
+        }
+    
+    def count(self, key: str, amount: int = 1) -> None:
+        with self._stats_lock:
+            self.stats[key] += amount
+    
+    def get_stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self.stats)
+    
+    def issue_token(self) -> str:
+        token = uuid.uuid4().hex
+        with self._stats_lock:
+            self._tokens.add(token)
+        return token
+    
+    def is_valid_token(self, token: str) -> bool:
+        with self._stats_lock:
+            return token in self._tokens
+    
+    def start(self) -> "LLMStubServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="llm-stub", daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов GigaChat/OpenAI"""
+    
+    protocol_version = "HTTP/1.1"
+    server: LLMStubServer
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.server.get_stats())
+        else:
+            self._send_json(404, {'error': 'not found'})
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path == '/api/v2/oauth':
+            self._handle_oauth()
+        elif self.path == '/api/v1/chat/completions':
+            self._handle_chat(body, 'gigachat')
+        elif self.path == '/v1/chat/completions':
+            self._handle_chat(body, 'openai')
+        else:
+            self._send_json(404, {'error': 'not found'})
+    
+    def _handle_oauth(self):
+        self.server.count('gigachat.oauth')
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            self._send_json(401, {'code': 6, 'message': 'credentials doesn\'t match db data'})
+            return
+        expires_at = int((time.time() + 1800) * 1000)
+        self._send_json(200, {'access_token': self.server.issue_token(), 'expires_at': expires_at})
+    
+    def _handle_chat(self, body: bytes, backend: str):
+        server = self.server
+        scenario = server.scenario
+        
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer ') or (
+                backend == 'gigachat' and not server.is_valid_token(authorization[len('Bearer '):])):
+            server.count(f"{backend}.unauthorized")
+            self._send_json(401, {'error': {'message': 'unauthorized'}})
+            return
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'invalid json'}})
+            return
+        
+        stream = bool(payload.get('stream'))
+        schema = self._response_schema(payload)
+        prompt = "\n".join(str(message.get('content') or '') for message in payload.get('messages', []))
+        server.count(f"{backend}.chat")
+        server.count(f"{backend}.{'stream' if stream else ('structured' if schema else 'text')}")
+        
+        fault = scenario.next_fault() or {}
+        if fault.get('status'):
+            status = int(fault['status'])
+            server.count(f"{backend}.fault_{status}")
+            headers = {'Retry-After': str(fault['retry_after'])} if fault.get('retry_after') is not None else None
+            self._send_json(status, {'error': {'message': f'injected fault {status}'}}, headers)
+            return
+        if fault.get('hang_seconds'):
+            server.count(f"{backend}.fault_timeout")
+            time.sleep(float(fault['hang_seconds']))
+            self._send_json(504, {'error': {'message': 'timeout'}})
+            return
+        
+        error = scenario.sample_error()
+        if error == 'rate_limit':
+            server.count(f"{backend}.error_429")
+            self._send_json(429, {'error': {'message': 'too many requests'}}, {'Retry-After': '1'})
+            return
+        if error == 'server_error':
+            server.count(f"{backend}.error_500")
+            self._send_json(500, {'error': {'message': 'internal error'}})
+            return
+        if error == 'timeout':
+            # Клиент уйдет по таймауту раньше, чем заглушка ответит
+            server.count(f"{backend}.error_timeout")
+            time.sleep(float(scenario.errors.get('hang_seconds', 130)))
+            self._send_json(504, {'error': {'message': 'timeout'}})
+            return
+        
+        time.sleep(scenario.sample_latency(prompt))
+        
+        if schema is not None:
+            content = json.dumps(scenario.structured_answer(schema, prompt), ensure_ascii=False)
+        else:
+            content = scenario.text_answer(prompt)
+        server.count(f"{backend}.prompt_tokens", len(prompt) // 3)
+        server.count(f"{backend}.completion_tokens", len(content) // 3)
+        
+        if stream:
+            self._send_stream(payload, content, fault.get('stream_break_after'))
+        else:
+            self._send_json(200, self._completion(payload, backend, content, schema is not None, len(prompt) // 3))
+    
+    @staticmethod
+    def _response_schema(payload: Dict) -> Optional[Dict]:
+        """Схема структурированного ответа: функция GigaChat или response_format OpenAI"""
+        if payload.get('functions') and payload.get('function_call'):
+            name = payload['function_call'].get('name') if isinstance(payload['function_call'], dict) else None
+            for function in payload['functions']:
+                if name is None or function.get('name') == name:
+                    return function.get('parameters') or {}
+        response_format = payload.get('response_format') or {}
+        if response_format.get('type') == 'json_schema':
+            return (response_format.get('json_schema') or {}).get('schema') or {}
+        return None
+    
+    @staticmethod
+    def _completion(payload: Dict, backend: str, content: str, structured: bool, prompt_tokens: int) -> Dict:
+        message = {'role': 'assistant', 'content': content}
+        finish_reason = 'stop'
+        if structured and backend == 'gigachat':
+            # GigaChat возвращает аргументы вызова функции объектом
+            name = (payload.get('function_call') or {}).get('name', 'submit_response')
+            message = {'role': 'assistant', 'content': '',
+                       'function_call': {'name': name, 'arguments': json.loads(content)}}
+            finish_reason = 'function_call'
+        return {
+            'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 3,
+                      'total_tokens': prompt_tokens + len(content) // 3}
+        }
+    
+    def _send_json(self, status: int, data: Dict, headers: Dict[str, str] = None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_stream(self, payload: Dict, content: str, break_after: Optional[int] = None):
+        """Ответ фрагментами SSE (chunked), как у API в режиме stream=true; break_after - обрыв после N фрагментов"""
+        scenario = self.server.scenario
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        
+        size = scenario.stream_chunk_chars
+        pieces: List[str] = [content[i:i + size] for i in range(0, len(content), size)]
+        try:
+            for index, piece in enumerate(pieces):
+                if break_after is not None and index >= break_after:
+                    # Соединение закрывается без завершающего фрагмента
+                    self.server.count('stream_broken')
+                    self.close_connection = True
+                    return
+                if index:
+                    time.sleep(scenario.stream_chunk_ms / 1000)
+                event = {
+                    'created': int(time.time()),
+                    'model': payload.get('model', 'stub'),
+                    'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': piece}}]
+                }
+                self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент закрыл поток раньше времени
+            self.server.count('stream_aborted')
+    
+    def _write_chunk(self, text: str):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+def load_scenario(path: Optional[str]) -> StubScenario:
+    """Сценарий из JSON файла (None - сценарий по умолчанию)"""
+    if not path:
+        return StubScenario()
+    with open(path, 'r', encoding='utf-8') as f:
+        return StubScenario(json.load(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка GigaChat/OpenAI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--scenario", help="JSON файл сценария")
+    args = parser.parse_args()
+    
+    server = LLMStubServer(load_scenario(args.scenario), args.host, args.port)
+    print(f"🧪 Заглушка LLM запущена на {server.url}")
+    print("Переменные окружения для бота:")
+    for key, value in server.env().items():
+        print(f"  {key}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Остановка заглушки")
+        print(json.dumps(server.get_stats(), ensure_ascii=False, indent=2))
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота на локальной заглушке LLM
+
+N виртуальных пользователей параллельно проходят опрос целиком (/start, выбор LLM,
+все вопросы, адаптивные Q11/Q12, функционал Q18, отчет), вызывая обработчики
+TelegramBot напрямую через поддельные объекты Telegram. Бот работает с копией базы
+во временном каталоге, LLM - с заглушкой llm_stub_server (или с указанным --stub-url).
+
+Отчет: пропускная способность, p50/p95/p99 длительности хода (обработки одного
+сообщения/нажатия), число вызовов Database, запросов к LLM и к Telegram.
+
+Пример:
+    python load_test.py --users 20 --llm gigachat --scenario stub_scenario.json --json result.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+from llm_stub_server import LLMStubServer, load_scenario
+
+# Ответы на вопросы без примера в тексте вопроса
+DEFAULT_ANSWERS = {
+    1: "Менеджер по продажам",
+    3: "Обеспечивать выручку компании за счет продаж продукции корпоративным клиентам",
+    18: "Ведение переговоров с клиентами"
+}
+# Повторный ответ после конфликта - другими словами (иначе детерминированная заглушка
+# снова даст те же уровни и конфликт повторится)
+REPHRASINGS = [
+    "; в основном под контролем руководителя",
+    "; решения согласовываются с руководителем отдела",
+    "; часть задач выполняется самостоятельно",
+    "; полномочия шире, чем у рядового специалиста",
+    "; работа типовая, по утвержденным регламентам"
+]
+CLARIFICATION_ANSWER = "Например, ежедневно веду переговоры с 5-10 клиентами и сам выбираю, как выполнить месячный план"
+_EXAMPLE_PATTERN = re.compile(r'Например, для менеджера по продажам:\s*(.+)', re.DOTALL)
+
+
+def example_answer(question_id: int, question_text: str) -> str:
+    """Ответ виртуального пользователя - пример из текста вопроса"""
+    match = _EXAMPLE_PATTERN.search(question_text or "")
+    if match:
+        return match.group(1).strip()
+    return DEFAULT_ANSWERS.get(question_id, "Затрудняюсь ответить подробнее, роль типовая для отдела продаж")
+
+
+def percentile(samples: List[float], p: float) -> Optional[float]:
+    """Перцентиль p (0-100) отсортированной выборки"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def latency_stats(samples: List[float]) -> Dict:
+    """Число, p50/p95/p99 и максимум длительностей (в мс)"""
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 1) if samples else None,
+        'p95_ms': round(percentile(samples, 95) * 1000, 1) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 1) if samples else None,
+        'max_ms': round(samples[-1] * 1000, 1) if samples else None
+    }
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"Load{user_id}"
+        self.username = f"load_{user_id}"
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.type = "private"
+
+
+class FakeBot:
+    """Клиент Telegram: считает вызовы и (опционально) имитирует задержку API"""
+    
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+        self.calls = Counter()
+    
+    async def call(self, method: str) -> None:
+        self.calls[method] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+    
+    async def send_chat_action(self, chat_id: int, action: str, **kwargs):
+        await self.call('send_chat_action')
+    
+    async def send_document(self, chat_id: int, document, caption: str = None, **kwargs):
+        await self.call('send_document')
+    
+    async def set_my_commands(self, commands, **kwargs):
+        await self.call('set_my_commands')
+
+
+class FakeMessage:
+    """Сообщение в чате виртуального пользователя (его собственное или бота)"""
+    
+    def __init__(self, chat: "VirtualChat", text: str, from_user: FakeUser, reply_markup=None):
+        self.chat_ref = chat
+        self.chat = chat.chat
+        self.bot = chat.bot
+        self.from_user = from_user
+        self.text = text
+        self.reply_markup = reply_markup
+        self.deleted = False
+    
+    async def answer(self, text: str, reply_markup=None, parse_mode: str = None, **kwargs) -> "FakeMessage":
+        await self.bot.call('send_message')
+        return self.chat_ref.add_bot_message(text, reply_markup)
+    
+    async def edit_text(self, text: str, reply_markup=None, parse_mode: str = None, **kwargs) -> "FakeMessage":
+        await self.bot.call('edit_message_text')
+        self.text = text
+        self.reply_markup = reply_markup
+        return self
+    
+    async def edit_reply_markup(self, reply_markup=None, **kwargs) -> "FakeMessage":
+        await self.bot.call('edit_message_reply_markup')
+        self.reply_markup = reply_markup
+        return self
+    
+    async def delete(self, **kwargs) -> bool:
+        await self.bot.call('delete_message')
+        self.deleted = True
+        return True
+
+
+class FakeCallbackQuery:
+    def __init__(self, from_user: FakeUser, data: str, message: FakeMessage):
+        self.id = str(random.getrandbits(32))
+        self.from_user = from_user
+        self.data = data
+        self.message = message
+    
+    async def answer(self, text: str = None, **kwargs) -> bool:
+        await self.message.bot.call('answer_callback_query')
+        return True
+
+
+class VirtualChat:
+    """Переписка одного пользователя с ботом"""
+    
+    def __init__(self, user_id: int, bot: FakeBot):
+        self.user = FakeUser(user_id)
+        self.chat = FakeChat(user_id)
+        self.bot = bot
+        self.bot_user = FakeUser(0)
+        self.messages: List[FakeMessage] = []
+        # Сообщения бота после последнего действия пользователя
+        self.since_action = 0
+    
+    def add_bot_message(self, text: str, reply_markup) -> FakeMessage:
+        message = FakeMessage(self, text, self.bot_user, reply_markup)
+        self.messages.append(message)
+        return message
+    
+    def new_bot_messages(self) -> List[FakeMessage]:
+        return [message for message in self.messages[self.since_action:] if not message.deleted]
+    
+    def user_message(self, text: str) -> FakeMessage:
+        self.since_action = len(self.messages)
+        return FakeMessage(self, text, self.user)
+
+
+def callback_handler(telegram_bot, data: str):
+    """Обработчик TelegramBot для callback_data (как при регистрации в Dispatcher) и тип хода"""
+    if data.startswith(("q11_", "q12_")):
+        return telegram_bot.handle_adaptive_callback, 'adaptive'
+    if data == "restart_from_q8":
+        return telegram_bot.handle_restart_callback, 'restart'
+    if data.startswith("func_"):
+        return telegram_bot.handle_functionality_callback, 'functionality'
+    if data.startswith("llm_"):
+        return telegram_bot.handle_llm_selection, 'llm_selection'
+    if data == "start_interview":
+        return telegram_bot.handle_start_interview, 'start_interview'
+    raise ValueError(f"неизвестная кнопка {data}")
+
+
+class VirtualUser:
+    """Проходит опрос, выбирая ответы детерминированно по своему номеру"""
+    
+    def __init__(self, telegram_bot, fake_bot: FakeBot, user_id: int, llm_type: str,
+                 think_time: float = 0.0, max_turns: int = 120):
+        self.telegram_bot = telegram_bot
+        self.chat = VirtualChat(user_id, fake_bot)
+        self.user_id = user_id
+        self.llm_type = llm_type
+        self.think_time = think_time
+        self.max_turns = max_turns
+        self.rng = random.Random(user_id)
+        self.turns: List[Dict] = []
+        self.attempts = Counter()
+        self.completed = False
+        self.error: Optional[str] = None
+    
+    async def run(self) -> None:
+        bot = self.telegram_bot
+        try:
+            await self._turn('start', bot.start_command(self.chat.user_message("/start")))
+            while len(self.turns) < self.max_turns:
+                if self.think_time:
+                    await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.think_time)
+                button = self._pending_button()
+                if button is not None:
+                    await self._press(*button)
+                elif self.user_id in bot.active_sessions:
+                    await self._answer()
+                else:
+                    self.completed = True
+                    return
+            self.error = f"не завершил опрос за {self.max_turns} ходов"
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+    
+    async def _turn(self, kind: str, handler_call) -> None:
+        started = time.perf_counter()
+        await handler_call
+        self.turns.append({'kind': kind, 'seconds': time.perf_counter() - started})
+    
+    def _pending_button(self):
+        """Inline кнопка из последних сообщений бота: (сообщение, callback_data)"""
+        for message in reversed(self.chat.new_bot_messages()):
+            if isinstance(message.reply_markup, InlineKeyboardMarkup):
+                data = [button.callback_data for row in message.reply_markup.inline_keyboard for button in row]
+                if any(item.startswith("llm_") for item in data):
+                    return message, f"llm_{self.llm_type}"
+                # Пересдачу выбираем, только если других кнопок нет
+                answers = [item for item in data if item != "restart_from_q8"] or data
+                return message, self.rng.choice(answers)
+        return None
+    
+    async def _press(self, message: FakeMessage, data: str) -> None:
+        handler, kind = callback_handler(self.telegram_bot, data)
+        self.chat.since_action = len(self.chat.messages)
+        await self._turn(kind, handler(FakeCallbackQuery(self.chat.user, data, message)))
+    
+    async def _answer(self) -> None:
+        new_messages = self.chat.new_bot_messages()
+        text = None
+        # Вопрос с вариантами - выбираем кнопку reply клавиатуры
+        for message in reversed(new_messages):
+            if isinstance(message.reply_markup, ReplyKeyboardMarkup):
+                options = [button.text for row in message.reply_markup.keyboard for button in row]
+                text = self.rng.choice(options)
+                break
+        if text is None:
+            if any(message.text.startswith("❓") for message in new_messages):
+                text = CLARIFICATION_ANSWER
+            else:
+                state = self.telegram_bot.active_sessions[self.user_id]['state']
+                question_id = state['remaining_questions'][0] if state['remaining_questions'] else None
+                question = self.telegram_bot.db.get_question(question_id) if question_id else None
+                text = example_answer(question_id, question['question'] if question else "")
+                self.attempts[question_id] += 1
+                if self.attempts[question_id] > 1:
+                    text += self.rng.choice(REPHRASINGS)
+        await self._turn('message', self.telegram_bot.handle_message(self.chat.user_message(text)))
+
+
+def count_database_calls(db, counter: Counter) -> None:
+    """Подсчет вызовов публичных методов Database (включая вызовы из фоновых потоков)"""
+    lock = threading.Lock()
+    
+    def wrap(name, method):
+        def counted(*args, **kwargs):
+            with lock:
+                counter[name] += 1
+            return method(*args, **kwargs)
+        return counted
+    
+    for name in dir(db):
+        if name.startswith('_'):
+            continue
+        method = getattr(db, name)
+        if callable(method):
+            setattr(db, name, wrap(name, method))
+
+
+async def run_load_test(users: int, llm_type: str, concurrency: int, think_time: float,
+                        telegram_latency: float, max_turns: int, db_path: str, workdir: str) -> Dict:
+    # Модули бота импортируются после настройки окружения (config читается при импорте)
+    from database import Database
+    from telegram_bot import TelegramBot
+    
+    db = Database(db_path)
+    db_calls = Counter()
+    count_database_calls(db, db_calls)
+    fake_bot = FakeBot(telegram_latency)
+    reports_dir = os.path.join(workdir, "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+    telegram_bot = TelegramBot(bot=fake_bot, db=db, reports_dir=reports_dir)
+    
+    # Идентификаторы вне диапазона реальных пользователей Telegram
+    virtual_users = [
+        VirtualUser(telegram_bot, fake_bot, 9_000_000_000 + index, llm_type, think_time, max_turns)
+        for index in range(users)
+    ]
+    semaphore = asyncio.Semaphore(concurrency or users)
+    
+    async def run_user(virtual_user: VirtualUser):
+        async with semaphore:
+            await virtual_user.run()
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(virtual_user) for virtual_user in virtual_users))
+    duration = time.perf_counter() - started
+    
+    turns = [turn for virtual_user in virtual_users for turn in virtual_user.turns]
+    by_kind: Dict[str, List[float]] = {}
+    for turn in turns:
+        by_kind.setdefault(turn['kind'], []).append(turn['seconds'])
+    
+    completed = [virtual_user for virtual_user in virtual_users if virtual_user.completed]
+    return {
+        'users': users,
+        'llm': llm_type,
+        'completed': len(completed),
+        'failed': {str(virtual_user.user_id): virtual_user.error
+                   for virtual_user in virtual_users if not virtual_user.completed},
+        'duration_seconds': round(duration, 2),
+        'turns': len(turns),
+        'turns_per_second': round(len(turns) / duration, 2) if duration else None,
+        'interviews_per_minute': round(len(completed) / duration * 60, 2) if duration else None,
+        'turn_latency': latency_stats([turn['seconds'] for turn in turns]),
+        'turn_latency_by_kind': {kind: latency_stats(samples) for kind, samples in sorted(by_kind.items())},
+        'db_calls_total': sum(db_calls.values()),
+        'db_calls': dict(db_calls.most_common()),
+        'telegram_calls': dict(fake_bot.calls.most_common())
+    }
+
+
+def print_report(result: Dict) -> None:
+    print("\n" + "=" * 70)
+    print("📊 РЕЗУЛЬТАТЫ НАГРУЗОЧНОГО ТЕСТА")
+    print("=" * 70)
+    print(f"Пользователей: {result['users']} ({result['llm']}), завершили опрос: {result['completed']}")
+    for user_id, error in result['failed'].items():
+        print(f"  ❌ {user_id}: {error}")
+    print(f"Длительность: {result['duration_seconds']} с, ходов: {result['turns']}")
+    print(f"Пропускная способность: {result['turns_per_second']} ходов/с, "
+          f"{result['interviews_per_minute']} опросов/мин")
+    latency = result['turn_latency']
+    print(f"Длительность хода: p50 {latency['p50_ms']} мс, p95 {latency['p95_ms']} мс, "
+          f"p99 {latency['p99_ms']} мс, max {latency['max_ms']} мс")
+    for kind, stats in result['turn_latency_by_kind'].items():
+        print(f"  {kind:<16} n={stats['count']:<5} p50 {stats['p50_ms']} мс, p95 {stats['p95_ms']} мс, "
+              f"p99 {stats['p99_ms']} мс")
+    print(f"Вызовов Database: {result['db_calls_total']}")
+    for name, count in list(result['db_calls'].items())[:10]:
+        print(f"  {name:<32} {count}")
+    print("Запросы к LLM:")
+    for name, count in sorted(result['llm_calls'].items()):
+        print(f"  {name:<32} {count}")
+    print("Вызовы Telegram:")
+    for name, count in result['telegram_calls'].items():
+        print(f"  {name:<32} {count}")
+    print("=" * 70)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушке LLM")
+    parser.add_argument("--users", type=int, default=10, help="Число виртуальных пользователей")
+    parser.add_argument("--concurrency", type=int, default=0, help="Одновременно активных (0 - все)")
+    parser.add_argument("--llm", default="gigachat", choices=["gigachat", "openai"])
+    parser.add_argument("--scenario", help="JSON сценарий заглушки (см. llm_stub_server.py)")
+    parser.add_argument("--stub-url", help="Уже запущенная заглушка вместо встроенной")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Пауза пользователя между ходами, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Имитация задержки API Telegram, с")
+    parser.add_argument("--max-turns", type=int, default=120, help="Предел ходов на пользователя")
+    parser.add_argument("--db", default="data/database.db", help="База, копия которой используется в тесте")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результаты в JSON")
+    parser.add_argument("--verbose", action="store_true", help="Не подавлять вывод бота")
+    args = parser.parse_args()
+    
+    workdir = tempfile.mkdtemp(prefix="hay_load_test_")
+    db_path = os.path.join(workdir, "database.db")
+    shutil.copyfile(args.db, db_path)
+    
+    server = None
+    if args.stub_url:
+        stub_url = args.stub_url.rstrip('/')
+        os.environ.update({
+            'GIGACHAT_AUTH': 'stub',
+            'GIGACHAT_TOKEN_URL': f"{stub_url}/api/v2/oauth",
+            'GIGACHAT_API_URL': f"{stub_url}/api/v1/chat/completions",
+            'OPENAI_API_KEY': 'stub',
+            'OPENAI_API_URL': f"{stub_url}/v1/chat/completions",
+            'OPENAI_USE_PROXY': 'False'
+        })
+    else:
+        server = LLMStubServer(load_scenario(args.scenario)).start()
+        stub_url = server.url
+        os.environ.update(server.env())
+    # Кэш LLM - отдельный для прогона, иначе повторные прогоны меряют кэш
+    os.environ['LLM_CACHE_PATH'] = os.path.join(workdir, "llm_cache.db")
+    print(f"🧪 Заглушка LLM: {stub_url}, рабочий каталог: {workdir}")
+    
+    if args.verbose:
+        from app_logging import setup_logging
+        setup_logging()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            result = asyncio.run(run_load_test(args.users, args.llm, args.concurrency, args.think_time,
+                                               args.telegram_latency, args.max_turns, db_path, workdir))
+        if server is not None:
+            result['llm_calls'] = server.get_stats()
+        else:
+            import requests
+            result['llm_calls'] = requests.get(f"{stub_url}/stats", timeout=10).json()
+    finally:
+        if server is not None:
+            server.stop()
+    
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Трассировка ходов пользователя и метрики в формате Prometheus
+
+Ход (turn) - обработка одного сообщения пользователя; внутри него участки (span):
+чтение БД, проверка, сводка, классификация, проверка конфликтов, пересборка портрета,
+сохранение состояния, отправка в Telegram. Длительности и токены LLM копятся в гистограммах
+и отдаются по HTTP (GET /metrics) для Prometheus. Текущие значения (очереди, перцентили задержек)
+модули отдают через register_collector.
+
+При METRICS_ENABLED=False turn() и span() возвращают общий пустой контекст - накладные
+расходы сводятся к одной проверке флага.
+
+Пример:
+    with metrics.turn('message'):
+        with metrics.span('classification'):
+            ...
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+from app_logging import get_logger
+
+logger = get_logger('bot')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+# Описание метрик: имя -> (тип, подсказка, границы корзин гистограммы)
+METRIC_FAMILIES = {
+    'hay_turn_duration_seconds': ('histogram', 'Длительность хода пользователя', DURATION_BUCKETS),
+    'hay_span_duration_seconds': ('histogram', 'Длительность участка хода', DURATION_BUCKETS),
+    'hay_span_tokens': ('histogram', 'Токены LLM на участке хода', TOKEN_BUCKETS),
+    'hay_llm_tokens_total': ('counter', 'Токены LLM (в том числе вне ходов)', None),
+    'hay_llm_cache_requests_total': ('counter', 'Обращения к кэшу ответов LLM (result: hit/miss)', None),
+    'hay_llm_cache_saved_seconds_total': ('counter', 'Время ответов LLM, сэкономленное кэшем', None),
+    'hay_llm_latency_seconds': ('gauge', 'Перцентиль задержки успешных ответов бэкенда (окно последних запросов)', None),
+    'hay_llm_queue_wait_seconds': ('histogram', 'Ожидание запроса LLM в очереди клиентских лимитов', DURATION_BUCKETS),
+    'hay_llm_queue_length': ('gauge', 'Запросы LLM, ожидающие места под параллельный запрос', None),
+    'hay_llm_rate_limit_available': ('gauge', 'Остаток токен-бакета клиентских лимитов (bucket: requests/tokens)', None)
+}
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (без блокировки - под блокировкой реестра)"""
+    
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Сборщик текущих значений: () -> [(имя метрики, значение, метки)]
+Collector = Callable[[], Iterable[Tuple[str, float, Dict]]]
+
+
+class MetricsRegistry:
+    """Гистограммы и счетчики с метками; датчики (gauge) - от сборщиков в момент выдачи"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[Tuple, Histogram]] = {}
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._collectors: List[Collector] = []
+    
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(METRIC_FAMILIES[name][2])
+            histogram.observe(value)
+    
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+    
+    def register_collector(self, collector: Collector) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+    
+    def _collect_gauges(self) -> Dict[str, Dict[Tuple, float]]:
+        """Значения датчиков (сборщики вызываются вне блокировки реестра)"""
+        with self._lock:
+            collectors = list(self._collectors)
+        gauges: Dict[str, Dict[Tuple, float]] = {}
+        for collector in collectors:
+            try:
+                for name, value, labels in collector():
+                    gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+            except Exception as e:
+                logger.warning("⚠️ Ошибка сборщика метрик: %s", e)
+        return gauges
+    
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        gauges = self._collect_gauges()
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines += self._header(name)
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{_labels(key + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_labels(key)} {histogram.count}")
+            for name, series in sorted(self._counters.items()) + sorted(gauges.items()):
+                lines += self._header(name)
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    def _header(name: str) -> List[str]:
+        metric_type, help_text = METRIC_FAMILIES[name][:2]
+        return [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(key: Tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+
+registry = MetricsRegistry()
+
+_current_turn: ContextVar[Optional["_Turn"]] = ContextVar('metrics_turn', default=None)
+_current_span: ContextVar[Optional["_Span"]] = ContextVar('metrics_span', default=None)
+
+
+class _NoopContext:
+    """Пустой контекст при выключенных метриках"""
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+    
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int) -> None:
+        pass
+
+
+_NOOP = _NoopContext()
+
+
+class _Turn:
+    """Ход пользователя: общая длительность и разбивка по участкам"""
+    
+    __slots__ = ('kind', 'started', 'spans', '_token')
+    
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.spans: List[Tuple[str, float, int]] = []
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self._token = _current_turn.set(self)
+        return self
+    
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.started
+        _current_turn.reset(self._token)
+        registry.observe('hay_turn_duration_seconds', duration, kind=self.kind)
+        if logger.isEnabledFor(logging.INFO):
+            parts = ", ".join(f"{name} {span_duration * 1000:.0f} мс" + (f" ({tokens} ток.)" if tokens else "")
+                              for name, span_duration, tokens in self.spans)
+            logger.info("⏱️ Ход %s: %.0f мс%s", self.kind, duration * 1000, f" - {parts}" if parts else "",
+                        extra={'turn': self.kind, 'duration_ms': round(duration * 1000)})
+        return False
+
+
+class _Span:
+    """Участок хода; токены LLM относятся к самому внутреннему открытому участку"""
+    
+    __slots__ = ('name', 'started', 'prompt_tokens', 'completion_tokens', '_token')
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+    
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.started
+        _current_span.reset(self._token)
+        registry.observe('hay_span_duration_seconds', duration, span=self.name)
+        tokens = self.prompt_tokens + self.completion_tokens
+        if tokens:
+            registry.observe('hay_span_tokens', self.prompt_tokens, span=self.name, direction='prompt')
+            registry.observe('hay_span_tokens', self.completion_tokens, span=self.name, direction='completion')
+        current_turn = _current_turn.get()
+        if current_turn is not None:
+            current_turn.spans.append((self.name, duration, tokens))
+        return False
+    
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int) -> None:
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+
+def turn(kind: str):
+    """Контекст хода пользователя (kind - тип хода: message, callback...)"""
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _Turn(kind)
+
+
+def span(name: str):
+    """Контекст участка хода"""
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _Span(name)
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    """Увеличить счетчик из METRIC_FAMILIES (при выключенных метриках - ничего)"""
+    if METRICS_ENABLED:
+        registry.inc(name, amount, **labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Значение в гистограмму из METRIC_FAMILIES (при выключенных метриках - ничего)"""
+    if METRICS_ENABLED:
+        registry.observe(name, value, **labels)
+
+
+def register_collector(collector: Collector) -> None:
+    """Сборщик датчиков, вызываемый при каждой выдаче /metrics (при выключенных метриках - ничего)"""
+    if METRICS_ENABLED:
+        registry.register_collector(collector)
+
+
+def record_tokens(prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    """Учесть токены ответа LLM (из поля usage) в текущем участке и в общем счетчике"""
+    if not METRICS_ENABLED:
+        return
+    prompt_tokens = int(prompt_tokens or 0)
+    completion_tokens = int(completion_tokens or 0)
+    registry.inc('hay_llm_tokens_total', prompt_tokens, direction='prompt')
+    registry.inc('hay_llm_tokens_total', completion_tokens, direction='completion')
+    current_span = _current_span.get()
+    if current_span is not None:
+        current_span.add_tokens(prompt_tokens, completion_tokens)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """Запустить HTTP эндпоинт /metrics в фоновом потоке (при выключенных метриках - ничего)"""
+    if not METRICS_ENABLED:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("📈 Метрики доступны на http://%s:%s/metrics", host, server.server_address[1])
+    return server
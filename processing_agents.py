@@ -1,13 +1,218 @@
-from typing import Dict, List, Tuple
-from llm_services import BaseLLMService
+import json
+import logging
+import math
+import re
+from typing import Dict, List, Tuple, Iterator, Optional, Callable
+from config import LLM_TASK_SETTINGS, PORTRAIT_CONTEXT_ALWAYS, PORTRAIT_CONTEXT_QUESTIONS, PORTRAIT_ANSWER_MAX_TOKENS
+from llm_services import BaseLLMService, LLMResponseError
+from llm_cache import cache_only_valid, cache_bypass
+from semantic_cache import get_semantic_cache
+from app_logging import get_logger, prompt_dump_sampled, dump_prompt
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Граница между вопросами в портрете (см. Database.generate_user_portrait)
+_PORTRAIT_SPLIT = re.compile(r'\n\n(?=Вопрос \d+: )')
+_PORTRAIT_ENTRY = re.compile(r'^Вопрос (\d+): (.*?)\n→ Ответ: (.*?)\n→ Уровень: (.*)$', re.DOTALL)
+
+logger = get_logger('agents')
+
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    """
+    Число токенов текста
+    
+    Локальный токенизатор tiktoken (словарь cl100k_base), если установлен и словарь доступен;
+    иначе - оценка ~3 символа на токен (для русского текста обе модели дают близкие значения).
+    Без доступа в интернет словарь загружается заранее в TIKTOKEN_CACHE_DIR (см. requirements.txt),
+    иначе весь бюджет контекста считается по оценке - об этом одно предупреждение в логе.
+    """
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning("⚠️ Токенизатор tiktoken недоступен, используем оценку по символам: %s", e)
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 3)
+
+def split_portrait(portrait: Optional[str]) -> List[Tuple[int, str]]:
+    """Портрет по вопросам: [(номер вопроса, фрагмент портрета)]"""
+    if not portrait:
+        return []
+    entries = []
+    for part in _PORTRAIT_SPLIT.split(portrait):
+        match = re.match(r'Вопрос (\d+): ', part)
+        if match:
+            entries.append((int(match.group(1)), part))
+    return entries
+
+
+class PromptContextBuilder:
+    """
+    Контекст для промпта агента из портрета пользователя
+    
+    Берутся только ответы, относящиеся к текущему вопросу (PORTRAIT_CONTEXT_QUESTIONS),
+    из текста вопроса убирается пример, длинные ответы обрезаются, а весь контекст
+    укладывается в бюджет 'context_tokens' типа задачи из LLM_TASK_SETTINGS.
+    """
+    
+    def __init__(self, always: List[int] = None, relevance: Dict[int, List[int]] = None,
+                 answer_max_tokens: int = PORTRAIT_ANSWER_MAX_TOKENS):
+        self.always = always if always is not None else PORTRAIT_CONTEXT_ALWAYS
+        self.relevance = relevance if relevance is not None else PORTRAIT_CONTEXT_QUESTIONS
+        self.answer_max_tokens = answer_max_tokens
+    
+    def _compact_entry(self, question_id: int, entry: str) -> str:
+        """Вопрос без примера, ответ не длиннее answer_max_tokens, уровень - только если он не повторяет ответ"""
+        match = _PORTRAIT_ENTRY.match(entry)
+        if not match:
+            return entry
+        question_text, answer, level = match.group(2), match.group(3).strip(), match.group(4).strip()
+        question_text = question_text.split("\n\n")[0].strip()
+        
+        compact_answer = answer
+        if count_tokens(compact_answer) > self.answer_max_tokens:
+            # Пропорциональная обрезка по символам с запасом, затем до границы слова
+            compact_answer = compact_answer[:self.answer_max_tokens * len(compact_answer) // count_tokens(compact_answer)]
+            compact_answer = compact_answer.rsplit(' ', 1)[0] + " …"
+        
+        text = f"Вопрос {question_id}: {question_text}\n→ Ответ: {compact_answer}"
+        if level and level != answer:
+            text += f"\n→ Уровень: {level}"
+        return text
+    
+    def _priority(self, question_id: int, entry_id: int) -> Tuple[int, int]:
+        """Порядок включения в бюджет: всегда нужные, затем ближайшие по номеру"""
+        return (0 if entry_id in self.always else 1, abs(question_id - entry_id))
+    
+    def build(self, user_portrait: Optional[str], question_id: int, task_type: str) -> Optional[str]:
+        """Сжатый портрет для промпта по вопросу question_id (None - контекста нет)"""
+        entries = split_portrait(user_portrait)
+        if not entries:
+            return user_portrait
+        
+        relevant = self.relevance.get(question_id)
+        if relevant is not None:
+            allowed = set(self.always) | set(relevant)
+            entries = [(entry_id, entry) for entry_id, entry in entries if entry_id in allowed]
+        
+        compacted = {entry_id: self._compact_entry(entry_id, entry) for entry_id, entry in entries}
+        
+        budget = LLM_TASK_SETTINGS.get(task_type, {}).get('context_tokens')
+        selected = []
+        used = 0
+        for entry_id in sorted(compacted, key=lambda entry_id: self._priority(question_id, entry_id)):
+            tokens = count_tokens(compacted[entry_id])
+            if budget is not None and used + tokens > budget:
+                continue
+            selected.append(entry_id)
+            used += tokens
+        
+        if not selected:
+            return None
+        context = "\n\n".join(compacted[entry_id] for entry_id in sorted(selected))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("✂️ Контекст Q%s (%s): %s → %s токенов, ответов %s из %s", question_id, task_type,
+                         count_tokens(user_portrait), used, len(selected), len(split_portrait(user_portrait)))
+        return context
+
+_JSON_TYPES = {
+    'boolean': lambda value: isinstance(value, bool),
+    'integer': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'string': lambda value: isinstance(value, str)
+}
+
+def parse_structured_response(response: str, schema: Dict) -> Dict:
+    """
+    Строгий разбор JSON ответа модели по схеме: объект, обязательные поля, типы полей
+    
+    Raises:
+        ValueError: с описанием несоответствия (используется в запросе на исправление)
+    """
+    text = response.strip()
+    fenced = re.match(r'^```(?:json)?\s*(.*?)\s*```$', text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise ValueError(f"ответ не является JSON ({e})")
+    if not isinstance(data, dict):
+        raise ValueError("ожидался JSON объект")
+    for key in schema.get('required', []):
+        if key not in data:
+            raise ValueError(f"нет обязательного поля \"{key}\"")
+    for key, spec in schema.get('properties', {}).items():
+        if key in data and not _JSON_TYPES[spec['type']](data[key]):
+            raise ValueError(f"поле \"{key}\" должно иметь тип {spec['type']}")
+    return data
+
+def request_structured(llm_service: BaseLLMService, messages: List[Dict], task_type: str,
+                       validate: Callable[[Dict], None] = None) -> Dict:
+    """
+    Запрос к LLM со структурированным ответом по схеме 'response_schema' задачи
+    
+    Некорректный ответ (не JSON, не по схеме, не прошел validate) отправляется модели
+    на исправление один раз; если и исправленный ответ некорректен - LLMResponseError.
+    В кэш ответов попадают только корректные ответы на исходный запрос.
+    """
+    schema = LLM_TASK_SETTINGS[task_type]['response_schema']
+    
+    def is_valid(response: str) -> bool:
+        try:
+            data = parse_structured_response(response, schema)
+            if validate:
+                validate(data)
+        except ValueError:
+            return False
+        return True
+    
+    with cache_only_valid(is_valid):
+        response = llm_service.generate_response(messages, task_type=task_type)
+    try:
+        data = parse_structured_response(response, schema)
+        if validate:
+            validate(data)
+        return data
+    except ValueError as e:
+        logger.warning("⚠️ Некорректный структурированный ответ (%s): %s. Запрашиваем исправление", task_type, e)
+        repair_messages = messages + [
+            {"role": "assistant", "content": response},
+            {"role": "user", "content": f"Ответ не соответствует требуемому формату: {e}. "
+                                        f"Верни только JSON по схеме: {json.dumps(schema, ensure_ascii=False)}"}
+        ]
+    
+    # Ключ запроса на исправление содержит некорректный ответ - такой запрос не кэшируется
+    with cache_bypass():
+        response = llm_service.generate_response(repair_messages, task_type=task_type)
+    try:
+        data = parse_structured_response(response, schema)
+        if validate:
+            validate(data)
+        return data
+    except ValueError as e:
+        raise LLMResponseError(f"Некорректный структурированный ответ ({task_type}) после исправления: {e}",
+                               llm_service.name)
+
 
 class VerificationAgent:
-    def __init__(self, llm_service: BaseLLMService):
+    def __init__(self, llm_service: BaseLLMService, context_builder: PromptContextBuilder = None):
         self.llm_service = llm_service
+        self.context_builder = context_builder or PromptContextBuilder()
     
     def process_answer(self, question_data: Dict, user_answer: str, conversation: List[str], user_portrait: str = None) -> Tuple[bool, str]:
         """Обработка ответа пользователя: проверка + уточнение если нужно"""
         
+        # Только относящиеся к вопросу ответы в пределах бюджета задачи
+        user_portrait = self.context_builder.build(user_portrait, question_data['id'], 'verification')
+        
         # Формируем структурированный диалог
         dialog_text = ""
         
@@ -35,31 +240,40 @@ class VerificationAgent:
         
         # Используем готовый промпт из таблицы и подставляем диалог
         prompt = question_data['verification_instruction'].format(dialog=dialog_text)
-
-        print("🔍 ВЕРИФИКАТОР - Отправляю в LLM:")
-        print("-" * 50)
-        print(prompt)
-        print("-" * 50)
+        prompt += ("\n\nФОРМАТ ОТВЕТА: верни только JSON. Если по инструкции выше ответ ПРИНЯТО - "
+                   "{\"accepted\": true, \"question\": \"\"}, если нужно уточнение - "
+                   "{\"accepted\": false, \"question\": \"<уточняющий вопрос пользователю>\"}")
+        
+        dump = prompt_dump_sampled()
+        if dump:
+            dump_prompt("🔍 ВЕРИФИКАТОР - Отправляю в LLM:", prompt, question_id=question_data['id'])
+        
+        def validate(data: Dict) -> None:
+            if not data['accepted'] and not data['question'].strip():
+                raise ValueError("при \"accepted\": false поле \"question\" не должно быть пустым")
         
         messages = [{"role": "user", "content": prompt}]
-        response = self.llm_service.generate_response(messages, task_type='verification')
+        result = request_structured(self.llm_service, messages, 'verification', validate)
         
-        print("✅ ОТВЕТ LLM:")
-        print(response)
-        print("-" * 50)
+        if dump:
+            dump_prompt("✅ ВЕРИФИКАТОР - ответ LLM:", json.dumps(result, ensure_ascii=False), question_id=question_data['id'])
+        logger.info("🔍 Проверка ответа на вопрос %s: %s", question_data['id'],
+                    "принят" if result['accepted'] else "нужно уточнение")
         
-        # Простой парсинг
-        if "ПРИНЯТО" in response.upper():
+        if result['accepted']:
             return True, "Отлично!"
         else:
-            return False, response.replace("УТОЧНИ:", "").strip()
+            return False, result['question'].replace("УТОЧНИ:", "").strip()
 
 class AnswerCompilerAgent:
-    def __init__(self, llm_service: BaseLLMService):
+    def __init__(self, llm_service: BaseLLMService, context_builder: PromptContextBuilder = None):
         self.llm_service = llm_service
+        self.context_builder = context_builder or PromptContextBuilder()
     
     def create_full_answer(self, question_data: Dict, conversation: List[str], user_portrait: str = None) -> str:
         """Создание полного ответа из диалога"""
+        user_portrait = self.context_builder.build(user_portrait, question_data['id'], 'compilation')
+        
         # Собираем только ответы пользователя из диалога
         user_answers = []
         for i, msg in enumerate(conversation):
@@ -87,33 +301,40 @@ class AnswerCompilerAgent:
 {dialog_for_llm}
 
 Твоя задача - извлечь из диалога только суть ответа пользователя, убрав лишние слова и повторы. Ответ должен быть четким и конкретным."""
-
-        print("📝 АГЕНТ ОТВЕТОВ - Отправляю в LLM:")
-        print("-" * 50)
-        print(prompt)
-        print("-" * 50)
-
+        
+        dump = prompt_dump_sampled()
+        if dump:
+            dump_prompt("📝 АГЕНТ ОТВЕТОВ - Отправляю в LLM:", prompt, question_id=question_data['id'])
+        
         messages = [{"role": "user", "content": prompt}]
         response = self.llm_service.generate_response(messages, task_type='compilation')
         
-        print("✅ ОТВЕТ LLM:")
-        print(response)
-        print("-" * 50)
+        if dump:
+            dump_prompt("✅ АГЕНТ ОТВЕТОВ - ответ LLM:", response, question_id=question_data['id'])
         
         return response.strip()
 
 class ClassificationAgent:
-    def __init__(self, llm_service: BaseLLMService):
+    def __init__(self, llm_service: BaseLLMService, context_builder: PromptContextBuilder = None):
         self.llm_service = llm_service
+        self.context_builder = context_builder or PromptContextBuilder()
     
-    def classify_answer(self, question_data: Dict, full_answer: str, user_portrait: str = None) -> str:
-        """Классификация ответа согласно инструкции из поля Classifier"""
+    def classify_answer(self, question_data: Dict, full_answer: str, user_portrait: str = None,
+                        conflicting_levels: Dict[int, List[int]] = None) -> str:
+        """
+        Классификация ответа согласно инструкции из поля Classifier
+        
+        conflicting_levels - уровни, которые противоречат предыдущим ответам
+        ({уровень: [вопросы]}, см. ConflictDetector.conflicting_levels). Они только упоминаются
+        в промпте: допустимыми остаются все уровни, чтобы противоречие в ответе дошло
+        до ConflictDetector и пользователя переспросили.
+        """
         
         # Проверяем, есть ли инструкция классификации
         classifier_instruction = question_data.get('classifier')
         
         if not classifier_instruction or classifier_instruction.strip() == "":
-            print("🏷️ КЛАССИФИКАТОР - Инструкция пуста, возвращаю исходный ответ")
+            logger.debug("🏷️ КЛАССИФИКАТОР - Инструкция пуста, возвращаю исходный ответ")
             return full_answer
         
         # Формируем промпт для классификации
@@ -128,6 +349,7 @@ class ClassificationAgent:
                 prompt = classifier_instruction
         
         # Добавляем портрет пользователя в начало промпта, если есть
+        user_portrait = self.context_builder.build(user_portrait, question_data['id'], 'classification')
         if user_portrait:
             context_instruction = "КОНТЕКСТ О ПОЛЬЗОВАТЕЛЕ (предыдущие ответы):\n"
             context_instruction += f"{user_portrait}\n\n"
@@ -138,19 +360,52 @@ class ClassificationAgent:
             context_instruction += "- При граничных случаях: используй контекст для выбора уровня\n\n"
             prompt = context_instruction + prompt
         
-        print("🏷️ КЛАССИФИКАТОР - Отправляю в LLM:")
-        print("-" * 50)
-        print(prompt)
-        print("-" * 50)
+        # Допустимые уровни вопроса из справочника HAY (пусто - любой положительный номер)
+        levels = question_data.get('levels') or []
+        
+        # Уровни, которые сразу дадут противоречие с предыдущими ответами
+        if conflicting_levels:
+            notes = "\n".join(
+                f"- уровень {level} противоречит ответам на вопросы {', '.join(str(q) for q in questions)}"
+                for level, questions in conflicting_levels.items()
+            )
+            prompt += ("\n\nСОГЛАСОВАННОСТЬ С ПРЕДЫДУЩИМИ ОТВЕТАМИ:\n" + notes +
+                       "\nВыбирай такой уровень, только если ответ пользователя явно на него указывает")
+        
+        levels_text = ", ".join(str(level) for level in levels) if levels else "номер уровня из инструкции"
+        prompt += f"\n\nФОРМАТ ОТВЕТА: верни только JSON вида {{\"level\": N}}, где N - {levels_text}"
+        
+        # Почти такой же ответ на этот вопрос уже классифицировался - берем его уровень
+        semantic_cache = get_semantic_cache()
+        if semantic_cache is not None:
+            cached_level = semantic_cache.lookup(question_data['id'], classifier_instruction, full_answer)
+            if cached_level is not None and (not levels or int(cached_level) in levels):
+                return cached_level
+        
+        dump = prompt_dump_sampled()
+        if dump:
+            dump_prompt("🏷️ КЛАССИФИКАТОР - Отправляю в LLM:", prompt, question_id=question_data['id'])
+        
+        def validate(data: Dict) -> None:
+            if levels and data['level'] not in levels:
+                raise ValueError(f"уровень {data['level']} недопустим, допустимые уровни: {levels_text}")
+            if data['level'] < 1:
+                raise ValueError(f"уровень {data['level']} недопустим, номер уровня начинается с 1")
         
         messages = [{"role": "user", "content": prompt}]
-        response = self.llm_service.generate_response(messages, task_type='classification')
+        result = request_structured(self.llm_service, messages, 'classification', validate)
         
-        print("✅ ОТВЕТ LLM (КЛАССИФИКАЦИЯ):")
-        print(response)
-        print("-" * 50)
+        if dump:
+            dump_prompt("✅ КЛАССИФИКАТОР - ответ LLM:", json.dumps(result, ensure_ascii=False), question_id=question_data['id'])
+        logger.info("🏷️ Вопрос %s классифицирован: уровень %s", question_data['id'], result['level'])
         
-        return response.strip()
+        # Всегда допустимый номер уровня - дальше он разбирается через int()
+        level = str(result['level'])
+        # Уровень, выбранный с подсказкой о противоречиях этой сессии, не годится для других сессий
+        if semantic_cache is not None and not conflicting_levels:
+            semantic_cache.add(question_data['id'], classifier_instruction, full_answer, level)
+        
+        return level
 
 # Агенты теперь создаются с передачей llm_service в telegram_bot.py
 
@@ -158,19 +413,19 @@ class ClassificationAgent:
 class FunctionalityAgent:
     """Агент для генерации функционала должности на основе ответов"""
     
-    def __init__(self, llm_service):
+    def __init__(self, llm_service, context_builder: PromptContextBuilder = None):
         self.llm_service = llm_service
+        self.context_builder = context_builder or PromptContextBuilder()
     
-    def generate_functionality(self, user_portrait: str) -> str:
-        """
-        Генерирует функционал должности на основе портрета пользователя
-        Портрет теперь в формате: Вопрос - Полный ответ - Уровень
-        """
-        try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": """Твоя задача - сгенерировать функционал должности на основе ответов пользователя.
+    # Ответ на случай недоступности LLM
+    FALLBACK_FUNCTIONALITY = "• Выполнение основных рабочих задач\n• Взаимодействие с коллегами\n• Соблюдение корпоративных стандартов"
+    
+    def _build_messages(self, user_portrait: str) -> List[Dict]:
+        """Промпт генерации функционала по портрету пользователя"""
+        return [
+            {
+                "role": "system",
+                "content": """Твоя задача - сгенерировать функционал должности на основе ответов пользователя.
 
 ВАЖНО:
 - Создай список из 5-8 основных функций должности
@@ -194,23 +449,85 @@ class FunctionalityAgent:
 • Документировать техническую документацию
 
 Сгенерируй функционал на основе следующих ответов пользователя:"""
-                },
-                {
-                    "role": "user", 
-                    "content": user_portrait or "Информация о должности не предоставлена"
-                }
-            ]
-            
+            },
+            {
+                "role": "user", 
+                "content": self.context_builder.build(user_portrait, 18, 'functionality')
+                           or "Информация о должности не предоставлена"
+            }
+        ]
+    
+    def generate_functionality(self, user_portrait: str) -> str:
+        """
+        Генерирует функционал должности на основе портрета пользователя
+        Портрет теперь в формате: Вопрос - Полный ответ - Уровень
+        """
+        try:
+            messages = self._build_messages(user_portrait)
             functionality = self.llm_service.generate_response(messages, task_type='functionality')
             
             # Убираем возможные лишние элементы форматирования
             functionality = functionality.strip()
             
             return functionality
-            
+        
         except Exception as e:
-            print(f"❌ Ошибка FunctionalityAgent: {e}")
-            return "• Выполнение основных рабочих задач\n• Взаимодействие с коллегами\n• Соблюдение корпоративных стандартов"
+            logger.error("❌ Ошибка FunctionalityAgent: %s", e)
+            return self.FALLBACK_FUNCTIONALITY
+    
+    def generate_functionality_stream(self, user_portrait: str) -> Iterator[str]:
+        """
+        То же, что generate_functionality, но фрагментами по мере генерации
+        Если LLM недоступен до начала ответа - отдается стандартный функционал
+        """
+        started = False
+        try:
+            for chunk in self.llm_service.generate_response_stream(self._build_messages(user_portrait),
+                                                                   task_type='functionality'):
+                started = True
+                yield chunk
+        except Exception as e:
+            logger.error("❌ Ошибка FunctionalityAgent: %s", e)
+            if not started:
+                yield self.FALLBACK_FUNCTIONALITY
+    
+    # Длина одного примера подтвержденного функционала в промпте заготовки (символов)
+    DRAFT_EXAMPLE_MAX_CHARS = 1500
+    
+    def _build_draft_messages(self, role: str, full_path: str, examples: List[str]) -> List[Dict]:
+        """Промпт типового функционала должности по ее месту в штатном расписании"""
+        content = f"Должность: {role}\nМесто в структуре: {full_path}"
+        if examples:
+            content += "\n\nФункционал, подтвержденный сотрудниками на этой должности:"
+            for i, example in enumerate(examples, 1):
+                if len(example) > self.DRAFT_EXAMPLE_MAX_CHARS:
+                    example = example[:self.DRAFT_EXAMPLE_MAX_CHARS].rsplit(' ', 1)[0] + " …"
+                content += f"\n\n--- Пример {i} ---\n{example}"
+        return [
+            {
+                "role": "system",
+                "content": """Твоя задача - составить типовой функционал должности по ее месту в штатном расписании.
+
+ВАЖНО:
+- Создай список из 5-8 основных функций должности
+- Формулируй функции конкретно и профессионально
+- Каждая функция - отдельный пункт списка, начинающийся с "• "
+- Используй глаголы в инфинитиве: "Разрабатывать", "Анализировать", "Координировать"
+- Учитывай подразделение, в котором находится должность
+- Если приведен функционал, подтвержденный сотрудниками на этой должности, опирайся на него
+
+Выведи только список функций."""
+            },
+            {"role": "user", "content": content}
+        ]
+    
+    def generate_role_draft(self, role: str, full_path: str, examples: List[str] = None) -> str:
+        """
+        Типовой функционал должности штатного расписания (заготовка Q18, functionality_drafts.py)
+        Ошибки LLM пробрасываются: заготовку с запасным функционалом сохранять нельзя
+        """
+        messages = self._build_draft_messages(role, full_path, examples or [])
+        return self.llm_service.generate_response(messages, task_type='functionality').strip()
 
 # PortraitAgent больше не используется - портрет формируется напрямую в database.py
 # без использования LLM, просто структурированным форматированием данных 
\ No newline at end of file
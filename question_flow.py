@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Условия показа вопросов (show_conditions), скомпилированные один раз
+
+Формат условия: {"show_if": {"question_13": ["2", "3", "4", "5"]}} - вопрос показывается,
+если на каждый из перечисленных вопросов дан один из допустимых ответов (final_answer,
+а если его нет - answer).
+
+QuestionFlow разбирает условия при загрузке вопросов в предикаты и строит индекс
+зависимостей: какие вопросы читает условие каждого вопроса. QuestionScheduler держит
+ответы одной сессии и после ответа на вопрос X пересчитывает только условия, зависящие от X.
+
+DependencyGraph - граф зависимостей ответов и производных значений (P1, варианты Q11/Q12,
+портрет, функционал Q18) от вопросов; хранится в таблице question_dependencies
+(заполняется update_questions.py) и определяет, какие ответы становятся неактуальными,
+когда вопрос переспрашивается.
+
+Условия нестандартной формы (не словарь, не список допустимых ответов и т.п.) не компилируются:
+для них вызывается исходная проверка should_show_question, и они пересчитываются после
+любого ответа - так результат в точности совпадает с прежним
+(проверяется на случайных последовательностях ответов в tests/test_question_flow.py).
+"""
+
+import json
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_QUESTION_KEY = re.compile(r'question_(-?\d+)')
+
+
+def should_show_question(show_conditions_json: str, user_responses: List[Dict]) -> bool:
+    """Исходная (эталонная) проверка условия показа по списку ответов"""
+    try:
+        conditions = json.loads(show_conditions_json)
+        if not conditions or 'show_if' not in conditions:
+            return True
+        
+        show_if = conditions['show_if']
+        
+        responses_dict = {}
+        for response in user_responses:
+            answer_value = response['final_answer'] if response['final_answer'] else response['answer']
+            responses_dict[f"question_{response['question']}"] = answer_value
+        
+        for condition_question, required_answers in show_if.items():
+            if condition_question not in responses_dict:
+                return False
+            
+            user_answer = responses_dict[condition_question]
+            if user_answer not in required_answers:
+                return False
+        
+        return True
+    
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return True
+
+
+def answers_from_responses(user_responses: List[Dict]) -> Dict[int, object]:
+    """Ответы сессии {вопрос: значение} - как их видит условие показа"""
+    answers = {}
+    for response in user_responses:
+        answers[response['question']] = response['final_answer'] if response['final_answer'] else response['answer']
+    return answers
+
+
+class ShowCondition:
+    """Скомпилированное условие: все перечисленные вопросы отвечены одним из допустимых ответов"""
+    
+    __slots__ = ('requirements', 'depends_on')
+    
+    def __init__(self, requirements: List[Tuple[Optional[int], frozenset]]):
+        # (вопрос, допустимые ответы); вопрос None - ключ, который ни один ответ не заполнит
+        self.requirements = requirements
+        self.depends_on = frozenset(question_id for question_id, _ in requirements if question_id is not None)
+    
+    def evaluate(self, answers: Dict[int, object]) -> bool:
+        for question_id, allowed in self.requirements:
+            if question_id is None or question_id not in answers or answers[question_id] not in allowed:
+                return False
+        return True
+
+
+class AlwaysShown:
+    """Условие без show_if (или неразбираемый JSON) - вопрос показывается всегда"""
+    
+    __slots__ = ()
+    depends_on = frozenset()
+    
+    def evaluate(self, answers: Dict[int, object]) -> bool:
+        return True
+
+
+class LegacyCondition:
+    """Условие нестандартной формы - исходная проверка, зависит от всех ответов"""
+    
+    __slots__ = ('show_conditions_json',)
+    depends_on = None
+    
+    def __init__(self, show_conditions_json: str):
+        self.show_conditions_json = show_conditions_json
+    
+    def evaluate(self, answers: Dict[int, object]) -> bool:
+        responses = [{'question': question_id, 'answer': value, 'final_answer': value}
+                     for question_id, value in answers.items()]
+        return should_show_question(self.show_conditions_json, responses)
+
+
+_ALWAYS_SHOWN = AlwaysShown()
+
+
+def _question_id(key) -> Optional[int]:
+    """Номер вопроса из ключа условия, если ключ совпадает с f"question_{номер}" """
+    match = _QUESTION_KEY.fullmatch(key) if isinstance(key, str) else None
+    if match is None or str(int(match.group(1))) != match.group(1):
+        return None
+    return int(match.group(1))
+
+
+def compile_condition(show_conditions_json: Optional[str]):
+    """Предикат условия показа (None - условия нет)"""
+    if not show_conditions_json:
+        return None
+    try:
+        conditions = json.loads(show_conditions_json)
+    except (json.JSONDecodeError, TypeError):
+        return _ALWAYS_SHOWN
+    if not conditions:
+        return _ALWAYS_SHOWN
+    if not isinstance(conditions, dict):
+        return LegacyCondition(show_conditions_json)
+    if 'show_if' not in conditions:
+        return _ALWAYS_SHOWN
+    
+    show_if = conditions['show_if']
+    if not isinstance(show_if, dict):
+        return LegacyCondition(show_conditions_json)
+    requirements = []
+    for key, allowed in show_if.items():
+        # Только список допустимых значений: для строки `in` - поиск подстроки, для числа - ошибка
+        if not isinstance(allowed, list) or not all(isinstance(value, (str, int, float, bool)) or value is None
+                                                    for value in allowed):
+            return LegacyCondition(show_conditions_json)
+        requirements.append((_question_id(key), frozenset(allowed)))
+    return ShowCondition(requirements)
+
+
+class QuestionFlow:
+    """Порядок вопросов, скомпилированные условия показа и индекс зависимостей"""
+    
+    def __init__(self, questions: Iterable[Dict]):
+        """
+        Args:
+            questions: словари с ключами 'id' и 'show_conditions' (как из Database.get_all_questions)
+        """
+        self.question_ids: List[int] = []
+        self.conditions: Dict[int, object] = {}
+        # Вопрос -> вопросы, условия которых читают ответ на него
+        self.dependents: Dict[int, List[int]] = {}
+        # Условия нестандартной формы - пересчитываются после любого ответа
+        self.global_dependents: List[int] = []
+        
+        for question in sorted(questions, key=lambda question: question['id']):
+            question_id = question['id']
+            self.question_ids.append(question_id)
+            condition = compile_condition(question.get('show_conditions'))
+            if condition is None:
+                continue
+            self.conditions[question_id] = condition
+            if condition.depends_on is None:
+                self.global_dependents.append(question_id)
+            else:
+                for dependency in condition.depends_on:
+                    self.dependents.setdefault(dependency, []).append(question_id)
+    
+    def affected_by(self, question_id: int) -> List[int]:
+        """Вопросы, видимость которых может измениться после ответа на question_id"""
+        return self.dependents.get(question_id, []) + self.global_dependents
+    
+    def dependents_closure(self, question_ids: Iterable[int]) -> List[int]:
+        """Вопросы и все вопросы, условия которых (транзитивно) от них зависят"""
+        result = list(question_ids)
+        seen = set(result)
+        index = 0
+        while index < len(result):
+            for dependent in self.dependents.get(result[index], []):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    result.append(dependent)
+            index += 1
+        return result
+    
+    def is_visible(self, question_id: int, answers: Dict[int, object]) -> bool:
+        condition = self.conditions.get(question_id)
+        return condition is None or condition.evaluate(answers)
+    
+    def remaining(self, answers: Dict[int, object]) -> List[int]:
+        """Неотвеченные вопросы, условия показа которых выполнены (по возрастанию номера)"""
+        return [question_id for question_id in self.question_ids
+                if question_id not in answers and self.is_visible(question_id, answers)]
+    
+    def scheduler(self, answers: Optional[Dict[int, object]] = None) -> "QuestionScheduler":
+        return QuestionScheduler(self, answers)
+
+
+class QuestionScheduler:
+    """Оставшиеся вопросы одной сессии с пересчетом только зависимых условий"""
+    
+    def __init__(self, flow: QuestionFlow, answers: Optional[Dict[int, object]] = None):
+        self.flow = flow
+        self.answers: Dict[int, object] = dict(answers or {})
+        self.visible: Dict[int, bool] = {
+            question_id: condition.evaluate(self.answers) for question_id, condition in flow.conditions.items()
+        }
+    
+    def _reevaluate(self, question_id: int) -> None:
+        for dependent in self.flow.affected_by(question_id):
+            self.visible[dependent] = self.flow.conditions[dependent].evaluate(self.answers)
+    
+    def answer(self, question_id: int, value) -> None:
+        """Активный ответ на вопрос (новый или замена прежнего)"""
+        self.answers[question_id] = value
+        self._reevaluate(question_id)
+    
+    def retract(self, question_ids: Iterable[int]) -> None:
+        """Ответы стали неактивными (конфликт, пересдача)"""
+        for question_id in question_ids:
+            if self.answers.pop(question_id, _MISSING) is not _MISSING:
+                self._reevaluate(question_id)
+    
+    def remaining(self) -> List[int]:
+        return [question_id for question_id in self.flow.question_ids
+                if question_id not in self.answers and self.visible.get(question_id, True)]
+
+
+_MISSING = object()
+
+
+# Производные значения (P1-P4, варианты Q11/Q12, функционал Q18) и их входные данные:
+# (узел, от чего зависит, вид зависимости)
+# Виды: 'show' - условие показа вопроса, 'derived' - значение вычисляется из входных,
+# 'options' - ответ выбран из вариантов, построенных по входным данным
+DERIVED_DEPENDENCIES = [
+    ('p1', 'question_8', 'derived'),
+    ('p1', 'question_9', 'derived'),
+    ('p1', 'question_10', 'derived'),
+    ('q11_variants', 'p1', 'derived'),
+    ('q12_variants', 'p1', 'derived'),
+    ('q12_variants', 'question_11', 'derived'),
+    ('p2', 'question_11', 'derived'),
+    ('p2', 'question_12', 'derived'),
+    ('p3', 'p1', 'derived'),
+    ('p3', 'p2', 'derived'),
+    ('p4', 'question_13', 'derived'),
+    ('p4', 'question_14', 'derived'),
+    ('p4', 'question_15', 'derived'),
+    ('p4', 'question_16', 'derived'),
+    ('question_11', 'q11_variants', 'options'),
+    ('question_12', 'q12_variants', 'options'),
+    ('functionality', 'portrait', 'derived'),
+    ('question_18', 'functionality', 'options'),
+]
+
+
+def question_node(question_id: int) -> str:
+    return f"question_{question_id}"
+
+
+def default_dependencies(questions: Iterable[Dict]) -> List[Tuple[str, str, str]]:
+    """
+    Ребра графа по вопросам: условия показа, портрет из ответов на все вопросы
+    и производные значения DERIVED_DEPENDENCIES
+    """
+    edges = []
+    for question in sorted(questions, key=lambda question: question['id']):
+        node = question_node(question['id'])
+        condition = compile_condition(question.get('show_conditions'))
+        if condition is not None and condition.depends_on:
+            edges += [(node, question_node(dependency), 'show') for dependency in sorted(condition.depends_on)]
+        edges.append(('portrait', node, 'derived'))
+    return edges + DERIVED_DEPENDENCIES
+
+
+class DependencyGraph:
+    """Что становится неактуальным при изменении ответов на вопросы"""
+    
+    def __init__(self, edges: Iterable[Tuple[str, str, str]]):
+        """
+        Args:
+            edges: (узел, от чего зависит, вид) - строки таблицы question_dependencies
+        """
+        self.dependents: Dict[str, List[str]] = {}
+        for node, depends_on, _ in edges:
+            targets = self.dependents.setdefault(depends_on, [])
+            if node not in targets:
+                targets.append(node)
+    
+    def affected_nodes(self, nodes: Iterable[str]) -> List[str]:
+        """Узлы и все узлы, транзитивно зависящие от них (в порядке обхода)"""
+        result = list(dict.fromkeys(nodes))
+        seen = set(result)
+        index = 0
+        while index < len(result):
+            for dependent in self.dependents.get(result[index], []):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    result.append(dependent)
+            index += 1
+        return result
+    
+    def affected_questions(self, question_ids: Iterable[int]) -> List[int]:
+        """Вопросы, ответы на которые неактуальны после изменения ответов на question_ids"""
+        affected = set()
+        for node in self.affected_nodes(question_node(question_id) for question_id in question_ids):
+            question_id = _question_id(node)
+            if question_id is not None:
+                affected.add(question_id)
+        return sorted(affected)
@@ -0,0 +1,27 @@
+"""
+Версия справочных таблиц базы (вопросы, зависимости, грейдинг, конфликты, словарь Hay).
+
+Справочники держатся в памяти процесса (get_grading_tables, get_conflict_rules, условия показа
+и граф зависимостей Database). Скрипты загрузки (update_questions.py, update_grading_tables.py,
+update_conflicts.py / conflict_analyzer.py, update_question_variants.py, update_hay_dictionary.py)
+увеличивают PRAGMA user_version; кэши сравнивают сохраненную версию с текущей и перечитывают
+таблицы, если она изменилась - работающий бот подхватывает справочники без перезапуска.
+"""
+import sqlite3
+from contextlib import closing
+
+
+def reference_version(db_path: str) -> int:
+    """Текущая версия справочников базы db_path (0 - база не размечена update_*.py)"""
+    try:
+        with closing(sqlite3.connect(db_path)) as conn:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.Error:
+        return 0
+
+
+def bump_reference_version(conn: sqlite3.Connection) -> int:
+    """Увеличивает версию справочников (вызывается скриптами загрузки перед commit)"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0] + 1
+    conn.execute(f"PRAGMA user_version = {version}")
+    return version
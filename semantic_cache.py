@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Семантический кэш результатов классификации
+
+Ответы, отличающиеся только формулировкой, получают тот же уровень без запроса к LLM.
+Эмбеддинг - хэширование символьных n-грамм (работает офлайн на CPU, без скачивания моделей),
+индекс - LSH по случайным гиперплоскостям с точным доранжированием кандидатов.
+
+Лексическое сходство не видит разницы между "5 подчиненных" и "50 подчиненных" или между
+"согласует" и "не согласует", поэтому числа и отрицания ответа (guard_key) должны совпадать
+точно: записи с разными ключами лежат в разных разделах индекса.
+
+Сигнатуры LSH хранятся в таблице вместе с векторами - при запуске индекс строится без
+пересчета (пересчитываются только записи без сигнатур или после смены параметров LSH).
+"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import (
+    LLM_CACHE_PATH, SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_LSH_TABLES, SEMANTIC_CACHE_LSH_BITS
+)
+from app_logging import get_logger
+
+logger = get_logger('llm')
+
+# Отрицания меняют смысл ответа при почти том же наборе символов
+NEGATION_WORDS = frozenset((
+    'не', 'нет', 'ни', 'без', 'никогда', 'никто', 'никого', 'никому', 'ничего', 'ничто',
+    'нельзя', 'невозможно', 'отсутствует', 'отсутствуют'
+))
+
+
+class HashingEmbedder:
+    """Локальная модель эмбеддингов: хэшированные символьные n-граммы и слова"""
+    
+    def __init__(self, dim: int = SEMANTIC_CACHE_DIM, ngram_sizes: Tuple[int, ...] = (3, 4, 5)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Нижний регистр, ё -> е, только буквы и цифры через одиночные пробелы"""
+        text = text.lower().replace('ё', 'е')
+        text = re.sub(r'[^\w]+', ' ', text)
+        return ' '.join(text.split())
+    
+    def guard_key(self, text: str) -> str:
+        """Числа и слова-отрицания ответа: у почти-дубликата они должны совпадать точно"""
+        words = self.normalize(text).split()
+        numbers = sorted({str(int(word)) for word in words if word.isdigit()})
+        negations = sorted({word for word in words if word in NEGATION_WORDS})
+        return ' '.join(numbers + negations)
+    
+    def _features(self, text: str) -> List[str]:
+        normalized = self.normalize(text)
+        features = ['w:' + word for word in normalized.split()]
+        padded = f" {normalized} "
+        for size in self.ngram_sizes:
+            features.extend(padded[i:i + size] for i in range(len(padded) - size + 1))
+        return features
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Нормированный вектор размерности dim"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            h = zlib.crc32(feature.encode('utf-8'))
+            # Старший бит хэша задает знак, чтобы коллизии взаимно гасились
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class _Partition:
+    """Векторы одного вопроса (и одной версии инструкции классификатора)"""
+    
+    def __init__(self, dim: int, n_tables: int):
+        self.vectors = np.zeros((64, dim), dtype=np.float32)
+        self.size = 0
+        self.ids: List[int] = []
+        self.levels: List[str] = []
+        self.buckets: List[Dict[int, List[int]]] = [{} for _ in range(n_tables)]
+    
+    def _reserve(self, size: int) -> None:
+        if size <= len(self.vectors):
+            return
+        capacity = len(self.vectors)
+        while capacity < size:
+            capacity *= 2
+        grown = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+        grown[:self.size] = self.vectors[:self.size]
+        self.vectors = grown
+    
+    def append(self, vector: np.ndarray, signatures: List[int], entry_id: int, level: str) -> None:
+        self._reserve(self.size + 1)
+        row = self.size
+        self.vectors[row] = vector
+        self.size += 1
+        self.ids.append(entry_id)
+        self.levels.append(level)
+        for table, signature in zip(self.buckets, signatures):
+            table.setdefault(signature, []).append(row)
+    
+    def extend(self, vectors: np.ndarray, signatures: np.ndarray, ids: List[int], levels: List[str]) -> None:
+        """Добавление многих записей сразу (загрузка): signatures - матрица (записи x таблицы)"""
+        start = self.size
+        self._reserve(start + len(ids))
+        self.vectors[start:start + len(ids)] = vectors
+        self.size += len(ids)
+        self.ids.extend(ids)
+        self.levels.extend(levels)
+        rows = np.arange(start, start + len(ids))
+        for t, table in enumerate(self.buckets):
+            column = signatures[:, t]
+            order = np.argsort(column, kind='stable')
+            keys, first = np.unique(column[order], return_index=True)
+            for key, bucket_rows in zip(keys.tolist(), np.split(rows[order], first[1:])):
+                table.setdefault(key, []).extend(bucket_rows.tolist())
+
+
+class SemanticClassificationCache:
+    """Поиск ближайшего ранее классифицированного ответа на тот же вопрос"""
+    
+    def __init__(self, db_path: str = LLM_CACHE_PATH, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 dim: int = SEMANTIC_CACHE_DIM, n_tables: int = SEMANTIC_CACHE_LSH_TABLES,
+                 n_bits: int = SEMANTIC_CACHE_LSH_BITS):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.embedder = HashingEmbedder(dim)
+        self.n_tables = n_tables
+        
+        # Фиксированное зерно: сигнатуры совпадают между перезапусками
+        rng = np.random.default_rng(20240601)
+        self.hyperplanes = rng.standard_normal((n_tables, n_bits, dim)).astype(np.float32)
+        self.bit_weights = (1 << np.arange(n_bits)).astype(np.int64)
+        # Сохраненные сигнатуры действительны только для тех же параметров LSH
+        self.lsh_config = f"{dim}:{n_tables}:{n_bits}:20240601"
+        
+        self._partitions: Dict[Tuple[int, str, str], _Partition] = {}
+        self._lock = threading.Lock()
+        
+        self.reuses = 0
+        self.lookups = 0
+        
+        self._create_tables()
+        self._load()
+    
+    def _create_tables(self) -> None:
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS semantic_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question_id INTEGER NOT NULL,
+                    classifier_hash TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    guard TEXT,
+                    signatures BLOB
+                )
+            """)
+            # Таблица более ранней версии - без ключа чисел/отрицаний и сигнатур
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(semantic_cache)")}
+            for column, column_type in (('guard', 'TEXT'), ('signatures', 'BLOB')):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE semantic_cache ADD COLUMN {column} {column_type}")
+            cursor.execute("CREATE TABLE IF NOT EXISTS semantic_cache_meta (key TEXT PRIMARY KEY, value TEXT)")
+            # Журнал каждого переиспользования уровня (для аудита)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS semantic_cache_audit (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question_id INTEGER NOT NULL,
+                    answer TEXT NOT NULL,
+                    matched_id INTEGER NOT NULL,
+                    matched_answer TEXT NOT NULL,
+                    similarity REAL NOT NULL,
+                    level TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+    
+    def _migrate(self, conn: sqlite3.Connection, batch_size: int = 10000) -> None:
+        """Ключи чисел/отрицаний и сигнатуры для записей, у которых их нет или они устарели"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM semantic_cache_meta WHERE key = 'lsh_config'")
+        stored = cursor.fetchone()
+        if stored is None or stored[0] != self.lsh_config:
+            cursor.execute("UPDATE semantic_cache SET signatures = NULL")
+            cursor.execute("INSERT OR REPLACE INTO semantic_cache_meta (key, value) VALUES ('lsh_config', ?)",
+                           (self.lsh_config,))
+        
+        rows = cursor.execute("SELECT id, answer FROM semantic_cache WHERE guard IS NULL").fetchall()
+        cursor.executemany("UPDATE semantic_cache SET guard = ? WHERE id = ?",
+                           [(self.embedder.guard_key(answer), entry_id) for entry_id, answer in rows])
+        
+        updated = 0
+        while True:
+            rows = cursor.execute("""
+                SELECT id, vector FROM semantic_cache WHERE signatures IS NULL AND length(vector) = ? LIMIT ?
+            """, (self.embedder.dim * 4, batch_size)).fetchall()
+            if not rows:
+                break
+            vectors = np.frombuffer(b''.join(blob for _, blob in rows), dtype=np.float32).reshape(len(rows), -1)
+            signatures = self._signatures_batch(vectors)
+            cursor.executemany("UPDATE semantic_cache SET signatures = ? WHERE id = ?",
+                               [(signatures[i].tobytes(), entry_id) for i, (entry_id, _) in enumerate(rows)])
+            updated += len(rows)
+        conn.commit()
+        if updated:
+            logger.info("🧠 Семантический кэш: пересчитаны сигнатуры LSH для %s записей", updated)
+    
+    def _load(self) -> None:
+        """Загрузка сохраненных векторов и сигнатур в индекс в памяти"""
+        groups: Dict[Tuple[int, str, str], Tuple[List[bytes], List[bytes], List[int], List[str]]] = {}
+        with sqlite3.connect(self.db_path) as conn:
+            conn.text_factory = str
+            self._migrate(conn)
+            cursor = conn.cursor()
+            # Записи другой размерности эмбеддинга не загружаются
+            cursor.execute("""
+                SELECT id, question_id, classifier_hash, guard, level, vector, signatures
+                FROM semantic_cache WHERE length(vector) = ? AND signatures IS NOT NULL ORDER BY id
+            """, (self.embedder.dim * 4,))
+            for entry_id, question_id, classifier_hash, guard, level, vector, signatures in cursor:
+                group = groups.setdefault((question_id, classifier_hash, guard), ([], [], [], []))
+                group[0].append(vector)
+                group[1].append(signatures)
+                group[2].append(entry_id)
+                group[3].append(level)
+        
+        for (question_id, classifier_hash, guard), (vectors, signatures, ids, levels) in groups.items():
+            self._partition(question_id, classifier_hash, guard).extend(
+                np.frombuffer(b''.join(vectors), dtype=np.float32).reshape(len(ids), -1),
+                np.frombuffer(b''.join(signatures), dtype=np.int64).reshape(len(ids), -1),
+                ids, levels
+            )
+    
+    @staticmethod
+    def _classifier_hash(classifier_instruction: str) -> str:
+        """Смена инструкции классификатора делает старые уровни неприменимыми"""
+        return hashlib.sha1((classifier_instruction or '').encode('utf-8')).hexdigest()[:16]
+    
+    def _partition(self, question_id: int, classifier_hash: str, guard: str) -> _Partition:
+        key = (question_id, classifier_hash, guard)
+        if key not in self._partitions:
+            self._partitions[key] = _Partition(self.embedder.dim, self.n_tables)
+        return self._partitions[key]
+    
+    def _signatures(self, vector: np.ndarray) -> List[int]:
+        bits = (self.hyperplanes @ vector) > 0
+        return [int(x) for x in bits.astype(np.int64) @ self.bit_weights]
+    
+    def _signatures_batch(self, vectors: np.ndarray) -> np.ndarray:
+        """Сигнатуры многих векторов: матрица (векторы x таблицы) int64"""
+        bits = np.einsum('tbd,nd->ntb', self.hyperplanes, vectors) > 0
+        return bits.astype(np.int64) @ self.bit_weights
+    
+    def _nearest(self, partition: _Partition, vector: np.ndarray, signatures: List[int]) -> Tuple[Optional[int], float]:
+        candidates = set()
+        for table, signature in zip(partition.buckets, signatures):
+            candidates.update(table.get(signature, ()))
+        if not candidates:
+            return None, 0.0
+        rows = np.fromiter(candidates, dtype=np.int64)
+        scores = partition.vectors[rows] @ vector
+        best = int(np.argmax(scores))
+        return int(rows[best]), float(scores[best])
+    
+    def lookup(self, question_id: int, classifier_instruction: str, answer: str) -> Optional[str]:
+        """Уровень ближайшего похожего ответа или None, если похожих нет"""
+        vector = self.embedder.embed(answer)
+        signatures = self._signatures(vector)
+        
+        with self._lock:
+            self.lookups += 1
+            partition = self._partitions.get((question_id, self._classifier_hash(classifier_instruction),
+                                              self.embedder.guard_key(answer)))
+            if partition is None:
+                return None
+            row, similarity = self._nearest(partition, vector, signatures)
+            if row is None or similarity < self.threshold:
+                return None
+            matched_id = partition.ids[row]
+            level = partition.levels[row]
+            self.reuses += 1
+        
+        self._audit(question_id, answer, matched_id, similarity, level)
+        return level
+    
+    def add(self, question_id: int, classifier_instruction: str, answer: str, level: str) -> None:
+        """Запомнить классифицированный ответ (почти-дубликаты не сохраняются повторно)"""
+        vector = self.embedder.embed(answer)
+        signatures = self._signatures(vector)
+        classifier_hash = self._classifier_hash(classifier_instruction)
+        guard = self.embedder.guard_key(answer)
+        
+        with self._lock:
+            partition = self._partition(question_id, classifier_hash, guard)
+            row, similarity = self._nearest(partition, vector, signatures)
+            if row is not None and similarity >= self.threshold:
+                return
+            
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO semantic_cache (question_id, classifier_hash, answer, level, vector, created_at,
+                                                guard, signatures)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (question_id, classifier_hash, answer, level, vector.tobytes(), time.time(), guard,
+                      np.array(signatures, dtype=np.int64).tobytes()))
+                conn.commit()
+                entry_id = cursor.lastrowid
+            
+            partition.append(vector, signatures, entry_id, level)
+    
+    def _audit(self, question_id: int, answer: str, matched_id: int, similarity: float, level: str) -> None:
+        """Запись о переиспользовании уровня в журнал аудита"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.text_factory = str
+            cursor = conn.cursor()
+            cursor.execute("SELECT answer FROM semantic_cache WHERE id = ?", (matched_id,))
+            result = cursor.fetchone()
+            matched_answer = result[0] if result else ''
+            cursor.execute("""
+                INSERT INTO semantic_cache_audit
+                (question_id, answer, matched_id, matched_answer, similarity, level, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (question_id, answer, matched_id, matched_answer, similarity, level, time.time()))
+            conn.commit()
+        
+        logger.info("🧠 Семантический кэш Q%s: уровень %s (сходство %.3f с записью #%s), переиспользований %s/%s",
+                    question_id, level, similarity, matched_id, self.reuses, self.lookups)
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+def get_semantic_cache() -> Optional[SemanticClassificationCache]:
+    """Общий экземпляр семантического кэша (None, если он выключен)"""
+    global _semantic_cache
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticClassificationCache()
+        return _semantic_cache
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Производные значения сессии: уровни ответов, P1, варианты Q11/Q12, компоненты и границы грейда
+
+Database держит по объекту на сессию (LRU) и обновляет его при каждой записи ответа:
+меняется уровень вопроса X - сбрасываются только значения, зависящие от X по графу
+зависимостей (question_dependencies). Поэтому показ адаптивных вопросов и нажатия кнопок
+вариантов не пересчитывают P1 и не перечитывают ответы и таблицы.
+"""
+
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+from grade_bounds import get_grade_bounds
+from grade_calculator import GradeCalculator, answer_level
+from question_flow import DependencyGraph, question_node
+
+# Узлы графа, от которых зависят компоненты и границы грейда
+_GRADE_NODES = frozenset(('p1', 'p2', 'p3', 'p4'))
+_GRADE_VALUES = ('grade_components', 'grade_bounds')
+
+
+class SessionDerivedValues:
+    """Кэш производных значений одной сессии"""
+    
+    def __init__(self, db, graph: DependencyGraph, levels: Dict[int, int]):
+        """
+        Args:
+            db: Database - источник вариантов Q11/Q12
+            graph: граф зависимостей, по которому сбрасываются значения
+            levels: уровни активных ответов {вопрос: число}
+        """
+        self.db = db
+        self.graph = graph
+        self.calculator = GradeCalculator(db.db_path)
+        self.levels: Dict[int, int] = dict(levels)
+        self._values: Dict[str, object] = {}
+        # Значения запрашиваются и из потоков упреждающих вычислений
+        self._lock = threading.RLock()
+    
+    def _memo(self, node: str, compute: Callable[[], object]):
+        with self._lock:
+            if node not in self._values:
+                self._values[node] = compute()
+            return self._values[node]
+    
+    def _invalidate(self, question_ids: Iterable[int]) -> None:
+        affected = set(self.graph.affected_nodes(question_node(question_id) for question_id in question_ids))
+        for node in list(self._values):
+            if node in affected or (node in _GRADE_VALUES and affected & _GRADE_NODES):
+                del self._values[node]
+    
+    def set_level(self, question_id: int, final_answer) -> None:
+        """Новый активный ответ на вопрос"""
+        level = answer_level(final_answer)
+        with self._lock:
+            if level is None:
+                changed = self.levels.pop(question_id, None) is not None
+            else:
+                changed = self.levels.get(question_id) != level
+                self.levels[question_id] = level
+            if changed:
+                self._invalidate([question_id])
+    
+    def drop_levels(self, question_ids: Iterable[int]) -> None:
+        """Ответы на вопросы стали неактивными"""
+        with self._lock:
+            dropped = [question_id for question_id in question_ids if self.levels.pop(question_id, None) is not None]
+            if dropped:
+                self._invalidate(dropped)
+    
+    def p1(self) -> Optional[int]:
+        """Промежуточный P1 (None - нет ответов на Q8-Q10 или их комбинации в таблице)"""
+        return self.grade_components()['p1']
+    
+    def variants(self, question_num: int, q11_answer: int = None) -> List[Dict]:
+        """
+        Варианты ответа Q11/Q12 по текущему P1 (для Q12 - и по ответу на Q11;
+        q11_answer - чтобы подготовить варианты заранее для еще не данного ответа)
+        """
+        with self._lock:
+            p1_value = self.p1()
+            if p1_value is None:
+                return []
+            if question_num == 11:
+                return self._memo('q11_variants', lambda: self.db.get_question_variants(11, p1_value))
+            
+            by_q11 = self._memo('q12_variants', dict)
+            if q11_answer is None:
+                q11_answer = self.levels.get(11)
+            if q11_answer is None:
+                return []
+            if q11_answer not in by_q11:
+                by_q11[q11_answer] = self.db.get_question_variants(12, p1_value, q11_answer)
+            return by_q11[q11_answer]
+    
+    def variant_text(self, question_num: int, answer_value: int) -> Optional[str]:
+        """Полный текст варианта по номеру ответа (None - такого варианта нет)"""
+        for variant in self.variants(question_num):
+            if variant['answer_value'] == answer_value:
+                return variant['variant_text']
+        return None
+    
+    def grade_components(self) -> Dict[str, Optional[int]]:
+        """Компоненты грейда p1-p4 по текущим ответам"""
+        return self._memo('grade_components', lambda: self.calculator.calculate_components(self.levels))
+    
+    def grade_bounds(self) -> Optional[Dict]:
+        """Границы total_p и грейда по текущим ответам (см. GradeBounds.bounds)"""
+        return self._memo('grade_bounds', lambda: get_grade_bounds(self.db.db_path).bounds(self.levels))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Упреждающая подготовка данных адаптивных вопросов сессии
+
+Как только есть нужные ответы, в фоне считаются P1, варианты Q11 и Q12 (для каждого
+возможного ответа на Q11) и генерируется функционал для Q18 - пока пользователь
+отвечает на последние вопросы. Каждый результат помечен отпечатком входных данных;
+если ответы изменились (конфликт, пересдача), результат не используется.
+"""
+
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Optional, Tuple
+
+from config import PREFETCH_ENABLED, FUNCTIONALITY_PREFETCH_IGNORED_QUESTIONS
+from database import Database
+from processing_agents import split_portrait
+from app_logging import get_logger
+
+logger = get_logger('bot')
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="prefetch")
+
+
+def strip_portrait(portrait: Optional[str], question_ids: List[int]) -> Optional[str]:
+    """Портрет без ответов на указанные вопросы"""
+    if not portrait or not question_ids:
+        return portrait
+    parts = [part for question_id, part in split_portrait(portrait) if question_id not in question_ids]
+    return "\n\n".join(parts) or None
+
+
+class SessionPrefetcher:
+    """Фоновые вычисления для одной сессии пользователя"""
+    
+    def __init__(self, db: Database, user_id: int, session_id: int):
+        self.db = db
+        self.user_id = user_id
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        # (отпечаток, future) для адаптивных данных и для функционала
+        self._adaptive: Optional[Tuple[tuple, Future]] = None
+        self._functionality: Optional[Tuple[str, Future]] = None
+    
+    def _active_levels(self) -> Dict[int, int]:
+        return self.db.get_session_derived(self.user_id, self.session_id).levels
+    
+    @staticmethod
+    def _adaptive_key(levels: Dict[int, int]) -> tuple:
+        return tuple(levels.get(question_id) for question_id in (8, 9, 10))
+    
+    def update(self, remaining_questions: List[int], functionality_agent=None) -> None:
+        """
+        Запустить подготовку того, для чего уже есть входные данные
+
+        Вызывается перед показом каждого следующего вопроса; устаревшие задачи отменяются
+        (уже выполняющийся запрос к LLM не прерывается, его результат просто не будет использован).
+        """
+        if not PREFETCH_ENABLED:
+            return
+        levels = self._active_levels()
+        
+        if {8, 9, 10}.issubset(levels) and ({11, 12} & set(remaining_questions)):
+            key = self._adaptive_key(levels)
+            with self._lock:
+                if self._adaptive is None or self._adaptive[0] != key:
+                    if self._adaptive is not None:
+                        self._adaptive[1].cancel()
+                    self._adaptive = (key, _executor.submit(contextvars.copy_context().run, self._compute_adaptive))
+        
+        # Функционал Q18 - когда до него остались только вопросы, которые в нем не учитываются
+        pending = [question_id for question_id in remaining_questions if question_id != 18]
+        if (functionality_agent is not None and 18 in remaining_questions
+                and all(question_id in FUNCTIONALITY_PREFETCH_IGNORED_QUESTIONS for question_id in pending)):
+            portrait = strip_portrait(self.db.get_session_portrait(self.user_id, self.session_id),
+                                      FUNCTIONALITY_PREFETCH_IGNORED_QUESTIONS)
+            if portrait:
+                with self._lock:
+                    if self._functionality is None or self._functionality[0] != portrait:
+                        if self._functionality is not None:
+                            self._functionality[1].cancel()
+                        logger.info("🔮 Упреждающая генерация функционала Q18 (пользователь %s)", self.user_id)
+                        future = _executor.submit(contextvars.copy_context().run, self._compute_functionality,
+                                                  functionality_agent, portrait)
+                        self._functionality = (portrait, future)
+    
+    def _compute_adaptive(self) -> Dict:
+        """P1, варианты Q11 и варианты Q12 для каждого возможного ответа на Q11"""
+        # Считается через кэш сессии - при показе Q11/Q12 значения уже в нем
+        derived = self.db.get_session_derived(self.user_id, self.session_id)
+        p1_value = derived.p1()
+        if p1_value is None:
+            return {'p1': None, 'variants_11': [], 'variants_12': {}}
+        variants_11 = derived.variants(11)
+        variants_12 = {
+            variant['answer_value']: derived.variants(12, variant['answer_value'])
+            for variant in variants_11
+        }
+        return {'p1': p1_value, 'variants_11': variants_11, 'variants_12': variants_12}
+    
+    @staticmethod
+    def _compute_functionality(functionality_agent, portrait: str) -> Optional[str]:
+        functionality = functionality_agent.generate_functionality(portrait)
+        # Стандартный текст при сбое LLM не запоминаем - при показе Q18 будет новая попытка
+        if functionality == functionality_agent.FALLBACK_FUNCTIONALITY:
+            return None
+        return functionality
+    
+    async def get_adaptive(self) -> Optional[Dict]:
+        """Подготовленные P1 и варианты, если они посчитаны по текущим ответам на Q8-Q10"""
+        with self._lock:
+            prefetched = self._adaptive
+        if prefetched is None or prefetched[0] != self._adaptive_key(self._active_levels()):
+            return None
+        try:
+            return await asyncio.wrap_future(prefetched[1])
+        except Exception as e:
+            logger.warning("⚠️ Упреждающий расчет вариантов не удался: %s", e)
+            return None
+    
+    async def take_functionality(self, portrait: str) -> Optional[str]:
+        """Подготовленный функционал Q18, если он построен по тому же портрету"""
+        key = strip_portrait(portrait, FUNCTIONALITY_PREFETCH_IGNORED_QUESTIONS)
+        with self._lock:
+            prefetched = self._functionality
+            if prefetched is None or prefetched[0] != key:
+                return None
+            self._functionality = None
+        try:
+            functionality = await asyncio.wrap_future(prefetched[1])
+        except Exception as e:
+            logger.warning("⚠️ Упреждающая генерация функционала не удалась: %s", e)
+            return None
+        if functionality:
+            logger.info("🔮 Функционал Q18 взят из упреждающей генерации (пользователь %s)", self.user_id)
+        return functionality
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Запись сессий пользователей для воспроизведения
+
+Запись начинается с /start и заканчивается отчетом. В нее попадают входящие сообщения,
+нажатия кнопок и пары запрос/ответ LLM (секреты вычищаются), в конце - итог сессии:
+активные ответы и грейд. Одна сессия - один файл JSON Lines, сжатый gzip
+(data/recordings/<время>_<хэш пользователя>.jsonl.gz); каждое событие дописывается
+отдельным членом gzip, так что оборванная запись читается до последнего события.
+
+Вызовы LLM привязываются к сессии через контекстную переменную: ее выставляет
+middleware на время обработки события, фоновые задачи получают копию контекста.
+
+При воспроизведении (session_replay.py) тот же контекст указывает на загруженную запись,
+а LLMFactory вместо настоящих сервисов отдает ReplayLLMService с ответами из нее.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from config import (
+    SESSION_RECORDING_ENABLED, SESSION_RECORDING_DIR,
+    TELEGRAM_BOT_TOKEN, GIGACHAT_AUTH, OPENAI_API_KEY, OPENAI_PROXY_PASSWORD
+)
+from llm_services import BaseLLMService, LLMError
+from app_logging import get_logger
+
+logger = get_logger('bot')
+
+RECORDING_VERSION = 1
+
+_SECRET_PATTERNS = [
+    re.compile(r'sk-[A-Za-z0-9_\-]{16,}'),                 # ключи OpenAI
+    re.compile(r'\b\d{8,10}:[A-Za-z0-9_\-]{35}\b'),        # токены ботов Telegram
+    re.compile(r'(?i)\b(bearer|basic)\s+[A-Za-z0-9._~+/=\-]{16,}')
+]
+_SECRET_VALUES = [value for value in (TELEGRAM_BOT_TOKEN, GIGACHAT_AUTH, OPENAI_API_KEY, OPENAI_PROXY_PASSWORD)
+                  if value and len(value) >= 8]
+
+
+def scrub(text: Optional[str]) -> Optional[str]:
+    """Убрать из текста ключи и токены"""
+    if not text:
+        return text
+    for value in _SECRET_VALUES:
+        text = text.replace(value, "[секрет]")
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub("[секрет]", text)
+    return text
+
+
+def request_key(task_type: str, messages: List[Dict]) -> str:
+    """Отпечаток запроса к LLM (по нему ответ находится при воспроизведении)"""
+    payload = json.dumps([task_type, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:24]
+
+
+def session_outcome(db, user_id: int, session_id: int) -> Dict:
+    """Итог сессии для сравнения записи и воспроизведения: уровни ответов и грейд"""
+    from grade_calculator import GradeCalculator
+    responses = db.get_user_responses(user_id, session_id, only_active=True)
+    grade = GradeCalculator(db.db_path).calculate_grade(user_id, session_id)
+    return {
+        'answers': {str(response['question']): response['final_answer'] for response in responses},
+        'grade': grade.get('final_grade'),
+        'total_p': grade.get('calculations', {}).get('total_p'),
+        'error': grade.get('error')
+    }
+
+
+_current_recording: ContextVar[Optional["SessionRecording"]] = ContextVar('session_recording', default=None)
+
+
+class SessionRecording:
+    """Запись одной сессии: события с отметкой времени от начала"""
+    
+    def __init__(self, path: Optional[str] = None, header: Optional[Dict] = None):
+        self.path = path
+        self.started = time.monotonic()
+        self.events: List[Dict] = []
+        self._lock = threading.Lock()
+        if header is not None:
+            self.add(header)
+    
+    def add(self, event: Dict) -> None:
+        event.setdefault('t', round(time.monotonic() - self.started, 3))
+        with self._lock:
+            self.events.append(event)
+            if self.path:
+                # Ошибка записи не должна ломать обработку сообщения
+                try:
+                    with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                        f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    logger.warning("⚠️ Не удалось дописать запись сессии %s: %s", self.path, e)
+    
+    def compact(self) -> None:
+        """Переписать файл одним членом gzip (повторяющиеся промпты сжимаются между событиями)"""
+        if not self.path:
+            return
+        with self._lock:
+            temp_path = self.path + ".tmp"
+            try:
+                with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+                    for event in self.events:
+                        f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                logger.warning("⚠️ Не удалось сжать запись сессии %s: %s", self.path, e)
+    
+    def record_llm_call(self, service_type: str, task_type: str, messages: List[Dict], started: float,
+                        response: Optional[str] = None, chunks: Optional[List[str]] = None,
+                        error: Optional[Exception] = None) -> None:
+        event = {
+            'type': 'llm',
+            'service': service_type,
+            'task_type': task_type,
+            'key': request_key(task_type, messages),
+            'messages': [{**message, 'content': scrub(message.get('content'))} for message in messages],
+            'latency': round(time.monotonic() - started, 3)
+        }
+        if chunks is not None:
+            event['chunks'] = [scrub(chunk) for chunk in chunks]
+        elif response is not None:
+            event['response'] = scrub(response)
+        if error is not None:
+            event['error'] = type(error).__name__
+            event['error_message'] = scrub(str(error))
+        self.add(event)
+
+
+def load_recording(path: str) -> List[Dict]:
+    """События записи (оборванный последний член gzip пропускается)"""
+    events = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    events.append(json.loads(line))
+    except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+        logger.warning("⚠️ Запись %s прочитана не полностью: %s", path, e)
+    return events
+
+
+class SessionRecorder:
+    """Текущие записи пользователей и middleware aiogram, которые их пополняют"""
+    
+    def __init__(self, directory: str = SESSION_RECORDING_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._recordings: Dict[int, SessionRecording] = {}
+        self._lock = threading.Lock()
+    
+    def _start(self, user_id: int) -> SessionRecording:
+        user_hash = hashlib.sha256(str(user_id).encode()).hexdigest()[:10]
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{user_hash}.jsonl.gz"
+        recording = SessionRecording(os.path.join(self.directory, name), {
+            'type': 'header',
+            'version': RECORDING_VERSION,
+            'recorded_at': datetime.now().isoformat(timespec='seconds')
+        })
+        with self._lock:
+            self._recordings[user_id] = recording
+        logger.info("🎙️ Запись сессии: %s", recording.path)
+        return recording
+    
+    def get(self, user_id: int) -> Optional[SessionRecording]:
+        with self._lock:
+            return self._recordings.get(user_id)
+    
+    async def message_middleware(self, handler, event, data):
+        """Входящее сообщение; /start начинает новую запись"""
+        text = getattr(event, 'text', None)
+        user = getattr(event, 'from_user', None)
+        if text is None or user is None:
+            return await handler(event, data)
+        if text.startswith("/start"):
+            recording = self._start(user.id)
+        else:
+            recording = self.get(user.id)
+        if recording is None:
+            return await handler(event, data)
+        recording.add({'type': 'message', 'text': scrub(text)})
+        return await self._run(recording, handler, event, data)
+    
+    async def callback_middleware(self, handler, event, data):
+        """Нажатие inline кнопки"""
+        recording = self.get(event.from_user.id)
+        if recording is None:
+            return await handler(event, data)
+        recording.add({'type': 'callback', 'data': event.data})
+        return await self._run(recording, handler, event, data)
+    
+    @staticmethod
+    async def _run(recording: SessionRecording, handler, event, data):
+        token = _current_recording.set(recording)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_recording.reset(token)
+    
+    def finish(self, db, user_id: int, session_id: int) -> None:
+        """Записать итог сессии и закрыть запись"""
+        with self._lock:
+            recording = self._recordings.pop(user_id, None)
+        if recording is not None:
+            recording.add({'type': 'outcome', **session_outcome(db, user_id, session_id)})
+            recording.compact()
+
+
+_recorder: Optional[SessionRecorder] = None
+_recorder_lock = threading.Lock()
+
+def get_session_recorder() -> Optional[SessionRecorder]:
+    """Общий экземпляр записи сессий на процесс (None, если запись выключена)"""
+    global _recorder
+    if not SESSION_RECORDING_ENABLED:
+        return None
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = SessionRecorder()
+        return _recorder
+
+
+class RecordingLLMService(BaseLLMService):
+    """Обертка над LLM сервисом: пишет запросы и ответы в запись текущей сессии"""
+    
+    def __init__(self, service: BaseLLMService, service_type: str):
+        self.service = service
+        self.service_type = service_type
+    
+    @property
+    def name(self) -> str:
+        return self.service.name
+    
+    @property
+    def emoji(self) -> str:
+        return self.service.emoji
+    
+    @property
+    def model(self) -> str:
+        return self.service.model
+    
+    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
+        recording = _current_recording.get()
+        if recording is None:
+            return self.service.generate_response(messages, task_type)
+        started = time.monotonic()
+        try:
+            response = self.service.generate_response(messages, task_type)
+        except LLMError as e:
+            recording.record_llm_call(self.service_type, task_type, messages, started, error=e)
+            raise
+        recording.record_llm_call(self.service_type, task_type, messages, started, response=response)
+        return response
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        recording = _current_recording.get()
+        if recording is None:
+            yield from self.service.generate_response_stream(messages, task_type)
+            return
+        started = time.monotonic()
+        chunks = []
+        try:
+            for chunk in self.service.generate_response_stream(messages, task_type):
+                chunks.append(chunk)
+                yield chunk
+        except LLMError as e:
+            recording.record_llm_call(self.service_type, task_type, messages, started, chunks=chunks, error=e)
+            raise
+        recording.record_llm_call(self.service_type, task_type, messages, started, chunks=chunks)
+
+
+class ReplaySource:
+    """Записанные вызовы LLM одной сессии; ответ ищется по отпечатку запроса"""
+    
+    def __init__(self, events: List[Dict], latency_scale: float = 0.0):
+        self.calls = [event for event in events if event.get('type') == 'llm']
+        self.used = [False] * len(self.calls)
+        self.latency_scale = latency_scale
+        self.matched = 0
+        self.mismatched = 0
+        self.missing = 0
+        self._lock = threading.Lock()
+    
+    def take(self, task_type: str, messages: List[Dict]) -> Dict:
+        """
+        Записанный вызов для запроса: сначала с тем же отпечатком, иначе первый
+        неиспользованный того же типа задачи (промпт изменился - считается расхождением)
+        """
+        key = request_key(task_type, messages)
+        with self._lock:
+            fallback = None
+            for index, call in enumerate(self.calls):
+                if self.used[index] or call['task_type'] != task_type:
+                    continue
+                if call['key'] == key:
+                    self.used[index] = True
+                    self.matched += 1
+                    return call
+                if fallback is None:
+                    fallback = index
+            if fallback is None:
+                self.missing += 1
+                raise LLMError(f"В записи нет вызова LLM для задачи {task_type}", "replay")
+            self.used[fallback] = True
+            self.mismatched += 1
+            return self.calls[fallback]
+    
+    def unused(self) -> int:
+        with self._lock:
+            return self.used.count(False)
+    
+    def wait(self, call: Dict) -> None:
+        if self.latency_scale:
+            time.sleep(call.get('latency', 0) * self.latency_scale)
+
+
+class ReplayLLMService(BaseLLMService):
+    """LLM сервис, отвечающий из записи сессии текущего контекста"""
+    
+    def __init__(self, service: BaseLLMService, service_type: str):
+        # Настоящий сервис - только ради имени и модели, запросы к нему не идут
+        self.base_service = service
+        self.service_type = service_type
+    
+    @property
+    def name(self) -> str:
+        return self.base_service.name
+    
+    @property
+    def emoji(self) -> str:
+        return self.base_service.emoji
+    
+    @property
+    def model(self) -> str:
+        return self.base_service.model
+    
+    @staticmethod
+    def _take(task_type: str, messages: List[Dict]) -> Dict:
+        source = _current_replay.get()
+        if source is None:
+            raise LLMError("Воспроизведение вне контекста записи", "replay")
+        call = source.take(task_type, messages)
+        source.wait(call)
+        if call.get('error'):
+            raise LLMError(call.get('error_message') or call['error'], "replay")
+        return call
+    
+    def generate_response(self, messages: List[Dict], task_type: str = 'verification') -> str:
+        call = self._take(task_type, messages)
+        if 'chunks' in call:
+            return "".join(call['chunks'])
+        return call.get('response', "")
+    
+    def generate_response_stream(self, messages: List[Dict], task_type: str = 'verification') -> Iterator[str]:
+        call = self._take(task_type, messages)
+        if 'chunks' in call:
+            yield from call['chunks']
+        else:
+            yield call.get('response', "")
+
+
+_current_replay: ContextVar[Optional[ReplaySource]] = ContextVar('session_replay', default=None)
+_replay_enabled = False
+
+
+def enable_replay() -> None:
+    """Переключить LLMFactory на ответы из записей (для session_replay.py)"""
+    global _replay_enabled
+    _replay_enabled = True
+
+
+def set_replay_source(source: ReplaySource):
+    """Источник ответов LLM для текущего контекста (задачи asyncio наследуют его)"""
+    return _current_replay.set(source)
+
+
+def wrap_llm_service(service: BaseLLMService, service_type: str) -> BaseLLMService:
+    """Внешняя обертка LLMFactory: запись или воспроизведение, если включены"""
+    if _replay_enabled:
+        return ReplayLLMService(service, service_type)
+    if get_session_recorder() is not None:
+        return RecordingLLMService(service, service_type)
+    return service
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанных сессий через TelegramBot
+
+Каждая запись (session_recorder.py) проигрывается виртуальным пользователем: сообщения и
+нажатия кнопок передаются обработчикам TelegramBot в записанном порядке, ответы LLM отдаются
+из записи (по отпечатку запроса), сеть не нужна. Бот работает с копией базы во временном каталоге.
+
+Проверяется:
+- совпадение итога сессии (уровни ответов и грейд) с записанным;
+- запросы к LLM: совпавшие по отпечатку, с измененным промптом, отсутствующие в записи
+  и неиспользованные записанные;
+- длительность ходов (p50/p95/p99), как в load_test.py.
+
+Пример:
+    python session_replay.py data/recordings --concurrency 4 --json replay.json
+    python session_replay.py data/recordings/20250101_120000_ab12cd34ef.jsonl.gz --llm-latency 1 --strict
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from aiogram.types import InlineKeyboardMarkup
+
+from load_test import FakeBot, FakeCallbackQuery, VirtualChat, callback_handler, latency_stats
+
+
+class SessionReplayer:
+    """Проигрывает одну запись от имени виртуального пользователя"""
+    
+    def __init__(self, telegram_bot, fake_bot: FakeBot, user_id: int, path: str, events: List[Dict],
+                 latency_scale: float = 0.0):
+        from session_recorder import ReplaySource
+        self.telegram_bot = telegram_bot
+        self.chat = VirtualChat(user_id, fake_bot)
+        self.user_id = user_id
+        self.path = path
+        self.events = events
+        self.source = ReplaySource(events, latency_scale)
+        self.turns: List[Dict] = []
+        self.error: Optional[str] = None
+        self.outcome: Optional[Dict] = None
+    
+    async def run(self) -> None:
+        from session_recorder import set_replay_source
+        # Задача asyncio - свой контекст, источник ответов виден только этому пользователю
+        set_replay_source(self.source)
+        bot = self.telegram_bot
+        try:
+            for event in self.events:
+                if event['type'] == 'message':
+                    text = event['text']
+                    if text.startswith("/start"):
+                        await self._turn('start', bot.start_command(self.chat.user_message(text)))
+                    elif not text.startswith("/"):
+                        await self._turn('message', bot.handle_message(self.chat.user_message(text)))
+                elif event['type'] == 'callback':
+                    handler, kind = callback_handler(bot, event['data'])
+                    message = self._button_message(event['data'])
+                    self.chat.since_action = len(self.chat.messages)
+                    await self._turn(kind, handler(FakeCallbackQuery(self.chat.user, event['data'], message)))
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        
+        from session_recorder import session_outcome
+        session_id = bot.db.get_next_session_id(self.user_id) - 1
+        if session_id > 0:
+            self.outcome = session_outcome(bot.db, self.user_id, session_id)
+    
+    async def _turn(self, kind: str, handler_call) -> None:
+        started = time.perf_counter()
+        await handler_call
+        self.turns.append({'kind': kind, 'seconds': time.perf_counter() - started})
+    
+    def _button_message(self, data: str):
+        """Сообщение бота с нажатой кнопкой (иначе - последнее сообщение бота)"""
+        for message in reversed(self.chat.messages):
+            if isinstance(message.reply_markup, InlineKeyboardMarkup):
+                if any(button.callback_data == data for row in message.reply_markup.inline_keyboard for button in row):
+                    return message
+        if self.chat.messages:
+            return self.chat.messages[-1]
+        return self.chat.add_bot_message("", None)
+    
+    def recorded_outcome(self) -> Optional[Dict]:
+        for event in reversed(self.events):
+            if event['type'] == 'outcome':
+                return {key: value for key, value in event.items() if key not in ('type', 't')}
+        return None
+    
+    def result(self) -> Dict:
+        recorded = self.recorded_outcome()
+        if recorded is None:
+            outcome_status = 'не записан'
+        elif self.outcome is None:
+            outcome_status = 'нет сессии'
+        else:
+            outcome_status = 'совпадает' if recorded == self.outcome else 'расходится'
+        result = {
+            'recording': os.path.basename(self.path),
+            'turns': len(self.turns),
+            'error': self.error,
+            'outcome': outcome_status,
+            'llm_matched': self.source.matched,
+            'llm_mismatched': self.source.mismatched,
+            'llm_missing': self.source.missing,
+            'llm_unused': self.source.unused()
+        }
+        if outcome_status == 'расходится':
+            result['outcome_recorded'] = recorded
+            result['outcome_replayed'] = self.outcome
+        return result
+
+
+def find_recordings(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.jsonl.gz")))
+        else:
+            files.append(path)
+    return files
+
+
+async def run_replay(files: List[str], db_path: str, workdir: str, concurrency: int,
+                     latency_scale: float) -> Dict:
+    # Модули бота импортируются после настройки окружения (config читается при импорте)
+    from database import Database
+    from telegram_bot import TelegramBot
+    from session_recorder import enable_replay, load_recording
+    
+    enable_replay()
+    fake_bot = FakeBot()
+    reports_dir = os.path.join(workdir, "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+    telegram_bot = TelegramBot(bot=fake_bot, db=Database(db_path), reports_dir=reports_dir)
+    
+    # Идентификаторы вне диапазона реальных пользователей Telegram
+    replayers = [
+        SessionReplayer(telegram_bot, fake_bot, 8_000_000_000 + index, path, load_recording(path), latency_scale)
+        for index, path in enumerate(files)
+    ]
+    semaphore = asyncio.Semaphore(concurrency or len(replayers) or 1)
+    
+    async def run_one(replayer: SessionReplayer):
+        async with semaphore:
+            await replayer.run()
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(run_one(replayer) for replayer in replayers))
+    duration = time.perf_counter() - started
+    
+    turns = [turn['seconds'] for replayer in replayers for turn in replayer.turns]
+    return {
+        'recordings': len(replayers),
+        'duration_s': round(duration, 2),
+        'turn_latency': latency_stats(turns),
+        'sessions': [replayer.result() for replayer in replayers],
+        'telegram_calls': dict(fake_bot.calls.most_common())
+    }
+
+
+def print_report(result: Dict) -> None:
+    print("=" * 70)
+    print(f"🔁 Воспроизведено записей: {result['recordings']} за {result['duration_s']} с")
+    latency = result['turn_latency']
+    print(f"⏱️ Ходы: {latency['count']}, p50 {latency['p50_ms']} мс, p95 {latency['p95_ms']} мс, "
+          f"p99 {latency['p99_ms']} мс, max {latency['max_ms']} мс")
+    for session in result['sessions']:
+        mark = "✅" if session['outcome'] in ('совпадает', 'не записан') and not session['error'] else "❌"
+        print(f"{mark} {session['recording']}: ходов {session['turns']}, итог {session['outcome']}, LLM: "
+              f"совпало {session['llm_matched']}, промпт изменился {session['llm_mismatched']}, "
+              f"нет в записи {session['llm_missing']}, не использовано {session['llm_unused']}")
+        if session['error']:
+            print(f"   ошибка: {session['error']}")
+    print("=" * 70)
+
+
+def has_regressions(result: Dict) -> bool:
+    return any(session['error'] or session['outcome'] == 'расходится'
+               or session['llm_mismatched'] or session['llm_missing']
+               for session in result['sessions'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных сессий")
+    parser.add_argument("paths", nargs="+", help="Файлы записей или каталоги с ними")
+    parser.add_argument("--concurrency", type=int, default=1, help="Одновременно воспроизводимых записей (0 - все)")
+    parser.add_argument("--llm-latency", type=float, default=0.0,
+                        help="Множитель записанной задержки LLM (0 - ответ сразу, 1 - как при записи)")
+    parser.add_argument("--db", default="data/database.db", help="База, копия которой используется")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результаты в JSON")
+    parser.add_argument("--strict", action="store_true",
+                        help="Код выхода 1 при ошибках, расхождении итога или запросов к LLM")
+    args = parser.parse_args()
+    
+    files = find_recordings(args.paths)
+    if not files:
+        print("❌ Записи не найдены")
+        sys.exit(1)
+    
+    # Кэши и маршрутизация LLM при воспроизведении не участвуют - ответы только из записи
+    os.environ.update({
+        'LLM_CACHE_ENABLED': 'False',
+        'SEMANTIC_CACHE_ENABLED': 'False',
+        'LLM_ROUTING_ENABLED': 'False',
+        'SESSION_RECORDING_ENABLED': 'False'
+    })
+    workdir = tempfile.mkdtemp(prefix="hay_replay_")
+    db_path = os.path.join(workdir, "database.db")
+    shutil.copyfile(args.db, db_path)
+    try:
+        result = asyncio.run(run_replay(files, db_path, workdir, args.concurrency, args.llm_latency))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены: {args.json_path}")
+    if args.strict and has_regressions(result):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
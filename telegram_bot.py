@@ -1,4 +1,7 @@
 import asyncio
+import contextvars
+import logging
+import os
 from typing import List, Dict
 from aiogram import Bot, Dispatcher
 from aiogram.types import Message
@@ -8,19 +11,37 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemo
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 
 from database import Database
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, CONFLICT_AWARE_OPTIONS, CONFLICT_EXPLANATION_PERSONALIZE, FUNCTIONALITY_DRAFT_REFINE
 from processing_agents import VerificationAgent, AnswerCompilerAgent, ClassificationAgent
 from html_report_generator import HTMLReportGenerator
-from llm_services import LLMFactory
+from llm_services import LLMFactory, LLMError
+from telegram_streaming import TelegramStreamSink
+from session_prefetcher import SessionPrefetcher
+from session_recorder import get_session_recorder
+from explanation_cache import get_explanation_cache, role_family
+from functionality_drafts import get_functionality_drafts
+import metrics
+from app_logging import setup_logging, get_logger, prompt_dump_sampled, dump_prompt
+
+logger = get_logger('bot')
 
 class TelegramBot:
-    def __init__(self):
-        self.bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    def __init__(self, bot: Bot = None, db: Database = None, reports_dir: str = "reports"):
+        """
+        Args:
+            bot: клиент Telegram (по умолчанию - с токеном из конфигурации)
+            db: база данных (по умолчанию - data/database.db)
+            reports_dir: каталог HTML отчетов
+        """
+        self.bot = bot or Bot(token=TELEGRAM_BOT_TOKEN)
         self.dp = Dispatcher()
-        self.db = Database()
-        self.report_generator = HTMLReportGenerator()
+        self.db = db or Database()
+        self.reports_dir = reports_dir
+        self.report_generator = HTMLReportGenerator(self.db.db_path)
         # Словарь для хранения активных сессий пользователей
         self.active_sessions = {}
+        # Фоновые задачи (персональные объяснения конфликтов) - ссылки, чтобы их не собрал GC
+        self._background_tasks = set()
         
         self.dp.message.register(self.start_command, Command("start"))
         self.dp.message.register(self.handle_message, ~F.text.startswith("/"))
@@ -38,6 +59,12 @@ class TelegramBot:
         
         # Регистрируем обработчик кнопки "Начать интервью"
         self.dp.callback_query.register(self.handle_start_interview, F.data == "start_interview")
+        
+        # Запись сессий для воспроизведения (session_replay.py)
+        recorder = get_session_recorder()
+        if recorder is not None:
+            self.dp.message.outer_middleware(recorder.message_middleware)
+            self.dp.callback_query.outer_middleware(recorder.callback_middleware)
     
     async def start_command(self, message: Message):
         """Начать опрос"""
@@ -73,7 +100,7 @@ class TelegramBot:
         try:
             await callback_query.message.edit_text(text=selected_text, reply_markup=None, parse_mode="Markdown")
         except Exception as e:
-            print(f"⚠️ Не удалось отредактировать сообщение: {e}")
+            logger.warning("⚠️ Не удалось отредактировать сообщение: %s", e)
         
         await callback_query.answer(f"Выбран {service.name}!")
         
@@ -94,7 +121,7 @@ class TelegramBot:
         try:
             await callback_query.message.edit_reply_markup(reply_markup=None)
         except Exception as e:
-            print(f"⚠️ Не удалось убрать кнопку: {e}")
+            logger.warning("⚠️ Не удалось убрать кнопку: %s", e)
         
         await callback_query.answer("🚀 Начинаю интервью!")
         
@@ -167,6 +194,15 @@ class TelegramBot:
             'functionality': functionality_agent
         }
     
+    def get_prefetcher(self, user_id: int, session_id: int) -> SessionPrefetcher:
+        """Упреждающие вычисления текущей сессии пользователя"""
+        session_data = self.active_sessions[user_id]
+        prefetcher = session_data.get('prefetcher')
+        if prefetcher is None or prefetcher.session_id != session_id:
+            prefetcher = SessionPrefetcher(self.db, user_id, session_id)
+            session_data['prefetcher'] = prefetcher
+        return prefetcher
+    
     def format_question_text(self, question_text: str) -> str:
         """Форматирует вопрос: вторую часть (пример) делает курсивом"""
         # Если есть двойной перенос строки - вторую часть делаем курсивом
@@ -192,25 +228,42 @@ class TelegramBot:
         else:
             await message.answer(f"Вопрос {question_id}: {formatted_question}", reply_markup=ReplyKeyboardRemove(), parse_mode="Markdown")
     
+    @staticmethod
+    async def _run_blocking(func, *args):
+        """
+        Синхронный вызов агента в пуле потоков
+        
+        Запросы к LLM блокируют поток (ожидание ответа, паузы между повторами) - в цикле событий
+        они остановили бы обработку сообщений всех пользователей. Контекст (метрики хода, логирование)
+        переносится в поток.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+    
     async def handle_message(self, message: Message):
+        """Обработка ответов (ход пользователя с замером участков)"""
+        with metrics.turn('message'):
+            await self._process_message(message)
+    
+    async def _process_message(self, message: Message):
         """Обработка ответов"""
         user_id = message.from_user.id
         user_answer = message.text
         
-        print(f"🔍 Получено сообщение от пользователя {user_id}: '{user_answer}'")
+        logger.debug("🔍 Получено сообщение от пользователя %s: '%s'", user_id, user_answer)
         
         # Проверяем, есть ли активная сессия для пользователя
         if user_id not in self.active_sessions:
-            print("❌ Нет активной сессии, отправляю сообщение о /start")
+            logger.error("❌ Нет активной сессии, отправляю сообщение о /start")
             await message.answer("Напишите /start для начала опроса")
             return
-            
+        
         session_data = self.active_sessions[user_id]
         session_id = session_data['session_id']
         state = session_data['state']
         
-        print(f"🔍 Active Session ID: {session_id}")
-        print(f"🔍 User state: {state}")
+        logger.debug("🔍 Active Session ID: %s", session_id)
+        logger.debug("🔍 User state: %s", state)
         
         # Проверяем, ожидаются ли дополнения к функционалу (вопрос 18)
         if state.get('awaiting_functionality_addition', False):
@@ -218,7 +271,7 @@ class TelegramBot:
             return
         
         if not state:
-            print("❌ Состояние не найдено, отправляю сообщение о /start")
+            logger.error("❌ Состояние не найдено, отправляю сообщение о /start")
             await message.answer("Напишите /start для начала опроса")
             return
         
@@ -228,12 +281,13 @@ class TelegramBot:
             if user_id in self.active_sessions:
                 del self.active_sessions[user_id]
             return
-            
+        
         current_question = state['remaining_questions'][0]
-        question_data = self.db.get_question(current_question)
-        print(f"🔍 Current question: {current_question}")
-        print(f"🔍 Question text: {question_data['question']}")
-        print(f"🔍 Conversation before: {state['conversation']}")
+        with metrics.span('db_read'):
+            question_data = self.db.get_question(current_question)
+        logger.debug("🔍 Current question: %s", current_question)
+        logger.debug("🔍 Question text: %s", question_data['question'])
+        logger.debug("🔍 Conversation before: %s", state['conversation'])
         
         # Добавляем ответ пользователя в conversation
         state['conversation'].append(user_answer)
@@ -241,7 +295,7 @@ class TelegramBot:
         # Обновляем состояние в памяти
         self.active_sessions[user_id]['state'] = state
         
-        print(f"🔍 Conversation after: {state['conversation']}")
+        logger.debug("🔍 Conversation after: %s", state['conversation'])
         
         # Получаем агенты с правильным LLM
         agents = self.get_agents_for_user(user_id)
@@ -249,95 +303,173 @@ class TelegramBot:
         answer_agent = agents['answer'] 
         classification_agent = agents['classification']
         
-        if question_data['answer_options']:
-            # Получаем портрет для контекста
-            portrait = self.db.get_session_portrait(user_id, session_id)
-            
-            # Показываем typing indicator (если есть классификатор)
-            if question_data.get('classifier'):
-                await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
-            
-            final_answer = classification_agent.classify_answer(question_data, user_answer, portrait)
-            
-            # Сохраняем ответ в БД и проверяем конфликты (только для вопросов с классификатором)
-            has_classifier = bool(question_data.get('classifier'))
-            response_id, conflicts = self.db.save_response(user_id, session_id, current_question, user_answer, final_answer, None, check_conflicts=has_classifier)
-            
-            # Генерируем/обновляем портрет пользователя
-            self.db.generate_user_portrait(user_id, session_id)
-            
-            # Обрабатываем конфликты если они найдены
-            if conflicts:
-                # Берем первый конфликт (может быть только один)
-                first_conflict = conflicts[0]
-                await self.handle_conflict(message, user_id, session_id, first_conflict, state)
-                return  # Прекращаем обработку, конфликт обнаружен
-            
-            # Теперь пересчитываем список оставшихся вопросов с учетом нового ответа
-            state['remaining_questions'] = self.db.get_remaining_questions(user_id, session_id)
-            state['conversation'] = []  # Сбрасываем conversation для следующего вопроса
-            
-            # Обновляем состояние в памяти
-            self.active_sessions[user_id]['state'] = state
-            
-            # Сохраняем обновленное состояние
-            self.db.save_user_state(user_id, session_id, state)
-            
-            await self.next_question(message, user_id, session_id)
-        else:
-            # Получаем портрет пользователя для контекста
-            portrait = self.db.get_session_portrait(user_id, session_id)
-            
-            # Показываем typing indicator
-            await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
-            
-            is_accepted, response_text = verification_agent.process_answer(
-                question_data, user_answer, state['conversation'], portrait
-            )
-            
-            if is_accepted:
-                # Портрет уже получен выше, используем его
-                full_answer = answer_agent.create_full_answer(question_data, state['conversation'], portrait)
-                final_answer = classification_agent.classify_answer(question_data, full_answer, portrait)
+        try:
+            if question_data['answer_options']:
+                # Получаем портрет для контекста
+                with metrics.span('db_read'):
+                    portrait = self.db.get_session_portrait(user_id, session_id)
+                
+                # Показываем typing indicator (если есть классификатор)
+                if question_data.get('classifier'):
+                    with metrics.span('telegram_send'):
+                        await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
+                
+                with metrics.span('classification'):
+                    final_answer = await self._run_blocking(
+                        classification_agent.classify_answer, question_data, user_answer, portrait,
+                        self._conflicting_levels(user_id, session_id, question_data)
+                    )
                 
                 # Сохраняем ответ в БД и проверяем конфликты (только для вопросов с классификатором)
-                # В поле answer записываем полный ответ из диалога, а не только последнее сообщение
                 has_classifier = bool(question_data.get('classifier'))
-                response_id, conflicts = self.db.save_response(user_id, session_id, current_question, full_answer, final_answer, None, check_conflicts=has_classifier)
+                response_id, conflicts = self.db.save_response(user_id, session_id, current_question, user_answer, final_answer, None, check_conflicts=has_classifier)
                 
                 # Генерируем/обновляем портрет пользователя
-                self.db.generate_user_portrait(user_id, session_id)
+                with metrics.span('portrait_rebuild'):
+                    self.db.generate_user_portrait(user_id, session_id)
                 
                 # Обрабатываем конфликты если они найдены
                 if conflicts:
                     # Берем первый конфликт (может быть только один)
                     first_conflict = conflicts[0]
-                    await self.handle_conflict(message, user_id, session_id, first_conflict, state)
+                    with metrics.span('conflict_handling'):
+                        await self.handle_conflict(message, user_id, session_id, first_conflict, state)
                     return  # Прекращаем обработку, конфликт обнаружен
                 
                 # Теперь пересчитываем список оставшихся вопросов с учетом нового ответа
-                state['remaining_questions'] = self.db.get_remaining_questions(user_id, session_id)
-                state['conversation'] = []  # Сбрасываем conversation для следующего вопроса
-                
-                # Обновляем состояние в памяти
-                self.active_sessions[user_id]['state'] = state
-                
-                # Сохраняем обновленное состояние
-                self.db.save_user_state(user_id, session_id, state)
-                
-                # Формируем ответ
-                response_message = f"✅ Принято! {response_text}"
+                with metrics.span('state_save'):
+                    state['remaining_questions'] = self.db.get_remaining_questions(user_id, session_id)
+                    state['conversation'] = []  # Сбрасываем conversation для следующего вопроса
+                    
+                    # Обновляем состояние в памяти
+                    self.active_sessions[user_id]['state'] = state
+                    
+                    # Сохраняем обновленное состояние
+                    self.db.save_user_state(user_id, session_id, state)
                 
-                await message.answer(response_message, parse_mode="Markdown")
-                await self.next_question(message, user_id, session_id)
+                with metrics.span('next_question'):
+                    await self.next_question(message, user_id, session_id)
             else:
-                # Добавляем вопрос бота в conversation и обновляем состояние
-                state['conversation'].append(response_text)
+                # Получаем портрет пользователя для контекста
+                with metrics.span('db_read'):
+                    portrait = self.db.get_session_portrait(user_id, session_id)
                 
-                # Обновляем состояние в памяти
-                self.active_sessions[user_id]['state'] = state
+                # Показываем typing indicator
+                with metrics.span('telegram_send'):
+                    await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
+                
+                with metrics.span('verification'):
+                    is_accepted, response_text = await self._run_blocking(
+                        verification_agent.process_answer, question_data, user_answer, state['conversation'], portrait
+                    )
                 
-                await message.answer(f"❓ {response_text}", parse_mode="Markdown")
+                if is_accepted:
+                    # Портрет уже получен выше, используем его
+                    with metrics.span('compilation'):
+                        full_answer = await self._run_blocking(
+                            answer_agent.create_full_answer, question_data, state['conversation'], portrait
+                        )
+                    with metrics.span('classification'):
+                        final_answer = await self._run_blocking(
+                            classification_agent.classify_answer, question_data, full_answer, portrait,
+                            self._conflicting_levels(user_id, session_id, question_data)
+                        )
+                    
+                    # Сохраняем ответ в БД и проверяем конфликты (только для вопросов с классификатором)
+                    # В поле answer записываем полный ответ из диалога, а не только последнее сообщение
+                    has_classifier = bool(question_data.get('classifier'))
+                    response_id, conflicts = self.db.save_response(user_id, session_id, current_question, full_answer, final_answer, None, check_conflicts=has_classifier)
+                    
+                    # Генерируем/обновляем портрет пользователя
+                    with metrics.span('portrait_rebuild'):
+                        self.db.generate_user_portrait(user_id, session_id)
+                    
+                    # Обрабатываем конфликты если они найдены
+                    if conflicts:
+                        # Берем первый конфликт (может быть только один)
+                        first_conflict = conflicts[0]
+                        with metrics.span('conflict_handling'):
+                            await self.handle_conflict(message, user_id, session_id, first_conflict, state)
+                        return  # Прекращаем обработку, конфликт обнаружен
+                    
+                    # Теперь пересчитываем список оставшихся вопросов с учетом нового ответа
+                    with metrics.span('state_save'):
+                        state['remaining_questions'] = self.db.get_remaining_questions(user_id, session_id)
+                        state['conversation'] = []  # Сбрасываем conversation для следующего вопроса
+                        
+                        # Обновляем состояние в памяти
+                        self.active_sessions[user_id]['state'] = state
+                        
+                        # Сохраняем обновленное состояние
+                        self.db.save_user_state(user_id, session_id, state)
+                    
+                    # Формируем ответ
+                    response_message = f"✅ Принято! {response_text}"
+                    
+                    with metrics.span('telegram_send'):
+                        await message.answer(response_message, parse_mode="Markdown")
+                    with metrics.span('next_question'):
+                        await self.next_question(message, user_id, session_id)
+                else:
+                    # Добавляем вопрос бота в conversation и обновляем состояние
+                    state['conversation'].append(response_text)
+                    
+                    # Обновляем состояние в памяти
+                    self.active_sessions[user_id]['state'] = state
+                    
+                    with metrics.span('telegram_send'):
+                        await message.answer(f"❓ {response_text}", parse_mode="Markdown")
+        except LLMError as e:
+            # Сбой LLM - это не ответ модели: ничего не сохраняем и просим отправить ответ повторно
+            logger.error("❌ Ошибка LLM при обработке ответа на вопрос %s: %s", current_question, e)
+            if state['conversation']:
+                state['conversation'].pop()
+            self.active_sessions[user_id]['state'] = state
+            await message.answer("⚠️ Сервис ИИ временно недоступен. Пожалуйста, отправьте ваш ответ еще раз через минуту.")
+    
+    def _conflicting_levels(self, user_id: int, session_id: int, question_data: Dict) -> Dict[int, List[int]]:
+        """Уровни вопроса, которые сразу дадут конфликт с предыдущими ответами (пусто - проверка выключена)"""
+        if CONFLICT_AWARE_OPTIONS == 'off' or not question_data.get('classifier'):
+            return {}
+        from conflictator import ConflictDetector
+        
+        try:
+            return ConflictDetector(self.db).conflicting_levels(user_id, session_id, question_data['id'])
+        except Exception as e:
+            logger.warning("⚠️ Не удалось проверить конфликтные уровни Q%s: %s", question_data['id'], e)
+            return {}
+    
+    def _conflict_aware_variants(self, user_id: int, session_id: int, question_data: Dict,
+                                 variants: List[Dict]) -> List[Dict]:
+        """
+        Варианты Q11/Q12 с учетом конфликтов: в режиме mark конфликтные варианты получают
+        поле conflict_questions, в режиме hide скрываются (если скрыть пришлось бы все - помечаются)
+        """
+        conflicting = self._conflicting_levels(user_id, session_id, question_data)
+        if not conflicting:
+            return variants
+        
+        if CONFLICT_AWARE_OPTIONS == 'hide':
+            kept = [variant for variant in variants if variant['answer_value'] not in conflicting]
+            if kept:
+                logger.info("🚫 Q%s: скрыты конфликтные варианты %s", question_data['id'],
+                            sorted(set(conflicting) & {variant['answer_value'] for variant in variants}),
+                            extra={'user_id': user_id, 'session_id': session_id})
+                return kept
+        
+        # Копии - исходные варианты закэшированы в SessionDerivedValues
+        return [
+            dict(variant, conflict_questions=conflicting[variant['answer_value']])
+            if variant['answer_value'] in conflicting else variant
+            for variant in variants
+        ]
+    
+    @staticmethod
+    def _variant_conflict_note(variant: Dict) -> str:
+        questions = variant.get('conflict_questions')
+        if not questions:
+            return ""
+        return f"⚠️ Противоречит ответам на вопросы {', '.join(str(q) for q in questions)}\n\n"
     
     async def handle_conflict(self, message: Message, user_id: int, session_id: int, 
                             conflict: Dict, state: Dict):
@@ -365,75 +497,105 @@ class TelegramBot:
         
         await message.answer(conflict_details, parse_mode="Markdown")
         
-        # Выводим техническую информацию о конфликте БЕЗ LLM
-        print("\n" + "="*70)
-        print("📊 ТЕХНИЧЕСКАЯ ИНФОРМАЦИЯ О КОНФЛИКТЕ")
-        print("="*70)
-        print(f"Конфликт ID: {conflict.get('id', 'N/A')}")
-        print(f"Вопросы в конфликте: {conflict['question_ids']}")
-        print()
-        
         # Получаем ответы пользователя для технического лога
         user_responses = self.db.get_user_responses(user_id, session_id, only_active=True)
         response_map = {r['question']: r for r in user_responses}
         
-        # Выводим детали по каждому вопросу
-        for q_info in conflict['questions']:
-            question_id = q_info['question_id']
-            
-            # Получаем фактический уровень пользователя
-            if question_id in response_map:
-                user_level = response_map[question_id].get('final_answer', '')
-                print(f"Вопрос {question_id}:")
-                print(f"  ├─ Уровень пользователя: {user_level}")
-                print(f"  └─ Краткое описание уровня: {q_info['answer_text'][:80]}...")
-                print()
-        
-        print(f"❌ КОНФЛИКТ: Комбинация уровней {[response_map.get(q_id, {}).get('final_answer', '?') for q_id in conflict['question_ids']]} несовместима.")
-        print("="*70 + "\n")
-        
-        # Показываем typing indicator
-        await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
+        # Техническая информация о конфликте БЕЗ LLM - одной записью
+        levels = [response_map.get(q_id, {}).get('final_answer', '?') for q_id in conflict['question_ids']]
+        if logger.isEnabledFor(logging.INFO):
+            details = "\n".join(
+                f"  Вопрос {q_info['question_id']}: уровень {response_map[q_info['question_id']].get('final_answer', '')}"
+                f" - {q_info['answer_text'][:80]}..."
+                for q_info in conflict['questions'] if q_info['question_id'] in response_map
+            )
+            logger.info("📊 Конфликт %s: вопросы %s, комбинация уровней %s несовместима\n%s",
+                        conflict.get('id', 'N/A'), conflict['question_ids'], levels, details,
+                        extra={'user_id': user_id, 'session_id': session_id, 'conflict_id': conflict.get('id')})
         
         # Генерируем промпт для объяснения конфликта с учетом контекста
         explanation_prompt = detector.generate_conflict_explanation(conflict, portrait)
-        
-        print("🤖 КОНФЛИКТАТОР - Отправляем запрос в LLM для объяснения конфликта...")
-        print("-" * 50)
-        print(explanation_prompt)
-        print("-" * 50 + "\n")
-        
-        # Получаем объяснение от LLM (используем task_type='explanation' для более креативного ответа)
         messages = [{"role": "user", "content": explanation_prompt}]
-        explanation = llm.generate_response(messages, task_type='explanation')
-        
-        print("📥 КОНФЛИКТАТОР - Получен ответ от LLM:")
-        print("-" * 50)
-        print(explanation)
-        print("-" * 50)
         
-        # Получаем ID вопросов, участвующих в конфликте
-        conflicted_questions = conflict['question_ids']
-        print(f"🔄 КОНФЛИКТАТОР - Возвращаем вопросы в очередь: {conflicted_questions}")
+        # Объяснение этого правила для похожих должностей (семейство по ответу на Q1) может быть уже готово
+        explanation_cache = get_explanation_cache()
+        family = role_family(response_map.get(1, {}).get('answer'))
+        cached = explanation_cache.get(conflict, family) if explanation_cache is not None else None
         
-        # Добавляем конфликтующие вопросы обратно в remaining (с учетом подвопросов)
-        self.db.add_questions_to_remaining(user_id, session_id, conflicted_questions)
+        if cached is not None:
+            logger.info("⚡ Объяснение конфликта %s из кэша (семейство %s)", conflict.get('id'), family,
+                        extra={'user_id': user_id, 'session_id': session_id, 'conflict_id': conflict.get('id')})
+            try:
+                sent = await message.answer(f"🤖 {cached}", parse_mode="Markdown")
+            except Exception as e:
+                # Разметка в тексте модели некорректна - показываем без нее
+                logger.warning("⚠️ Не удалось отправить объяснение с разметкой Markdown: %s", e)
+                sent = await message.answer(f"🤖 {cached}")
+            if CONFLICT_EXPLANATION_PERSONALIZE:
+                self._personalize_explanation(sent, llm, messages, user_id, session_id)
+        else:
+            # Показываем typing indicator
+            await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
+            
+            dump = prompt_dump_sampled()
+            if dump:
+                dump_prompt("🤖 КОНФЛИКТАТОР - промпт объяснения конфликта", explanation_prompt,
+                            user_id=user_id, session_id=session_id)
+            
+            # Получаем объяснение от LLM (используем task_type='explanation' для более креативного ответа)
+            # и показываем его по мере генерации
+            sink = TelegramStreamSink(message, render=lambda text, final: f"🤖 {text}" if final else f"🤖 {text} ▌")
+            try:
+                explanation = await sink.stream(llm.generate_response_stream(messages, task_type='explanation'))
+            except LLMError as e:
+                # Без объяснения от LLM все равно переспрашиваем вопросы
+                logger.error("❌ Ошибка LLM при объяснении конфликта: %s", e)
+                explanation = "Ответы на эти вопросы не согласуются между собой. Пожалуйста, ответьте на них еще раз."
+                await message.answer(f"🤖 {explanation}", parse_mode="Markdown")
+            
+            if dump:
+                dump_prompt("📥 КОНФЛИКТАТОР - ответ LLM", explanation, user_id=user_id, session_id=session_id)
+            
+            # Обобщенное объяснение для следующих пользователей той же группы должностей
+            if explanation_cache is not None:
+                explanation_cache.generate_in_background(llm, conflict, family)
+        
+        # Ответы на конфликтующие вопросы и зависящие от них уже деактивированы при сохранении
+        # (Database.invalidate_questions) - вопросы снова в списке оставшихся
+        state['remaining_questions'] = self.db.get_remaining_questions(user_id, session_id)
+        logger.info("🔄 КОНФЛИКТАТОР - Возвращаем вопросы в очередь: %s (конфликт: %s)",
+                    state['remaining_questions'], conflict['question_ids'])
         
         # Обновляем состояние
-        state['remaining_questions'] = self.db.get_remaining_questions(user_id, session_id)
         state['conversation'] = []  # Сбрасываем conversation
         
         # Обновляем состояние в памяти и БД
         self.active_sessions[user_id]['state'] = state
         self.db.save_user_state(user_id, session_id, state)
         
-        # Отправляем объяснение от LLM
-        await message.answer(f"🤖 {explanation}", parse_mode="Markdown")
         await message.answer(f"🔄 Предлагаю ответить на эти вопросы заново...")
         
         # Продолжаем опрос с конфликтующих вопросов
         await self.next_question(message, user_id, session_id)
     
+    def _personalize_explanation(self, sent: Message, llm, messages: List[Dict], user_id: int, session_id: int):
+        """Заменить объяснение из кэша персональным (по портрету), когда оно будет готово"""
+        async def run():
+            try:
+                explanation = await self._run_blocking(llm.generate_response, messages, 'explanation')
+                if explanation.strip():
+                    try:
+                        await sent.edit_text(f"🤖 {explanation.strip()}", parse_mode="Markdown")
+                    except Exception:
+                        await sent.edit_text(f"🤖 {explanation.strip()}")
+            except Exception as e:
+                logger.warning("⚠️ Не удалось персонализировать объяснение конфликта: %s", e,
+                               extra={'user_id': user_id, 'session_id': session_id})
+        
+        task = asyncio.create_task(run())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
     async def next_question(self, message: Message, user_id: int, session_id: int):
         """Переход к следующему вопросу"""
         await self.send_next_question(message, user_id, session_id)
@@ -444,12 +606,27 @@ class TelegramBot:
         if user_id not in self.active_sessions:
             await message.answer("Напишите /start для начала опроса")
             return
-            
+        
         state = self.active_sessions[user_id]['state']
         
         if state['remaining_questions']:
             next_question_id = state['remaining_questions'][0]
             
+            # Оценка прогресса: в каких пределах уже находится грейд
+            if logger.isEnabledFor(logging.DEBUG):
+                bounds = self.db.get_session_derived(user_id, session_id).grade_bounds()
+                if bounds is not None:
+                    logger.debug("📈 Грейд: %s-%s (p: %s-%s)%s", bounds['grade_min'], bounds['grade_max'],
+                                 bounds['total_min'], bounds['total_max'], ", определен" if bounds['determined'] else "",
+                                 extra={'user_id': user_id, 'session_id': session_id})
+            
+            # Пока пользователь отвечает, готовим данные следующих адаптивных вопросов
+            try:
+                functionality_agent = self.get_agents_for_user(user_id)['functionality'] if 18 in state['remaining_questions'] else None
+                self.get_prefetcher(user_id, session_id).update(state['remaining_questions'], functionality_agent)
+            except Exception as e:
+                logger.warning("⚠️ Ошибка упреждающей подготовки: %s", e)
+            
             # Проверяем, нужна ли специальная логика для вопросов 11, 12 или 18
             if next_question_id == 11:
                 await self.send_adaptive_question_11(message, user_id, session_id)
@@ -462,6 +639,16 @@ class TelegramBot:
         else:
             # Сохраняем финальное состояние с пустым remaining_questions
             self.db.save_user_state(user_id, session_id, state)
+            
+            # Подтвержденный функционал сессии учитывается в заготовке ее должности
+            drafts = get_functionality_drafts(self.db.db_path)
+            if drafts is not None:
+                try:
+                    responses = self.db.get_user_responses(user_id, session_id)
+                    position = next((r['final_answer'] or r['answer'] for r in responses if r['question'] == 1), None)
+                    drafts.refresh_in_background(LLMFactory.create_service(state.get('llm_type', 'gigachat')), position)
+                except Exception as e:
+                    logger.warning("⚠️ Ошибка обновления заготовки функционала: %s", e)
             # Удаляем только активную сессию из памяти, состояние остается в БД
             if user_id in self.active_sessions:
                 del self.active_sessions[user_id]
@@ -471,17 +658,21 @@ class TelegramBot:
     
     async def generate_and_send_report(self, message: Message, user_id: int, session_id: int):
         """Генерирует HTML и XLSX отчеты и отправляет их администраторам"""
+        recorder = get_session_recorder()
+        if recorder is not None:
+            recorder.finish(self.db, user_id, session_id)
+        
         try:
             # Генерируем HTML отчет
             report_path = self.report_generator.save_report_to_file(
                 user_id=user_id, 
                 session_id=session_id,
-                output_path=f"reports/report_user_{user_id}_session_{session_id}.html"
+                output_path=os.path.join(self.reports_dir, f"report_user_{user_id}_session_{session_id}.html")
             )
             
             # Генерируем XLSX отчет
             from xlsx_report_generator import XLSXReportGenerator
-            xlsx_generator = XLSXReportGenerator()
+            xlsx_generator = XLSXReportGenerator(self.db.db_path)
             xlsx_report_path = xlsx_generator.generate_report(user_id, session_id)
             
             # Отправляем отчеты администраторам
@@ -511,42 +702,42 @@ class TelegramBot:
                                f"🔢 Сессия: {session_id}"
                     )
                     
-                    print(f"✅ Отчеты отправлены администратору {admin_chat_id}")
-                    
+                    logger.info("✅ Отчеты отправлены администратору %s", admin_chat_id)
+                
                 except Exception as e:
-                    print(f"❌ Ошибка отправки отчета администратору {admin_chat_id}: {e}")
+                    logger.error("❌ Ошибка отправки отчета администратору %s: %s", admin_chat_id, e)
             
             # Отправляем пользователю только сообщение о завершении
             await message.answer("🎉 Интервьюирование завершено. Спасибо!", reply_markup=ReplyKeyboardRemove())
-            
+        
         except Exception as e:
-            print(f"Ошибка при генерации отчета: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Ошибка при генерации отчета: %s", e)
             await message.answer("❌ Произошла ошибка при генерации отчета. Обратитесь к администратору.")
     
     async def send_adaptive_question_11(self, message: Message, user_id: int, session_id: int):
         """Отправка вопроса 11 с адаптивными вариантами на основе P1"""
         try:
-            # Вычисляем промежуточный P1
-            from grade_calculator import GradeCalculator
-            calculator = GradeCalculator()
-            p1_value = calculator.calculate_intermediate_p1(user_id, session_id)
+            # P1 и варианты обычно уже посчитаны заранее (упреждающе или при прошлом показе)
+            prefetched = await self.get_prefetcher(user_id, session_id).get_adaptive()
+            derived = self.db.get_session_derived(user_id, session_id)
+            p1_value = prefetched['p1'] if prefetched is not None else derived.p1()
             
             if p1_value is None:
-                print("⚠️ Не удалось вычислить P1, показываем варианты для Q8,Q9,Q10")
+                logger.warning("⚠️ Не удалось вычислить P1, показываем варианты для Q8,Q9,Q10")
                 await self.show_missing_p1_options(message, user_id, session_id)
                 return
             
             # Получаем варианты для Q11
-            variants = self.db.get_question_variants(11, p1_value)
+            variants = prefetched['variants_11'] if prefetched is not None else derived.variants(11)
             question_data = self.db.get_question(11)
             
             if not variants:
-                print("⚠️ Нет вариантов для Q11, используем стандартную логику")
+                logger.warning("⚠️ Нет вариантов для Q11, используем стандартную логику")
                 await self.send_question(message, 11)
                 return
             
+            variants = self._conflict_aware_variants(user_id, session_id, question_data, variants)
+            
             # Убираем Q11 из remaining_questions
             state = self.active_sessions[user_id]['state']
             if 11 in state['remaining_questions']:
@@ -571,9 +762,9 @@ class TelegramBot:
                 pass
             
             await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
-            
+        
         except Exception as e:
-            print(f"❌ Ошибка в адаптивном Q11: {e}")
+            logger.error("❌ Ошибка в адаптивном Q11: %s", e)
             # Fallback к стандартной логике
             await self.send_question(message, 11)
     
@@ -586,8 +777,8 @@ class TelegramBot:
 
 📋 {variant['variant_text']}
 
-Согласны ли вы с этим вариантом?"""
-
+{self._variant_conflict_note(variant)}Согласны ли вы с этим вариантом?"""
+    
     def _format_multiple_variants_message(self, question_data: Dict, p1_value: int, variants: List[Dict]) -> str:
         """Формат сообщения для множественных вариантов"""
         formatted_question = self.format_question_text(question_data['question'])
@@ -598,16 +789,16 @@ class TelegramBot:
 """
         # Добавляем все варианты в текст сообщения
         for variant in variants:
-            text += f"📋 {variant['variant_text']}\n\n"
+            text += f"📋 {variant['variant_text']}\n\n{self._variant_conflict_note(variant)}"
         
         text += "Выберите наиболее подходящий вариант:"
         return text
-
+    
     def _create_single_variant_keyboard(self, variant: Dict, question_num: int) -> InlineKeyboardMarkup:
         """Клавиатура для единственного варианта"""
         buttons = [
             [InlineKeyboardButton(
-                text=f"✅ Вариант {variant['answer_value']}", 
+                text=f"{'⚠️' if variant.get('conflict_questions') else '✅'} Вариант {variant['answer_value']}", 
                 callback_data=f"q{question_num}_accept_{variant['answer_value']}"
             )],
             [InlineKeyboardButton(
@@ -616,7 +807,7 @@ class TelegramBot:
             )]
         ]
         return InlineKeyboardMarkup(inline_keyboard=buttons)
-
+    
     def _create_multiple_variants_keyboard(self, variants: List[Dict], question_num: int) -> InlineKeyboardMarkup:
         """Клавиатура для множественных вариантов"""
         buttons = []
@@ -624,7 +815,7 @@ class TelegramBot:
         # Кнопки для каждого варианта - только номера
         for variant in variants:
             buttons.append([InlineKeyboardButton(
-                text=f"{variant['answer_value']}",  # Только номер
+                text=f"⚠️ {variant['answer_value']}" if variant.get('conflict_questions') else f"{variant['answer_value']}",  # Только номер
                 callback_data=f"q{question_num}_select_{variant['answer_value']}"
             )])
         
@@ -682,7 +873,7 @@ class TelegramBot:
             try:
                 await callback_query.message.edit_reply_markup(reply_markup=None)
             except Exception as e:
-                print(f"⚠️ Не удалось убрать кнопки: {e}")
+                logger.warning("⚠️ Не удалось убрать кнопки: %s", e)
             
             # Отправляем стандартное подтверждение для Q11 и Q12
             await callback_query.message.answer("✅ Принято! Отлично!")
@@ -694,11 +885,11 @@ class TelegramBot:
             else:
                 # Q12 завершён, переходим к обычной логике
                 await self.next_question(callback_query.message, user_id, session_id)
-                
+        
         except Exception as e:
-            print(f"❌ Ошибка обработки callback: {e}")
+            logger.error("❌ Ошибка обработки callback: %s", e)
             await callback_query.answer("❌ Произошла ошибка")
-
+    
     async def handle_restart_callback(self, callback_query: CallbackQuery):
         """Обработка пересдачи с 8-го вопроса"""
         user_id = callback_query.from_user.id
@@ -731,18 +922,18 @@ class TelegramBot:
                     reply_markup=None
                 )
             except Exception as e:
-                print(f"⚠️ Не удалось отредактировать сообщение: {e}")
+                logger.warning("⚠️ Не удалось отредактировать сообщение: %s", e)
             
             await callback_query.message.answer("Хорошо, давайте пересдадим вопросы с 8-го.", 
                                                reply_markup=ReplyKeyboardRemove())
             
             # Переходим к вопросу 8
             await self.send_next_question(callback_query.message, user_id, session_id)
-            
+        
         except Exception as e:
-            print(f"❌ Ошибка пересдачи: {e}")
+            logger.error("❌ Ошибка пересдачи: %s", e)
             await callback_query.answer("❌ Произошла ошибка")
-
+    
     async def handle_functionality_callback(self, callback_query: CallbackQuery):
         """Обработка кнопки принятия функционала (вопрос 18)"""
         user_id = callback_query.from_user.id
@@ -791,17 +982,17 @@ class TelegramBot:
                         parse_mode="Markdown"
                     )
                 except Exception as e:
-                    print(f"⚠️ Не удалось отредактировать сообщение: {e}")
+                    logger.warning("⚠️ Не удалось отредактировать сообщение: %s", e)
                 
                 await callback_query.answer("✅ Функционал принят!")
                 
                 # Переходим к следующему вопросу
                 await self.send_next_question(callback_query.message, user_id, session_id)
-                
+        
         except Exception as e:
-            print(f"❌ Ошибка обработки функционала: {e}")
+            logger.error("❌ Ошибка обработки функционала: %s", e)
             await callback_query.answer("❌ Произошла ошибка")
-
+    
     async def handle_functionality_addition(self, message: Message, user_id: int, session_id: int, addition_text: str):
         """Обработка текстовых дополнений к функционалу"""
         try:
@@ -827,74 +1018,58 @@ class TelegramBot:
             
             # Переходим к следующему вопросу
             await self.send_next_question(message, user_id, session_id)
-            
+        
         except Exception as e:
-            print(f"❌ Ошибка обработки дополнений функционала: {e}")
+            logger.error("❌ Ошибка обработки дополнений функционала: %s", e)
             await message.answer("❌ Произошла ошибка при сохранении дополнений")
-
+    
     def _get_variant_text_by_value(self, question_num: int, answer_value: int, user_id: int, session_id: int) -> str:
-        """Получить полный текст варианта по номеру ответа"""
+        """Получить полный текст варианта по номеру ответа (варианты уже в кэше сессии)"""
         try:
-            from grade_calculator import GradeCalculator
-            calculator = GradeCalculator()
-            p1_value = calculator.calculate_intermediate_p1(user_id, session_id)
-            
-            if p1_value is not None:
-                variants = self.db.get_question_variants(question_num, p1_value)
-                
-                for variant in variants:
-                    if variant['answer_value'] == answer_value:
-                        return variant['variant_text']
-            
-            return f"Вариант {answer_value}"  # Fallback
-            
+            variant_text = self.db.get_session_derived(user_id, session_id).variant_text(question_num, answer_value)
+            return variant_text if variant_text is not None else f"Вариант {answer_value}"  # Fallback
+        
         except Exception as e:
-            print(f"❌ Ошибка получения текста варианта: {e}")
+            logger.error("❌ Ошибка получения текста варианта: %s", e)
             return f"Вариант {answer_value}"
-
+    
     async def send_adaptive_question_12(self, message: Message, user_id: int, session_id: int):
         """Отправка вопроса 12 с адаптивными вариантами с учетом ответа на Q11"""
         try:
-            # Вычисляем промежуточный P1
-            from grade_calculator import GradeCalculator
-            calculator = GradeCalculator()
-            p1_value = calculator.calculate_intermediate_p1(user_id, session_id)
+            # P1 и варианты Q12 для каждого ответа на Q11 обычно уже посчитаны заранее
+            prefetched = await self.get_prefetcher(user_id, session_id).get_adaptive()
+            derived = self.db.get_session_derived(user_id, session_id)
+            p1_value = prefetched['p1'] if prefetched is not None else derived.p1()
             
             if p1_value is None:
-                print("⚠️ Не удалось вычислить P1 для Q12, показываем варианты для Q8,Q9,Q10")
+                logger.warning("⚠️ Не удалось вычислить P1 для Q12, показываем варианты для Q8,Q9,Q10")
                 await self.show_missing_p1_options(message, user_id, session_id)
                 return
             
-            # Получаем ответ на Q11 из БД
-            user_responses = self.db.get_user_responses(user_id, session_id)
-            q11_answer = None
-            
-            for response in user_responses:
-                if response['question'] == 11:  # question номер 11
-                    q11_final_answer = response['final_answer']  # final_answer
-                    try:
-                        q11_answer = int(q11_final_answer)
-                        break
-                    except (ValueError, TypeError):
-                        print(f"⚠️ Не удалось преобразовать ответ Q11 в число: {q11_final_answer}")
-                        continue
+            # Уровень ответа на Q11 (нечисловой ответ не учитывается)
+            q11_answer = derived.levels.get(11)
             
             if q11_answer is None:
-                print("⚠️ Не найден ответ на Q11, используем стандартную логику")
+                logger.warning("⚠️ Не найден ответ на Q11, используем стандартную логику")
                 await self.send_question(message, 12)
                 return
             
-            print(f"🔍 Для Q12: P1={p1_value}, Q11_answer={q11_answer}")
+            logger.debug("🔍 Для Q12: P1=%s, Q11_answer=%s", p1_value, q11_answer)
             
             # Получаем варианты для Q12 с учетом ответа на Q11
-            variants = self.db.get_question_variants(12, p1_value, q11_answer)
+            if prefetched is not None and q11_answer in prefetched['variants_12']:
+                variants = prefetched['variants_12'][q11_answer]
+            else:
+                variants = derived.variants(12)
             question_data = self.db.get_question(12)
             
             if not variants:
-                print("⚠️ Нет вариантов для Q12, используем стандартную логику")
+                logger.warning("⚠️ Нет вариантов для Q12, используем стандартную логику")
                 await self.send_question(message, 12)
                 return
             
+            variants = self._conflict_aware_variants(user_id, session_id, question_data, variants)
+            
             # Убираем Q12 из remaining_questions
             state = self.active_sessions[user_id]['state']
             if 12 in state['remaining_questions']:
@@ -919,9 +1094,9 @@ class TelegramBot:
                 pass
             
             await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
-            
+        
         except Exception as e:
-            print(f"❌ Ошибка в адаптивном Q12: {e}")
+            logger.error("❌ Ошибка в адаптивном Q12: %s", e)
             # Fallback к стандартной логике
             await self.send_question(message, 12)
     
@@ -932,7 +1107,7 @@ class TelegramBot:
             portrait = self.db.get_session_portrait(user_id, session_id)
             
             if not portrait:
-                print("⚠️ Портрет пользователя пуст, используем стандартную логику")
+                logger.warning("⚠️ Портрет пользователя пуст, используем стандартную логику")
                 await self.send_question(message, 18)
                 return
             
@@ -943,19 +1118,6 @@ class TelegramBot:
             # Показываем typing indicator
             await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
             
-            # Генерируем функционал
-            generated_functionality = functionality_agent.generate_functionality(portrait)
-            
-            # Убираем Q18 из remaining_questions и сохраняем сгенерированный функционал
-            state = self.active_sessions[user_id]['state']
-            if 18 in state['remaining_questions']:
-                state['remaining_questions'].remove(18)
-            
-            # Сохраняем состояние для обработки дополнений к функционалу
-            state['awaiting_functionality_addition'] = True
-            state['generated_functionality'] = generated_functionality
-            self.active_sessions[user_id]['state'] = state
-            
             # Получаем данные вопроса
             question_data = self.db.get_question(18)
             formatted_question = self.format_question_text(question_data['question'])
@@ -963,32 +1125,110 @@ class TelegramBot:
             # Сначала убираем старую клавиатуру от предыдущего вопроса
             temp_msg = await message.answer("⏳", reply_markup=ReplyKeyboardRemove())
             
-            # Формируем сообщение
-            text = f"📋 **{formatted_question}**\n\n"
-            text += f"На основании ваших предыдущих ответов сформирован следующий функционал:\n\n"
-            text += f"{generated_functionality}\n\n"
-            text += f"При необходимости можете добавить еще функции, напишите их. "
-            text += f"Или нажмите \"✅ Принять как есть\", если функционал подходит."
+            # Формируем сообщение: функционал дописывается по мере генерации,
+            # подсказка о дополнениях появляется, когда он готов
+            def render(functionality: str, final: bool) -> str:
+                text = f"📋 **{formatted_question}**\n\n"
+                text += f"На основании ваших предыдущих ответов сформирован следующий функционал:\n\n"
+                if not final:
+                    return text + f"{functionality} ▌"
+                text += f"{functionality}\n\n"
+                text += f"При необходимости можете добавить еще функции, напишите их. "
+                text += f"Или нажмите \"✅ Принять как есть\", если функционал подходит."
+                return text
             
             # Создаем inline клавиатуру
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="✅ Принять как есть", callback_data=f"func_accept_18")]
             ])
             
+            # Функционал, сгенерированный заранее по портрету, или заготовка должности (по ответу
+            # на Q1) показываются сразу; иначе генерируем, отправляя сообщение с inline кнопкой по завершении
+            draft = None
+            prefetched_functionality = await self.get_prefetcher(user_id, session_id).take_functionality(portrait)
+            if prefetched_functionality:
+                chunks = iter([prefetched_functionality])
+            else:
+                draft = self._functionality_draft(user_id, session_id)
+                chunks = iter([draft]) if draft else functionality_agent.generate_functionality_stream(portrait)
+            sink = TelegramStreamSink(message, render=render)
+            generated_functionality = await sink.stream(chunks, reply_markup=keyboard)
+            
             # Удаляем временное сообщение с песочными часами
             try:
                 await temp_msg.delete()
             except:
                 pass
             
-            # Отправляем сообщение с inline кнопкой
-            await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+            # Убираем Q18 из remaining_questions и сохраняем сгенерированный функционал
+            state = self.active_sessions[user_id]['state']
+            if 18 in state['remaining_questions']:
+                state['remaining_questions'].remove(18)
             
+            # Сохраняем состояние для обработки дополнений к функционалу
+            state['awaiting_functionality_addition'] = True
+            state['generated_functionality'] = generated_functionality
+            self.active_sessions[user_id]['state'] = state
+            
+            if draft and FUNCTIONALITY_DRAFT_REFINE and sink.sent_message is not None:
+                self._refine_functionality(sink.sent_message, functionality_agent, portrait, render, keyboard,
+                                           user_id, session_id, generated_functionality)
+        
         except Exception as e:
-            print(f"❌ Ошибка в адаптивном Q18: {e}")
+            logger.error("❌ Ошибка в адаптивном Q18: %s", e)
             # Fallback к стандартной логике
             await self.send_question(message, 18)
     
+    def _functionality_draft(self, user_id: int, session_id: int):
+        """Заготовка функционала должности из штатного расписания по ответу на Q1 (None - нет)"""
+        drafts = get_functionality_drafts(self.db.db_path)
+        if drafts is None:
+            return None
+        try:
+            responses = self.db.get_user_responses(user_id, session_id)
+            position = next((r['final_answer'] or r['answer'] for r in responses if r['question'] == 1), None)
+            found = drafts.get(position)
+        except Exception as e:
+            logger.warning("⚠️ Ошибка поиска заготовки функционала: %s", e)
+            return None
+        if found is None:
+            return None
+        draft, role = found
+        logger.info("⚡ Функционал Q18 из заготовки должности '%s'", role['full_path'],
+                    extra={'user_id': user_id, 'session_id': session_id})
+        return draft
+    
+    def _refine_functionality(self, sent: Message, functionality_agent, portrait: str, render, keyboard,
+                              user_id: int, session_id: int, draft: str):
+        """Заменить заготовку функционалом по портрету сессии, если пользователь еще не ответил на Q18"""
+        async def run():
+            try:
+                functionality = await self._run_blocking(functionality_agent.generate_functionality, portrait)
+                functionality = functionality.strip()
+                if not functionality or functionality == functionality_agent.FALLBACK_FUNCTIONALITY:
+                    return
+                session = self.active_sessions.get(user_id)
+                if session is None or session['session_id'] != session_id:
+                    return
+                state = session['state']
+                if not state.get('awaiting_functionality_addition') or state.get('generated_functionality') != draft:
+                    return
+                # Дополнения пользователя теперь добавляются к уточненному функционалу
+                state['generated_functionality'] = functionality
+                try:
+                    await sent.edit_text(render(functionality, True), reply_markup=keyboard, parse_mode="Markdown")
+                except Exception:
+                    await sent.edit_text(render(functionality, True), reply_markup=keyboard)
+                logger.info("✨ Заготовка функционала Q18 заменена функционалом по портрету",
+                            extra={'user_id': user_id, 'session_id': session_id})
+            except Exception as e:
+                logger.warning("⚠️ Не удалось уточнить функционал Q18: %s", e,
+                               extra={'user_id': user_id, 'session_id': session_id})
+        
+        task = asyncio.create_task(run())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
     async def show_missing_p1_options(self, message: Message, user_id: int, session_id: int):
         """Показать пользователю его ответы на Q8,Q9,Q10 и предложить пересдать"""
         try:
@@ -1030,9 +1270,9 @@ class TelegramBot:
             ])
             
             await message.answer(text, reply_markup=keyboard)
-            
+        
         except Exception as e:
-            print(f"❌ Ошибка в show_missing_p1_options: {e}")
+            logger.error("❌ Ошибка в show_missing_p1_options: %s", e)
             # Fallback - показываем простое сообщение
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(
@@ -1057,13 +1297,15 @@ class TelegramBot:
             BotCommand(command="start", description="Начать опрос")
         ]
         await self.bot.set_my_commands(commands)
-
+    
     async def start_polling(self):
         """Запуск бота"""
         await self.setup_bot_commands()
+        metrics.start_metrics_server()
         await self.dp.start_polling(self.bot)
 
 async def main():
+    setup_logging()
     bot = TelegramBot()
     await bot.start_polling()
 
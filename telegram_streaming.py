@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Потоковый вывод ответа LLM в Telegram
+
+Первое сообщение отправляется с первым фрагментом ответа и затем редактируется
+не чаще TELEGRAM_STREAM_EDIT_INTERVAL (ограничение Telegram на частоту правок).
+Промежуточные версии отправляются без разметки: незакрытая ** ломает Markdown.
+Итоговый текст длиннее лимита Telegram разбивается на несколько сообщений.
+"""
+
+import asyncio
+import contextvars
+import time
+from typing import Callable, Iterator, List, Optional
+
+from aiogram.types import Message, InlineKeyboardMarkup
+
+from config import TELEGRAM_STREAMING_ENABLED, TELEGRAM_STREAM_EDIT_INTERVAL
+from app_logging import get_logger
+
+logger = get_logger('bot')
+
+# Лимит длины сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+_DONE = object()
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Части текста не длиннее limit: разрез по последнему переводу строки, пробелу или по лимиту"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return [part for part in parts if part]
+
+
+def default_render(text: str, final: bool) -> str:
+    """Текст как есть, во время генерации - с курсором в конце"""
+    return text if final else f"{text} ▌"
+
+
+class TelegramStreamSink:
+    """Одно сообщение Telegram, которое дописывается по мере генерации"""
+    
+    def __init__(self, message: Message, render: Callable[[str, bool], str] = default_render,
+                 edit_interval: float = TELEGRAM_STREAM_EDIT_INTERVAL, enabled: bool = TELEGRAM_STREAMING_ENABLED):
+        """
+        Args:
+            message: сообщение пользователя, в чат которого отправляется ответ
+            render: (накопленный текст, финальная версия) -> текст сообщения
+            edit_interval: минимальный интервал между правками в секундах
+            enabled: False - промежуточные правки не отправляются, сообщение уходит целиком
+        """
+        self.message = message
+        self.render = render
+        self.edit_interval = edit_interval
+        self.enabled = enabled
+        self.text = ""
+        self.sent_message: Optional[Message] = None
+        self._shown_text = None
+        self._last_edit = 0.0
+    
+    async def stream(self, chunks: Iterator[str], reply_markup: InlineKeyboardMarkup = None,
+                     parse_mode: Optional[str] = "Markdown") -> str:
+        """
+        Прочитать поток фрагментов и показать итоговый текст
+
+        Ошибка до первого фрагмента пробрасывается (сообщение не отправлено), после -
+        сообщение завершается полученной частью ответа.
+
+        Returns:
+            Весь полученный текст ответа
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        
+        def produce():
+            # Синхронный поток (requests) читается в отдельном потоке, чтобы не блокировать бота
+            try:
+                for chunk in chunks:
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+        
+        producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+        error = None
+        started = time.monotonic()
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                error = item
+                continue
+            if not self.text:
+                logger.info("⚡ Первый фрагмент ответа через %.1f с", time.monotonic() - started)
+            self.text += item
+            await self._show(final=False)
+        await producer
+        
+        if error is not None:
+            if not self.text:
+                raise error
+            logger.warning("⚠️ Поток ответа прерван, показываем полученную часть: %s", error)
+        
+        self.text = self.text.strip()
+        await self._show(final=True, reply_markup=reply_markup, parse_mode=parse_mode)
+        return self.text
+    
+    async def _show(self, final: bool, reply_markup: InlineKeyboardMarkup = None,
+                    parse_mode: Optional[str] = None) -> None:
+        """Отправить или отредактировать сообщение (промежуточные правки - с учетом интервала)"""
+        if not final:
+            if not self.enabled or time.monotonic() - self._last_edit < self.edit_interval:
+                return
+        
+        text = self.render(self.text, final)
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            if final:
+                await self._show_parts(split_message(text), reply_markup, parse_mode)
+                return
+            text = text[:TELEGRAM_MESSAGE_LIMIT - 2] + " …"
+        if text == self._shown_text and not final:
+            return
+        
+        if await self._deliver(text, reply_markup, parse_mode):
+            self._shown_text = text
+            self._last_edit = time.monotonic()
+    
+    async def _show_parts(self, parts: List[str], reply_markup: Optional[InlineKeyboardMarkup],
+                          parse_mode: Optional[str]) -> None:
+        """Длинный итоговый текст: первая часть - в текущее сообщение, остальные - новыми, клавиатура - у последней"""
+        for index, part in enumerate(parts):
+            if index:
+                self.sent_message = None
+            last = index == len(parts) - 1
+            if not await self._deliver(part, reply_markup if last else None, parse_mode):
+                return
+        self._shown_text = parts[-1]
+        self._last_edit = time.monotonic()
+    
+    async def _deliver(self, text: str, reply_markup: Optional[InlineKeyboardMarkup],
+                       parse_mode: Optional[str]) -> bool:
+        """Отправка с разметкой, при ошибке - без нее; False - сообщение не обновлено"""
+        try:
+            await self._send(text, reply_markup, parse_mode)
+            return True
+        except Exception as e:
+            if parse_mode is None:
+                logger.warning("⚠️ Не удалось обновить сообщение: %s", e)
+                return False
+            # Разметка в ответе модели некорректна - показываем без нее
+            logger.warning("⚠️ Не удалось отправить с разметкой %s: %s", parse_mode, e)
+        try:
+            await self._send(text, reply_markup, None)
+            return True
+        except Exception as e:
+            logger.warning("⚠️ Не удалось обновить сообщение: %s", e)
+            return False
+    
+    async def _send(self, text: str, reply_markup: InlineKeyboardMarkup, parse_mode: Optional[str]) -> None:
+        if self.sent_message is None:
+            self.sent_message = await self.message.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        else:
+            await self.sent_message.edit_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
@@ -0,0 +1,62 @@
+import os
+import shutil
+import sqlite3
+
+import batch_classify
+from batch_classify import BatchClassifier
+
+REPO_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "database.db")
+
+# Правило 1 таблицы conflicts: Q10 = 1, Q9 = 1, Q8 = 3
+CONFLICT_LEVELS = {8: "3", 9: "1", 10: "1"}
+
+
+class FakeClassificationAgent:
+    """Уровень по номеру вопроса; остальные ответы - как есть"""
+
+    def __init__(self):
+        self.calls = []
+
+    def classify_answer(self, question_data, answer, portrait=None, conflicting_levels=None):
+        self.calls.append(question_data['id'])
+        return CONFLICT_LEVELS.get(question_data['id'], answer)
+
+
+class FakeAnswerAgent:
+    def create_full_answer(self, question_data, conversation, portrait=None):
+        return conversation[-1]
+
+
+def make_classifier(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "database.db")
+    shutil.copy(REPO_DB, db_path)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DELETE FROM conflict_analysis WHERE conflict_id = 1")
+    monkeypatch.setattr(batch_classify.LLMFactory, 'create_service', staticmethod(lambda llm_type: None))
+    classifier = BatchClassifier(db_path=db_path, reports_dir=str(tmp_path / "reports"))
+    classifier.answer_agent = FakeAnswerAgent()
+    classifier.classification_agent = FakeClassificationAgent()
+    return classifier
+
+
+def test_conflict_is_recorded_and_processing_finishes(tmp_path, monkeypatch):
+    classifier = make_classifier(tmp_path, monkeypatch)
+    answers = {question_id: "1" for question_id in range(2, 18)}
+    answers[1] = "Менеджер по продажам"
+
+    result = classifier.process_employee("test.xlsx", "Иванов", answers)
+
+    assert result['status'] == 'needs_review'
+    assert result['conflicts'].startswith("1 (")
+    assert {8, 9, 10} <= set(result['needs_review'])
+    # Каждый вопрос классифицирован один раз - конфликтующие ответы не переспрашиваются
+    calls = classifier.classification_agent.calls
+    assert len(calls) == len(set(calls))
+
+    checkpoint = classifier.checkpoints.get("test.xlsx", "Иванов")
+    assert checkpoint['status'] == 'needs_review'
+    assert checkpoint['conflicts'] == result['conflicts']
+    # Ответы на вопросы конфликта сохранены
+    levels = {response['question']: response['final_answer']
+              for response in classifier.db.get_user_responses(checkpoint['user'], checkpoint['session_id'])}
+    assert {question_id: levels.get(question_id) for question_id in CONFLICT_LEVELS} == CONFLICT_LEVELS
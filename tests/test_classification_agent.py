@@ -0,0 +1,50 @@
+import processing_agents
+from processing_agents import ClassificationAgent
+
+QUESTION = {'id': 8, 'classifier': "Определи уровень ответа: {answer}", 'levels': [1, 2, 3]}
+
+
+class FakeService:
+    name = "fake"
+
+    def __init__(self, response):
+        self.response = response
+        self.prompts = []
+
+    def generate_response(self, messages, task_type='verification'):
+        self.prompts.append(messages[-1]['content'])
+        return self.response
+
+
+class FakeSemanticCache:
+    def __init__(self):
+        self.added = []
+
+    def lookup(self, question_id, instruction, answer):
+        return None
+
+    def add(self, question_id, instruction, answer, level):
+        self.added.append((question_id, level))
+
+
+def test_conflicting_level_is_kept_and_not_cached(monkeypatch):
+    cache = FakeSemanticCache()
+    monkeypatch.setattr(processing_agents, 'get_semantic_cache', lambda: cache)
+    service = FakeService('{"level": 3}')
+
+    level = ClassificationAgent(service).classify_answer(QUESTION, "Руковожу отделом", None, {3: [9, 10]})
+
+    # Противоречащий уровень допустим - конфликт обнаружит ConflictDetector
+    assert level == "3"
+    assert "уровень 3 противоречит ответам на вопросы 9, 10" in service.prompts[0]
+    assert "где N - 1, 2, 3" in service.prompts[0]
+    # Уровень, выбранный с подсказкой этой сессии, не попадает в общий кэш
+    assert cache.added == []
+
+
+def test_level_without_conflict_hint_is_cached(monkeypatch):
+    cache = FakeSemanticCache()
+    monkeypatch.setattr(processing_agents, 'get_semantic_cache', lambda: cache)
+
+    assert ClassificationAgent(FakeService('{"level": 2}')).classify_answer(QUESTION, "Руковожу отделом") == "2"
+    assert cache.added == [(8, "2")]
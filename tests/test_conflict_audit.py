@@ -0,0 +1,40 @@
+import os
+import shutil
+import sqlite3
+
+from conflict_audit import _level, audit
+
+REPO_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "database.db")
+
+
+def test_level_parsing():
+    assert _level("3", None) == 3
+    assert _level("", "2") == 2
+    assert _level("0", None) is None
+    assert _level("abc", None) is None
+    assert _level("²", None) is None
+    assert _level("99999999999999999999", None) is None
+    assert _level("9", None, max_level=8) is None
+    assert _level("8", None, max_level=8) == 8
+
+
+def test_audit_skips_odd_answers(tmp_path):
+    db_path = str(tmp_path / "database.db")
+    shutil.copy(REPO_DB, db_path)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DELETE FROM conflict_analysis WHERE conflict_id = 1")
+        rows = [
+            # Правило 1: Q10 = 1, Q9 = 1, Q8 = 3
+            (-1, 1, 8, "3"), (-1, 1, 9, "1"), (-1, 1, 10, "1"),
+            # Нечисловые и запредельные уровни не прерывают аудит и не дают срабатываний
+            (-2, 1, 8, "²"), (-2, 1, 9, "99999999999999999999"), (-2, 1, 10, "12")
+        ]
+        conn.executemany("INSERT INTO responses (user, session_id, question, answer, final_answer, status) "
+                         "VALUES (?, ?, ?, ?, ?, 'active')",
+                         [(user, session_id, question, answer, answer) for user, session_id, question, answer in rows])
+
+    result = audit(db_path)
+
+    flagged = {(entry['user_id'], entry['session_id']): entry['conflicts'] for entry in result['per_session']}
+    assert 1 in flagged[(-1, 1)]
+    assert (-2, 1) not in flagged
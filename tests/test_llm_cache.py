@@ -0,0 +1,91 @@
+import pytest
+
+import llm_cache
+from llm_cache import CachedLLMService, LLMResponseCache
+from llm_router import RoutingLLMService
+from llm_services import BaseLLMService, LLMServerError
+from processing_agents import request_structured
+
+MESSAGES = [{"role": "user", "content": "Определи уровень"}]
+
+
+class FakeService(BaseLLMService):
+    """Бэкенд с заранее заданными ответами (исключение - сбой)"""
+
+    def __init__(self, name, responses):
+        self._name = name
+        self.responses = list(responses)
+        self.calls = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def emoji(self):
+        return ""
+
+    def generate_response(self, messages, task_type='verification'):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LLMResponseCache(db_path=str(tmp_path / "llm_cache.db"))
+
+
+def test_routed_reply_is_cached_under_answering_model(cache):
+    primary = FakeService('primary-test', [LLMServerError("HTTP 503"), '{"level": 2}'])
+    secondary = FakeService('secondary-test', ['{"level": 3}'])
+    service = CachedLLMService(RoutingLLMService(primary, secondary), cache)
+
+    assert service.generate_response(MESSAGES, 'classification') == '{"level": 3}'
+    assert cache.get(cache.make_key('secondary-test', 'classification', MESSAGES)) == '{"level": 3}'
+    assert cache.get(cache.make_key('primary-test', 'classification', MESSAGES)) is None
+
+    # Ответ второго бэкенда не выдается за ответ основного - основной спрашивается снова
+    assert service.generate_response(MESSAGES, 'classification') == '{"level": 2}'
+    assert primary.calls == 2
+    assert service.generate_response(MESSAGES, 'classification') == '{"level": 2}'
+    assert primary.calls == 2
+
+
+def classify(service):
+    return request_structured(service, MESSAGES, 'classification')
+
+
+def test_only_valid_structured_replies_are_cached(cache):
+    backend = FakeService('test', ['не JSON', '{"level": 2}', '{"level": 2}'])
+    service = CachedLLMService(backend, cache)
+
+    # Некорректный ответ и ответ на запрос исправления в кэш не попадают
+    assert classify(service) == {'level': 2}
+    assert cache.get(cache.make_key('test', 'classification', MESSAGES)) is None
+    assert cache.get_stats()['hits'] == 0
+
+    # Корректный ответ на исходный запрос кэшируется и выдается без обращения к бэкенду
+    assert classify(service) == {'level': 2}
+    assert classify(service) == {'level': 2}
+    assert backend.calls == 3
+
+
+def test_invalid_cached_reply_is_dropped(cache):
+    key = cache.make_key('test', 'classification', MESSAGES)
+    cache.put(key, 'classification', '{"level": "два"}', 1.0)
+    backend = FakeService('test', ['{"level": 1}'])
+
+    assert classify(CachedLLMService(backend, cache)) == {'level': 1}
+    assert backend.calls == 1
+    assert cache.get(key) == '{"level": 1}'
+
+
+def test_key_depends_on_response_schema(monkeypatch):
+    key = LLMResponseCache.make_key('test', 'classification', MESSAGES)
+    settings = dict(llm_cache.LLM_TASK_SETTINGS)
+    settings['classification'] = {**settings['classification'], 'response_schema': {'type': 'object'}}
+    monkeypatch.setattr(llm_cache, 'LLM_TASK_SETTINGS', settings)
+    assert LLMResponseCache.make_key('test', 'classification', MESSAGES) != key
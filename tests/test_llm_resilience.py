@@ -0,0 +1,139 @@
+import time
+
+import pytest
+
+import llm_services
+from llm_resilience import CircuitBreaker, ResilientLLMService, RetryPolicy
+from llm_services import (
+    LLMCircuitOpenError, LLMClientError, LLMServerError, LLMTimeoutError, OpenAIService
+)
+from llm_stub_server import LLMStubServer, StubScenario
+
+MESSAGES = [{"role": "user", "content": "Проверка"}]
+# Задача с текстовым ответом (без response_schema)
+TASK = 'compilation'
+
+
+class RecordingRetryPolicy(RetryPolicy):
+    """Короткие паузы между повторами; запоминает выбранные паузы"""
+
+    def __init__(self, max_attempts: int = 3):
+        super().__init__(max_attempts=max_attempts, base_delay=0.01, max_delay=2.0)
+        self.delays = []
+
+    def get_delay(self, attempt, error):
+        delay = super().get_delay(attempt, error)
+        self.delays.append(delay)
+        return delay
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Заглушка OpenAI со сценарием сбоев: stub(faults) -> сервер"""
+    servers = []
+
+    def start(faults, **config):
+        server = LLMStubServer(StubScenario({
+            'latency': {'distribution': 'fixed', 'ms': 0},
+            'stream_chunk_chars': 4,
+            'stream_chunk_ms': 0,
+            'default_response': "Ответ заглушки",
+            'faults': faults,
+            **config
+        })).start()
+        servers.append(server)
+        monkeypatch.setattr(llm_services, 'OPENAI_API_URL', f"{server.url}/v1/chat/completions")
+        monkeypatch.setattr(llm_services, 'OPENAI_API_KEY', 'stub')
+        monkeypatch.setattr(llm_services, 'OPENAI_USE_PROXY', False)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def make_service(policy=None, breaker=None):
+    return ResilientLLMService(OpenAIService(), policy or RecordingRetryPolicy(),
+                               breaker or CircuitBreaker('test', failure_threshold=5, reset_timeout=60))
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_retries_rate_limit_and_server_errors(stub, status):
+    server = stub([{'status': status}, {'status': status}])
+    assert make_service().generate_response(MESSAGES, TASK) == "Ответ заглушки"
+    assert server.get_stats()['openai.chat'] == 3
+
+
+def test_retry_after_is_respected(stub):
+    stub([{'status': 429, 'retry_after': 1}])
+    policy = RecordingRetryPolicy()
+    started = time.monotonic()
+    assert make_service(policy).generate_response(MESSAGES, TASK) == "Ответ заглушки"
+    assert policy.delays == [1.0]
+    assert time.monotonic() - started >= 1.0
+
+
+def test_timeout_is_retried(stub, monkeypatch):
+    settings = {task: {**values, 'timeout': 0.3} for task, values in llm_services.LLM_TASK_SETTINGS.items()}
+    monkeypatch.setattr(llm_services, 'LLM_TASK_SETTINGS', settings)
+    server = stub([{'hang_seconds': 1}])
+    assert make_service().generate_response(MESSAGES, TASK) == "Ответ заглушки"
+    assert server.get_stats()['openai.fault_timeout'] == 1
+
+    stub([{'hang_seconds': 1}] * 3)
+    with pytest.raises(LLMTimeoutError):
+        make_service().generate_response(MESSAGES, TASK)
+
+
+@pytest.mark.parametrize('status', [400, 401, 404, 422])
+def test_client_errors_are_not_retried(stub, status):
+    server = stub([{'status': status}])
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+    with pytest.raises(LLMClientError):
+        make_service(breaker=breaker).generate_response(MESSAGES, TASK)
+    assert server.get_stats()['openai.chat'] == 1
+    # Бэкенд ответил - автомат защиты не срабатывает
+    assert breaker.state == 'closed'
+
+
+def test_circuit_breaker_opens_and_half_opens(stub):
+    server = stub([{'status': 503}] * 3)
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.3)
+    service = make_service(RecordingRetryPolicy(max_attempts=2), breaker)
+
+    with pytest.raises(LLMServerError):
+        service.generate_response(MESSAGES, TASK)
+    assert breaker.state == 'open'
+
+    # Открытый автомат отклоняет запрос, не обращаясь к бэкенду
+    with pytest.raises(LLMCircuitOpenError):
+        service.generate_response(MESSAGES, TASK)
+    assert server.get_stats()['openai.chat'] == 2
+
+    # После паузы пробный запрос неудачен - автомат снова открыт, повтор не пропускается
+    time.sleep(0.35)
+    with pytest.raises(LLMCircuitOpenError):
+        service.generate_response(MESSAGES, TASK)
+    assert breaker.state == 'open'
+    assert server.get_stats()['openai.chat'] == 3
+
+    # Удачный пробный запрос закрывает автомат
+    time.sleep(0.35)
+    assert service.generate_response(MESSAGES, TASK) == "Ответ заглушки"
+    assert breaker.state == 'closed'
+
+
+def test_stream_is_retried_before_first_chunk(stub):
+    server = stub([{'status': 503}])
+    assert "".join(make_service().generate_response_stream(MESSAGES, TASK)) == "Ответ заглушки"
+    assert server.get_stats()['openai.chat'] == 2
+
+
+def test_stream_is_not_retried_after_first_chunk(stub):
+    server = stub([{'stream_break_after': 1}])
+    chunks = []
+    with pytest.raises(LLMServerError):
+        for chunk in make_service().generate_response_stream(MESSAGES, TASK):
+            chunks.append(chunk)
+    assert chunks == ["Отве"]
+    assert server.get_stats()['openai.chat'] == 1
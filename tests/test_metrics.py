@@ -0,0 +1,34 @@
+import metrics
+import llm_rate_limiter
+from llm_rate_limiter import BackendGovernor, get_rate_limiter_stats
+
+
+def test_collector_gauges_are_rendered():
+    registry = metrics.MetricsRegistry()
+    registry.register_collector(lambda: [('hay_llm_queue_length', 3, {'backend': 'gigachat'})])
+    text = registry.render()
+    assert "# TYPE hay_llm_queue_length gauge" in text
+    assert 'hay_llm_queue_length{backend="gigachat"} 3' in text
+
+
+def test_queue_wait_histogram_and_limiter_gauges(monkeypatch):
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    monkeypatch.setattr(metrics, 'METRICS_ENABLED', True)
+    governor = BackendGovernor('test', rpm=60, tpm=10000, max_concurrency=2)
+    monkeypatch.setitem(llm_rate_limiter._governors, 'test', governor)
+
+    with governor.slot('classification', 500):
+        pass
+
+    stats = get_rate_limiter_stats()['test']
+    assert stats['queue_length'] == 0
+    assert 58 < stats['requests_available'] <= 59.1
+    assert 9400 < stats['tokens_available'] <= 9600
+    assert stats['wait']['classification']['count'] == 1
+
+    registry.register_collector(llm_rate_limiter._collect_metrics)
+    text = registry.render()
+    assert 'hay_llm_queue_wait_seconds_count{backend="test",task="classification"} 1' in text
+    assert 'hay_llm_queue_length{backend="test"} 0' in text
+    assert 'hay_llm_rate_limit_available{backend="test",bucket="tokens"}' in text
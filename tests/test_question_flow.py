@@ -0,0 +1,98 @@
+import json
+import os
+import random
+import shutil
+
+import pytest
+
+from database import Database
+from question_flow import QuestionFlow, should_show_question
+
+REPO_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "database.db")
+
+VALUES = ["1", "2", "3", "4", "5", "", None, "abc", 1, 2.0]
+ODD_CONDITIONS = [
+    None, "", "{}", "[]", "null", "not json", '{"other": 1}', '{"show_if": {}}',
+    '{"show_if": {"question_1": "123"}}',
+    '{"show_if": {"question_1": 1}}', '{"show_if": {"question_01": ["1"]}}', '["show_if"]',
+    '"show_if"', '{"show_if": {"question_1": ["1"], "question_2": 5}}',
+    '{"show_if": {"question_2": [[1]], "question_1": ["2"]}}'
+]
+
+
+def legacy_remaining(questions, responses):
+    """Исходный расчет: should_show_question для каждого неотвеченного вопроса"""
+    answered = {response['question'] for response in responses}
+    return sorted(
+        question['id'] for question in questions
+        if question['id'] not in answered
+        and (not question['show_conditions'] or should_show_question(question['show_conditions'], responses))
+    )
+
+
+def random_questions(rng):
+    """Случайный набор вопросов: обычные условия show_if вперемешку с условиями нестандартной формы"""
+    ids = rng.sample(range(1, 13), rng.randint(3, 10))
+    questions = []
+    for question_id in ids:
+        if rng.random() < 0.4:
+            show_if = {f"question_{dependency}": rng.sample(["1", "2", "3", "4", "5", ""], rng.randint(1, 3))
+                       for dependency in rng.sample(ids, rng.randint(1, 2))}
+            conditions = json.dumps({'show_if': show_if})
+        else:
+            conditions = rng.choice(ODD_CONDITIONS)
+        questions.append({'id': question_id, 'show_conditions': conditions})
+    return questions
+
+
+@pytest.fixture
+def db(tmp_path):
+    db_path = str(tmp_path / "database.db")
+    shutil.copy(REPO_DB, db_path)
+    return Database(db_path)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_scheduler_matches_legacy_on_random_questions(seed):
+    rng = random.Random(seed)
+    for _ in range(25):
+        questions = random_questions(rng)
+        flow = QuestionFlow(questions)
+        scheduler = flow.scheduler()
+        answers = {}
+        for _ in range(rng.randint(1, 25)):
+            if answers and rng.random() < 0.2:
+                retracted = rng.sample(list(answers), rng.randint(1, len(answers)))
+                for question_id in retracted:
+                    answers.pop(question_id)
+                scheduler.retract(retracted)
+            else:
+                question_id = rng.choice(flow.question_ids)
+                answers[question_id] = rng.choice(VALUES)
+                scheduler.answer(question_id, answers[question_id])
+
+            responses = [{'question': question_id, 'answer': value, 'final_answer': value}
+                         for question_id, value in answers.items()]
+            expected = legacy_remaining(questions, responses)
+            assert flow.remaining(answers) == expected, (questions, answers)
+            assert scheduler.remaining() == expected, (questions, answers)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_database_remaining_matches_legacy(db, seed):
+    """Вопросы и условия из базы; ответы, переспрашивание и кэш планировщика - через Database"""
+    rng = random.Random(seed)
+    questions = [{'id': question['id'], 'show_conditions': question['show_conditions']}
+                 for question in db.get_all_questions()]
+    question_ids = [question['id'] for question in questions]
+    user = -1000 - seed
+    for session_id in range(1, 4):
+        for _ in range(rng.randint(5, 30)):
+            if rng.random() < 0.15:
+                db.invalidate_questions(user, session_id, rng.sample(question_ids, rng.randint(1, 3)))
+            else:
+                value = rng.choice(["1", "2", "3", "4", "5", "abc"])
+                db.save_response(user, session_id, rng.choice(question_ids), value, value, check_conflicts=False)
+
+            expected = legacy_remaining(questions, db.get_user_responses(user, session_id))
+            assert db.get_remaining_questions(user, session_id) == expected
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from conflict_analyzer import analyze_conflicts_table
+from conflictator import get_conflict_rules
+from database import Database
+from grade_calculator import get_grading_tables
+from reference_version import bump_reference_version, reference_version
+
+REPO_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "database.db")
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "database.db")
+    shutil.copy(REPO_DB, path)
+    return path
+
+
+def update(db_path, *statements):
+    """Изменение справочников так, как это делают скрипты загрузки"""
+    with sqlite3.connect(db_path) as conn:
+        for statement in statements:
+            conn.execute(statement)
+        bump_reference_version(conn)
+        conn.commit()
+
+
+def conflict_ids(db_path):
+    return {conflict['id'] for conflict in get_conflict_rules(db_path).all_conflicts()}
+
+
+def test_conflict_rules_reload_after_update(db_path):
+    rules = get_conflict_rules(db_path)
+    assert 1 in conflict_ids(db_path)
+    # Ответы пользователей не меняют версию - правила не перечитываются
+    Database(db_path).save_response(-1, 1, 8, "3", "3", check_conflicts=False)
+    assert get_conflict_rules(db_path) is rules
+    
+    update(db_path, "DELETE FROM conflict_analysis WHERE conflict_id = 1")
+    
+    assert get_conflict_rules(db_path) is not rules
+    assert 1 in conflict_ids(db_path)
+
+
+def test_grading_tables_reload_after_update(db_path):
+    tables = get_grading_tables(db_path)
+    assert get_grading_tables(db_path) is tables
+    
+    update(db_path)
+    
+    assert get_grading_tables(db_path) is not tables
+
+
+def test_question_flow_and_sessions_reload_after_update(db_path):
+    db = Database(db_path)
+    flow = db.get_question_flow()
+    remaining = db.get_remaining_questions(-1, 1)
+    assert 2 in remaining
+    
+    update(db_path, "UPDATE questions SET show_conditions = '{\"show_if\": {\"question_1\": [\"нет\"]}}' WHERE id = 2")
+    
+    assert db.get_question_flow() is not flow
+    assert 2 not in db.get_remaining_questions(-1, 1)
+
+
+def test_conflict_analysis_bumps_version(db_path):
+    version = reference_version(db_path)
+    with sqlite3.connect(db_path) as conn:
+        assert analyze_conflicts_table(conn, save=False)['reference_version'] is None
+        assert reference_version(db_path) == version
+        assert analyze_conflicts_table(conn)['reference_version'] == version + 1
+    assert reference_version(db_path) == version + 1
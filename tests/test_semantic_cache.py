@@ -0,0 +1,46 @@
+import sqlite3
+
+from semantic_cache import SemanticClassificationCache
+
+INSTRUCTION = "Определи уровень ответа"
+
+
+def make_cache(tmp_path, **kwargs):
+    return SemanticClassificationCache(db_path=str(tmp_path / "cache.db"), **kwargs)
+
+
+def test_near_duplicate_reuses_level(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.add(8, INSTRUCTION, "Руководит отделом из 5 подчиненных, согласует бюджет", "3")
+    assert cache.lookup(8, INSTRUCTION, "руководит отделом из 5 подчиненных,  согласует бюджет.") == "3"
+
+
+def test_different_number_is_not_reused(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.add(8, INSTRUCTION, "Руководит отделом из 5 подчиненных, согласует бюджет", "3")
+    assert cache.lookup(8, INSTRUCTION, "Руководит отделом из 50 подчиненных, согласует бюджет") is None
+    # Ответ с другим числом сохраняется отдельно, а не считается дубликатом
+    cache.add(8, INSTRUCTION, "Руководит отделом из 50 подчиненных, согласует бюджет", "5")
+    assert cache.lookup(8, INSTRUCTION, "руководит отделом из 50 подчиненных, согласует бюджет") == "5"
+
+
+def test_negation_is_not_reused(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.add(16, INSTRUCTION, "Самостоятельно согласует закупки с поставщиками", "4")
+    assert cache.lookup(16, INSTRUCTION, "Самостоятельно не согласует закупки с поставщиками") is None
+
+
+def test_index_is_restored_from_stored_signatures(tmp_path):
+    cache = make_cache(tmp_path)
+    answers = [f"Ответ номер {i} про планирование задач отдела" for i in range(50)]
+    for i, answer in enumerate(answers):
+        cache.add(9, INSTRUCTION, answer, str(i % 5 + 1))
+    
+    reloaded = make_cache(tmp_path)
+    assert reloaded.lookup(9, INSTRUCTION, answers[7]) == "3"
+    
+    # Смена параметров LSH - сигнатуры пересчитываются при загрузке
+    rebuilt = make_cache(tmp_path, n_tables=4, n_bits=8)
+    assert rebuilt.lookup(9, INSTRUCTION, answers[7]) == "3"
+    with sqlite3.connect(str(tmp_path / "cache.db")) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM semantic_cache WHERE signatures IS NULL").fetchone()[0] == 0
@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram_streaming import TELEGRAM_MESSAGE_LIMIT, TelegramStreamSink, split_message
+
+
+class FakeMessage:
+    """Сообщение Telegram: запоминает отправленные и отредактированные тексты"""
+
+    def __init__(self, chat, reject_markdown=False):
+        self.chat = chat
+        self.reject_markdown = reject_markdown
+        self.text = None
+        self.reply_markup = None
+
+    async def answer(self, text, reply_markup=None, parse_mode=None):
+        sent = FakeMessage(self.chat, self.reject_markdown)
+        await sent.edit_text(text, reply_markup, parse_mode)
+        self.chat.append(sent)
+        return sent
+
+    async def edit_text(self, text, reply_markup=None, parse_mode=None):
+        assert len(text) <= TELEGRAM_MESSAGE_LIMIT
+        if parse_mode and self.reject_markdown:
+            raise ValueError("can't parse entities")
+        self.text = text
+        self.reply_markup = reply_markup
+
+
+def run_sink(chunks, **kwargs):
+    chat = []
+    sink = TelegramStreamSink(FakeMessage(chat, **kwargs), edit_interval=0)
+    asyncio.run(sink.stream(iter(chunks), reply_markup='keyboard'))
+    return chat, sink
+
+
+def test_split_message_prefers_line_breaks():
+    text = "\n".join(f"• Пункт {i} " + "x" * 50 for i in range(200))
+    parts = split_message(text)
+    assert len(parts) > 1
+    assert all(len(part) <= TELEGRAM_MESSAGE_LIMIT for part in parts)
+    assert all(part.startswith("• Пункт") for part in parts)
+    assert "\n".join(parts) == text
+
+
+def test_long_final_text_is_split_with_keyboard_on_last_message():
+    line = "• Обязанность " + "y" * 80 + "\n"
+    chat, sink = run_sink([line] * 120)
+    assert len(chat) > 1
+    assert "".join(message.text + "\n" for message in chat) == "".join([line] * 120)
+    assert [message.reply_markup for message in chat] == [None] * (len(chat) - 1) + ['keyboard']
+    assert sink.sent_message is chat[-1]
+
+
+def test_long_final_text_falls_back_to_plain_text():
+    chat, _ = run_sink(["**" + "z" * 5000], reject_markdown=True)
+    assert len(chat) == 2
+    assert chat[-1].reply_markup == 'keyboard'
@@ -3,6 +3,8 @@ import pandas as pd
 import sqlite3
 import os
 
+from conflict_analyzer import analyze_conflicts_table, print_report
+
 def update_conflicts():
     try:
         print("📋 Читаем конфликты из Excel...")
@@ -103,6 +105,9 @@ def update_conflicts():
             cursor.execute("SELECT COUNT(*) FROM conflicts")
             count = cursor.fetchone()[0]
             print(f"🔍 Проверка: в таблице conflicts {count} записей")
+            
+            # Дубликаты, поглощенные и недостижимые правила не проверяются ConflictDetector
+            print_report(analyze_conflicts_table(conn))
     
     except Exception as e:
         print(f"❌ Ошибка: {e}")
@@ -3,6 +3,8 @@ import pandas as pd
 import sqlite3
 import os
 
+from reference_version import bump_reference_version
+
 def update_grading_tables():
     """Обновление таблиц для расчета грейда из Excel файла"""
     try:
@@ -91,7 +93,7 @@ def update_grading_tables():
                     round(row.iloc[1]),  # p2 значение
                     round(row.iloc[2])   # p3 значение
                 ))
-                
+            
             # === ТАБЛИЦА P4-14 ===
             print("📊 Обрабатываем таблицу P4-14...")
             df_p4_14 = pd.read_excel('data/hag.xlsx', sheet_name='p4-14')
@@ -119,7 +121,7 @@ def update_grading_tables():
                     round(row.iloc[2]),  # ответ на вопрос 14
                     round(row.iloc[3])   # значение p4
                 ))
-                
+            
             # === ТАБЛИЦА P4-15 ===
             print("📊 Обрабатываем таблицу P4-15...")
             df_p4_15 = pd.read_excel('data/hag.xlsx', sheet_name='p4-15')
@@ -147,7 +149,7 @@ def update_grading_tables():
                     round(row.iloc[2]),  # ответ на вопрос 15
                     round(row.iloc[3])   # значение p4
                 ))
-                
+            
             # === ТАБЛИЦА ГРЕЙД ===
             print("📊 Обрабатываем таблицу грейдов...")
             df_grade = pd.read_excel('data/hag.xlsx', sheet_name='грейд')
@@ -177,8 +179,10 @@ def update_grading_tables():
                         str(row.iloc[3]) if pd.notna(row.iloc[3]) else None  # Sber Grade
                     ))
             
+            version = bump_reference_version(conn)
             conn.commit()
             print("✅ Все таблицы грейдинга успешно загружены в базу данных")
+            print(f"🔄 Версия справочников: {version} - работающий бот перечитает таблицы без перезапуска")
             
             # Проверяем результат
             tables = ['grading_p1', 'grading_p2', 'grading_p3', 'grading_p4_14', 'grading_p4_15', 'grading_scale']
@@ -1,6 +1,8 @@
 import sqlite3
 import pandas as pd
 
+from reference_version import bump_reference_version
+
 with sqlite3.connect("data/database.db") as conn:
     cursor = conn.cursor()
     cursor.execute("DROP TABLE IF EXISTS hay_dictionary")
@@ -26,7 +28,9 @@ with sqlite3.connect("data/database.db") as conn:
             row['определение по hay']
         ))
     
+    version = bump_reference_version(conn)
     conn.commit()
     
     print(f"✅ Загружено {len(df)} определений из справочника Hay")
+    print(f"🔄 Версия справочников: {version} - работающий бот перечитает таблицы без перезапуска")
 
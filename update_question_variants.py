@@ -3,6 +3,8 @@ import pandas as pd
 import sqlite3
 import os
 
+from reference_version import bump_reference_version
+
 def extract_answer_value(variant_text: str) -> int:
     """
     Извлечь номер ответа из текста варианта
@@ -94,13 +96,15 @@ def update_question_variants():
                         VALUES (?, ?, ?, ?, ?)
                     """, (p1_value, q11_variant_text, q11_answer_value, q12_variant_text, q12_answer_value))
                     variants_added += 1
-                    
+                
                 except Exception as e:
                     print(f"⚠️ Пропущена строка: {e}")
                     continue
             
+            version = bump_reference_version(conn)
             conn.commit()
             print(f"✅ Загружено связанных вариантов Q11-Q12: {variants_added}")
+            print(f"🔄 Версия справочников: {version} - работающий бот перечитает таблицы без перезапуска")
             
             # Проверяем результат
             cursor.execute("SELECT COUNT(*) FROM question_variants_q11_q12")
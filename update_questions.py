@@ -1,6 +1,9 @@
 import sqlite3
 import pandas as pd
 
+from question_flow import default_dependencies
+from reference_version import bump_reference_version
+
 with sqlite3.connect("data/database.db") as conn:
     cursor = conn.cursor()
     cursor.execute("DROP TABLE IF EXISTS questions")
@@ -32,4 +35,24 @@ with sqlite3.connect("data/database.db") as conn:
             row.get('Раздел')
         ))
     
-    conn.commit() 
\ No newline at end of file
+    # Граф зависимостей: условия показа из таблицы вопросов + производные значения (P1, варианты, портрет)
+    cursor.execute("DROP TABLE IF EXISTS question_dependencies")
+    cursor.execute("""
+        CREATE TABLE question_dependencies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            node TEXT NOT NULL,
+            depends_on TEXT NOT NULL,
+            kind TEXT NOT NULL
+        )
+    """)
+    
+    cursor.execute("SELECT id, show_conditions FROM questions")
+    questions = [{'id': row[0], 'show_conditions': row[1]} for row in cursor.fetchall()]
+    cursor.executemany("""
+        INSERT INTO question_dependencies (node, depends_on, kind) VALUES (?, ?, ?)
+    """, default_dependencies(questions))
+    
+    version = bump_reference_version(conn)
+    conn.commit()
+    
+    print(f"🔄 Версия справочников: {version} - работающий бот перечитает таблицы без перезапуска")